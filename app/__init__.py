@@ -36,6 +36,13 @@ def create_app():
     # Import models after db is initialized
     from . import models
 
+    # Register ORM listeners that maintain derived tables and business ids
+    from . import search, sequences, user_cache, access, storage, vitals_series, cohorts, patient_summary
+
+    # Register CLI commands
+    from .commands import register_commands
+    register_commands(app)
+
     # Register routes
     from . import routes
     app.register_blueprint(routes.bp)
@@ -48,6 +55,14 @@ def create_app():
             #if request.endpoint in ['main.login', 'main.register', 'main.index']:
                #return routes.redirect_dashboard(role)  # Call `redirect_dashboard` from routes
             
+    # Send queued emails (password resets) from this process unless a separate worker does
+    from . import outbox
+
+    @app.before_request
+    def start_outbox_worker():
+        if not app.testing:
+            outbox.start_in_process(app)
+
     # Redirect authenticated users if they attempt to access login, register, or home
     @app.before_request
     def check_login_redirect():
@@ -61,5 +76,6 @@ def create_app():
 # User loader function
 @login_manager.user_loader
 def load_user(user_id):
-    from .models import User
-    return User.query.get(user_id)
\ No newline at end of file
+    # Served from the per-process user cache; see app/user_cache.py
+    from .user_cache import user_cache
+    return user_cache.load(user_id)
\ No newline at end of file
@@ -0,0 +1,137 @@
+import threading, time
+from functools import wraps
+from flask import current_app, flash, redirect, url_for
+from flask_login import current_user
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session, object_session
+from . import db
+from .models import DoctorPatient
+
+DEFAULT_TTL = 30
+
+
+class PatientAccessIndex:
+    """
+    Per-process map of doctor id -> frozenset of the patient ids linked to
+    that doctor through doctor_patient.
+
+    A doctor's set is read with one query the first time it is needed and
+    then answers every access check with a set lookup. It is dropped when a
+    DoctorPatient row of that doctor is inserted, updated or deleted through
+    the ORM in this process, and after `ttl` seconds so links changed by
+    other worker processes are picked up.
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _ttl(self):
+        if self.ttl is not None:
+            return self.ttl
+        return current_app.config.get('ACCESS_CACHE_TTL', DEFAULT_TTL)
+
+    def patient_ids(self, doctor_id):
+        """All patient ids the doctor may access."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(doctor_id)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        rows = db.session.execute(select(DoctorPatient.patient_id).where(DoctorPatient.doctor_id == doctor_id))
+        patient_ids = frozenset(patient_id for (patient_id,) in rows)
+        ttl = self._ttl()
+        if ttl > 0:
+            with self._lock:
+                self._entries[doctor_id] = (now + ttl, patient_ids)
+        return patient_ids
+
+    def can_access(self, doctor_id, patient_id):
+        return patient_id in self.patient_ids(doctor_id)
+
+    def invalidate(self, doctor_id):
+        with self._lock:
+            if self._entries.pop(doctor_id, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "patients": sum(len(entry[1]) for entry in self._entries.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else None,
+            }
+
+
+access_index = PatientAccessIndex()
+
+
+def can_access_patient(doctor_id, patient_id):
+    """Whether the doctor is linked to the patient (patient_basic.id)."""
+    return access_index.can_access(doctor_id, patient_id)
+
+
+def patient_access_required(message='You do not have permission to view this patient.'):
+    """
+    Route decorator for views that take a `patient_id` argument: only lets
+    doctors linked to that patient through, and sends everyone else back to
+    their dashboard.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if current_user.role != 'doctor':
+                flash('Access unauthorized.', 'danger')
+                return redirect(url_for('main.login'))
+            if not can_access_patient(current_user.id, kwargs['patient_id']):
+                flash(message, 'danger')
+                return redirect(url_for('main.doctor_dashboard'))
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _changed_doctor_ids(target):
+    """The doctor id of a DoctorPatient row, plus its previous value if it was reassigned."""
+    doctor_ids = {target.doctor_id}
+    history = db.inspect(target).attrs.doctor_id.history
+    doctor_ids.update(value for value in history.deleted if value)
+    return doctor_ids
+
+
+# Drop a doctor's set when one of their links changes, and again after the
+# commit so a concurrent request cannot cache the pre-commit state
+@event.listens_for(DoctorPatient, 'after_insert')
+@event.listens_for(DoctorPatient, 'after_update')
+@event.listens_for(DoctorPatient, 'after_delete')
+def invalidate_doctor_access(mapper, connection, target):
+    doctor_ids = _changed_doctor_ids(target)
+    for doctor_id in doctor_ids:
+        access_index.invalidate(doctor_id)
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('changed_doctor_ids', set()).update(doctor_ids)
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_committed_access(session):
+    for doctor_id in session.info.pop('changed_doctor_ids', ()):
+        access_index.invalidate(doctor_id)
+
+@event.listens_for(Session, 'after_rollback')
+def forget_rolled_back_access(session):
+    session.info.pop('changed_doctor_ids', None)
@@ -0,0 +1,281 @@
+import json, logging, os, secrets, shutil, threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import func, select, update
+from . import db
+from .fhir import RESOURCES, FhirError, dumps
+from .models import DoctorPatient, ExportJob
+
+log = logging.getLogger(__name__)
+
+# FHIR Bulk Data Access (https://hl7.org/fhir/uv/bulkdata/export.html):
+# kick-off returns at once, a worker writes one NDJSON file per resource
+# type (split every BULK_EXPORT_FILE_ROWS lines) and the client polls the
+# status URL until the manifest of files is ready
+NDJSON_MIMETYPE = 'application/fhir+ndjson'
+OUTPUT_FORMATS = ('application/fhir+ndjson', 'application/ndjson', 'ndjson')
+DEFAULT_FILE_ROWS = 1_000_000
+DEFAULT_FETCH_SIZE = 2000
+DEFAULT_TTL = 7 * 24 * 3600
+# Resources written between progress updates, which are also when a cancel is noticed
+PROGRESS_EVERY = 10_000
+# A running job without progress for this many seconds belongs to a worker that died
+STALE_AFTER = 3600
+FINISHED_STATUSES = ('complete', 'failed', 'cancelled')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+def job_folder(job_id):
+    return os.path.join(current_app.config['BULK_EXPORT_FOLDER'], job_id)
+
+
+def parse_types(value):
+    """The resource types of a _type parameter, all of them when it is empty."""
+    names = [name.strip() for name in (value or '').split(',') if name.strip()]
+    unknown = [name for name in names if name not in RESOURCES]
+    if unknown:
+        raise FhirError(f"_type {', '.join(unknown)} is not supported")
+    return list(dict.fromkeys(names)) or list(RESOURCES)
+
+
+def create_job(resource_types, user_id=None, doctor_id=None, request_url=None):
+    """Queue an export of `resource_types` for every patient, or for `doctor_id`'s patients."""
+    now = datetime.utcnow()
+    job = ExportJob(id=secrets.token_hex(16), user_id=user_id, doctor_id=doctor_id,
+                    resource_types=','.join(resource_types), request_url=request_url,
+                    status='queued', exported=0, created_at=now, updated_at=now)
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+
+def _executor_for(workers):
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bulk-export')
+        return _executor
+
+
+def _run_in_app(app, job_id):
+    with app.app_context():
+        try:
+            run(job_id)
+        except Exception:
+            log.exception("Bulk export %s failed", job_id)
+        finally:
+            db.session.remove()
+
+
+def start(job):
+    """Run a queued job on the export threads of this process."""
+    app = current_app._get_current_object()
+    workers = app.config.get('BULK_EXPORT_WORKERS', 1)
+    return _executor_for(workers).submit(_run_in_app, app, job.id)
+
+
+def _statement(resource, doctor_id):
+    statement = select(resource.table)
+    if doctor_id is not None:
+        patients = select(DoctorPatient.patient_id).where(DoctorPatient.doctor_id == doctor_id)
+        statement = statement.where(resource.patient_column.in_(patients))
+    return statement
+
+
+def _progress(job_id, only_running=False, **values):
+    """
+    Record progress on a connection of its own, since the export's
+    connection is busy streaming. Returns the job's status, 'cancelled'
+    once a client has deleted it.
+    """
+    t = ExportJob.__table__
+    with db.engine.begin() as connection:
+        statement = update(t).where(t.c.id == job_id).values(updated_at=datetime.utcnow(), **values)
+        if only_running:
+            statement = statement.where(t.c.status == 'running')
+        connection.execute(statement)
+        return connection.execute(select(t.c.status).where(t.c.id == job_id)).scalar()
+
+
+class _NdjsonWriter:
+    """Writes one resource type to numbered NDJSON files of at most `max_rows` lines each."""
+
+    def __init__(self, folder, resource_type, max_rows):
+        self.folder = folder
+        self.resource_type = resource_type
+        self.max_rows = max_rows
+        self.files = []
+        self.handle = None
+        self.rows = 0
+
+    def write(self, line):
+        if self.handle is None or self.rows >= self.max_rows:
+            self.close()
+            name = f"{self.resource_type}.{len(self.files) + 1:03d}.ndjson"
+            self.handle = open(os.path.join(self.folder, name + '.part'), 'w', encoding='utf-8',
+                               newline='\n', buffering=1024 * 1024)
+            self.files.append({"type": self.resource_type, "name": name, "count": 0})
+            self.rows = 0
+        self.handle.write(line)
+        self.handle.write('\n')
+        self.rows += 1
+        self.files[-1]["count"] += 1
+
+    def close(self):
+        # Files only get their final name once complete
+        if self.handle is not None:
+            self.handle.close()
+            name = self.files[-1]["name"]
+            os.replace(os.path.join(self.folder, name + '.part'), os.path.join(self.folder, name))
+            self.handle = None
+
+
+def run(job_id, report=None):
+    """
+    Write a queued export job's NDJSON files. Each resource type is read
+    with a single streaming SELECT (a server-side cursor on MySQL) whose
+    rows are fetched BULK_EXPORT_FETCH_SIZE at a time, serialized and
+    written out before the next fetch, so memory use is the same for a
+    thousand rows or ten million. A type served from several tables, like
+    Observation from observations and vitals, reads them one after the
+    other into the same files. `report(job)` is called with the job after
+    every progress update.
+    """
+    job = db.session.get(ExportJob, job_id)
+    if job is None or job.status != 'queued':
+        return job
+    config = current_app.config
+    fetch_size = config.get('BULK_EXPORT_FETCH_SIZE', DEFAULT_FETCH_SIZE)
+    file_rows = config.get('BULK_EXPORT_FILE_ROWS', DEFAULT_FILE_ROWS)
+    folder = job_folder(job.id)
+    types, doctor_id = job.type_list, job.doctor_id
+    db.session.commit()
+
+    def progress(**values):
+        status = _progress(job_id, **values)
+        if report is not None:
+            db.session.expire_all()
+            report(db.session.get(ExportJob, job_id))
+        if status == 'cancelled':
+            raise ExportCancelled()
+
+    output = []
+    exported = 0
+    try:
+        os.makedirs(folder, exist_ok=True)
+        progress(status='running', started_at=datetime.utcnow())
+        with db.engine.connect() as connection:
+            total = sum(connection.execute(
+                select(func.count()).select_from(_statement(source, doctor_id).subquery())
+            ).scalar() for name in types for source in RESOURCES[name].sources)
+        progress(total=total)
+
+        for name in types:
+            progress(current_type=name)
+            writer = _NdjsonWriter(folder, name, file_rows)
+            reported = exported
+            try:
+                for source in RESOURCES[name].sources:
+                    with db.engine.connect() as connection:
+                        result = connection.execution_options(stream_results=True, yield_per=fetch_size).execute(
+                            _statement(source, doctor_id))
+                        for rows in result.partitions():
+                            for row in rows:
+                                writer.write(dumps(source.build(row)))
+                            exported += len(rows)
+                            if exported - reported >= PROGRESS_EVERY:
+                                progress(exported=exported)
+                                reported = exported
+            finally:
+                writer.close()
+            output += writer.files
+    except ExportCancelled:
+        shutil.rmtree(folder, ignore_errors=True)
+        return _finished(job_id)
+    except Exception as error:
+        log.exception("Bulk export %s failed", job_id)
+        shutil.rmtree(folder, ignore_errors=True)
+        _progress(job_id, only_running=True, status='failed', error=f"{type(error).__name__}: {error}",
+                  finished_at=datetime.utcnow())
+        return _finished(job_id)
+
+    _progress(job_id, only_running=True, status='complete', exported=exported, current_type=None,
+              output=json.dumps(output), finished_at=datetime.utcnow())
+    return _finished(job_id)
+
+
+def _finished(job_id):
+    db.session.expire_all()
+    job = db.session.get(ExportJob, job_id)
+    if job is not None and job.status == 'cancelled':
+        shutil.rmtree(job_folder(job_id), ignore_errors=True)
+    return job
+
+
+def files(job):
+    return json.loads(job.output) if job.output else []
+
+
+def progress_text(job):
+    """The X-Progress header of a job still in progress."""
+    if job.status == 'queued':
+        return 'queued'
+    if job.total is None:
+        return 'counting'
+    percent = 100 * job.exported // job.total if job.total else 100
+    return f"{job.current_type or 'starting'}: {job.exported} of {job.total} resources ({percent}%)"
+
+
+def manifest(job, file_url):
+    """The completion manifest; `file_url(job, name)` is the download URL of one file."""
+    return {
+        "transactionTime": (job.started_at or job.created_at).isoformat() + 'Z',
+        "request": job.request_url,
+        "requiresAccessToken": True,
+        "output": [{"type": item["type"], "url": file_url(job, item["name"]), "count": item["count"]}
+                   for item in files(job)],
+        "error": [],
+    }
+
+
+def cancel(job):
+    """Stop a job still in progress, or delete a finished one and its files."""
+    if job.status in ('queued', 'running'):
+        # A running worker notices at its next progress update and removes its files
+        job.status = 'cancelled'
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+        return
+    shutil.rmtree(job_folder(job.id), ignore_errors=True)
+    db.session.delete(job)
+    db.session.commit()
+
+
+def expire_jobs(now=None):
+    """
+    Delete finished exports older than BULK_EXPORT_TTL with their files,
+    and fail running ones whose worker stopped reporting. Returns
+    (deleted, failed).
+    """
+    now = now or datetime.utcnow()
+    ttl = timedelta(seconds=current_app.config.get('BULK_EXPORT_TTL', DEFAULT_TTL))
+    expired = ExportJob.query.filter(ExportJob.status.in_(FINISHED_STATUSES), ExportJob.finished_at < now - ttl).all()
+    for job in expired:
+        shutil.rmtree(job_folder(job.id), ignore_errors=True)
+        db.session.delete(job)
+    stale = ExportJob.query.filter(ExportJob.status == 'running',
+                                   ExportJob.updated_at < now - timedelta(seconds=STALE_AFTER)).all()
+    for job in stale:
+        shutil.rmtree(job_folder(job.id), ignore_errors=True)
+        job.status = 'failed'
+        job.error = 'The export worker stopped'
+        job.finished_at = now
+    db.session.commit()
+    return len(expired), len(stale)
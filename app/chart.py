@@ -0,0 +1,91 @@
+from .models import Visit, Appointment, Immunization, AllergyIntolerance, MedicationStatement, Observation, Vitals, Procedure, MedicalHistory
+from .pagination import keyset_paginate, CursorError
+
+DEFAULT_SECTION_SIZE = 20
+MAX_SECTION_SIZE = 500
+
+
+class ChartSection:
+    """
+    One collection shown on a patient's chart.
+
+    `columns` is the newest-first sort key. It ends with the primary key so
+    it is total, and only uses non-nullable columns so keyset cursors work.
+    """
+
+    def __init__(self, name, model, columns):
+        self.name = name
+        self.model = model
+        self.columns = columns
+
+    def query(self, patient_id):
+        return self.model.query.filter(self.model.patient_id == patient_id)
+
+    def key(self, row):
+        return [getattr(row, column.key) for column in self.columns]
+
+
+CHART_SECTIONS = {
+    section.name: section for section in (
+        ChartSection('visits', Visit, (Visit.visit_date, Visit.id)),
+        ChartSection('appointments', Appointment, (Appointment.start, Appointment.id)),
+        ChartSection('immunizations', Immunization, (Immunization.date, Immunization.id)),
+        ChartSection('allergies', AllergyIntolerance, (AllergyIntolerance.id,)),
+        ChartSection('medications', MedicationStatement, (MedicationStatement.id,)),
+        ChartSection('observations', Observation, (Observation.id,)),
+        ChartSection('vitals', Vitals, (Vitals.effective_date, Vitals.id)),
+        ChartSection('procedures', Procedure, (Procedure.id,)),
+        ChartSection('medical_history', MedicalHistory, (MedicalHistory.onset_date, MedicalHistory.id)),
+    )
+}
+
+
+def clamp_section_size(limit):
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return DEFAULT_SECTION_SIZE
+    return max(1, min(limit, MAX_SECTION_SIZE))
+
+
+def load_section(patient_id, name, cursor=None, limit=DEFAULT_SECTION_SIZE):
+    """
+    Load the newest `limit` rows of one chart section, or the rows after
+    `cursor` when paging further back. Each call is a single bounded
+    `WHERE patient_id = ? ORDER BY ... LIMIT` query.
+    """
+    section = CHART_SECTIONS[name]
+    limit = clamp_section_size(limit)
+    scope = f"chart:{name}"
+    try:
+        return keyset_paginate(section.query(patient_id), section.columns, section.key,
+                               cursor=cursor, limit=limit, descending=True, scope=scope)
+    except CursorError:
+        return keyset_paginate(section.query(patient_id), section.columns, section.key,
+                               limit=limit, descending=True, scope=scope)
+
+
+def load_chart(patient_id, sections, limits=None):
+    """
+    Load several chart sections with one query each.
+
+    Unlike chained joinedloads, the number of rows read is the sum of the
+    section sizes rather than their product. `limits` optionally overrides
+    the page size per section.
+    """
+    limits = limits or {}
+    return {
+        name: load_section(patient_id, name, limit=limits.get(name, DEFAULT_SECTION_SIZE))
+        for name in sections
+    }
+
+
+def latest_appointments(patient_id, limit=3):
+    """The patient's most recent appointments by start time."""
+    return (
+        Appointment.query
+        .filter(Appointment.patient_id == patient_id)
+        .order_by(Appointment.start.desc(), Appointment.id.desc())
+        .limit(limit)
+        .all()
+    )
@@ -0,0 +1,236 @@
+import re
+from sqlalchemy import and_, bindparam, case, event, func, inspect, select, update
+from . import db
+from .models import DoctorPatient, Observation
+
+# Units and usual adult reference ranges of the quantitative lab codes in
+# the observation.code value set: code -> (unit, low, high). Used when a
+# result comes without a unit or range of its own.
+LAB_DEFAULTS = {
+    '4548-4': ('%', 4.0, 5.6),            # HbA1c
+    '718-7': ('g/dL', 12.0, 17.5),        # Hemoglobin
+    '6690-2': ('10*3/uL', 4.5, 11.0),     # White blood cell count
+    '789-8': ('mm/h', 0.0, 20.0),         # ESR
+    '2345-7': ('mg/dL', 70.0, 99.0),      # Glucose, blood
+    '6299-2': ('mg/dL', None, 200.0),     # Cholesterol, total
+    '2093-3': ('mg/dL', None, 100.0),     # LDL
+    '2571-8': ('mg/dL', 40.0, None),      # HDL
+    '32354-0': ('mg/dL', 7.0, 20.0),      # BUN
+    '2823-3': ('mmol/L', 3.5, 5.1),       # Potassium
+    '2710-2': ('mmol/L', 135.0, 145.0),   # Sodium
+    '2160-0': ('mg/dL', 0.6, 1.3),        # Creatinine
+    '10834-0': ('ng/mL', None, 4.0),      # PSA
+    '15074-8': ('%', 95.0, 100.0),        # SpO2
+}
+
+# A number, optionally followed by its unit: "9.1", "9.1 %", "5,4 mmol/L"
+_QUANTITY = re.compile(r'^\s*([-+]?\d+(?:[.,]\d+)?)\s*([^\d\s][^\s]{0,19})?\s*$')
+
+# Fields of Observation the quantitative columns are derived from
+PARSED_FIELDS = ('code', 'value')
+
+
+def parse_quantity(code, value, unit=None):
+    """
+    (value_numeric, unit, reference_low, reference_high) for an observation
+    value, with Nones for qualitative results like "Positive" or "<5". A
+    `unit` given separately overrides the one in the text. The code's
+    default unit fills in a missing unit, and its reference range applies
+    when the units agree, ignoring case ("mg/dl" is stored as "mg/dL").
+    """
+    match = _QUANTITY.match(value or '')
+    if not match:
+        return None, None, None, None
+    number = float(match.group(1).replace(',', '.'))
+    default_unit, low, high = LAB_DEFAULTS.get(code, (None, None, None))
+    unit = unit or match.group(2) or default_unit
+    if default_unit is not None and unit.lower() == default_unit.lower():
+        unit = default_unit
+    else:
+        low = high = None
+    return number, unit, low, high
+
+
+def backfill(batch_size=5000):
+    """
+    Fill the quantitative columns of every observation from its value, a
+    batch per transaction. Returns (observations read, numeric results).
+    """
+    statement = (
+        update(Observation.__table__)
+        .where(Observation.__table__.c.id == bindparam('row_id'))
+        .values(value_numeric=bindparam('value_numeric'), unit=bindparam('unit'),
+                reference_low=bindparam('reference_low'), reference_high=bindparam('reference_high'))
+    )
+    read = numeric = 0
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            select(Observation.id, Observation.code, Observation.value)
+            .where(Observation.id > last_id).order_by(Observation.id).limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        params = []
+        for row_id, code, value in rows:
+            value_numeric, unit, low, high = parse_quantity(code, value)
+            params.append({"row_id": row_id, "value_numeric": value_numeric, "unit": unit,
+                           "reference_low": low, "reference_high": high})
+            numeric += value_numeric is not None
+        db.session.execute(statement, params)
+        db.session.commit()
+        read += len(rows)
+        last_id = rows[-1][0]
+    return read, numeric
+
+
+def _value_bounds(column, above=None, below=None):
+    conditions = []
+    if above is not None:
+        conditions.append(column > above)
+    if below is not None:
+        conditions.append(column < below)
+    return conditions
+
+
+def _unit_conditions(column, code, unit=None):
+    # Values in different units do not compare: keep the results in `unit`,
+    # by default the code's usual one. Codes without one are not filtered.
+    unit = unit or LAB_DEFAULTS.get(code, (None,))[0]
+    if unit is None:
+        return []
+    return [func.lower(column) == unit.lower()]
+
+
+def _restricted(statement, patient_column, doctor_id):
+    if doctor_id is None:
+        return statement
+    return statement.join(DoctorPatient, DoctorPatient.patient_id == patient_column).where(DoctorPatient.doctor_id == doctor_id)
+
+
+def latest_results(code, doctor_id=None):
+    """
+    Subquery of every patient's most recent numeric result of `code`:
+    patient_id, value, unit, effective. The newest date per patient comes
+    from the (code, patient_id, effectiveDateTime, value_numeric) index
+    alone; only the winning rows are read from the table, the highest id
+    breaking ties between results recorded at the same moment.
+    """
+    o = Observation.__table__
+    numeric = (o.c.code == code, o.c.value_numeric.isnot(None), o.c.effectiveDateTime.isnot(None))
+    newest = select(o.c.patient_id, func.max(o.c.effectiveDateTime).label('effective')).where(*numeric)
+    newest = _restricted(newest, o.c.patient_id, doctor_id).group_by(o.c.patient_id).subquery('newest')
+    winner = (
+        select(func.max(o.c.id).label('id'))
+        .join(newest, and_(o.c.patient_id == newest.c.patient_id, o.c.effectiveDateTime == newest.c.effective))
+        .where(*numeric)
+        .group_by(o.c.patient_id)
+        .subquery('winner')
+    )
+    return (
+        select(o.c.patient_id, o.c.value_numeric.label('value'), o.c.unit, o.c.effectiveDateTime.label('effective'))
+        .join(winner, o.c.id == winner.c.id)
+        .subquery('latest')
+    )
+
+
+def latest_value_cohort(code, above=None, below=None, doctor_id=None, unit=None):
+    """
+    Patients whose latest result of `code` is above and/or below the given
+    bounds (exclusive), e.g. latest HbA1c above 9: latest_value_cohort('4548-4', above=9).
+    The bounds are in `unit`, by default the code's unit in LAB_DEFAULTS;
+    patients whose latest result is in another unit are left out.
+    Selects patient_id, value, unit, effective.
+    """
+    latest = latest_results(code, doctor_id)
+    return (
+        select(latest.c.patient_id, latest.c.value, latest.c.unit, latest.c.effective)
+        .where(*_value_bounds(latest.c.value, above, below), *_unit_conditions(latest.c.unit, code, unit))
+        .order_by(latest.c.patient_id)
+    )
+
+
+def threshold_cohort(code, above=None, below=None, start=None, end=None, doctor_id=None, unit=None):
+    """
+    Patients with at least one result of `code` in `unit` (by default the
+    code's own) beyond the bounds between `start` and `end`: a range scan
+    of the (code, effectiveDateTime) index. Selects patient_id, the number
+    of such results, the extreme value and the last time it happened.
+    """
+    o = Observation.__table__
+    conditions = [o.c.code == code] + _value_bounds(o.c.value_numeric, above, below) + _unit_conditions(o.c.unit, code, unit)
+    if start is not None:
+        conditions.append(o.c.effectiveDateTime >= start)
+    if end is not None:
+        conditions.append(o.c.effectiveDateTime <= end)
+    extreme = func.max(o.c.value_numeric) if above is not None or below is None else func.min(o.c.value_numeric)
+    statement = select(
+        o.c.patient_id, func.count().label('results'), extreme.label('extreme'),
+        func.max(o.c.effectiveDateTime).label('last_effective'),
+    ).where(and_(*conditions, o.c.value_numeric.isnot(None)))
+    return _restricted(statement, o.c.patient_id, doctor_id).group_by(o.c.patient_id).order_by(o.c.patient_id)
+
+
+def trend_cohort(code, start=None, end=None, min_change=None, max_change=None, doctor_id=None, unit=None):
+    """
+    Patients whose result of `code` moved between their first and last
+    result in the window, e.g. min_change=1 for a rise of at least one
+    unit, max_change=-1 for a fall of at least one. Only results in `unit`
+    (by default the code's own) count. Selects patient_id, first, last,
+    change and the number of results.
+    """
+    o = Observation.__table__
+    conditions = [o.c.code == code, o.c.value_numeric.isnot(None), o.c.effectiveDateTime.isnot(None),
+                  *_unit_conditions(o.c.unit, code, unit)]
+    if start is not None:
+        conditions.append(o.c.effectiveDateTime >= start)
+    if end is not None:
+        conditions.append(o.c.effectiveDateTime <= end)
+    ranked = select(
+        o.c.patient_id, o.c.value_numeric,
+        func.row_number().over(partition_by=o.c.patient_id, order_by=(o.c.effectiveDateTime, o.c.id)).label('oldest'),
+        func.row_number().over(partition_by=o.c.patient_id,
+                               order_by=(o.c.effectiveDateTime.desc(), o.c.id.desc())).label('newest'),
+    ).where(*conditions)
+    ranked = _restricted(ranked, o.c.patient_id, doctor_id).subquery('ranked')
+
+    # MySQL has no aggregate FILTER clause; a CASE inside MAX works everywhere
+    first = func.max(case((ranked.c.oldest == 1, ranked.c.value_numeric)))
+    last = func.max(case((ranked.c.newest == 1, ranked.c.value_numeric)))
+    change = last - first
+    statement = (
+        select(ranked.c.patient_id, first.label('first'), last.label('last'), change.label('change'),
+               func.count().label('results'))
+        .group_by(ranked.c.patient_id)
+        .having(func.count() > 1)
+        .order_by(ranked.c.patient_id)
+    )
+    if min_change is not None:
+        statement = statement.having(change >= min_change)
+    if max_change is not None:
+        statement = statement.having(change <= max_change)
+    return statement
+
+
+def run(statement, connection=None):
+    """Execute a cohort statement and return its rows as dicts."""
+    result = (connection or db.session).execute(statement)
+    return [dict(row._mapping) for row in result]
+
+
+def _needs_reparse(target):
+    state = inspect(target)
+    return state.transient or state.pending or any(state.attrs[field].history.has_changes() for field in PARSED_FIELDS)
+
+
+# Derive the quantitative columns whenever an observation's code or value is written
+@event.listens_for(Observation, 'before_insert')
+@event.listens_for(Observation, 'before_update')
+def parse_observation(mapper, connection, target):
+    if not _needs_reparse(target):
+        return
+    value_numeric, unit, low, high = parse_quantity(target.code, target.value)
+    target.value_numeric = value_numeric
+    target.unit = unit
+    target.reference_low = low
+    target.reference_high = high
@@ -0,0 +1,664 @@
+import click
+
+# App used by forked stress-test workers
+_worker_app = None
+
+
+def _allocate_ids(kind, count, block_size, bulk):
+    """Run in a worker process: allocate ids the way a web worker or an import would."""
+    from . import db
+    from .sequences import IdAllocator
+    with _worker_app.app_context():
+        # Never reuse connections inherited from the parent process
+        db.engine.dispose(close=False)
+        allocator = IdAllocator(block_size)
+        ids = [allocator.next_id(kind) for _ in range(count)]
+        if bulk:
+            ids += allocator.bulk_ids(kind, bulk)
+        return ids
+
+
+def register_commands(app):
+    """Attach the maintenance commands to the `flask` CLI."""
+
+    @app.cli.command('reindex-patients')
+    @click.option('--batch-size', default=1000, show_default=True, help='Patients indexed per transaction.')
+    def reindex_patients(batch_size):
+        """Rebuild the patient search token index from patient_basic."""
+        from .search import rebuild_index
+        count = rebuild_index(batch_size=batch_size)
+        click.echo(f"Indexed {count} patients.")
+
+    @app.cli.command('rebuild-patient-summaries')
+    @click.option('--batch-size', default=1000, show_default=True, help='Patients summarized per transaction.')
+    @click.option('--expired-only', is_flag=True, help='Only move on next appointments that have passed.')
+    def rebuild_patient_summaries(batch_size, expired_only):
+        """Recompute the patient_summary read model from the chart tables."""
+        from .patient_summary import rebuild, refresh_expired
+        if expired_only:
+            click.echo(f"Refreshed {refresh_expired(batch_size=batch_size)} summaries.")
+            return
+        count = rebuild(batch_size=batch_size)
+        click.echo(f"Summarized {count} patients.")
+
+    @app.cli.command('backfill-vitals')
+    @click.option('--batch-size', default=1000, show_default=True, help='Vitals rows converted per transaction.')
+    def backfill_vitals(batch_size):
+        """Rebuild the numeric vital_samples series from the vitals table."""
+        from .vitals_series import backfill
+        read, written = backfill(batch_size=batch_size)
+        click.echo(f"Converted {written} of {read} vitals rows; {read - written} have no numeric value or a unit that does not convert.")
+
+    @app.cli.command('benchmark-terminology')
+    @click.option('--rows', default=10000, show_default=True, help='Rows decoded per value set.')
+    def benchmark_terminology(rows):
+        """Compare per-row code decoding against the terminology registry."""
+        import random, time
+        from . import terminology
+
+        rng = random.Random(0)
+        legacy_total = lookup_total = bulk_total = 0.0
+        for name in terminology.names():
+            value_set = terminology.get(name)
+            codes = [rng.choice(value_set.choices)[0] for _ in range(rows)] + ['unknown']
+
+            # What the *_description properties used to do: rebuild the map for every row
+            start = time.perf_counter()
+            for code in codes:
+                {item["code"]: item["display"] for item in value_set.source()}.get(code)
+            legacy = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for code in codes:
+                value_set.display(code)
+            lookup = time.perf_counter() - start
+
+            start = time.perf_counter()
+            value_set.decode(codes)
+            bulk = time.perf_counter() - start
+
+            legacy_total += legacy
+            lookup_total += lookup
+            bulk_total += bulk
+            click.echo(f"{name:45} {len(value_set):4} codes  rebuild {legacy * 1000:9.2f}ms"
+                       f"  lookup {lookup * 1000:7.2f}ms  decode {bulk * 1000:7.2f}ms")
+
+        click.echo(f"{'total':45} {'':10} rebuild {legacy_total * 1000:9.2f}ms"
+                   f"  lookup {lookup_total * 1000:7.2f}ms  decode {bulk_total * 1000:7.2f}ms")
+        if lookup_total:
+            click.echo(f"Per-row lookups are {legacy_total / lookup_total:.0f}x faster than rebuilding the map.")
+
+    @app.cli.command('stress-ids')
+    @click.option('--kind', type=click.Choice(['patient', 'user']), default='patient', show_default=True)
+    @click.option('--workers', default=8, show_default=True, help='Concurrent worker processes.')
+    @click.option('--ids', 'per_worker', default=500, show_default=True, help='Ids each worker allocates one at a time.')
+    @click.option('--bulk', default=200, show_default=True, help='Ids each worker then reserves in one block.')
+    @click.option('--block-size', default=10, show_default=True, help='Per-worker reservation size.')
+    @click.option('--yes', is_flag=True, help='Do not ask for confirmation.')
+    def stress_ids(kind, workers, per_worker, bulk, block_size, yes):
+        """Allocate business ids from concurrent processes and check that none collide."""
+        import multiprocessing, time
+        from collections import Counter
+
+        if not yes:
+            click.confirm('The allocated numbers are consumed in id_sequence. Use a scratch database. Continue?', abort=True)
+
+        global _worker_app
+        _worker_app = app
+        context = multiprocessing.get_context('fork')
+        start = time.perf_counter()
+        with context.Pool(workers) as pool:
+            results = pool.starmap(_allocate_ids, [(kind, per_worker, block_size, bulk)] * workers)
+        elapsed = time.perf_counter() - start
+
+        ids = [value for worker_ids in results for value in worker_ids]
+        duplicates = [value for value, seen in Counter(ids).items() if seen > 1]
+        click.echo(f"{len(ids)} ids from {workers} workers in {elapsed:.2f}s ({len(ids) / elapsed:.0f} ids/s)")
+        click.echo(f"First {min(ids)}, last {max(ids)}")
+        if duplicates:
+            raise click.ClickException(f"{len(duplicates)} duplicate ids, e.g. {duplicates[:5]}")
+        click.echo("No duplicates.")
+
+    @app.cli.command('outbox-worker')
+    @click.option('--threads', default=2, show_default=True, help='Sending threads, each with its own SMTP connection.')
+    @click.option('--batch-size', default=None, type=int, help='Emails per SMTP connection [default: OUTBOX_BATCH_SIZE].')
+    @click.option('--poll', 'poll_interval', default=None, type=float, help='Seconds between polls of an empty queue.')
+    @click.option('--once', is_flag=True, help='Send what is due now and exit.')
+    def outbox_worker(threads, batch_size, poll_interval, once):
+        """Deliver queued emails from the email outbox."""
+        import time
+        from . import outbox
+
+        worker = outbox.OutboxWorker(app, threads=threads, batch_size=batch_size, poll_interval=poll_interval)
+        if once:
+            claimed = worker.drain()
+            click.echo(f"Processed {claimed} emails: {outbox.metrics.stats()}")
+            return
+
+        worker.start()
+        click.echo(f"Outbox worker running with {threads} threads, Ctrl+C to stop.")
+        try:
+            while True:
+                time.sleep(60)
+                with app.app_context():
+                    click.echo(f"{outbox.stats()}")
+        except KeyboardInterrupt:
+            worker.stop(timeout=30)
+
+    @app.cli.command('smtp-sink')
+    @click.option('--host', default='127.0.0.1', show_default=True)
+    @click.option('--port', default=8025, show_default=True)
+    @click.option('--maildir', default=None, help='Also write every message to this directory as .eml.')
+    @click.option('--fail-rate', default=0.0, show_default=True, help='Fraction of messages answered with a temporary error.')
+    def smtp_sink(host, port, maildir, fail_rate):
+        """Run a local SMTP server that accepts mail instead of delivering it."""
+        from .smtp_sink import LocalSMTPServer
+
+        server = LocalSMTPServer(host, port, maildir=maildir, fail_rate=fail_rate)
+        click.echo(f"SMTP sink on {host}:{port}; set MAIL_SERVER={host} MAIL_PORT={port} MAIL_USE_TLS=false.")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
+        click.echo(f"Accepted {len(server.messages)} messages.")
+
+    @app.cli.command('storage-gc')
+    @click.option('--grace', default=None, type=int, help='Keep unreferenced blobs younger than this many seconds [default: STORAGE_GC_GRACE].')
+    @click.option('--recount', is_flag=True, help='Recompute reference counts from the referencing tables first.')
+    @click.option('--dry-run', is_flag=True, help='Only report what would be removed.')
+    def storage_gc(grace, recount, dry_run):
+        """Remove uploaded blobs that no lab scan or document references any more."""
+        from .storage import get_store
+
+        store = get_store()
+        if recount:
+            click.echo(f"Corrected the reference count of {store.recount()} blobs.")
+        grace = app.config['STORAGE_GC_GRACE'] if grace is None else grace
+        removed, freed = store.collect_garbage(grace=grace, dry_run=dry_run)
+        click.echo(f"{'Would remove' if dry_run else 'Removed'} {removed} blobs ({freed / 1024 / 1024:.1f} MB).")
+
+    @app.cli.command('storage-import-legacy')
+    @click.option('--batch-size', default=500, show_default=True, help='Records to update per transaction.')
+    @click.option('--remove-files', is_flag=True, help='Delete each legacy file once no record still needs it.')
+    def storage_import_legacy(batch_size, remove_files):
+        """Copy the files of lab scans and documents from before the blob store into it."""
+        from .storage import import_legacy_files
+
+        imported, missing = import_legacy_files(batch_size=batch_size, remove_files=remove_files)
+        click.echo(f"Imported {imported} records; {missing} have no file in UPLOAD_FOLDER.")
+
+    @app.cli.command('upload-sessions-gc')
+    def upload_sessions_gc():
+        """Delete resumable upload sessions past their expiry, with their partial files."""
+        from .resumable import expire_sessions
+
+        click.echo(f"Removed {expire_sessions()} expired upload sessions.")
+
+    @app.cli.command('bulk-export')
+    @click.option('--type', 'types', default=None, help='Comma-separated FHIR resource types [default: all].')
+    @click.option('--doctor', 'doctor_id', default=None, help="Only this doctor's patients (user id).")
+    @click.option('--pending', is_flag=True, help='Run the queued API exports instead of starting a new one.')
+    def bulk_export_command(types, doctor_id, pending):
+        """Write a FHIR Bulk Data export to NDJSON files in the foreground, e.g. from a nightly cron job."""
+        import os
+        from . import bulk_export
+        from .models import ExportJob
+
+        def report(job):
+            click.echo(f"  {bulk_export.progress_text(job)}")
+
+        if pending:
+            jobs = [job.id for job in ExportJob.query.filter_by(status='queued').order_by(ExportJob.created_at)]
+        else:
+            jobs = [bulk_export.create_job(bulk_export.parse_types(types), doctor_id=doctor_id).id]
+        for job_id in jobs:
+            click.echo(f"Export {job_id}:")
+            job = bulk_export.run(job_id, report=report)
+            if job.status != 'complete':
+                click.echo(f"  {job.status}: {job.error or ''}")
+                continue
+            folder = bulk_export.job_folder(job.id)
+            for item in bulk_export.files(job):
+                click.echo(f"  {os.path.join(folder, item['name'])}  {item['count']} resources")
+
+    @app.cli.command('export-jobs-gc')
+    def export_jobs_gc():
+        """Delete expired bulk exports and fail those whose worker died."""
+        from .bulk_export import expire_jobs
+        deleted, failed = expire_jobs()
+        click.echo(f"Deleted {deleted} expired exports, marked {failed} stalled exports as failed.")
+
+    @app.cli.command('import-fhir')
+    @click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+    @click.option('--doctor', 'doctor_id', required=True, help='User id of the doctor new patients are linked to.')
+    @click.option('--chunk-size', default=None, type=int, help='Resources per chunk [default: IMPORT_CHUNK_SIZE].')
+    def import_fhir(paths, doctor_id, chunk_size):
+        """Import FHIR NDJSON files (.ndjson, .ndjson.gz), patients first, or transaction/batch Bundles (.json)."""
+        import gzip, json, os
+        from collections import Counter
+        from . import db
+        from .fhir import FhirError
+        from .fhir_import import Importer, import_bundle, import_ndjson
+        from .models import User
+
+        doctor = db.session.get(User, doctor_id)
+        if doctor is None or doctor.role != 'doctor':
+            raise click.ClickException(f"No doctor with id {doctor_id}")
+
+        def report(importer):
+            click.echo(f"  {importer.imported} imported, {importer.failed} failed, {importer.rate():.0f} resources/s")
+
+        for path in paths:
+            click.echo(f"{path}:")
+            if path.endswith('.json'):
+                with open(path, encoding='utf-8') as handle:
+                    bundle = json.load(handle)
+                try:
+                    response = import_bundle(bundle, doctor_id, restrict=False, chunk_size=chunk_size)
+                except FhirError as error:
+                    click.echo(f"  {error.message}")
+                    continue
+                statuses = Counter(entry["response"]["status"] for entry in response.get("entry", []))
+                click.echo('  ' + ', '.join(f"{count} {status}" for status, count in sorted(statuses.items())))
+                continue
+
+            importer = Importer(doctor_id, restrict=False, chunk_size=chunk_size, report=report)
+            opener = gzip.open if path.endswith('.gz') else open
+            with opener(path, 'rb') as handle:
+                import_ndjson(handle, importer, source=f"{os.path.basename(path)} ").finish()
+            for location, message in importer.issues:
+                click.echo(f"  {location}: {message}")
+            click.echo(f"  Imported {importer.imported}, failed {importer.failed}, {importer.rate():.0f} resources/s")
+
+    @app.cli.command('import-patients')
+    @click.argument('path', type=click.Path(exists=True, dir_okay=False))
+    @click.option('--doctor', 'doctor_id', required=True, help='User id of the doctor the patients are linked to.')
+    @click.option('--rejected', 'rejected_path', default=None,
+                  help='Where to write the rejected rows [default: PATH with .rejected.csv].')
+    @click.option('--chunk-size', default=None, type=int, help='Rows per transaction [default: ROSTER_CHUNK_SIZE].')
+    def import_patients(path, doctor_id, rejected_path, chunk_size):
+        """Import a CSV roster of patients for a doctor; rows that fail the patient form's checks are written to a report."""
+        import csv, os
+        from . import db
+        from .models import User
+        from .patient_import import RosterError, import_roster, rejected_fields, rejected_row
+
+        doctor = db.session.get(User, doctor_id)
+        if doctor is None or doctor.role != 'doctor':
+            raise click.ClickException(f"No doctor with id {doctor_id}")
+        rejected_path = rejected_path or os.path.splitext(path)[0] + '.rejected.csv'
+        report_file = writer = None
+
+        def reject(line, values, errors):
+            nonlocal report_file, writer
+            if writer is None:
+                report_file = open(rejected_path, 'w', encoding='utf-8', newline='')
+                writer = csv.DictWriter(report_file, rejected_fields(values.keys()), extrasaction='ignore')
+                writer.writeheader()
+            writer.writerow(rejected_row(line, values, errors))
+
+        def report(result):
+            click.echo(f"  {result.imported} imported, {result.rejected} rejected, {result.rate():.0f} rows/s")
+
+        try:
+            with open(path, encoding='utf-8-sig', newline='') as handle:
+                result = import_roster(handle, doctor_id, chunk_size=chunk_size, on_reject=reject, report=report)
+        except RosterError as error:
+            raise click.ClickException(error.message)
+        except UnicodeDecodeError:
+            raise click.ClickException('The file is not UTF-8 encoded text.')
+        finally:
+            if report_file is not None:
+                report_file.close()
+        click.echo(f"Imported {result.imported} patients, rejected {result.rejected} rows "
+                   f"in {result.elapsed:.1f}s ({result.rate():.0f} rows/s)")
+        if result.rejected:
+            click.echo(f"Rejected rows: {rejected_path}")
+        if result.error:
+            raise click.ClickException(result.error)
+
+    @app.cli.command('benchmark-import')
+    @click.option('--patients', default=200, show_default=True, help='Synthetic patients to import.')
+    @click.option('--records', 'per_patient', default=25, show_default=True, help='Clinical resources per patient.')
+    @click.option('--chunk-sizes', default='1,100,1000', show_default=True, help='Comma-separated chunk sizes to compare.')
+    @click.option('--doctor', 'doctor_id', default=None, help='Doctor the patients are linked to [default: the first one].')
+    @click.option('--seed', default=0, show_default=True)
+    @click.option('--yes', is_flag=True, help='Do not ask for confirmation.')
+    def benchmark_import(patients, per_patient, chunk_sizes, doctor_id, seed, yes):
+        """Time the NDJSON import of a synthetic clinic at several chunk sizes, rolling every run back."""
+        import json, random, time
+        from datetime import datetime, timedelta
+        from . import db
+        from .cohorts import LAB_DEFAULTS
+        from .fhir import CVX, LOINC, RXNORM, UCUM
+        from .fhir_import import Importer, import_ndjson
+        from .models import User
+
+        if not yes:
+            click.confirm('Patient numbers reserved in id_sequence are consumed. Use a scratch database. Continue?', abort=True)
+        doctor = db.session.get(User, doctor_id) if doctor_id else User.query.filter_by(role='doctor').first()
+        if doctor is None or doctor.role != 'doctor':
+            raise click.ClickException('No doctor to import the patients for')
+        doctor_id = doctor.id
+        db.session.commit()
+
+        # A clinic's export, patients followed by their encounters and records
+        rng = random.Random(seed)
+        origin = datetime(2020, 1, 1)
+        labs = sorted(LAB_DEFAULTS)
+        lines = []
+        for number in range(patients):
+            patient = f"p{number}"
+            lines.append({"resourceType": "Patient", "id": patient, "gender": rng.choice(['male', 'female']),
+                          "name": [{"family": f"Family{number}", "given": [f"Given{number}"]}],
+                          "birthDate": f"{rng.randint(1940, 2015)}-0{rng.randint(1, 9)}-1{rng.randint(0, 9)}",
+                          "telecom": [{"system": "phone", "value": f"09{rng.randrange(10 ** 9):09d}"}]})
+            encounters = []
+            for visit in range(3):
+                encounter = f"e{number}-{visit}"
+                encounters.append(encounter)
+                start = origin + timedelta(minutes=rng.randrange(4 * 365 * 24 * 60))
+                lines.append({"resourceType": "Encounter", "id": encounter, "status": "finished",
+                              "class": {"code": "AMB"}, "subject": {"reference": f"Patient/{patient}"},
+                              "period": {"start": start.isoformat() + 'Z'}})
+            for record in range(per_patient):
+                common = {"subject": {"reference": f"Patient/{patient}"},
+                          "encounter": {"reference": f"Encounter/{rng.choice(encounters)}"}}
+                when = (origin + timedelta(minutes=rng.randrange(4 * 365 * 24 * 60))).isoformat() + 'Z'
+                kind = record % 5
+                if kind == 0:
+                    lines.append(dict(common, resourceType="Observation", status="final",
+                                      category=[{"coding": [{"code": "vital-signs"}]}],
+                                      code={"coding": [{"system": LOINC, "code": "8867-4"}]}, effectiveDateTime=when,
+                                      valueQuantity={"value": rng.randint(50, 120), "system": UCUM, "code": "/min"}))
+                elif kind == 1:
+                    code = rng.choice(labs)
+                    unit, low, high = LAB_DEFAULTS[code]
+                    middle = ((low or 0) + (high or low * 2)) / 2
+                    lines.append(dict(common, resourceType="Observation", status="final",
+                                      category=[{"coding": [{"code": "laboratory"}]}],
+                                      code={"coding": [{"system": LOINC, "code": code}]}, effectiveDateTime=when,
+                                      valueQuantity={"value": round(rng.gauss(middle, middle * 0.3), 1), "code": unit}))
+                elif kind == 2:
+                    lines.append({"resourceType": "Immunization", "status": "completed", "patient": common["subject"],
+                                  "encounter": common["encounter"], "occurrenceDateTime": when[:10],
+                                  "vaccineCode": {"coding": [{"system": CVX, "code": rng.choice(['08', '20', '140'])}]}})
+                elif kind == 3:
+                    lines.append({"resourceType": "MedicationStatement", "status": rng.choice(['active', 'completed']),
+                                  "subject": common["subject"], "context": common["encounter"],
+                                  "medicationCodeableConcept": {"coding": [{"system": RXNORM, "code": "197361"}],
+                                                                "text": "Amlodipine 5 MG Oral Tablet"},
+                                  "effectivePeriod": {"start": when[:10]}})
+                else:
+                    lines.append(dict(common, resourceType="AllergyIntolerance", code={"text": rng.choice(['Peanut', 'Penicillin', 'Dust'])},
+                                      clinicalStatus={"coding": [{"code": "active"}]},
+                                      reaction=[{"manifestation": [{"text": "Rash"}], "severity": rng.choice(['mild', 'severe'])}]))
+        lines = [json.dumps(line) for line in lines]
+
+        click.echo(f"{len(lines)} resources for {patients} patients")
+        for chunk_size in [int(size) for size in chunk_sizes.split(',') if size.strip()]:
+            importer = Importer(doctor_id, restrict=False, chunk_size=chunk_size, commit_chunks=False)
+            started = time.perf_counter()
+            import_ndjson(lines, importer).finish()
+            elapsed = time.perf_counter() - started
+            db.session.rollback()
+            click.echo(f"chunk size {chunk_size:>6}: {importer.imported} imported, {importer.failed} failed, "
+                       f"{elapsed:7.2f}s, {importer.imported / elapsed:9.0f} resources/s")
+
+    @app.cli.command('storage-migrate')
+    @click.option('--delete-originals', is_flag=True, help='Delete the files from UPLOAD_FOLDER once stored.')
+    def storage_migrate(delete_originals):
+        """Move lab scans and documents uploaded before the blob store into it."""
+        import os
+        from . import db
+        from .models import AdditionalDocument, LabScan
+        from .storage import get_store
+
+        store = get_store()
+        upload_folder = app.config['UPLOAD_FOLDER']
+        moved, missing, originals = 0, 0, set()
+        for model, path_column in ((LabScan, 'file_path'), (AdditionalDocument, 'document_file')):
+            for record in model.query.all():
+                if record.content_hash and store.exists(record.content_hash):
+                    continue
+                path = os.path.join(upload_folder, getattr(record, path_column))
+                if not os.path.isfile(path):
+                    missing += 1
+                    continue
+                record.content_hash = store.save_path(path).content_hash
+                originals.add(path)
+                moved += 1
+            db.session.commit()
+
+        click.echo(f"Stored {moved} files, {missing} records had no file.")
+        click.echo(f"Corrected the reference count of {store.recount()} blobs.")
+        if delete_originals:
+            for path in originals:
+                os.remove(path)
+            click.echo(f"Deleted {len(originals)} original files.")
+
+    @app.cli.command('benchmark-zip-export')
+    @click.option('--size-gb', default=2.0, show_default=True, help='Total size of the generated group.')
+    @click.option('--files', default=8, show_default=True, help='Number of scan files to split it into.')
+    @click.option('--output', default=None, help='Write the archive here instead of discarding it.')
+    def benchmark_zip_export(size_gb, files, output):
+        """Stream a ZIP of a large synthetic scan group and report memory and time to first byte."""
+        import os, resource, tempfile, time, tracemalloc
+        from .exports import ExportEntry, zip_stream
+
+        file_size = int(size_gb * 1024 ** 3 / files)
+        with tempfile.TemporaryDirectory() as directory:
+            entries = []
+            for number in range(files):
+                path = os.path.join(directory, f"scan-{number}.jpeg")
+                # Sparse files: the disk stays empty, the archive is still written byte for byte
+                with open(path, 'wb') as handle:
+                    handle.truncate(file_size)
+                entries.append(ExportEntry(f"scans/scan-{number}.jpeg", lambda path=path: open(path, 'rb'), file_size))
+
+            rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            tracemalloc.start()
+            target = open(output, 'wb') if output else None
+            start = time.perf_counter()
+            first_byte = None
+            total = 0
+            for chunk in zip_stream(entries, {"benchmark": True}):
+                if chunk and first_byte is None:
+                    first_byte = time.perf_counter() - start
+                total += len(chunk)
+                if target:
+                    target.write(chunk)
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            if target:
+                target.close()
+            rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        click.echo(f"{files} files, {total / 1024 ** 3:.2f} GB archive in {elapsed:.1f}s ({total / 1024 ** 2 / elapsed:.0f} MB/s)")
+        click.echo(f"First byte after {first_byte * 1000:.1f}ms")
+        click.echo(f"Peak Python allocations {peak / 1024 ** 2:.1f} MB, max RSS grew by {(rss_after - rss_before) / 1024:.1f} MB")
+
+    @app.cli.command('benchmark-fhir')
+    @click.option('--resource', 'resource_type', default='Observation', show_default=True, help='FHIR resource type.')
+    @click.option('--limit', default=10_000, show_default=True, help='Rows to serialize.')
+    def benchmark_fhir(resource_type, limit):
+        """Time the FHIR fast path against ORM objects round-tripped through fhirclient models, validating every resource."""
+        import importlib, time
+        from fhirclient.models.fhirabstractbase import FHIRValidationError
+        from sqlalchemy import select
+        from . import db
+        from .fhir import dumps, get_resource
+
+        resource = get_resource(resource_type)
+        model_class = getattr(importlib.import_module(f"fhirclient.models.{resource.name.lower()}"), resource.name)
+
+        started = time.perf_counter()
+        rows = db.session.execute(select(resource.table).order_by(resource.table.c.id).limit(limit)).all()
+        fast = dumps([resource.build(row) for row in rows])
+        fast_elapsed = time.perf_counter() - started
+
+        started = time.perf_counter()
+        invalid = 0
+        resources = []
+        for record in resource.model.query.order_by(resource.model.id).limit(limit):
+            try:
+                resources.append(model_class(resource.build(record), strict=True).as_json())
+            except FHIRValidationError as error:
+                invalid += 1
+                if invalid <= 3:
+                    click.echo(f"{resource.name}/{record.id}: {error}")
+        slow = dumps(resources)
+        slow_elapsed = time.perf_counter() - started
+        db.session.expunge_all()
+
+        click.echo(f"{len(rows)} {resource.name} resources, {len(fast) / 1024:.0f} KB")
+        click.echo(f"Core rows, direct serialization   {fast_elapsed * 1000:9.1f}ms")
+        click.echo(f"ORM objects through fhirclient     {slow_elapsed * 1000:9.1f}ms")
+        click.echo(f"{invalid} resources failed fhirclient validation.")
+
+    @app.cli.command('backfill-observations')
+    @click.option('--batch-size', default=5000, show_default=True, help='Observations updated per transaction.')
+    def backfill_observations(batch_size):
+        """Fill the numeric value, unit and reference range of every observation from its value text."""
+        from .cohorts import backfill
+        read, numeric = backfill(batch_size=batch_size)
+        click.echo(f"Parsed {read} observations, {numeric} with a numeric result.")
+
+    @app.cli.command('benchmark-cohorts')
+    @click.option('--rows', default=10_000_000, show_default=True, help='Synthetic observations to generate.')
+    @click.option('--patients', default=200_000, show_default=True, help='Patients they are spread over.')
+    @click.option('--path', default=None, help='SQLite file to build the table in [default: a temporary file].')
+    @click.option('--seed', default=0, show_default=True)
+    def benchmark_cohorts(rows, patients, path, seed):
+        """Time cohort queries in SQL against parsing the value text in Python, on a synthetic observation table."""
+        import os, random, tempfile, time
+        from datetime import datetime, timedelta
+        from sqlalchemy import create_engine, insert, select
+        from .cohorts import LAB_DEFAULTS, latest_value_cohort, parse_quantity, threshold_cohort, trend_cohort
+        from .models import Observation
+
+        directory = None
+        if path is None:
+            directory = tempfile.TemporaryDirectory()
+            path = os.path.join(directory.name, 'cohorts.db')
+        engine = create_engine(f"sqlite:///{path}")
+        table = Observation.__table__
+        table.drop(engine, checkfirst=True)
+        table.create(engine)
+        with engine.begin() as connection:
+            for index in table.indexes:
+                index.drop(connection)
+
+        # Lab results of random patients over five years; some qualitative, some with a unit
+        rng = random.Random(seed)
+        codes = ['4548-4', '2345-7', '2160-0', '2823-3', '718-7']
+        origin = datetime(2020, 1, 1)
+        click.echo(f"Generating {rows} observations for {patients} patients...")
+        start = time.perf_counter()
+        batch = []
+        with engine.begin() as connection:
+            for number in range(1, rows + 1):
+                code = rng.choice(codes)
+                unit, low, high = LAB_DEFAULTS[code]
+                middle = ((low or 0) + (high or low * 2)) / 2
+                roll = rng.random()
+                value = 'Pending' if roll < 0.02 else f"{rng.gauss(middle, middle * 0.3):.1f}" + (f" {unit}" if roll > 0.7 else '')
+                value_numeric, parsed_unit, reference_low, reference_high = parse_quantity(code, value)
+                batch.append({
+                    "patient_id": f"p{rng.randrange(patients):07d}", "visit_id": number, "code": code, "value": value,
+                    "status": 'final', "category": 'laboratory',
+                    "effectiveDateTime": origin + timedelta(minutes=rng.randrange(5 * 365 * 24 * 60)),
+                    "value_numeric": value_numeric, "unit": parsed_unit,
+                    "reference_low": reference_low, "reference_high": reference_high,
+                })
+                if len(batch) == 50_000:
+                    connection.execute(insert(table), batch)
+                    batch = []
+            if batch:
+                connection.execute(insert(table), batch)
+        click.echo(f"  loaded in {time.perf_counter() - start:.1f}s")
+        start = time.perf_counter()
+        with engine.begin() as connection:
+            for index in table.indexes:
+                index.create(connection)
+            connection.exec_driver_sql('ANALYZE')
+        click.echo(f"  indexed in {time.perf_counter() - start:.1f}s")
+
+        def timed(label, work):
+            started = time.perf_counter()
+            result = work()
+            click.echo(f"{label:58} {(time.perf_counter() - started) * 1000:9.1f}ms  {len(result):7} patients")
+            return result
+
+        def parse_in_python():
+            # The old way: read every HbA1c row and parse its text
+            latest = {}
+            with engine.connect() as connection:
+                for patient_id, value, effective, row_id in connection.execute(
+                    select(table.c.patient_id, table.c.value, table.c.effectiveDateTime, table.c.id)
+                    .where(table.c.code == '4548-4')
+                ):
+                    number = parse_quantity('4548-4', value)[0]
+                    if number is not None and (patient_id not in latest or (effective, row_id) > latest[patient_id][:2]):
+                        latest[patient_id] = (effective, row_id, number)
+            return sorted(patient_id for patient_id, (_, _, number) in latest.items() if number > 9)
+
+        def in_sql(statement):
+            with engine.connect() as connection:
+                return connection.execute(statement).all()
+
+        python_ids = timed("latest HbA1c > 9, parsed in Python", parse_in_python)
+        sql_rows = timed("latest HbA1c > 9, latest_value_cohort", lambda: in_sql(latest_value_cohort('4548-4', above=9)))
+        timed("any glucose > 180 in 2023, threshold_cohort", lambda: in_sql(threshold_cohort(
+            '2345-7', above=180, start=datetime(2023, 1, 1), end=datetime(2023, 12, 31, 23, 59))))
+        timed("creatinine up by >= 0.5 since 2024, trend_cohort", lambda: in_sql(trend_cohort(
+            '2160-0', start=datetime(2024, 1, 1), min_change=0.5)))
+        click.echo(f"Python and SQL cohorts {'match' if python_ids == [row[0] for row in sql_rows] else 'DIFFER'}.")
+        engine.dispose()
+        if directory is not None:
+            directory.cleanup()
+
+    @app.cli.command('seed')
+    @click.option('--doctors', default=10, show_default=True, help='Doctor accounts to add; 0 spreads the patients over the existing doctors.')
+    @click.option('--patients', default=1000, show_default=True, help='Patients to generate, each with a chart.')
+    @click.option('--visits', default=6.0, show_default=True, help='Average visits per patient.')
+    @click.option('--years', default=5, show_default=True, help='Years of history before --today.')
+    @click.option('--today', type=click.DateTime(['%Y-%m-%d']), default=None, help='Date the history ends [default: today].')
+    @click.option('--seed', 'seed_value', default=0, show_default=True, help='Same seed, same --today: same data.')
+    @click.option('--workers', default=None, type=int, help='Processes generating blocks [default: CPU count].')
+    @click.option('--block-size', default=None, type=int, help='Patients per block and transaction [default: 500].')
+    @click.option('--password', default='Passw0rd!', show_default=True, help='Password of the new doctor accounts.')
+    @click.option('--yes', is_flag=True, help='Do not ask for confirmation.')
+    def seed_command(doctors, patients, visits, years, today, seed_value, workers, block_size, password, yes):
+        """Fill the database with synthetic doctors, patients and charts for load testing."""
+        import os
+        from datetime import date
+        from sqlalchemy import select
+        from . import db
+        from .models import User
+        from .seed import DEFAULT_BLOCK_SIZE, SeedSettings, create_doctors, sample_scans, seed
+
+        if not yes:
+            click.confirm(f'Add {patients} synthetic patients to {db.engine.url.render_as_string()}? '
+                          'Use a scratch database that nothing else writes to.', abort=True)
+        if doctors:
+            doctor_ids = create_doctors(doctors, seed_value, password)
+            click.echo(f"Added {doctors} doctors; they sign in with their user id in lower case and the password.")
+        else:
+            doctor_ids = sorted(db.session.execute(select(User.id).where(User.role == 'doctor')).scalars())
+            if not doctor_ids:
+                raise click.ClickException('No doctors to give the patients to; use --doctors')
+        db.session.commit()
+
+        settings = SeedSettings(seed_value, today.date() if today else date.today(), visits, years, doctor_ids,
+                                sample_scans(), block_size or DEFAULT_BLOCK_SIZE)
+        workers = workers or os.cpu_count() or 1
+
+        def report(result):
+            click.echo(f"  {result.done}/{result.patients} patients, {result.total()} rows, {result.rate():.0f} rows/s")
+
+        result = seed(app, patients, settings, workers=workers, report=report)
+        for table, count in sorted(result.rows.items()):
+            click.echo(f"{table:24} {count:10}")
+        click.echo(f"{result.total()} rows in {result.elapsed:.1f}s ({result.rate():.0f} rows/s) with {workers} workers")
@@ -0,0 +1,123 @@
+import hashlib, logging, os, threading
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+# Derivative name -> longest edge in pixels. The gallery shows thumbnails at
+# 200 CSS pixels, so 400 keeps them sharp on high-density screens.
+DERIVATIVE_SIZES = {
+    'thumb': 400,
+    'preview': 1280,
+}
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+JPEG_QUALITY = 80
+HASH_CHUNK_SIZE = 1024 * 1024
+
+_executor = None
+_executor_lock = threading.Lock()
+# One lock per derivative being generated, so concurrent requests for the
+# same thumbnail wait for a single resize instead of each doing their own
+_pending = {}
+_pending_lock = threading.Lock()
+
+
+def is_image(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in IMAGE_EXTENSIONS
+
+
+def file_hash(path):
+    """SHA-256 of a file, read in chunks so large scans are never loaded whole."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def derivative_path(folder, content_hash, size):
+    """Where the `size` derivative of the content `content_hash` lives, sharded by hash prefix."""
+    pixels = DERIVATIVE_SIZES[size]
+    return os.path.join(folder, content_hash[:2], f"{content_hash}_{pixels}.jpg")
+
+
+def remove_derivatives(folder, content_hash):
+    """Delete every cached size of a content hash, e.g. once its blob is garbage-collected."""
+    for size in DERIVATIVE_SIZES:
+        try:
+            os.remove(derivative_path(folder, content_hash, size))
+        except FileNotFoundError:
+            pass
+
+
+def render(source, target, size):
+    """
+    Resize `source` to fit within the `size` box and write it to `target` as
+    a progressive JPEG. `source` is a path or a callable returning an open
+    binary file, for storage backends without local files.
+    """
+    from PIL import Image, ImageOps
+
+    pixels = DERIVATIVE_SIZES[size]
+    temporary = f"{target}.{threading.get_ident()}.tmp"
+    try:
+        with Image.open(source() if callable(source) else source) as image:
+            # Let the JPEG decoder scale down by a power of two while decoding
+            image.draft('RGB' if image.mode not in ('L', 'LA') else 'L', (pixels, pixels))
+            image = ImageOps.exif_transpose(image)
+            if image.mode not in ('RGB', 'L'):
+                background = Image.new('RGB', image.size, 'white')
+                background.paste(image, mask=image.getchannel('A') if 'A' in image.getbands() else None)
+                image = background
+            image.thumbnail((pixels, pixels), Image.LANCZOS)
+
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            image.save(temporary, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+    except Image.DecompressionBombError as error:
+        # More pixels than Pillow will decode (Image.MAX_IMAGE_PIXELS); an OSError
+        # like any other unreadable image, so callers fall back to the original
+        raise OSError(f"Too large to render: {error}") from error
+    # Readers only ever see a complete file
+    os.replace(temporary, target)
+
+
+def ensure(source, folder, content_hash, size):
+    """Return the path of the derivative, rendering it first if it is not cached yet."""
+    target = derivative_path(folder, content_hash, size)
+    if os.path.exists(target):
+        return target
+
+    with _pending_lock:
+        lock = _pending.setdefault(target, threading.Lock())
+    try:
+        with lock:
+            if not os.path.exists(target):
+                render(source, target, size)
+    finally:
+        with _pending_lock:
+            _pending.pop(target, None)
+    return target
+
+
+def _executor_for(workers):
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='derivatives')
+        return _executor
+
+
+def _render_all(source, folder, content_hash):
+    for size in DERIVATIVE_SIZES:
+        try:
+            ensure(source, folder, content_hash, size)
+        except Exception:
+            log.exception("Could not render the %s derivative of %s", size, source)
+
+
+def schedule(source, folder, content_hash, workers=2):
+    """
+    Render every derivative of a freshly uploaded image on the background
+    pool, so the upload request returns without waiting for the resizes.
+    Requests that arrive before it is done render the missing size themselves.
+    """
+    return _executor_for(workers).submit(_render_all, source, folder, content_hash)
@@ -0,0 +1,95 @@
+import os
+from flask import abort, current_app, request
+from werkzeug.utils import send_file as werkzeug_send_file
+from .storage import get_store
+
+# DOWNLOAD_HANDOFF values: stream from the app worker, or let the front-end server send the file
+HANDOFF_MODES = ('x-sendfile', 'x-accel-redirect')
+
+
+def _accel_uri(path):
+    """
+    The internal nginx location serving `path`, from X_ACCEL_LOCATIONS
+    (filesystem root -> location prefix). The most specific root wins.
+    """
+    path = os.path.abspath(path)
+    locations = current_app.config.get('X_ACCEL_LOCATIONS') or {}
+    for root in sorted(locations, key=len, reverse=True):
+        root_path = os.path.abspath(root)
+        if path.startswith(root_path + os.sep):
+            relative = os.path.relpath(path, root_path).replace(os.sep, '/')
+            return locations[root].rstrip('/') + '/' + relative
+    return None
+
+
+def _handoff_header(path):
+    """The (header, value) telling the front-end server to send `path`, or None to stream it from here."""
+    mode = current_app.config.get('DOWNLOAD_HANDOFF')
+    if path is None or mode not in HANDOFF_MODES:
+        return None
+    if mode == 'x-sendfile':
+        return 'X-Sendfile', os.path.abspath(path)
+    uri = _accel_uri(path)
+    return ('X-Accel-Redirect', uri) if uri else None
+
+
+def serve_file(source, download_name=None, as_attachment=False, mimetype=None, etag=True, last_modified=None):
+    """
+    Send a file with validators and byte ranges.
+
+    `source` is a path or a binary file object. A string `etag` is sent as
+    a strong ETag; True derives one from the file's mtime and size, which
+    only works for paths. If-None-Match and If-Modified-Since are answered
+    with 304 and Range requests with 206.
+
+    With DOWNLOAD_HANDOFF set and a local path, the app only answers the
+    conditional checks and leaves reading the file, and any Range, to the
+    front-end server (Apache mod_xsendfile or an nginx internal location).
+    """
+    path = source if isinstance(source, str) else None
+    handoff = _handoff_header(path)
+    if handoff is not None:
+        response = werkzeug_send_file(
+            path, request.environ, mimetype=mimetype, as_attachment=as_attachment, download_name=download_name,
+            conditional=False, etag=etag, last_modified=last_modified, use_x_sendfile=True,
+            response_class=current_app.response_class,
+        )
+        # werkzeug only left the X-Sendfile header as the body; ranges are up to the front-end server
+        del response.headers['X-Sendfile']
+        response.headers[handoff[0]] = handoff[1]
+        response.headers['Accept-Ranges'] = 'bytes'
+        response.cache_control.private = True
+        response = response.make_conditional(request.environ)
+        if response.status_code == 304:
+            # Some front-end servers would send the file anyway
+            del response.headers[handoff[0]]
+        return response
+
+    response = werkzeug_send_file(
+        source, request.environ, mimetype=mimetype, as_attachment=as_attachment, download_name=download_name,
+        conditional=True, etag=etag if path is not None or isinstance(etag, str) else False,
+        last_modified=last_modified, response_class=current_app.response_class,
+    )
+    # Patient files may only be cached by the user's own browser, which revalidates every time
+    response.cache_control.private = True
+    # Advertise ranges up front so browsers can resume an interrupted download
+    response.headers.setdefault('Accept-Ranges', 'bytes')
+    return response
+
+
+def send_upload(content_hash, legacy_path, download_name, last_modified=None, as_attachment=True):
+    """
+    Download response for an uploaded scan or document: from the blob store
+    when the record has a blob, with the content hash as its strong ETag,
+    otherwise from its pre-blob location below UPLOAD_FOLDER.
+    """
+    store = get_store()
+    if content_hash and store.exists(content_hash):
+        source = store.local_path(content_hash) or store.open(content_hash)
+        return serve_file(source, download_name=download_name, as_attachment=as_attachment,
+                          etag=content_hash, last_modified=last_modified)
+
+    path = os.path.join(current_app.config['UPLOAD_FOLDER'], legacy_path)
+    if not os.path.isfile(path):
+        abort(404)
+    return serve_file(path, download_name=download_name, as_attachment=as_attachment, last_modified=last_modified)
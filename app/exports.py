@@ -0,0 +1,137 @@
+import hashlib, json, os, zipfile
+from datetime import datetime
+from flask import current_app
+from .storage import get_store
+
+CHUNK_SIZE = 256 * 1024
+# Already compressed formats are stored as-is; deflating them costs CPU for nothing
+STORED_EXTENSIONS = {'jpg', 'jpeg', 'png', 'pdf', 'docx', 'zip'}
+
+
+class ExportEntry:
+    """One file of an archive: its name inside the ZIP, how to open it, its size and manifest fields."""
+
+    def __init__(self, name, opener, size, modified=None, **metadata):
+        self.name = name
+        self.opener = opener
+        self.size = size
+        self.modified = modified or datetime.utcnow()
+        self.metadata = metadata
+
+
+class _StreamSink:
+    """
+    Write-only, non-seekable file for ZipFile. Whatever zipfile writes is
+    kept only until the generator hands it to the response, so the archive
+    is never held in memory.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._offset = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _unique_name(name, used):
+    base, extension = os.path.splitext(name)
+    candidate, number = name, 2
+    while candidate in used:
+        candidate = f"{base} ({number}){extension}"
+        number += 1
+    used.add(candidate)
+    return candidate
+
+
+def zip_stream(entries, manifest=None, chunk_size=CHUNK_SIZE):
+    """
+    Yield a ZIP archive of `entries` piece by piece.
+
+    Each file is read and sent in `chunk_size` pieces, so memory use does
+    not depend on the size of the files or of the archive, and the
+    response starts as soon as the first chunk is read. Sizes are declared
+    up front so files over 4 GB get ZIP64 headers. A manifest.json with
+    every entry's metadata, size and SHA-256 is written last.
+    """
+    sink = _StreamSink()
+    used = set()
+    listed = []
+    with zipfile.ZipFile(sink, mode='w', allowZip64=True) as archive:
+        for entry in entries:
+            name = _unique_name(entry.name, used)
+            info = zipfile.ZipInfo(name, date_time=entry.modified.timetuple()[:6])
+            extension = name.rsplit('.', 1)[-1].lower() if '.' in name else ''
+            info.compress_type = zipfile.ZIP_STORED if extension in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+            info.file_size = entry.size
+
+            digest = hashlib.sha256()
+            size = 0
+            with entry.opener() as source, archive.open(info, mode='w', force_zip64=entry.size > zipfile.ZIP64_LIMIT) as target:
+                for chunk in iter(lambda: source.read(chunk_size), b''):
+                    digest.update(chunk)
+                    target.write(chunk)
+                    size += len(chunk)
+                    yield sink.drain()
+            yield sink.drain()
+            listed.append(dict(entry.metadata, path=name, size=size, sha256=digest.hexdigest()))
+
+        document = dict(manifest or {}, generated_at=datetime.utcnow().isoformat() + 'Z', files=listed)
+        archive.writestr('manifest.json', json.dumps(document, indent=2, default=str))
+    yield sink.drain()
+
+
+def _upload_entry(folder, filename, content_hash, legacy_path, modified, **metadata):
+    """An ExportEntry for a stored upload, or None if its file is missing."""
+    store = get_store()
+    if content_hash and store.exists(content_hash):
+        size = store.size(content_hash)
+        opener = lambda: store.open(content_hash)
+    else:
+        path = os.path.join(current_app.config['UPLOAD_FOLDER'], legacy_path)
+        if not os.path.isfile(path):
+            return None
+        size = os.path.getsize(path)
+        opener = lambda: open(path, 'rb')
+    return ExportEntry(f"{folder}/{filename}", opener, size, modified, filename=filename, **metadata)
+
+
+def lab_scan_group_entries(group, include_documents=False):
+    """
+    The files of a LabScanGroup, optionally followed by the patient's
+    documents. Everything is looked up before streaming starts, so the
+    response does not need the database while it runs.
+    """
+    entries, missing = [], []
+    for scan in sorted(group.scans, key=lambda scan: scan.id):
+        entry = _upload_entry('scans', scan.filename, scan.content_hash, scan.file_path, scan.upload_date,
+                              type='lab_scan', id=scan.id, uploaded=scan.upload_date)
+        if entry:
+            entries.append(entry)
+        else:
+            missing.append({"type": "lab_scan", "id": scan.id, "filename": scan.filename})
+
+    if include_documents:
+        for document in sorted(group.patient.additional_documents, key=lambda document: document.id):
+            filename = os.path.basename(document.document_file)
+            entry = _upload_entry('documents', filename, document.content_hash, document.document_file,
+                                  document.upload_date, type='document', id=document.id,
+                                  document_name=document.document_name, uploaded=document.upload_date)
+            if entry:
+                entries.append(entry)
+            else:
+                missing.append({"type": "document", "id": document.id, "filename": filename})
+    return entries, missing
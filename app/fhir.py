@@ -0,0 +1,697 @@
+import json
+from datetime import date, datetime, time, timedelta
+from flask import request, url_for
+from sqlalchemy import Date, DateTime, false, func, select
+from . import db, terminology, vitals_series
+from .access import can_access_patient
+from .models import (AllergyIntolerance, Appointment, DoctorPatient, Immunization, MedicalHistory, MedicationStatement,
+                     Observation, Patient, Procedure, Visit, Vitals)
+from .pagination import CursorError, decode_cursor, encode_cursor
+from .search import matching_patient_ids
+
+# FHIR R4 (https://hl7.org/fhir/R4/http.html): read and search of the chart
+# tables as resources, a Core SELECT per page serialized straight from the
+# rows, without loading ORM objects or building fhirclient models
+FHIR_VERSION = '4.0.1'
+FHIR_MIMETYPE = 'application/fhir+json'
+DEFAULT_COUNT = 50
+MAX_COUNT = 500
+
+LOINC = 'http://loinc.org'
+SNOMED = 'http://snomed.info/sct'
+CVX = 'http://hl7.org/fhir/sid/cvx'
+RXNORM = 'http://www.nlm.nih.gov/research/umls/rxnorm'
+UCUM = 'http://unitsofmeasure.org'
+PATIENT_ID_SYSTEM = 'urn:mdhs:patient-id'
+ACT_CODE = 'http://terminology.hl7.org/CodeSystem/v3-ActCode'
+OBSERVATION_CATEGORY = 'http://terminology.hl7.org/CodeSystem/observation-category'
+ALLERGY_CLINICAL = 'http://terminology.hl7.org/CodeSystem/allergyintolerance-clinical'
+ALLERGY_VERIFICATION = 'http://terminology.hl7.org/CodeSystem/allergyintolerance-verification'
+CONDITION_CLINICAL = 'http://terminology.hl7.org/CodeSystem/condition-clinical'
+CONDITION_VERIFICATION = 'http://terminology.hl7.org/CodeSystem/condition-ver-status'
+CONDITION_CATEGORY = 'http://terminology.hl7.org/CodeSystem/condition-category'
+SYSTOLIC_PRESSURE = '8480-6'
+DIASTOLIC_PRESSURE = '8462-4'
+# Vitals rows are served as Observations too; their ids carry this prefix
+# so they never clash with those of the observations table
+VITALS_ID_PREFIX = 'vitals-'
+
+# Stored values -> FHIR codes, where the value sets differ
+GENDERS = {'male': 'male', 'female': 'female', 'other': 'other'}
+ENCOUNTER_STATUSES = {'planned': 'planned', 'in-progress': 'in-progress', 'completed': 'finished', 'cancelled': 'cancelled'}
+ENCOUNTER_CLASSES = {'outpatient': ('AMB', 'ambulatory'), 'inpatient': ('IMP', 'inpatient encounter'),
+                     'virtual': ('VR', 'virtual')}
+ALLERGY_CATEGORIES = {'food': 'food', 'medication': 'medication', 'environmental': 'environment',
+                      'environment': 'environment', 'biologic': 'biologic'}
+
+
+class FhirError(Exception):
+    """A request answered with an OperationOutcome; `status` is the HTTP status."""
+
+    def __init__(self, message, status=400, code='invalid'):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.code = code
+
+
+def operation_outcome(message, code='invalid'):
+    return {"resourceType": "OperationOutcome",
+            "issue": [{"severity": "error", "code": code, "diagnostics": message}]}
+
+
+def dumps(resource):
+    return json.dumps(resource, separators=(',', ':'), ensure_ascii=False)
+
+
+# Builders of the elements shared by several resources. FHIR has no nulls,
+# so each returns None for missing data and `_resource` drops those keys.
+def _instant(value):
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        # FHIR times need a zone; the tables hold naive UTC
+        return value.isoformat() + 'Z' if value.tzinfo is None else value.isoformat()
+    if isinstance(value, date):
+        return value.isoformat()
+    return str(value)
+
+
+def _coding(system, code, display=None):
+    if not code:
+        return None
+    coding = {"system": system, "code": code} if system else {"code": code}
+    if display:
+        coding["display"] = display
+    return coding
+
+
+def _concept(system=None, code=None, display=None, text=None):
+    coding = _coding(system, code, display)
+    if coding is None and not text:
+        return None
+    concept = {"coding": [coding]} if coding else {}
+    if text:
+        concept["text"] = text
+    return concept
+
+
+def _text(value):
+    return {"text": value} if value else None
+
+
+def _list(*items):
+    items = [item for item in items if item]
+    return items or None
+
+
+def _reference(resource_type, resource_id):
+    return {"reference": f"{resource_type}/{resource_id}"} if resource_id is not None else None
+
+
+def _resource(resource_type, resource_id, **elements):
+    resource = {"resourceType": resource_type, "id": str(resource_id)}
+    for key, value in elements.items():
+        if value is not None:
+            resource[key] = value
+    return resource
+
+
+def _display(value_set, code):
+    return terminology.display(value_set, code) if code else None
+
+
+def patient_resource(row):
+    gender = GENDERS.get((row.gender or '').lower(), 'unknown')
+    contact = None
+    if row.ecd_name or row.ecd_contact_number:
+        contact = [_resource_elements(name=_text(row.ecd_name),
+                                      telecom=_list(_telecom(row.ecd_contact_number)))]
+    return _resource(
+        'Patient', row.id,
+        identifier=[{"system": PATIENT_ID_SYSTEM, "value": row.patient_id}],
+        name=[{"family": row.lastname, "given": [row.firstname]}],
+        gender=gender,
+        birthDate=_instant(row.birthdate),
+        telecom=_list(_telecom(row.contact_number)),
+        address=_list(_text(row.home_address)),
+        contact=contact,
+    )
+
+
+def _telecom(number):
+    return {"system": "phone", "value": number} if number else None
+
+
+def _resource_elements(**elements):
+    return {key: value for key, value in elements.items() if value is not None}
+
+
+def encounter_resource(row):
+    class_code, class_display = ENCOUNTER_CLASSES.get(row.class_code or 'outpatient', ENCOUNTER_CLASSES['outpatient'])
+    return _resource(
+        'Encounter', row.id,
+        status=ENCOUNTER_STATUSES.get(row.status, 'unknown'),
+        **{"class": _coding(ACT_CODE, class_code, class_display)},
+        priority=_concept(text=row.priority),
+        subject=_reference('Patient', row.patient_id),
+        participant=[{"individual": _reference('Practitioner', row.doctor_id)}],
+        period={"start": _instant(row.visit_date)},
+        reasonCode=_list(_concept(SNOMED, row.reason_code, _display('visit.reason_code', row.reason_code))),
+        diagnosis=_list({"condition": {"display": row.diagnosis_code}} if row.diagnosis_code else None),
+        location=_list({"location": {"display": row.location}} if row.location else None),
+    )
+
+
+def observation_resource(row):
+    if row.value_numeric is not None:
+        quantity = {"value": row.value_numeric}
+        if row.unit:
+            quantity.update(unit=row.unit, system=UCUM, code=row.unit)
+        value = {"valueQuantity": quantity}
+    else:
+        value = {"valueString": row.value} if row.value else {}
+    reference_range = None
+    if row.reference_low is not None or row.reference_high is not None:
+        bounds = {}
+        for key, bound in (('low', row.reference_low), ('high', row.reference_high)):
+            if bound is not None:
+                bounds[key] = {"value": bound, "unit": row.unit, "system": UCUM, "code": row.unit} if row.unit else {"value": bound}
+        reference_range = [bounds]
+    return _resource(
+        'Observation', row.id,
+        status=row.status or 'unknown',
+        category=_list(_concept(OBSERVATION_CATEGORY, row.category)),
+        code=_concept(LOINC, row.code, _display('observation.code', row.code)),
+        subject=_reference('Patient', row.patient_id),
+        encounter=_reference('Encounter', row.visit_id),
+        effectiveDateTime=_instant(row.effectiveDateTime),
+        referenceRange=reference_range,
+        **value,
+    )
+
+
+def _quantity(value, unit):
+    # Converted units leave float noise, e.g. 36.99999 for 98.6 [degF]
+    return {"value": round(value, 2), "unit": unit, "system": UCUM, "code": unit}
+
+
+def vitals_resource(row):
+    """A vital-signs Observation, with the value in the code's canonical UCUM unit when it parses."""
+    code = vitals_series.normalize_code(row.code)
+    sample = vitals_series.parse_vitals(row)
+    if sample is None:
+        value = {"valueString": ' '.join(part for part in (row.value, row.unit) if part)} if row.value else {}
+    elif code == vitals_series.BLOOD_PRESSURE:
+        value = {"component": [
+            {"code": _concept(LOINC, SYSTOLIC_PRESSURE, 'Systolic blood pressure'),
+             "valueQuantity": _quantity(sample['systolic'], sample['unit'])},
+            {"code": _concept(LOINC, DIASTOLIC_PRESSURE, 'Diastolic blood pressure'),
+             "valueQuantity": _quantity(sample['diastolic'], sample['unit'])},
+        ]}
+    else:
+        value = {"valueQuantity": _quantity(sample['value'], sample['unit'])}
+    return _resource(
+        'Observation', f"{VITALS_ID_PREFIX}{row.id}",
+        status=row.status or 'unknown',
+        category=[_concept(OBSERVATION_CATEGORY, 'vital-signs')],
+        code=_concept(LOINC, code, _display('vitals.code', code)) if code else _concept(text=row.code),
+        subject=_reference('Patient', row.patient_id),
+        encounter=_reference('Encounter', row.visit_id),
+        effectiveDateTime=_instant(row.effective_date),
+        **value,
+    )
+
+
+def immunization_resource(row):
+    return _resource(
+        'Immunization', row.id,
+        status=row.status or 'completed',
+        vaccineCode=_concept(CVX, row.vaccine_code, _display('immunization.vaccine_code', row.vaccine_code)),
+        patient=_reference('Patient', row.patient_id),
+        encounter=_reference('Encounter', row.visit_id),
+        occurrenceDateTime=_instant(row.date),
+        manufacturer={"display": row.manufacturer} if row.manufacturer else None,
+        lotNumber=row.lot_number,
+        site=_concept(text=row.site),
+        route=_concept(text=row.route),
+        note=_list(_text(row.notes)),
+    )
+
+
+def allergy_resource(row):
+    reaction = None
+    if row.reaction:
+        reaction = [_resource_elements(manifestation=[{"text": row.reaction}], severity=row.severity)]
+    return _resource(
+        'AllergyIntolerance', row.id,
+        clinicalStatus=_concept(ALLERGY_CLINICAL, row.clinical_status),
+        verificationStatus=_concept(ALLERGY_VERIFICATION, row.verification_status),
+        type=row.type if row.type in ('allergy', 'intolerance') else None,
+        category=_list(ALLERGY_CATEGORIES.get(row.category)),
+        criticality='high' if row.severity == 'severe' else None,
+        code={"text": row.substance},
+        patient=_reference('Patient', row.patient_id),
+        encounter=_reference('Encounter', row.visit_id),
+        reaction=reaction,
+    )
+
+
+def medication_resource(row):
+    dosage = _resource_elements(text=row.dosage_instruction, patientInstruction=row.timing,
+                                route=_concept(text=row.route_of_administration))
+    period = _resource_elements(start=_instant(row.effectivePeriod_start), end=_instant(row.effectivePeriod_end))
+    return _resource(
+        'MedicationStatement', row.id,
+        status=row.status,
+        statusReason=_list(_concept(text=row.status_reason)),
+        category=_concept(text=row.category),
+        medicationCodeableConcept=_concept(RXNORM, row.medication_code, row.medication_name, row.medication_name),
+        subject=_reference('Patient', row.patient_id),
+        context=_reference('Encounter', row.visit_id),
+        effectivePeriod=period or None,
+        dateAsserted=_instant(row.date_asserted),
+        reasonCode=_list(_concept(text=row.reason_code)),
+        note=_list(_text(row.notes)),
+        dosage=[dosage] if dosage else None,
+    )
+
+
+def appointment_resource(row):
+    return _resource(
+        'Appointment', row.id,
+        status=row.status,
+        serviceCategory=_list(_concept(text=row.service_category)),
+        serviceType=_list(_concept(text=row.service_type)),
+        specialty=_list(_concept(text=row.specialty)),
+        appointmentType=_concept(text=row.appointment_type),
+        reasonCode=_list(_concept(text=row.reason_code)),
+        start=_instant(row.start),
+        end=_instant(row.end),
+        participant=[
+            {"actor": _reference('Patient', row.patient_id), "status": 'accepted'},
+            {"actor": _reference('Practitioner', row.doctor_id), "status": row.participant_status or 'accepted'},
+        ],
+    )
+
+
+def procedure_resource(row):
+    return _resource(
+        'Procedure', row.id,
+        status=row.status or 'unknown',
+        category=_concept(text=row.category),
+        code=_concept(SNOMED, row.code),
+        subject=_reference('Patient', row.patient_id),
+        encounter=_reference('Encounter', row.visit_id),
+        performedDateTime=_instant(row.performed_date),
+        performer=_list({"actor": _reference('Practitioner', row.performer_id)} if row.performer_id else None),
+        reasonCode=_list(_concept(text=row.reason_code)),
+        outcome=_concept(text=row.outcome),
+        note=_list(_text(row.report)),
+    )
+
+
+def condition_resource(row):
+    return _resource(
+        'Condition', row.id,
+        clinicalStatus=_concept(CONDITION_CLINICAL, row.clinical_status),
+        verificationStatus=_concept(CONDITION_VERIFICATION, row.verification_status),
+        category=_list(_concept(CONDITION_CATEGORY, row.category)),
+        code=_concept(text=row.code),
+        subject=_reference('Patient', row.patient_id),
+        encounter=_reference('Encounter', row.visit_id),
+        onsetDateTime=_instant(row.onset_date),
+        abatementDateTime=_instant(row.abatement_date),
+        recorder=_reference('Practitioner', row.doctor_id),
+        note=_list(_text(row.notes)),
+    )
+
+
+class FhirResource:
+    """
+    How one model is served as a FHIR resource type.
+
+    `params` maps search parameters to ('token' | 'date' | 'reference',
+    column) or to a function(statement, value) for anything else; `mapping`
+    translates FHIR token values to stored ones. `includes` maps the names
+    accepted by _include to (resource type, column holding its id).
+    `more` are further models served as the same type, each with its own
+    `id_prefix`; searches page through them one after the other.
+    """
+
+    def __init__(self, name, model, build, params=None, includes=None, patient_column=None, id_prefix='', more=()):
+        self.name = name
+        self.model = model
+        self.build = build
+        self.params = params or {}
+        self.includes = includes or {}
+        self.patient_column = patient_column if patient_column is not None else model.patient_id
+        self.id_prefix = id_prefix
+        self.more = tuple(more)
+
+    @property
+    def table(self):
+        return self.model.__table__
+
+    @property
+    def sources(self):
+        return (self,) + self.more
+
+
+def _patient_name(statement, value):
+    matches = matching_patient_ids(value)
+    return statement.where(Patient.id.in_(matches)) if matches is not None else statement
+
+
+def _subject_includes(name, encounter=True):
+    includes = {f"{name}:patient": ('Patient', 'patient_id'), f"{name}:subject": ('Patient', 'patient_id')}
+    if encounter:
+        includes[f"{name}:encounter"] = ('Encounter', 'visit_id')
+    return includes
+
+
+def _vitals_code(statement, value):
+    # Older rows hold the code as typed, e.g. 'BP' or 'Body Temperature'
+    spellings = [spelling for code in _tokens(value) for spelling in vitals_series.code_spellings(code)]
+    return statement.where(func.lower(func.trim(Vitals.code)).in_(spellings))
+
+
+def _vital_signs_category(statement, value):
+    # Every vitals row is served as vital-signs, whatever its category column holds
+    return statement if 'vital-signs' in _tokens(value) else statement.where(false())
+
+
+VITAL_SIGNS = FhirResource('Observation', Vitals, vitals_resource, id_prefix=VITALS_ID_PREFIX, params={
+    'code': _vitals_code,
+    'date': ('date', Vitals.effective_date),
+    'status': ('token', Vitals.status),
+    'category': _vital_signs_category,
+    'encounter': ('reference', Vitals.visit_id),
+}, includes=_subject_includes('Observation'))
+
+
+RESOURCES = {resource.name: resource for resource in (
+    FhirResource('Patient', Patient, patient_resource, patient_column=Patient.id, params={
+        'identifier': ('token', Patient.patient_id),
+        'gender': ('token', Patient.gender),
+        'birthdate': ('date', Patient.birthdate),
+        'name': _patient_name,
+    }),
+    FhirResource('Encounter', Visit, encounter_resource, params={
+        'date': ('date', Visit.visit_date),
+        'status': ('token', Visit.status, {value: key for key, value in ENCOUNTER_STATUSES.items()}),
+        'practitioner': ('reference', Visit.doctor_id),
+    }, includes=_subject_includes('Encounter', encounter=False)),
+    FhirResource('Observation', Observation, observation_resource, params={
+        'code': ('token', Observation.code),
+        'date': ('date', Observation.effectiveDateTime),
+        'status': ('token', Observation.status),
+        'category': ('token', Observation.category),
+        'encounter': ('reference', Observation.visit_id),
+    }, includes=_subject_includes('Observation'), more=(VITAL_SIGNS,)),
+    FhirResource('Immunization', Immunization, immunization_resource, params={
+        'date': ('date', Immunization.date),
+        'status': ('token', Immunization.status),
+        'vaccine-code': ('token', Immunization.vaccine_code),
+    }, includes=_subject_includes('Immunization')),
+    FhirResource('AllergyIntolerance', AllergyIntolerance, allergy_resource, params={
+        'clinical-status': ('token', AllergyIntolerance.clinical_status),
+        'verification-status': ('token', AllergyIntolerance.verification_status),
+        'category': ('token', AllergyIntolerance.category, {'environment': 'environmental'}),
+    }, includes=_subject_includes('AllergyIntolerance')),
+    FhirResource('MedicationStatement', MedicationStatement, medication_resource, params={
+        'status': ('token', MedicationStatement.status),
+        'code': ('token', MedicationStatement.medication_code),
+        'effective': ('date', MedicationStatement.effectivePeriod_start),
+        'context': ('reference', MedicationStatement.visit_id),
+    }, includes=_subject_includes('MedicationStatement')),
+    FhirResource('Appointment', Appointment, appointment_resource, params={
+        'date': ('date', Appointment.start),
+        'status': ('token', Appointment.status),
+        'practitioner': ('reference', Appointment.doctor_id),
+    }, includes={'Appointment:patient': ('Patient', 'patient_id'), 'Appointment:actor': ('Patient', 'patient_id')}),
+    FhirResource('Procedure', Procedure, procedure_resource, params={
+        'date': ('date', Procedure.performed_date),
+        'status': ('token', Procedure.status),
+        'code': ('token', Procedure.code),
+        'encounter': ('reference', Procedure.visit_id),
+    }, includes=_subject_includes('Procedure')),
+    FhirResource('Condition', MedicalHistory, condition_resource, params={
+        'code': ('token', MedicalHistory.code),
+        'clinical-status': ('token', MedicalHistory.clinical_status),
+        'verification-status': ('token', MedicalHistory.verification_status),
+        'category': ('token', MedicalHistory.category),
+        'onset-date': ('date', MedicalHistory.onset_date),
+    }, includes=_subject_includes('Condition')),
+)}
+
+# Parameters every search accepts besides the resource's own
+COMMON_PARAMS = ('_id', 'patient', 'subject', '_count', '_cursor', '_include', '_format')
+
+
+def get_resource(name):
+    resource = RESOURCES.get(name)
+    if resource is None:
+        raise FhirError(f"Resource type {name} is not supported", 404, 'not-supported')
+    return resource
+
+
+def _tokens(value, mapping=None):
+    """The codes of a token parameter: comma-separated alternatives, each `code` or `system|code`."""
+    codes = [part.rsplit('|', 1)[-1] for part in value.split(',') if part.rsplit('|', 1)[-1]]
+    return [mapping.get(code, code) for code in codes] if mapping else codes
+
+
+def _reference_ids(value, resource_type=None):
+    ids = []
+    for part in value.split(','):
+        part = part.strip().rstrip('/')
+        if '/' in part:
+            kind, _, part = part.rpartition('/')
+            kind = kind.rsplit('/', 1)[-1]
+            if resource_type and kind != resource_type:
+                raise FhirError(f"Expected a {resource_type} reference, got {kind}")
+        if part:
+            ids.append(part)
+    return ids
+
+
+# Prefixes of date parameters: https://hl7.org/fhir/R4/search.html#prefix
+DATE_PREFIXES = ('eq', 'ge', 'gt', 'le', 'lt')
+
+
+def parse_date_param(value):
+    """(prefix, start, end) of a date parameter; `end` is the exclusive end of the value's precision."""
+    prefix = value[:2] if value[:2] in DATE_PREFIXES + ('ne', 'sa', 'eb', 'ap') else 'eq'
+    text = value[2:] if value[:2] == prefix else value
+    if prefix not in DATE_PREFIXES:
+        raise FhirError(f"Date prefix {prefix} is not supported")
+    try:
+        if len(text) == 4:
+            start = datetime(int(text), 1, 1)
+            end = datetime(start.year + 1, 1, 1)
+        elif len(text) == 7:
+            start = datetime(int(text[:4]), int(text[5:7]), 1)
+            end = datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+        elif len(text) == 10:
+            start = datetime.fromisoformat(text)
+            end = start + timedelta(days=1)
+        else:
+            start = datetime.fromisoformat(text.replace('Z', '+00:00')).replace(tzinfo=None)
+            end = start + timedelta(seconds=1)
+    except ValueError:
+        raise FhirError(f"Invalid date {value!r}")
+    return prefix, start, end
+
+
+def _date_bounds(column, prefix, start, end):
+    """Conditions for a date parameter on a DateTime column or, as whole days, on a Date one."""
+    if isinstance(column.type, Date) and not isinstance(column.type, DateTime):
+        # A day is within the bounds when its midnight is
+        ceil = lambda moment: moment.date() if moment.time() == time() else moment.date() + timedelta(days=1)
+        start, end = ceil(start), ceil(end)
+    return {
+        'eq': [column >= start, column < end],
+        'ge': [column >= start],
+        'gt': [column >= end],
+        'le': [column < end],
+        'lt': [column < start],
+    }[prefix]
+
+
+def _filtered(resource, args, doctor_id):
+    """The resource's table filtered by the search parameters and by the doctor's patients."""
+    statement = select(resource.table)
+    patients = []
+    for name in ('patient', 'subject'):
+        for value in args.getlist(name):
+            patients += _reference_ids(value, 'Patient')
+    if resource.name == 'Patient':
+        patients += [patient_id for value in args.getlist('_id') for patient_id in value.split(',')]
+    elif args.get('_id'):
+        ids = [value for values in args.getlist('_id') for value in values.split(',')]
+        ids = [value[len(resource.id_prefix):] for value in ids if value.startswith(resource.id_prefix)]
+        statement = statement.where(resource.table.c.id.in_([int(value) for value in ids if value.isdigit()]))
+
+    if patients:
+        patients = [patient_id for patient_id in set(patients) if can_access_patient(doctor_id, patient_id)]
+        statement = statement.where(resource.patient_column.in_(patients))
+    else:
+        statement = statement.join(DoctorPatient, DoctorPatient.patient_id == resource.patient_column).where(
+            DoctorPatient.doctor_id == doctor_id)
+
+    for name, spec in resource.params.items():
+        for value in args.getlist(name):
+            if not value:
+                continue
+            if callable(spec):
+                statement = spec(statement, value)
+                continue
+            kind, column = spec[:2]
+            if kind == 'token':
+                statement = statement.where(column.in_(_tokens(value, spec[2] if len(spec) > 2 else None)))
+            elif kind == 'reference':
+                statement = statement.where(column.in_(_reference_ids(value)))
+            elif kind == 'date':
+                statement = statement.where(*_date_bounds(column, *parse_date_param(value)))
+    return statement
+
+
+def clamp_count(count):
+    try:
+        count = int(count)
+    except (TypeError, ValueError):
+        return DEFAULT_COUNT
+    return max(1, min(count, MAX_COUNT))
+
+
+def base_url():
+    return request.url_root.rstrip('/') + '/fhir'
+
+
+def _entry(resource, mode):
+    return {"fullUrl": f"{base_url()}/{resource['resourceType']}/{resource['id']}", "resource": resource,
+            "search": {"mode": mode}}
+
+
+def _included(resource, matches, includes):
+    """The resources named by _include for a page of (source, row) matches, one primary key lookup per type."""
+    wanted = {}
+    for name in includes:
+        if name not in resource.includes:
+            raise FhirError(f"_include={name} is not supported")
+        target, column = resource.includes[name]
+        wanted.setdefault(target, set()).update(
+            getattr(row, column) for _, row in matches if getattr(row, column) is not None)
+    included = []
+    for target, ids in sorted(wanted.items()):
+        if not ids:
+            continue
+        target_resource = RESOURCES[target]
+        included += [target_resource.build(row) for row in db.session.execute(
+            select(target_resource.table).where(target_resource.table.c.id.in_(ids)).order_by(target_resource.table.c.id)
+        )]
+    return included
+
+
+def search(resource_type, args, doctor_id):
+    """
+    A searchset Bundle of one page of `resource_type` among the doctor's
+    patients. Pages follow the primary key of each source table in turn, so
+    the next link carries the source and last id as an opaque _cursor and
+    every page is an index seek.
+    """
+    resource = get_resource(resource_type)
+    count = clamp_count(args.get('_count'))
+    scope = f"fhir:{resource.name}"
+    first, last_id = 0, None
+    if args.get('_cursor'):
+        try:
+            values, _ = decode_cursor(args['_cursor'], scope=scope)
+            first, last_id = (int(value) for value in values)
+        except (CursorError, TypeError, ValueError):
+            raise FhirError('Invalid _cursor; start the search again')
+
+    # One row past the page tells whether there is a next one
+    matches = []
+    for index, source in enumerate(resource.sources[first:], first):
+        statement = _filtered(source, args, doctor_id)
+        if index == first and last_id is not None:
+            statement = statement.where(source.table.c.id > last_id)
+        rows = db.session.execute(statement.order_by(source.table.c.id).limit(count + 1 - len(matches))).all()
+        matches += [(index, source, row) for row in rows]
+        if len(matches) > count:
+            break
+    has_more = len(matches) > count
+    matches = matches[:count]
+
+    entries = [_entry(source.build(row), 'match') for _, source, row in matches]
+    includes = [name for value in args.getlist('_include') for name in value.split(',') if name]
+    entries += [_entry(included, 'include')
+                for included in _included(resource, [(source, row) for _, source, row in matches], includes)]
+
+    links = [{"relation": "self", "url": request.url}]
+    if has_more:
+        index, _, row = matches[-1]
+        next_args = {key: args.getlist(key) for key in args if key != '_cursor'}
+        next_args['_cursor'] = encode_cursor([index, row.id], 'next', scope)
+        links.append({"relation": "next", "url": url_for('main.fhir_search', resource_type=resource.name,
+                                                          _external=True, **next_args)})
+    bundle = {"resourceType": "Bundle", "type": "searchset", "link": links}
+    if entries:
+        bundle["entry"] = entries
+    return bundle
+
+
+def read(resource_type, resource_id, doctor_id):
+    """One resource by id, as long as it belongs to one of the doctor's patients."""
+    resource = get_resource(resource_type)
+    row_id = resource_id
+    for source in resource.more:
+        if resource_id.startswith(source.id_prefix):
+            resource, row_id = source, resource_id[len(source.id_prefix):]
+            break
+    table = resource.table
+    if resource.name != 'Patient':
+        if not row_id.isdigit():
+            raise FhirError(f"{resource_type}/{resource_id} not found", 404, 'not-found')
+        row_id = int(row_id)
+    row = db.session.execute(select(table).where(table.c.id == row_id)).first()
+    patient_id = row.id if row is not None and resource.name == 'Patient' else getattr(row, 'patient_id', None)
+    if row is None or not can_access_patient(doctor_id, patient_id):
+        raise FhirError(f"{resource_type}/{resource_id} not found", 404, 'not-found')
+    return resource.build(row)
+
+
+def capability_statement():
+    """The /metadata answer: which resources, interactions and search parameters are supported."""
+    resources = []
+    for resource in RESOURCES.values():
+        params = ['_id', '_count'] + (['patient'] if resource.name != 'Patient' else []) + list(resource.params)
+        resources.append({
+            "type": resource.name,
+            "interaction": [{"code": "read"}, {"code": "search-type"}],
+            "searchInclude": sorted(resource.includes),
+            "searchParam": [{"name": name, "type": _param_type(resource, name)} for name in params],
+        })
+    return {
+        "resourceType": "CapabilityStatement",
+        "status": "active",
+        "date": date.today().isoformat(),
+        "kind": "instance",
+        "fhirVersion": FHIR_VERSION,
+        "format": ["json"],
+        "rest": [{"mode": "server", "resource": resources,
+                  "interaction": [{"code": "transaction"}, {"code": "batch"}]}],
+    }
+
+
+def _param_type(resource, name):
+    if name == '_count':
+        return 'number'
+    if name == 'patient':
+        return 'reference'
+    spec = resource.params.get(name)
+    if spec is None or callable(spec):
+        return 'token' if name == '_id' else 'string'
+    return spec[0]
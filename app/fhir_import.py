@@ -0,0 +1,900 @@
+import json, time
+from collections import Counter
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from flask import current_app
+from sqlalchemy import String, insert, select
+from . import db
+from .cohorts import parse_quantity
+from .fhir import (ALLERGY_CATEGORIES, ENCOUNTER_CLASSES, ENCOUNTER_STATUSES, PATIENT_ID_SYSTEM, VITALS_ID_PREFIX, FhirError,
+                   operation_outcome)
+from .models import (AllergyIntolerance, Appointment, DoctorPatient, Immunization, MedicalHistory, MedicationStatement,
+                     Observation, Patient, Procedure, User, Visit, Vitals, VitalSample)
+from .patient_import import age_from_birthdate, insert_patients
+from .patient_summary import WATCHED_MODELS, refresh as refresh_summaries
+from .vitals_series import CANONICAL_UNITS, normalize_code, parse_vitals
+
+# FHIR import: resources of a transaction/batch Bundle or of NDJSON files are
+# parsed into rows, their Patient and Encounter references resolved with one
+# query per chunk, and each table written with multi-row INSERTs per chunk.
+# Core inserts skip the ORM listeners, so the search index, patient summaries
+# and vital samples are written here for the rows of every chunk.
+DEFAULT_CHUNK_SIZE = 1000
+# Issues kept for the report; the rest are only counted
+MAX_ISSUES = 100
+# SQLite allows 32766 bound parameters per statement
+MAX_STATEMENT_PARAMS = 30_000
+
+# FHIR codes -> stored values, the reverse of the maps in fhir.py
+ENCOUNTER_STATUS_VALUES = {code: value for value, code in ENCOUNTER_STATUSES.items()}
+ENCOUNTER_CLASS_VALUES = {code: value for value, (code, _) in ENCOUNTER_CLASSES.items()}
+ALLERGY_CATEGORY_VALUES = {code: value for value, code in ALLERGY_CATEGORIES.items() if value != 'environment'}
+GENDER_VALUES = {'male': 'male', 'female': 'female', 'other': 'other', 'unknown': 'other'}
+SYSTOLIC = '8480-6'
+DIASTOLIC = '8462-4'
+
+# Columns filled in from references once they are resolved, not by the parsers
+RESOLVED_COLUMNS = ('id', 'patient_id', 'visit_id', 'doctor_id', 'performer_id')
+# Order resources are written in, so references point at rows already written
+TYPE_ORDER = ('Patient', 'Encounter')
+
+
+class ImportIssue(Exception):
+    """A resource that cannot be imported; the message says why."""
+
+
+# Readers of FHIR elements. Missing elements read as None (or empty); an
+# element of the wrong JSON type is an ImportIssue naming it.
+def _json_type(value):
+    if isinstance(value, bool):
+        return 'a boolean'
+    if isinstance(value, (int, float)):
+        return 'a number'
+    return {str: 'a string', list: 'an array', dict: 'an object'}.get(type(value), type(value).__name__)
+
+
+def _object(value, element):
+    """`value`, checked to be an object; {} if missing."""
+    if value is None:
+        return {}
+    if not isinstance(value, dict):
+        raise ImportIssue(f"{element} must be an object, not {_json_type(value)}")
+    return value
+
+
+def _list(value, element):
+    """`value`, checked to be an array; [] if missing."""
+    if value is None:
+        return []
+    if not isinstance(value, list):
+        raise ImportIssue(f"{element} must be an array, not {_json_type(value)}")
+    return value
+
+
+def _objects(value, element):
+    return [_object(item, element) for item in _list(value, element)]
+
+
+def _string(value, element):
+    if value is not None and not isinstance(value, str):
+        raise ImportIssue(f"{element} must be a string, not {_json_type(value)}")
+    return value
+
+
+def _strings(value, element):
+    return [_string(item, element) for item in _list(value, element) if item is not None]
+
+
+def _first(items, element):
+    """The first object of an array, or None."""
+    items = _list(items, element)
+    return _object(items[0], element) if items else None
+
+
+def _code(concept, element):
+    coding = _first(_object(concept, element).get('coding'), f"{element}.coding") or {}
+    return _string(coding.get('code'), f"{element}.coding.code")
+
+
+def _text(concept, element):
+    concept = _object(concept, element)
+    if not concept:
+        return None
+    coding = _first(concept.get('coding'), f"{element}.coding") or {}
+    return (_string(concept.get('text'), f"{element}.text") or _string(coding.get('display'), f"{element}.coding.display")
+            or _string(coding.get('code'), f"{element}.coding.code"))
+
+
+def _notes(notes, element):
+    texts = [_string(note.get('text'), f"{element}.text") for note in _objects(notes, element)]
+    return '\n'.join(text for text in texts if text) or None
+
+
+def _phone(telecom, element):
+    """The value of the first phone ContactPoint."""
+    for item in _objects(telecom, element):
+        if item.get('system') == 'phone':
+            return _string(item.get('value'), f"{element}.value")
+    return None
+
+
+def _number(value):
+    return f"{value:g}" if isinstance(value, float) else str(value)
+
+
+def _decimal(quantity, element):
+    """The value of a Quantity, checked to be a number; None if missing."""
+    value = _object(quantity, element).get('value')
+    if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))):
+        raise ImportIssue(f"{element}.value must be a number, not {_json_type(value)}")
+    return value
+
+
+def _quantity(quantity, element):
+    """(number text, unit) of a Quantity, preferring its UCUM code as the unit."""
+    value = _decimal(quantity, element)
+    if value is None:
+        return None, None
+    return _number(value), _string(quantity.get('code'), f"{element}.code") or _string(quantity.get('unit'), f"{element}.unit")
+
+
+def _datetime(value, element):
+    """A naive UTC datetime from a FHIR date, dateTime or instant."""
+    if value is None:
+        return None
+    if not isinstance(value, str):
+        raise ImportIssue(f"{element} must be a dateTime")
+    text = value.strip()
+    try:
+        if len(text) == 4:
+            return datetime(int(text), 1, 1)
+        if len(text) == 7:
+            return datetime(int(text[:4]), int(text[5:7]), 1)
+        moment = datetime.fromisoformat(text.replace('Z', '+00:00'))
+    except ValueError:
+        raise ImportIssue(f"{element} {value!r} is not a valid dateTime")
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+
+def _date(value, element):
+    moment = _datetime(value, element)
+    return moment.date() if moment is not None else None
+
+
+def _reference_key(reference):
+    """('urn', uuid) for a reference within the Bundle, else (resource type, id)."""
+    if reference.startswith('urn:'):
+        return ('urn', reference)
+    parts = reference.rstrip('/').split('/')
+    if '_history' in parts:
+        parts = parts[:parts.index('_history')]
+    if len(parts) < 2 or not parts[-1]:
+        raise ImportIssue(f"Reference {reference!r} is not Type/id")
+    return (parts[-2], parts[-1])
+
+
+def _reference(value, element, resource_type):
+    """The key of a Patient or Encounter reference; patients can also be named by their MDHS identifier."""
+    if value is None:
+        return None
+    if not isinstance(value, dict):
+        raise ImportIssue(f"{element} must be a Reference")
+    reference = _string(value.get('reference'), f"{element}.reference")
+    if reference:
+        key = _reference_key(reference)
+        if key[0] not in (resource_type, 'urn'):
+            raise ImportIssue(f"{element} must refer to a {resource_type}")
+        return key
+    identifier = _object(value.get('identifier'), f"{element}.identifier")
+    number = _string(identifier.get('value'), f"{element}.identifier.value")
+    if resource_type == 'Patient' and identifier.get('system') == PATIENT_ID_SYSTEM and number:
+        return ('identifier', number)
+    raise ImportIssue(f"{element} must be a {resource_type}/<id> reference")
+
+
+def _practitioner(value, element):
+    """The key of a Practitioner reference, or None; practitioners are not imported, only matched to doctors."""
+    reference = _string(_object(value, element).get('reference'), f"{element}.reference") or ''
+    key = _reference_key(reference) if '/' in reference else None
+    return key if key is not None and key[0] == 'Practitioner' else None
+
+
+def _describe(key):
+    if key[0] == 'identifier':
+        return f"Patient with identifier {key[1]}"
+    return key[1] if key[0] == 'urn' else f"{key[0]}/{key[1]}"
+
+
+class Record:
+    """
+    A resource parsed into a row of `model`, waiting for its references:
+    `patient` and `encounter` are reference keys, `practitioner` fills
+    `practitioner_column`. `keys` are the references other resources can
+    use for it, once it is written.
+    """
+
+    def __init__(self, resource_type, model, row, patient=None, encounter=None, practitioner=None,
+                 practitioner_column=None):
+        self.resource_type = resource_type
+        self.model = model
+        self.row = row
+        self.patient = patient
+        self.encounter = encounter
+        self.practitioner = practitioner
+        self.practitioner_column = practitioner_column
+        self.location = None
+        self.keys = []
+
+
+def _patient(resource):
+    name = _first(resource.get('name'), 'Patient.name') or {}
+    given = ' '.join(_strings(name.get('given'), 'Patient.name.given')).strip()
+    family = (_string(name.get('family'), 'Patient.name.family') or '').strip()
+    if not given or not family:
+        raise ImportIssue('Patient.name needs a family and a given name')
+    gender = GENDER_VALUES.get(_string(resource.get('gender'), 'Patient.gender') or 'unknown')
+    if gender is None:
+        raise ImportIssue(f"Patient.gender {resource.get('gender')!r} is not a FHIR gender")
+    birthdate = _date(resource.get('birthDate'), 'Patient.birthDate')
+    address = _first(resource.get('address'), 'Patient.address') or {}
+    lines = _strings(address.get('line'), 'Patient.address.line') + [_string(address.get('city'), 'Patient.address.city')]
+    contact = _first(resource.get('contact'), 'Patient.contact') or {}
+    contact_name = _object(contact.get('name'), 'Patient.contact.name')
+    contact_names = (_strings(contact_name.get('given'), 'Patient.contact.name.given')
+                     + [_string(contact_name.get('family'), 'Patient.contact.name.family') or ''])
+    number = next((_string(item.get('value'), 'Patient.identifier.value')
+                   for item in _objects(resource.get('identifier'), 'Patient.identifier')
+                   if item.get('system') == PATIENT_ID_SYSTEM), None)
+    return Record('Patient', Patient, {
+        "id": None, "patient_id": number, "firstname": given, "lastname": family,
+        "age": str(age_from_birthdate(birthdate)) if birthdate else '', "birthdate": birthdate, "gender": gender,
+        "contact_number": _phone(resource.get('telecom'), 'Patient.telecom') or '',
+        "home_address": address.get('text') or ', '.join(line for line in lines if line),
+        "ecd_name": _string(contact_name.get('text'), 'Patient.contact.name.text') or ' '.join(contact_names).strip() or None,
+        "ecd_contact_number": _phone(contact.get('telecom'), 'Patient.contact.telecom'),
+    })
+
+
+def _encounter(resource):
+    status = ENCOUNTER_STATUS_VALUES.get(_string(resource.get('status'), 'Encounter.status'))
+    if status is None:
+        raise ImportIssue(f"Encounter.status {resource.get('status')!r} is not supported")
+    visit_date = _datetime(_object(resource.get('period'), 'Encounter.period').get('start'), 'Encounter.period.start')
+    if visit_date is None:
+        raise ImportIssue('Encounter.period.start is required')
+    reason = _first(resource.get('reasonCode'), 'Encounter.reasonCode')
+    diagnosis = _object((_first(resource.get('diagnosis'), 'Encounter.diagnosis') or {}).get('condition'),
+                        'Encounter.diagnosis.condition')
+    location = _object((_first(resource.get('location'), 'Encounter.location') or {}).get('location'),
+                       'Encounter.location.location')
+    participant = next((item.get('individual') for item in _objects(resource.get('participant'), 'Encounter.participant')
+                        if _practitioner(item.get('individual'), 'Encounter.participant.individual')), None)
+    class_code = _string(_object(resource.get('class'), 'Encounter.class').get('code'), 'Encounter.class.code')
+    return Record('Encounter', Visit, {
+        "patient_id": None, "doctor_id": None, "visit_date": visit_date,
+        "reason_code": _code(reason, 'Encounter.reasonCode') or _text(reason, 'Encounter.reasonCode'),
+        "diagnosis_code": diagnosis.get('display'),
+        "status": status, "class_code": ENCOUNTER_CLASS_VALUES.get(class_code, 'outpatient'),
+        "priority": _text(resource.get('priority'), 'Encounter.priority'), "location": location.get('display'), "notes": None,
+    }, patient=_reference(resource.get('subject'), 'Encounter.subject', 'Patient'),
+        practitioner=_practitioner(participant, 'Encounter.participant.individual'), practitioner_column='doctor_id')
+
+
+# value[x] types stored as text, with the Python type each must have
+OBSERVATION_VALUE_TYPES = (('valueString', str, 'a string'), ('valueInteger', int, 'an integer'),
+                           ('valueBoolean', bool, 'a boolean'))
+
+
+def _observation_value(resource):
+    """(value text, unit) of an Observation, blood pressure written systolic/diastolic."""
+    components = {_code(item.get('code'), 'Observation.component.code'): item.get('valueQuantity')
+                  for item in _objects(resource.get('component'), 'Observation.component')}
+    if SYSTOLIC in components and DIASTOLIC in components:
+        systolic, unit = _quantity(components[SYSTOLIC], 'Observation.component.valueQuantity')
+        diastolic, _ = _quantity(components[DIASTOLIC], 'Observation.component.valueQuantity')
+        if systolic is not None and diastolic is not None:
+            return f"{systolic}/{diastolic}", unit
+    if 'valueQuantity' in resource:
+        return _quantity(resource['valueQuantity'], 'Observation.valueQuantity')
+    if 'valueCodeableConcept' in resource:
+        return _text(resource['valueCodeableConcept'], 'Observation.valueCodeableConcept'), None
+    for key, kind, description in OBSERVATION_VALUE_TYPES:
+        if key in resource:
+            value = resource[key]
+            if not isinstance(value, kind) or (kind is int and isinstance(value, bool)):
+                raise ImportIssue(f"Observation.{key} must be {description}, not {_json_type(value)}")
+            return (str(value).lower() if isinstance(value, bool) else str(value)), None
+    return None, None
+
+
+def _observation(resource):
+    """An observation row, or a vitals row for a vital-signs Observation of a known vitals code."""
+    code = _code(resource.get('code'), 'Observation.code') or _text(resource.get('code'), 'Observation.code')
+    if not code:
+        raise ImportIssue('Observation.code is required')
+    categories = [_code(category, 'Observation.category')
+                  for category in _list(resource.get('category'), 'Observation.category')]
+    effective = _datetime(resource.get('effectiveDateTime') or resource.get('effectiveInstant')
+                          or _object(resource.get('effectivePeriod'), 'Observation.effectivePeriod').get('start'),
+                          'Observation.effective[x]')
+    value, unit = _observation_value(resource)
+    references = dict(patient=_reference(resource.get('subject'), 'Observation.subject', 'Patient'),
+                      encounter=_reference(resource.get('encounter'), 'Observation.encounter', 'Encounter'))
+
+    vitals_code = normalize_code(code) if 'vital-signs' in categories else None
+    if vitals_code in CANONICAL_UNITS:
+        if effective is None:
+            raise ImportIssue('Observation.effectiveDateTime is required for vital signs')
+        return Record('Observation', Vitals, {
+            "patient_id": None, "visit_id": None, "status": resource.get('status'), "category": 'vital-signs',
+            "code": vitals_code, "effective_date": effective, "value": value, "unit": unit,
+        }, **references)
+
+    if 'valueQuantity' in resource and value is not None:
+        # The number alone gives the code's default unit and reference range
+        value_numeric, unit, low, high = parse_quantity(code, value, unit)
+        value = f"{value} {unit}" if unit else value
+    else:
+        value_numeric, unit, low, high = parse_quantity(code, value)
+    reference_range = _first(resource.get('referenceRange'), 'Observation.referenceRange') or {}
+    if reference_range:
+        range_low = _decimal(reference_range.get('low'), 'Observation.referenceRange.low')
+        range_high = _decimal(reference_range.get('high'), 'Observation.referenceRange.high')
+        low = range_low if range_low is not None else low
+        high = range_high if range_high is not None else high
+    return Record('Observation', Observation, {
+        "patient_id": None, "visit_id": None, "code": code, "value": value, "status": resource.get('status'),
+        "category": categories[0] if categories else None, "effectiveDateTime": effective,
+        "value_numeric": value_numeric, "unit": unit, "reference_low": low, "reference_high": high,
+    }, **references)
+
+
+def _immunization(resource):
+    vaccine_code = (_code(resource.get('vaccineCode'), 'Immunization.vaccineCode')
+                    or _text(resource.get('vaccineCode'), 'Immunization.vaccineCode'))
+    if not vaccine_code:
+        raise ImportIssue('Immunization.vaccineCode is required')
+    occurred = _date(resource.get('occurrenceDateTime'), 'Immunization.occurrenceDateTime')
+    if occurred is None:
+        raise ImportIssue('Immunization.occurrenceDateTime is required')
+    dose, dose_unit = _quantity(resource.get('doseQuantity'), 'Immunization.doseQuantity')
+    return Record('Immunization', Immunization, {
+        "patient_id": None, "visit_id": None, "vaccine_code": vaccine_code, "status": resource.get('status'),
+        "date": occurred, "lot_number": resource.get('lotNumber'), "site": _text(resource.get('site'), 'Immunization.site'),
+        "route": _text(resource.get('route'), 'Immunization.route'),
+        "dose_quantity": f"{dose} {dose_unit or ''}".strip() if dose else None,
+        "manufacturer": _object(resource.get('manufacturer'), 'Immunization.manufacturer').get('display'),
+        "notes": _notes(resource.get('note'), 'Immunization.note'),
+    }, patient=_reference(resource.get('patient'), 'Immunization.patient', 'Patient'),
+        encounter=_reference(resource.get('encounter'), 'Immunization.encounter', 'Encounter'))
+
+
+def _allergy(resource):
+    substance = _text(resource.get('code'), 'AllergyIntolerance.code')
+    if not substance:
+        raise ImportIssue('AllergyIntolerance.code is required')
+    reaction = _first(resource.get('reaction'), 'AllergyIntolerance.reaction') or {}
+    manifestations = [_text(item, 'AllergyIntolerance.reaction.manifestation')
+                      for item in _list(reaction.get('manifestation'), 'AllergyIntolerance.reaction.manifestation')]
+    severity = reaction.get('severity') or ('severe' if resource.get('criticality') == 'high' else None)
+    categories = _strings(resource.get('category'), 'AllergyIntolerance.category')
+    return Record('AllergyIntolerance', AllergyIntolerance, {
+        "patient_id": None, "visit_id": None, "substance": substance,
+        "clinical_status": _code(resource.get('clinicalStatus'), 'AllergyIntolerance.clinicalStatus'),
+        "verification_status": _code(resource.get('verificationStatus'), 'AllergyIntolerance.verificationStatus'),
+        "severity": severity, "type": resource.get('type'),
+        "category": ALLERGY_CATEGORY_VALUES.get(categories[0]) if categories else None,
+        "reaction": '; '.join(text for text in manifestations if text) or None, "onset": None,
+    }, patient=_reference(resource.get('patient'), 'AllergyIntolerance.patient', 'Patient'),
+        encounter=_reference(resource.get('encounter'), 'AllergyIntolerance.encounter', 'Encounter'))
+
+
+def _medication(resource):
+    concept = resource.get('medicationCodeableConcept')
+    name = _text(concept, 'MedicationStatement.medicationCodeableConcept')
+    if not name:
+        raise ImportIssue('MedicationStatement.medicationCodeableConcept is required')
+    if not resource.get('status'):
+        raise ImportIssue('MedicationStatement.status is required')
+    period = _object(resource.get('effectivePeriod'), 'MedicationStatement.effectivePeriod')
+    dosage = _first(resource.get('dosage'), 'MedicationStatement.dosage') or {}
+    return Record('MedicationStatement', MedicationStatement, {
+        "patient_id": None, "visit_id": None,
+        "medication_code": _code(concept, 'MedicationStatement.medicationCodeableConcept') or name, "medication_name": name,
+        "status": resource['status'],
+        "effectivePeriod_start": _date(period.get('start') or resource.get('effectiveDateTime'),
+                                       'MedicationStatement.effective[x]'),
+        "effectivePeriod_end": _date(period.get('end'), 'MedicationStatement.effectivePeriod.end'),
+        "date_asserted": _date(resource.get('dateAsserted'), 'MedicationStatement.dateAsserted'),
+        "information_source": None, "adherence": None,
+        "reason_code": _text(_first(resource.get('reasonCode'), 'MedicationStatement.reasonCode'),
+                             'MedicationStatement.reasonCode'),
+        "reason_reference": None,
+        "status_reason": _text(_first(resource.get('statusReason'), 'MedicationStatement.statusReason'),
+                               'MedicationStatement.statusReason'),
+        "dosage_instruction": dosage.get('text'), "notes": _notes(resource.get('note'), 'MedicationStatement.note'),
+        "category": _text(resource.get('category'), 'MedicationStatement.category') or 'outpatient',
+        "route_of_administration": _text(dosage.get('route'), 'MedicationStatement.dosage.route'),
+        "timing": dosage.get('patientInstruction'),
+    }, patient=_reference(resource.get('subject'), 'MedicationStatement.subject', 'Patient'),
+        encounter=_reference(resource.get('context'), 'MedicationStatement.context', 'Encounter'))
+
+
+def _procedure(resource):
+    performer = next((item.get('actor') for item in _objects(resource.get('performer'), 'Procedure.performer')
+                      if _practitioner(item.get('actor'), 'Procedure.performer.actor')), None)
+    performed = (resource.get('performedDateTime')
+                 or _object(resource.get('performedPeriod'), 'Procedure.performedPeriod').get('start'))
+    return Record('Procedure', Procedure, {
+        "patient_id": None, "visit_id": None, "status": resource.get('status'),
+        "category": _text(resource.get('category'), 'Procedure.category'),
+        "code": _code(resource.get('code'), 'Procedure.code') or _text(resource.get('code'), 'Procedure.code'),
+        "performed_date": _date(performed, 'Procedure.performed[x]'),
+        "performer_id": None,
+        "reason_code": _text(_first(resource.get('reasonCode'), 'Procedure.reasonCode'), 'Procedure.reasonCode'),
+        "outcome": _text(resource.get('outcome'), 'Procedure.outcome'), "report": _notes(resource.get('note'), 'Procedure.note'),
+    }, patient=_reference(resource.get('subject'), 'Procedure.subject', 'Patient'),
+        encounter=_reference(resource.get('encounter'), 'Procedure.encounter', 'Encounter'),
+        practitioner=_practitioner(performer, 'Procedure.performer.actor'), practitioner_column='performer_id')
+
+
+def _condition(resource):
+    code = _text(resource.get('code'), 'Condition.code')
+    if not code:
+        raise ImportIssue('Condition.code is required')
+    onset = _date(resource.get('onsetDateTime') or _object(resource.get('onsetPeriod'), 'Condition.onsetPeriod').get('start'),
+                  'Condition.onset[x]')
+    abatement = _date(resource.get('abatementDateTime')
+                      or _object(resource.get('abatementPeriod'), 'Condition.abatementPeriod').get('end'),
+                      'Condition.abatement[x]')
+    # Both dates are required by the medical_history table
+    if onset is None or abatement is None:
+        raise ImportIssue('Condition.onsetDateTime and Condition.abatementDateTime are required')
+    return Record('Condition', MedicalHistory, {
+        "patient_id": None, "doctor_id": None, "visit_id": None,
+        "clinical_status": _code(resource.get('clinicalStatus'), 'Condition.clinicalStatus') or 'active',
+        "verification_status": _code(resource.get('verificationStatus'), 'Condition.verificationStatus') or 'unconfirmed',
+        "category": _code(_first(resource.get('category'), 'Condition.category'), 'Condition.category')
+        or 'problem-list-item', "code": code,
+        "onset_date": onset, "abatement_date": abatement, "notes": _notes(resource.get('note'), 'Condition.note') or '',
+    }, patient=_reference(resource.get('subject'), 'Condition.subject', 'Patient'),
+        encounter=_reference(resource.get('encounter'), 'Condition.encounter', 'Encounter'),
+        practitioner=_practitioner(resource.get('recorder'), 'Condition.recorder'), practitioner_column='doctor_id')
+
+
+def _appointment(resource):
+    if not resource.get('status'):
+        raise ImportIssue('Appointment.status is required')
+    start = _datetime(resource.get('start'), 'Appointment.start')
+    if start is None:
+        raise ImportIssue('Appointment.start is required')
+    patient = practitioner = participant_status = None
+    for item in _objects(resource.get('participant'), 'Appointment.participant'):
+        actor = _object(item.get('actor'), 'Appointment.participant.actor')
+        if _practitioner(actor, 'Appointment.participant.actor'):
+            practitioner, participant_status = _practitioner(actor, 'Appointment.participant.actor'), item.get('status')
+        elif actor:
+            patient = _reference(actor, 'Appointment.participant.actor', 'Patient')
+    return Record('Appointment', Appointment, {
+        "patient_id": None, "visit_id": None, "doctor_id": None, "status": resource['status'],
+        "service_category": _text(_first(resource.get('serviceCategory'), 'Appointment.serviceCategory'),
+                                  'Appointment.serviceCategory'),
+        "service_type": _text(_first(resource.get('serviceType'), 'Appointment.serviceType'), 'Appointment.serviceType'),
+        "specialty": _text(_first(resource.get('specialty'), 'Appointment.specialty'), 'Appointment.specialty'),
+        "appointment_type": _text(resource.get('appointmentType'), 'Appointment.appointmentType'),
+        "reason_code": _text(_first(resource.get('reasonCode'), 'Appointment.reasonCode'), 'Appointment.reasonCode'),
+        "priority": None, "start": start, "end": _datetime(resource.get('end'), 'Appointment.end'),
+        "participant_actor": None, "participant_status": participant_status,
+    }, patient=patient, practitioner=practitioner, practitioner_column='doctor_id')
+
+
+PARSERS = {
+    'Patient': _patient,
+    'Encounter': _encounter,
+    'Observation': _observation,
+    'Immunization': _immunization,
+    'AllergyIntolerance': _allergy,
+    'MedicationStatement': _medication,
+    'Procedure': _procedure,
+    'Condition': _condition,
+    'Appointment': _appointment,
+}
+# Tables written after patients and visits, in this order
+RECORD_MODELS = (Observation, Vitals, Immunization, AllergyIntolerance, MedicationStatement, Procedure, MedicalHistory,
+                 Appointment)
+
+
+def _check(record):
+    """Reject values the table would: missing required columns and strings that are too long."""
+    for column in record.model.__table__.columns:
+        value = record.row.get(column.name)
+        if value is None:
+            if column.name in record.row and not column.nullable and column.name not in RESOLVED_COLUMNS:
+                raise ImportIssue(f"{record.resource_type} has no value for {column.table.name}.{column.name}")
+        elif isinstance(column.type, String):
+            if not isinstance(value, str):
+                raise ImportIssue(f"{column.table.name}.{column.name} must be a string, not {_json_type(value)}")
+            if column.type.length and len(value) > column.type.length:
+                raise ImportIssue(f"{column.table.name}.{column.name} holds at most {column.type.length} characters")
+
+
+def parse(resource, full_url=None):
+    """The Record of one resource, or an ImportIssue."""
+    if not isinstance(resource, dict) or not resource.get('resourceType') or not isinstance(resource['resourceType'], str):
+        raise ImportIssue('Not a FHIR resource')
+    parser = PARSERS.get(resource['resourceType'])
+    if parser is None:
+        raise ImportIssue(f"Importing {resource['resourceType']} is not supported")
+    record = parser(resource)
+    if record.model in (Observation, Vitals, Immunization, AllergyIntolerance, MedicationStatement, Procedure):
+        if record.encounter is None:
+            raise ImportIssue(f"{record.resource_type} needs an encounter: the table requires a visit")
+    if record.patient is None and record.encounter is None and record.model is not Patient:
+        raise ImportIssue(f"{record.resource_type} needs a subject")
+    _check(record)
+    if resource.get('id'):
+        record.keys.append((record.resource_type, _string(resource['id'], f"{record.resource_type}.id")))
+    if full_url:
+        record.keys.append(_reference_key(_string(full_url, 'Bundle.entry.fullUrl')))
+    return record
+
+
+def _insert_values(connection, table, rows):
+    """
+    Insert `rows` as one executemany of a single compiled INSERT: PyMySQL
+    sends it as multi-row INSERT ... VALUES statements and SQLite reuses
+    one prepared statement. insert().values(rows) would compile a bind
+    parameter per value, which costs more than the database write.
+    """
+    if rows:
+        connection.execute(insert(table), rows)
+
+
+def _insert_with_ids(connection, table, rows):
+    """
+    Insert rows with an AUTO_INCREMENT key and return their ids in order.
+
+    Where the database has RETURNING (SQLite, MariaDB) SQLAlchemy batches
+    the rows into multi-row INSERT ... RETURNING statements. MySQL has none. A multi-row INSERT whose row count is known
+    gets consecutive AUTO_INCREMENT values (innodb_autoinc_lock_mode 1 and
+    2 alike), starting at the lastrowid MySQL reports; SQLite reports the
+    last one. The ids are checked against the rows before they are used.
+    """
+    if connection.dialect.insert_executemany_returning_sort_by_parameter_order:
+        return list(connection.execute(insert(table).returning(table.c.id, sort_by_parameter_order=True), rows).scalars())
+    ids = []
+    per_statement = max(1, MAX_STATEMENT_PARAMS // len(rows[0])) if rows else 1
+    for start in range(0, len(rows), per_statement):
+        batch = rows[start:start + per_statement]
+        lastrowid = connection.execute(insert(table).values(batch)).lastrowid
+        first = lastrowid - len(batch) + 1 if connection.dialect.name == 'sqlite' else lastrowid
+        written = connection.execute(
+            select(table.c.id, table.c.patient_id).where(table.c.id.between(first, first + len(batch) - 1))
+            .order_by(table.c.id)
+        ).all()
+        if [tuple(row) for row in written] != [(first + offset, row['patient_id']) for offset, row in enumerate(batch)]:
+            raise RuntimeError(f"Could not match the ids of {table.name} rows; is auto_increment_increment 1?")
+        ids += [first + offset for offset in range(len(batch))]
+    return ids
+
+
+class Importer:
+    """
+    Writes parsed resources in chunks of `chunk_size`.
+
+    New patients are linked to `doctor_id`, who is also the doctor of
+    visits, conditions and appointments whose practitioner is not one of
+    the doctors here. With `restrict`, references to existing patients and
+    visits resolve only for that doctor's patients. With `commit_chunks`
+    every chunk is committed on its own, so a large import holds one chunk
+    in memory and in the transaction at a time. References resolve against
+    existing rows and against resources written earlier by this importer,
+    so files must list patients before their encounters and records.
+    """
+
+    def __init__(self, doctor_id, restrict=True, chunk_size=None, commit_chunks=True, track=False, report=None):
+        self.doctor_id = doctor_id
+        self.restrict = restrict
+        self.chunk_size = chunk_size or current_app.config.get('IMPORT_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
+        self.commit_chunks = commit_chunks
+        self.track = track
+        self.report = report
+        self.pending = []
+        # Reference keys of the patients and visits written so far -> patient id / (visit id, patient id)
+        self.created = {}
+        self.counts = Counter()
+        self.failed = 0
+        self.issues = []
+        self.outcomes = {}
+        self.started = time.perf_counter()
+
+    @property
+    def imported(self):
+        return sum(self.counts.values())
+
+    def issue(self, location, message):
+        self.failed += 1
+        if len(self.issues) < MAX_ISSUES:
+            self.issues.append((location, message))
+        if self.track:
+            self.outcomes[location] = message
+
+    def parse(self, resource, location, full_url=None):
+        try:
+            record = parse(resource, full_url)
+        except ImportIssue as issue:
+            self.issue(location, str(issue))
+            return None
+        except Exception:
+            # Some shape of valid JSON the readers do not check; one resource must not stop the import
+            current_app.logger.exception("Could not read the FHIR resource at %s", location)
+            self.issue(location, 'The resource could not be read')
+            return None
+        record.location = location
+        return record
+
+    def append(self, record):
+        self.pending.append(record)
+        if len(self.pending) >= self.chunk_size:
+            self.flush()
+
+    def add(self, resource, location, full_url=None):
+        record = self.parse(resource, location, full_url)
+        if record is not None:
+            self.append(record)
+
+    def finish(self):
+        self.flush()
+        return self
+
+    def _allowed(self, connection, patient_ids):
+        if not self.restrict or not patient_ids:
+            return set(patient_ids)
+        return set(connection.execute(
+            select(DoctorPatient.patient_id)
+            .where(DoctorPatient.doctor_id == self.doctor_id, DoctorPatient.patient_id.in_(patient_ids))
+        ).scalars())
+
+    def _patients(self, connection, keys):
+        found = {key: self.created[key] for key in keys if key in self.created}
+        missing = keys - found.keys()
+        existing = {}
+        ids = [key[1] for key in missing if key[0] == 'Patient']
+        if ids:
+            for (patient_id,) in connection.execute(select(Patient.id).where(Patient.id.in_(ids))):
+                existing[('Patient', patient_id)] = patient_id
+        numbers = [key[1] for key in missing if key[0] == 'identifier']
+        if numbers:
+            for patient_id, number in connection.execute(
+                    select(Patient.id, Patient.patient_id).where(Patient.patient_id.in_(numbers))):
+                existing[('identifier', number)] = patient_id
+        allowed = self._allowed(connection, set(existing.values()))
+        found.update((key, patient_id) for key, patient_id in existing.items() if patient_id in allowed)
+        return found
+
+    def _visits(self, connection, keys):
+        found = {key: self.created[key] for key in keys if key in self.created}
+        ids = [int(key[1]) for key in keys - found.keys() if key[0] == 'Encounter' and key[1].isdigit()]
+        if ids:
+            existing = {('Encounter', str(visit_id)): (visit_id, patient_id) for visit_id, patient_id in
+                        connection.execute(select(Visit.id, Visit.patient_id).where(Visit.id.in_(ids)))}
+            allowed = self._allowed(connection, {patient_id for _, patient_id in existing.values()})
+            found.update((key, visit) for key, visit in existing.items() if visit[1] in allowed)
+        return found
+
+    def _doctors(self, connection, keys):
+        ids = [key[1] for key in keys]
+        if not ids:
+            return {}
+        return {('Practitioner', doctor_id): doctor_id for (doctor_id,) in connection.execute(
+            select(User.id).where(User.id.in_(ids), User.role == 'doctor'))}
+
+    def _resolve(self, connection, records):
+        """Fill in the patient, visit and doctor ids of `records`; returns those whose references all resolved."""
+        patients = self._patients(connection, {record.patient for record in records if record.patient})
+        visits = self._visits(connection, {record.encounter for record in records if record.encounter})
+        doctors = self._doctors(connection, {record.practitioner for record in records if record.practitioner})
+        resolved = []
+        for record in records:
+            visit = None
+            if record.encounter:
+                visit = visits.get(record.encounter)
+                if visit is None:
+                    self.issue(record.location, f"{_describe(record.encounter)} not found")
+                    continue
+            patient_id = visit[1] if visit else None
+            if record.patient:
+                patient_id = patients.get(record.patient)
+                if patient_id is None:
+                    self.issue(record.location, f"{_describe(record.patient)} not found")
+                    continue
+                if visit and visit[1] != patient_id:
+                    self.issue(record.location, f"{_describe(record.encounter)} belongs to another patient")
+                    continue
+            record.row['patient_id'] = patient_id
+            if 'visit_id' in record.row:
+                record.row['visit_id'] = visit[0] if visit else None
+            if record.practitioner_column:
+                default = self.doctor_id if record.practitioner_column == 'doctor_id' else None
+                record.row[record.practitioner_column] = doctors.get(record.practitioner, default)
+            resolved.append(record)
+        return resolved
+
+    def _written(self, record, record_id, register=None):
+        self.counts[record.resource_type] += 1
+        for key in record.keys:
+            self.created[key] = register if register is not None else record_id
+        if self.track:
+            location_id = f"{VITALS_ID_PREFIX}{record_id}" if record.model is Vitals else record_id
+            self.outcomes[record.location] = (record.resource_type, location_id)
+
+    def _write_patients(self, connection, records):
+        numbers = [record.row['patient_id'] for record in records if record.row['patient_id']]
+        taken = set(connection.execute(
+            select(Patient.patient_id).where(Patient.patient_id.in_(numbers))).scalars()) if numbers else set()
+        accepted = []
+        for record in records:
+            number = record.row['patient_id']
+            if number:
+                if number in taken:
+                    self.issue(record.location, f"Patient identifier {number} is already in use")
+                    continue
+                taken.add(number)
+            accepted.append(record)
+        if not accepted:
+            return []
+
+        insert_patients(connection, [record.row for record in accepted], self.doctor_id)
+        for record in accepted:
+            record.keys.append(('identifier', record.row['patient_id']))
+            self._written(record, record.row['id'])
+        return accepted
+
+    def flush(self):
+        """Write the pending resources: patients, then visits, then everything else."""
+        records, self.pending = self.pending, []
+        if not records:
+            return
+        connection = db.session.connection()
+        self._write_patients(connection, [record for record in records if record.model is Patient])
+
+        changes = {}
+        visits = self._resolve(connection, [record for record in records if record.model is Visit])
+        if visits:
+            for record, visit_id in zip(visits, _insert_with_ids(connection, Visit.__table__, [r.row for r in visits])):
+                self._written(record, visit_id, register=(visit_id, record.row['patient_id']))
+                changes.setdefault(record.row['patient_id'], set()).add('visits')
+
+        others = self._resolve(connection, [record for record in records if record.model not in (Patient, Visit)])
+        for model in RECORD_MODELS:
+            batch = [record for record in others if record.model is model]
+            if not batch:
+                continue
+            rows = [record.row for record in batch]
+            if self.track or model is Vitals:
+                ids = _insert_with_ids(connection, model.__table__, rows)
+            else:
+                # Nobody asks for the ids of these rows
+                _insert_values(connection, model.__table__, rows)
+                ids = [None] * len(rows)
+            for record, record_id in zip(batch, ids):
+                self._written(record, record_id)
+                if model in WATCHED_MODELS:
+                    changes.setdefault(record.row['patient_id'], set()).add(WATCHED_MODELS[model][0])
+            if model is Vitals:
+                samples = [parse_vitals(SimpleNamespace(id=record_id, **record.row))
+                           for record, record_id in zip(batch, ids)]
+                _insert_values(connection, VitalSample.__table__, [sample for sample in samples if sample])
+
+        if changes:
+            refresh_summaries(connection, changes)
+        if self.commit_chunks:
+            db.session.commit()
+        if self.report is not None:
+            self.report(self)
+
+    def rate(self):
+        """Resources written per second so far."""
+        return self.imported / max(time.perf_counter() - self.started, 1e-9)
+
+    def error_text(self, limit=10):
+        text = '; '.join(f"{location}: {message}" for location, message in self.issues[:limit])
+        return text + (f" (and {self.failed - limit} more)" if self.failed > limit else '')
+
+    def outcome(self):
+        """An OperationOutcome reporting what was imported and what was not."""
+        counts = ', '.join(f"{count} {name}" for name, count in sorted(self.counts.items())) or 'nothing'
+        outcome = operation_outcome(f"Imported {counts} ({self.rate():.0f} resources/s); {self.failed} failed",
+                                    'informational')
+        outcome["issue"][0]["severity"] = 'information'
+        outcome["issue"] += [{"severity": "error", "code": "processing", "diagnostics": message,
+                              "expression": [location]} for location, message in self.issues]
+        return outcome
+
+
+def _type_rank(resource_type):
+    return TYPE_ORDER.index(resource_type) if resource_type in TYPE_ORDER else len(TYPE_ORDER)
+
+
+def import_bundle(bundle, doctor_id, restrict=True, chunk_size=None):
+    """
+    Process a transaction or batch Bundle of creates and return the
+    response Bundle. A transaction is written in one database transaction
+    and fails as a whole; a batch writes every entry it can.
+    """
+    if not isinstance(bundle, dict) or bundle.get('resourceType') != 'Bundle':
+        raise FhirError('Expected a Bundle')
+    kind = bundle.get('type')
+    if kind not in ('transaction', 'batch'):
+        raise FhirError(f"Bundle type {kind!r} is not supported; use transaction or batch")
+    entries = bundle.get('entry') or []
+    if not isinstance(entries, list):
+        raise FhirError('Bundle.entry must be an array')
+    importer = Importer(doctor_id, restrict, chunk_size, commit_chunks=False, track=True)
+
+    records = []
+    for index, entry in enumerate(entries):
+        location = f"Bundle.entry[{index}]"
+        try:
+            entry = _object(entry, location)
+            method = _object(entry.get('request'), f"{location}.request").get('method', 'POST')
+        except ImportIssue as issue:
+            importer.issue(location, str(issue))
+            continue
+        if method != 'POST':
+            importer.issue(location, f"{method} entries are not supported, only POST (create)")
+            continue
+        record = importer.parse(entry.get('resource'), location, entry.get('fullUrl'))
+        if record is not None:
+            records.append(record)
+    if kind == 'transaction' and importer.failed:
+        raise FhirError(f"Transaction failed: {importer.error_text()}", 400, 'processing')
+
+    # Patients and encounters first, so the other entries can refer to them in any order
+    for record in sorted(records, key=lambda record: _type_rank(record.resource_type)):
+        importer.append(record)
+    try:
+        importer.finish()
+    except Exception:
+        db.session.rollback()
+        raise
+    if kind == 'transaction' and importer.failed:
+        db.session.rollback()
+        raise FhirError(f"Transaction failed: {importer.error_text()}", 400, 'processing')
+    db.session.commit()
+
+    response = []
+    for index in range(len(entries)):
+        outcome = importer.outcomes.get(f"Bundle.entry[{index}]")
+        if isinstance(outcome, tuple):
+            resource_type, record_id = outcome
+            result = {"status": "201 Created"}
+            if record_id is not None:
+                result["location"] = f"{resource_type}/{record_id}"
+        else:
+            result = {"status": "400 Bad Request", "outcome": operation_outcome(outcome or 'Not processed', 'processing')}
+        response.append({"response": result})
+    bundle = {"resourceType": "Bundle", "type": f"{kind}-response"}
+    if response:
+        bundle["entry"] = response
+    return bundle
+
+
+def import_ndjson(lines, importer, source=''):
+    """Feed the resources of an NDJSON stream, one per line, to `importer`."""
+    for number, line in enumerate(lines, 1):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.strip()
+        if not line:
+            continue
+        location = f"{source}line {number}"
+        try:
+            resource = json.loads(line)
+        except ValueError:
+            importer.issue(location, 'Not valid JSON')
+            continue
+        importer.add(resource, location)
+    return importer
@@ -3,7 +3,8 @@ from flask_wtf import FlaskForm
 from wtforms import StringField,FormField,FileField, FieldList,DateTimeField,TextAreaField, DateField, PasswordField, SelectField, TelField, SubmitField, HiddenField, EmailField, IntegerField, RadioField
 from wtforms.validators import DataRequired, Email, EqualTo, Length, Regexp, NumberRange, Optional, ValidationError
 from datetime import date, datetime
-from .models import MedicationStatement, Observation, AllergyIntolerance, Vitals, Procedure,Appointment, MedicalHistory, Immunization, User, Visit
+from .models import User
+from . import terminology
 from flask_wtf.file import FileAllowed, FileRequired
 
 class RegisterForm(FlaskForm):
@@ -119,13 +120,13 @@ class MedicationStatementForm(FlaskForm):
         super(MedicationStatementForm, self).__init__(*args, **kwargs)
         
         # Dynamically populate choices for status
-        self.status.choices = [(status['code'], status['display']) for status in MedicationStatement.get_status_codes()]
+        self.status.choices = terminology.choices('medication_statement.status')
 
         # Dynamically populate choices for adherence
-        self.adherence.choices = [(adherence['code'], adherence['display']) for adherence in MedicationStatement.get_adherence_codes()]
+        self.adherence.choices = terminology.choices('medication_statement.adherence')
 
         # Dynamically populate choices for category
-        self.category.choices = [(adherence['code'], adherence['display']) for adherence in MedicationStatement.get_category_codes()]
+        self.category.choices = terminology.choices('medication_statement.category')
 
 class VisitForm(FlaskForm):
     patient_id = HiddenField('Patient ID', validators=[DataRequired()])
@@ -149,16 +150,16 @@ class ObservationForm(FlaskForm):
         super(ObservationForm, self).__init__(*args, **kwargs)
         
         # Dynamically populate choices for status
-        self.status.choices = [(status['code'], status['display']) for status in Observation.get_status_options()]
+        self.status.choices = terminology.choices('observation.status')
         # Dynamically populate choices for status
     
         
         # Dynamically populate choices for category
         # Dynamically populate choices for status
-        self.category.choices = [(category['code'], category['display']) for category in Observation.get_category_options()]
+        self.category.choices = terminology.choices('observation.category')
         
         # Dynamically populate choices for code
-        self.code.choices = [(code['code'], code['display']) for code in Observation.get_code_options()]
+        self.code.choices = terminology.choices('observation.code')
 
 class ProcedureForm(FlaskForm):
     patient_id = StringField('Patient ID', validators=[DataRequired()])
@@ -173,12 +174,9 @@ class ProcedureForm(FlaskForm):
 
     def __init__(self, *args, **kwargs):
         super(ProcedureForm, self).__init__(*args, **kwargs)
-        self.status.choices = [(
-            status['code'], status['display']) for status in Procedure.get_status_options()]
-        self.category.choices = [(
-            category['code'], category['display']) for category in Procedure.get_category_options()]
-        self.outcome.choices = [(
-            outcome['code'], outcome['display']) for outcome in Procedure.get_outcome_options()]
+        self.status.choices = terminology.choices('procedure.status')
+        self.category.choices = terminology.choices('procedure.category')
+        self.outcome.choices = terminology.choices('procedure.outcome')
 
 class VitalsForm(FlaskForm):
     patient_id = StringField('Patient ID', validators=[DataRequired()])
@@ -192,10 +190,10 @@ class VitalsForm(FlaskForm):
 
     def __init__(self, *args, **kwargs):
         super(VitalsForm, self).__init__(*args, **kwargs)
-        self.status.choices = [(status['code'], status['display']) for status in Vitals.get_status_options()]
-        self.category.choices = [(category['code'], category['display']) for category in Vitals.get_category_options()]
-        self.unit.choices = [(unit['code'], unit['display']) for unit in Vitals.get_unit_options()]
-        self.code.choices = [(code['code'], code['display']) for code in Vitals.get_code_options()]
+        self.status.choices = terminology.choices('vitals.status')
+        self.category.choices = terminology.choices('vitals.category')
+        self.unit.choices = terminology.choices('vitals.unit')
+        self.code.choices = terminology.choices('vitals.code')
 
 class AllergyIntoleranceForm(FlaskForm):
     # Hidden fields for patient and visit IDs
@@ -217,11 +215,11 @@ class AllergyIntoleranceForm(FlaskForm):
         super(AllergyIntoleranceForm, self).__init__(*args, **kwargs)
         
         # Dynamically load the choices for clinical_status, verification_status, severity, and category
-        self.clinical_status.choices = [(status['code'], status['display']) for status in AllergyIntolerance.get_clinical_status_codes()]
-        self.verification_status.choices = [(status['code'], status['display']) for status in AllergyIntolerance.get_verification_status_codes()]
-        self.severity.choices = [(severity['code'], severity['display']) for severity in AllergyIntolerance.get_severity_levels()]
-        self.category.choices = [(category['code'], category['display']) for category in AllergyIntolerance.get_category_options()]
-        self.onset.choices = [(onset['code'], onset['display']) for onset in AllergyIntolerance.get_onset_choices()]
+        self.clinical_status.choices = terminology.choices('allergy_intolerance.clinical_status')
+        self.verification_status.choices = terminology.choices('allergy_intolerance.verification_status')
+        self.severity.choices = terminology.choices('allergy_intolerance.severity')
+        self.category.choices = terminology.choices('allergy_intolerance.category')
+        self.onset.choices = terminology.choices('allergy_intolerance.onset')
 
 class ImmunizationForm(FlaskForm):
     visit_id = HiddenField('Visit ID', validators=[Optional()])
@@ -240,10 +238,10 @@ class ImmunizationForm(FlaskForm):
     def __init__(self, *args, **kwargs):
         super(ImmunizationForm, self).__init__(*args, **kwargs)
         
-        self.vaccine_code.choices = [(item["code"], item["display"]) for item in Immunization.get_vaccine_codes()]
-        self.status.choices = [(item["code"], item["display"]) for item in Immunization.get_status_codes()]
-        self.site.choices = [(item["code"], item["display"]) for item in Immunization.get_site_options()]
-        self.route.choices = [(item["code"], item["display"]) for item in Immunization.get_route_options()]
+        self.vaccine_code.choices = terminology.choices('immunization.vaccine_code')
+        self.status.choices = terminology.choices('immunization.status')
+        self.site.choices = terminology.choices('immunization.site')
+        self.route.choices = terminology.choices('immunization.route')
 
 class MedicalHistoryForm(FlaskForm):
     patient_id = HiddenField('Patient ID', validators=[DataRequired()])
@@ -259,10 +257,10 @@ class MedicalHistoryForm(FlaskForm):
 
     def __init__(self, *args, **kwargs):
         super(MedicalHistoryForm, self).__init__(*args, **kwargs)
-        self.clinical_status.choices = [(status['code'], status['display']) for status in MedicalHistory.get_clinical_status_options()]
-        self.verification_status.choices = [(status['code'], status['display']) for status in MedicalHistory.get_verification_status_options()]
-        self.category.choices = [(category['code'], category['display']) for category in MedicalHistory.get_category_options()]
-        self.code.choices = [(code['code'], code['display']) for code in MedicalHistory.get_code_options()]
+        self.clinical_status.choices = terminology.choices('medical_history.clinical_status')
+        self.verification_status.choices = terminology.choices('medical_history.verification_status')
+        self.category.choices = terminology.choices('medical_history.category')
+        self.code.choices = terminology.choices('medical_history.code')
 
 class AppointmentForm(FlaskForm):
     id = HiddenField('Appointment ID', validators=[Optional()])
@@ -285,29 +283,29 @@ class AppointmentForm(FlaskForm):
         super(AppointmentForm, self).__init__(*args, **kwargs)
 
         # Dynamically populate choices for status
-        self.status.choices = [(status['code'], status['display']) for status in Appointment.get_status_options()]
+        self.status.choices = terminology.choices('appointment.status')
 
         # Dynamically populate choices for appointment type
-        self.appointment_type.choices = [(atype['code'], atype['display']) for atype in Appointment.get_appointment_types()]
+        self.appointment_type.choices = terminology.choices('appointment.appointment_type')
 
         # Dynamically populate choices for priority
-        self.priority.choices = [(priority['code'], priority['display']) for priority in Appointment.get_priority_options()]
+        self.priority.choices = terminology.choices('appointment.priority')
         # Dynamically populate choices for service category
-        self.service_category.choices = [(category['code'], category['display']) for category in Appointment.get_service_categories()]
+        self.service_category.choices = terminology.choices('appointment.service_category')
 
         # Dynamically populate choices for service type
-        self.service_type.choices = [(service['code'], service['display']) for service in Appointment.get_service_types()]
+        self.service_type.choices = terminology.choices('appointment.service_type')
 
         # Dynamically populate choices for specialty
-        self.specialty.choices = [(specialty['code'], specialty['display']) for specialty in Appointment.get_specialties()]
+        self.specialty.choices = terminology.choices('appointment.specialty')
 
         # Dynamically populate choices for participant actor
-        self.participant_actor.choices = [(actor['code'], actor['display']) for actor in Appointment.get_participant_actors()]
+        self.participant_actor.choices = terminology.choices('appointment.participant_actor')
 
         # Dynamically populate choices for participant status
-        self.participant_status.choices = [(status['code'], status['display']) for status in Appointment.get_participant_statuses()]
+        self.participant_status.choices = terminology.choices('appointment.participant_status')
 
-        self.reason_code.choices = [(status['code'], status['display']) for status in Appointment.get_reason_codes()]
+        self.reason_code.choices = terminology.choices('appointment.reason_code')
 
 class AddVisitForm(FlaskForm):
     visit_date = DateField('Visit Date', default=date.today, validators=[DataRequired()])
@@ -325,11 +323,11 @@ class AddVisitForm(FlaskForm):
         super(AddVisitForm, self).__init__(*args, **kwargs)
 
         # Populate dynamic fields using model methods
-        self.reason_code.choices = [(item["code"], item["display"]) for item in Visit.get_reason_codes()]
-        self.status.choices = [(item["code"], item["display"]) for item in Visit.get_status_codes()]
-        self.class_code.choices = [(item["code"], item["display"]) for item in Visit.get_class_codes()]
-        self.priority.choices = [(item["code"], item["display"]) for item in Visit.get_priority_codes()]
-        self.location.choices = [(item["code"], item["display"]) for item in Visit.get_locations()]
+        self.reason_code.choices = terminology.choices('visit.reason_code')
+        self.status.choices = terminology.choices('visit.status')
+        self.class_code.choices = terminology.choices('visit.class_code')
+        self.priority.choices = terminology.choices('visit.priority')
+        self.location.choices = terminology.choices('visit.location')
         
 class SurveyForm(FlaskForm):
     q1 = RadioField('I think that I would like to use this system frequently.',
@@ -371,6 +369,13 @@ class UploadDocumentForm(FlaskForm):
         FileAllowed(['pdf', 'doc', 'docx'], 'Only PDF, DOC, and DOCX files are allowed!')
     ])
 
+class PatientImportForm(FlaskForm):
+    roster_file = FileField('Patient Roster (CSV)', validators=[
+        FileRequired(),
+        FileAllowed(['csv'], 'Only CSV files are allowed!')
+    ])
+    submit = SubmitField('Import Patients')
+
 class RequestResetForm(FlaskForm):
     email = StringField('Email', validators=[DataRequired(), Email()])
     submit = SubmitField('Request Password Reset')
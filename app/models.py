@@ -2,8 +2,11 @@ import uuid, secrets
 from datetime import datetime, date, timedelta
 from . import db, bcrypt
 from flask_login import UserMixin
-from sqlalchemy import ForeignKey, event
+from sqlalchemy import ForeignKey
 from sqlalchemy.orm import relationship
+from . import terminology
+from .terminology import value_set
+from .derivatives import is_image
 from itsdangerous import URLSafeTimedSerializer as Serializer
 from flask import current_app
 
@@ -73,32 +76,13 @@ class User(UserMixin, db.Model):
         db.session.commit()
     
     @staticmethod
-    def generate_user_id(session):
+    def generate_user_id(session=None):
         """
         Generates a unique user ID in the format MDHS-USER-2024-XXXX.
+        Numbers come from the id_sequence counter, see app/sequences.py.
         """
-        current_year = datetime.now().year
-        prefix = f"MDHS-USER-{current_year}-"
-
-        # Get the maximum number suffix used this year
-        last_user = session.query(User).filter(
-            User.user_id.like(f"{prefix}%")
-        ).order_by(User.id.desc()).first()
-
-        if last_user and last_user.user_id:
-            # Extract the numeric part and increment it
-            last_number = int(last_user.user_id.split('-')[-1])
-            new_number = last_number + 1
-        else:
-            new_number = 1
-
-        # Format the user ID with zero-padded suffix
-        return f"{prefix}{str(new_number).zfill(4)}"
-@event.listens_for(User, 'before_insert')
-def set_user_id(mapper, connection, target):
-    if not target.user_id:
-        session = db.session
-        target.user_id = User.generate_user_id(session)
+        from .sequences import next_user_id
+        return next_user_id()
 class UserEducation(UserMixin, db.Model):
     __tablename__ = 'user_education'
 
@@ -131,7 +115,14 @@ class Patient(UserMixin, db.Model):
     home_address = db.Column(db.String(100), nullable=False)
     ecd_name = db.Column(db.String(50), nullable=True)
     ecd_contact_number = db.Column(db.String(50), nullable=True)
-    created_at = db.Column(db.DateTime, default=db.func.now())
+    # Never NULL: the recent-first patient list pages on (created_at, id)
+    created_at = db.Column(db.DateTime, nullable=False, default=db.func.now(), server_default=db.func.now())
+
+    # Composite indexes backing the keyset-paginated patient list
+    __table_args__ = (
+        db.Index('ix_patient_basic_created_at_id', 'created_at', 'id'),
+        db.Index('ix_patient_basic_firstname_id', 'firstname', 'id'),
+    )
 
     # Relationships
     #cascade='all, delete-orphan' will delete all child information link to this patient
@@ -147,41 +138,64 @@ class Patient(UserMixin, db.Model):
     visits = relationship('Visit', back_populates='patient')
     additional_documents = relationship('AdditionalDocument', back_populates='patient', lazy=True)
     lab_scan_groups = db.relationship('LabScanGroup', back_populates='patient', lazy=True)
+    # Maintained by app/patient_summary.py, never written through the ORM
+    summary = relationship('PatientSummary', uselist=False, viewonly=True, lazy='select')
 
     @staticmethod
-    def generate_patient_id(session):
+    def generate_patient_id(session=None):
         """
         Generates a unique patient ID in the format MDHS-2024-XXXX.
+        Numbers come from the id_sequence counter, see app/sequences.py.
         """
-        current_year = datetime.now().year
-        prefix = f"MDHS-{current_year}-"
-
-        # Query the last patient_id for the current year, ordering by ID
-        last_patient = (
-            session.query(Patient)
-            .filter(Patient.patient_id.like(f"{prefix}%"))
-            .order_by(Patient.patient_id.desc())
-            .first()
-        )
-
-        if last_patient and last_patient.patient_id:
-            # Extract the numeric part and increment it
-            last_number = int(last_patient.patient_id.split('-')[-1])
-            new_number = last_number + 1
-        else:
-            # Start from 1 if no patient exists
-            new_number = 1
-
-        # Format the patient ID with zero-padded suffix
-        return f"{prefix}{str(new_number).zfill(4)}"
-@event.listens_for(Patient, 'before_insert')
-def set_patient_id(mapper, connection, target):
-    if not target.patient_id:
-        # Use a scoped session to lock and ensure thread safety
-        session = db.session
-
-        with session.begin_nested():
-            target.patient_id = Patient.generate_patient_id(session)
+        from .sequences import next_patient_id
+        return next_patient_id()
+
+class PatientSearchToken(db.Model):
+    __tablename__ = 'patient_search_token'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    patient_id = db.Column(db.String(50), db.ForeignKey('patient_basic.id'), nullable=False)
+    token = db.Column(db.String(50), nullable=False)  # Normalized word, e.g. "jose" or "mdhs20240012"
+    field = db.Column(db.String(20), nullable=False)  # Source field: patient_id, firstname, lastname
+
+    # Prefix lookups (token LIKE 'abc%') are range scans on this index
+    __table_args__ = (
+        db.Index('ix_patient_search_token_token_patient_id', 'token', 'patient_id'),
+        db.Index('ix_patient_search_token_patient_id', 'patient_id'),
+    )
+
+class PatientSummary(db.Model):
+    __tablename__ = 'patient_summary'
+
+    # Read model for patient lists, kept up to date by app/patient_summary.py
+    patient_id = db.Column(db.String(50), db.ForeignKey('patient_basic.id'), primary_key=True)
+    last_visit_at = db.Column(db.DateTime, nullable=True)  # Latest visit that was not cancelled
+    visit_count = db.Column(db.Integer, nullable=False, default=0)
+    next_appointment_at = db.Column(db.DateTime, nullable=True)  # Earliest open appointment still ahead
+    active_medication_count = db.Column(db.Integer, nullable=False, default=0)
+    allergy_count = db.Column(db.Integer, nullable=False, default=0)  # Active allergies
+    allergy_flags = db.Column(db.String(255), nullable=True)  # Their substances, comma-separated
+    severe_allergy = db.Column(db.Boolean, nullable=False, default=False)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    # Rows whose next appointment has passed are refreshed when they are read
+    __table_args__ = (
+        db.Index('ix_patient_summary_next_appointment_at', 'next_appointment_at'),
+    )
+
+    @property
+    def allergy_list(self):
+        return [flag for flag in (self.allergy_flags or '').split(',') if flag]
+
+    def __repr__(self):
+        return f"<PatientSummary {self.patient_id}>"
+
+class IdSequence(db.Model):
+    __tablename__ = 'id_sequence'
+
+    # One counter per business id prefix, e.g. "MDHS-2024-" or "MDHS-USER-2024-"
+    prefix = db.Column(db.String(50), primary_key=True)
+    next_value = db.Column(db.Integer, nullable=False)  # First number not yet handed out
 
 class DoctorPatient(UserMixin, db.Model):
     __tablename__ = 'doctor_patient'
@@ -190,6 +204,10 @@ class DoctorPatient(UserMixin, db.Model):
     doctor_id = db.Column(db.String(50), db.ForeignKey('users.id'), nullable=False)
     patient_id = db.Column(db.String(50), db.ForeignKey('patient_basic.id'), nullable=False)
 
+    __table_args__ = (
+        db.Index('ix_doctor_patient_doctor_id_patient_id', 'doctor_id', 'patient_id'),
+    )
+
     # Relationships
     doctor = relationship('User', back_populates='patients')
     patient = relationship('Patient', back_populates='doctor_relationships')
@@ -197,7 +215,10 @@ class Visit(UserMixin, db.Model):
     __tablename__ = 'visits'
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    patient_id = db.Column(db.String(50), db.ForeignKey('patient_basic.id'), nullable=False)
+    # active_history keeps the old value when a row is moved to another patient, so patient_summary can
+    # refresh the previous patient too (also on AllergyIntolerance, MedicationStatement and Appointment)
+    patient_id = db.column_property(db.Column(db.String(50), db.ForeignKey('patient_basic.id'), nullable=False),
+                                    active_history=True)
     doctor_id = db.Column(db.String(50), db.ForeignKey('users.id'), nullable=False)
     visit_date = db.Column(db.DateTime, nullable=False)  # Date and time of the visit
     reason_code = db.Column(db.String(256), nullable=True)  # Reason for the visit (FHIR codeable concept)
@@ -208,6 +229,11 @@ class Visit(UserMixin, db.Model):
     location = db.Column(db.String(256), nullable=True)  # Location of the visit
     notes = db.Column(db.Text, nullable=True)  # Additional notes
 
+    # Newest-first chart section lookups
+    __table_args__ = (
+        db.Index('ix_visits_patient_id_visit_date_id', 'patient_id', 'visit_date', 'id'),
+    )
+
     # Relationships
     patient = relationship('Patient', back_populates='visits')
     doctor = relationship('User', back_populates='visits')
@@ -240,6 +266,7 @@ class Visit(UserMixin, db.Model):
         }
 
     @staticmethod
+    @value_set('visit.reason_code')
     def get_reason_codes():
         """Retrieve predefined reason codes."""
         return [
@@ -260,11 +287,11 @@ class Visit(UserMixin, db.Model):
 
     @property
     def reason_code_description(self):
-        """Compute the reason code description dynamically."""
-        reason_code_map = {item["code"]: item["display"] for item in Visit.get_reason_codes()}
-        return reason_code_map.get(self.reason_code, "Unknown Reason")
+        """Display text of the reason code, looked up in the terminology registry."""
+        return terminology.display('visit.reason_code', self.reason_code, "Unknown Reason")
     
     @staticmethod
+    @value_set('visit.status')
     def get_status_codes():
         """Retrieve predefined status codes."""
         return [
@@ -275,6 +302,7 @@ class Visit(UserMixin, db.Model):
         ]
 
     @staticmethod
+    @value_set('visit.class_code')
     def get_class_codes():
         """Retrieve predefined class codes."""
         return [
@@ -284,6 +312,7 @@ class Visit(UserMixin, db.Model):
         ]
 
     @staticmethod
+    @value_set('visit.priority')
     def get_priority_codes():
         """Retrieve predefined priority codes."""
         return [
@@ -293,6 +322,7 @@ class Visit(UserMixin, db.Model):
         ]
     
     @staticmethod
+    @value_set('visit.location')
     def get_locations():
         """Retrieve predefined locations."""
         return [
@@ -312,6 +342,17 @@ class Observation(UserMixin, db.Model):
     status = db.Column(db.String(20), nullable=True)  # Observation status (e.g., "final", "preliminary")
     category = db.Column(db.String(50), nullable=True)  # Category for the observation (e.g., "vital-signs")
     effectiveDateTime = db.Column(db.DateTime, nullable=True)  # Effective date/time
+    # Quantitative result parsed from `value` (see app/cohorts.py); NULL for results such as "Positive"
+    value_numeric = db.Column(db.Float, nullable=True)
+    unit = db.Column(db.String(20), nullable=True)  # e.g. %, mg/dL
+    reference_low = db.Column(db.Float, nullable=True)
+    reference_high = db.Column(db.Float, nullable=True)
+
+    # Cohort queries scan one code over a time range, or each patient's latest result of one code
+    __table_args__ = (
+        db.Index('ix_observation_code_effectiveDateTime', 'code', 'effectiveDateTime'),
+        db.Index('ix_observation_code_patient_id_effectiveDateTime', 'code', 'patient_id', 'effectiveDateTime', 'value_numeric'),
+    )
 
     # Relationships
     patient = relationship('Patient', back_populates='observations')
@@ -325,6 +366,7 @@ class Observation(UserMixin, db.Model):
     # code_ref = db.Column(db.Integer, db.ForeignKey('observation_code.id'), nullable=True)
 
     @staticmethod
+    @value_set('observation.status')
     def get_status_options():
         """Returns a list of possible status options."""
         return [
@@ -336,6 +378,7 @@ class Observation(UserMixin, db.Model):
         ]
 
     @staticmethod
+    @value_set('observation.category')
     def get_category_options():
         """Returns a list of possible category options."""
         return [
@@ -345,6 +388,7 @@ class Observation(UserMixin, db.Model):
         ]
 
     @staticmethod
+    @value_set('observation.code')
     def get_code_options():
         """Returns a list of possible code options (e.g., LOINC or SNOMED codes) for observations."""
         return [
@@ -400,14 +444,14 @@ class Observation(UserMixin, db.Model):
     
     @property
     def code_description(self):
-        """Compute the code description dynamically."""
-        code_map = {item["code"]: item["display"] for item in Observation.get_code_options()}
-        return code_map.get(self.code, "Unknown Reason")
+        """Display text of the observation code, looked up in the terminology registry."""
+        return terminology.display('observation.code', self.code, "Unknown Reason")
 class AllergyIntolerance(UserMixin, db.Model):
     __tablename__ = 'allergy_intolerance'
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    patient_id = db.Column(db.String(50), db.ForeignKey('patient_basic.id'), nullable=False)
+    patient_id = db.column_property(db.Column(db.String(50), db.ForeignKey('patient_basic.id'), nullable=False),
+                                    active_history=True)
     visit_id = db.Column(db.Integer, db.ForeignKey('visits.id'), nullable=False)
     substance = db.Column(db.String(100), nullable=False)  # This can be extended to reference a code system
     clinical_status = db.Column(db.String(20), nullable=True)
@@ -424,6 +468,7 @@ class AllergyIntolerance(UserMixin, db.Model):
     visit = relationship('Visit', back_populates='allergies', foreign_keys=[visit_id])
 
     @staticmethod
+    @value_set('allergy_intolerance.clinical_status')
     def get_clinical_status_codes():
         return [
             {"code": "active", "display": "Active"},
@@ -432,6 +477,7 @@ class AllergyIntolerance(UserMixin, db.Model):
         ]
 
     @staticmethod
+    @value_set('allergy_intolerance.verification_status')
     def get_verification_status_codes():
         return [
             {"code": "confirmed", "display": "Confirmed"},
@@ -440,6 +486,7 @@ class AllergyIntolerance(UserMixin, db.Model):
         ]
 
     @staticmethod
+    @value_set('allergy_intolerance.severity')
     def get_severity_levels():
         return [
             {"code": "mild", "display": "Mild"},
@@ -448,6 +495,7 @@ class AllergyIntolerance(UserMixin, db.Model):
         ]
 
     @staticmethod
+    @value_set('allergy_intolerance.category')
     def get_category_options():
         """Retrieve predefined category codes for the allergy (e.g., food, medication)."""
         return [
@@ -457,6 +505,7 @@ class AllergyIntolerance(UserMixin, db.Model):
         ]
     
     @staticmethod
+    @value_set('allergy_intolerance.onset')
     def get_onset_choices():
         """Retrieve predefined onset choices for allergic reactions (immediate or delayed)."""
         return [
@@ -467,7 +516,8 @@ class MedicationStatement(UserMixin, db.Model):
     __tablename__ = 'medication_statement'
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    patient_id = db.Column(db.String(50), db.ForeignKey('patient_basic.id'), nullable=False)
+    patient_id = db.column_property(db.Column(db.String(50), db.ForeignKey('patient_basic.id'), nullable=False),
+                                    active_history=True)
     visit_id = db.Column(db.Integer, db.ForeignKey('visits.id'), nullable=False)
     medication_code = db.Column(db.String(100), nullable=False)  # Consider referencing a code system (e.g., RxNorm)
     medication_name = db.Column(db.String(300), nullable=False)  # Name or description of the medication
@@ -491,6 +541,7 @@ class MedicationStatement(UserMixin, db.Model):
     visit = relationship('Visit', back_populates='medications', foreign_keys=[visit_id])
 
     @staticmethod
+    @value_set('medication_statement.status')
     def get_status_codes():
         return [
             {"code": "active", "display": "Active"},
@@ -502,6 +553,7 @@ class MedicationStatement(UserMixin, db.Model):
         ]
 
     @staticmethod
+    @value_set('medication_statement.adherence')
     def get_adherence_codes():
         """Retrieve predefined adherence options (e.g., compliant, non-compliant)."""
         return [
@@ -511,6 +563,7 @@ class MedicationStatement(UserMixin, db.Model):
         ]
 
     @staticmethod
+    @value_set('medication_statement.category')
     def get_category_codes():
         """Retrieve predefined categories (e.g., inpatient, outpatient)."""
         return [
@@ -534,11 +587,17 @@ class Immunization(UserMixin, db.Model):
     manufacturer = db.Column(db.String(100), nullable=True)  # Add manufacturer details
     notes = db.Column(db.Text, nullable=True)
 
+    # Newest-first chart section lookups
+    __table_args__ = (
+        db.Index('ix_immunization_patient_id_date_id', 'patient_id', 'date', 'id'),
+    )
+
     # Relationships
     patient = relationship('Patient', back_populates='immunizations')
     visit = relationship('Visit', back_populates='immunizations', foreign_keys=[visit_id])
 
     @staticmethod
+    @value_set('immunization.status')
     def get_status_codes():
         return [
             {"code": "completed", "display": "Completed"},
@@ -547,6 +606,7 @@ class Immunization(UserMixin, db.Model):
         ]
 
     @staticmethod
+    @value_set('immunization.site')
     def get_site_options():
         return [
             {"code": "left-arm", "display": "Left Arm"},
@@ -556,6 +616,7 @@ class Immunization(UserMixin, db.Model):
         ]
 
     @staticmethod
+    @value_set('immunization.route')
     def get_route_options():
         return [
             {"code": "IM", "display": "Intramuscular"},
@@ -564,6 +625,7 @@ class Immunization(UserMixin, db.Model):
         ]
 
     @staticmethod
+    @value_set('immunization.vaccine_code')
     def get_vaccine_codes():
         """Retrieve predefined vaccine codes or list."""
         return [
@@ -592,14 +654,14 @@ class Immunization(UserMixin, db.Model):
 
     @property
     def vaccine_code_description(self):
-        """Compute the vaccine code description dynamically."""
-        vaccine_code_map = {item["code"]: item["display"] for item in Immunization.get_vaccine_codes()}
-        return vaccine_code_map.get(self.vaccine_code, "Unknown Reason")  
+        """Display text of the vaccine code, looked up in the terminology registry."""
+        return terminology.display('immunization.vaccine_code', self.vaccine_code, "Unknown Reason")  
 class Appointment(UserMixin, db.Model):
     __tablename__ = 'appointment'
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    patient_id = db.Column(db.String(50), db.ForeignKey('patient_basic.id'), nullable=False)
+    patient_id = db.column_property(db.Column(db.String(50), db.ForeignKey('patient_basic.id'), nullable=False),
+                                    active_history=True)
     visit_id = db.Column(db.Integer, db.ForeignKey('visits.id'), nullable=True)
     doctor_id = db.Column(db.String(50), db.ForeignKey('users.id'), nullable=False)
     status = db.Column(db.String(20), nullable=False)  # e.g., booked, cancelled, noshow
@@ -614,12 +676,19 @@ class Appointment(UserMixin, db.Model):
     participant_actor = db.Column(db.String(50), nullable=True)  # Actor (e.g., patient, practitioner)
     participant_status = db.Column(db.String(20), nullable=True)  # e.g., accepted, declined, tentative
 
+    # Newest-first chart section lookups and the doctor's calendar windows
+    __table_args__ = (
+        db.Index('ix_appointment_patient_id_start_id', 'patient_id', 'start', 'id'),
+        db.Index('ix_appointment_doctor_id_start_id', 'doctor_id', 'start', 'id'),
+    )
+
     # Relationships
     patient = relationship('Patient', back_populates='appointments')
     doctor = relationship('User', back_populates='appointments')
     visit = relationship('Visit', back_populates='appointments', foreign_keys=[visit_id])
 
     @staticmethod
+    @value_set('appointment.status')
     def get_status_options():
         return [
             {"code": "proposed", "display": "Proposed"},
@@ -635,6 +704,7 @@ class Appointment(UserMixin, db.Model):
         ]
     
     @staticmethod
+    @value_set('appointment.service_type')
     def get_service_types():
         return [
             {"code": "consultation", "display": "Consultation"},
@@ -647,6 +717,7 @@ class Appointment(UserMixin, db.Model):
         ]
     
     @staticmethod
+    @value_set('appointment.specialty')
     def get_specialties():
         return [
             {"code": "general-practice", "display": "General Practice"},
@@ -663,6 +734,7 @@ class Appointment(UserMixin, db.Model):
     
 
     @staticmethod
+    @value_set('appointment.service_category')
     def get_service_categories():
         return [
             {"code": "general-practice", "display": "General Practice"},
@@ -677,6 +749,7 @@ class Appointment(UserMixin, db.Model):
         ]
     
     @staticmethod
+    @value_set('appointment.appointment_type')
     def get_appointment_types():
         return [
             {"code": "routine", "display": "Routine"},
@@ -686,6 +759,7 @@ class Appointment(UserMixin, db.Model):
         ]
 
     @staticmethod
+    @value_set('appointment.priority')
     def get_priority_options():
         return [
             {"code": "low", "display": "Low"},
@@ -695,6 +769,7 @@ class Appointment(UserMixin, db.Model):
         ]
 
     @staticmethod
+    @value_set('appointment.participant_actor')
     def get_participant_actors():
         return [
             {"code": "patient", "display": "Patient"},
@@ -704,6 +779,7 @@ class Appointment(UserMixin, db.Model):
         ]
 
     @staticmethod
+    @value_set('appointment.participant_status')
     def get_participant_statuses():
         return [
             {"code": "accepted", "display": "Accepted"},
@@ -713,6 +789,7 @@ class Appointment(UserMixin, db.Model):
         ]
     
     @staticmethod
+    @value_set('appointment.reason_code')
     def get_reason_codes():
         return [
             {"code": "routine", "display": "Routine Check-up"},
@@ -746,12 +823,18 @@ class MedicalHistory(UserMixin, db.Model):
     abatement_date = db.Column(db.Date, nullable=False)  # When the condition ended (if resolved)
     notes = db.Column(db.Text, nullable=False)
 
+    # Newest-first chart section lookups
+    __table_args__ = (
+        db.Index('ix_medical_history_patient_id_onset_date_id', 'patient_id', 'onset_date', 'id'),
+    )
+
     # Relationships
     patient = relationship('Patient', back_populates='medical_history')
     doctor = relationship('User', back_populates='medical_history')
     visit = relationship('Visit', back_populates='medical_histories', foreign_keys=[visit_id])
 
     @staticmethod
+    @value_set('medical_history.clinical_status')
     def get_clinical_status_options():
         return [
             {"code": "active", "display": "Active"},
@@ -763,6 +846,7 @@ class MedicalHistory(UserMixin, db.Model):
         ]
 
     @staticmethod
+    @value_set('medical_history.verification_status')
     def get_verification_status_options():
         return [
             {"code": "confirmed", "display": "Confirmed"},
@@ -773,6 +857,7 @@ class MedicalHistory(UserMixin, db.Model):
         ]
 
     @staticmethod
+    @value_set('medical_history.category')
     def get_category_options():
         return [
             {"code": "problem-list-item", "display": "Problem List Item"},
@@ -784,6 +869,7 @@ class MedicalHistory(UserMixin, db.Model):
         ]
 
     @staticmethod
+    @value_set('medical_history.code')
     def get_code_options():
         return [
             {"code": "SNOMED-CT", "display": "SNOMED-CT"},
@@ -813,6 +899,7 @@ class Procedure(UserMixin, db.Model):
     visit = relationship('Visit', back_populates='procedures', foreign_keys=[visit_id])
 
     @staticmethod
+    @value_set('procedure.status')
     def get_status_options():
         return [
             {"code": "preparation", "display": "Preparation"},
@@ -826,6 +913,7 @@ class Procedure(UserMixin, db.Model):
         ]
     
     @staticmethod
+    @value_set('procedure.category')
     def get_category_options():
         return [
             {"code": "surgical", "display": "Surgical"},
@@ -833,6 +921,7 @@ class Procedure(UserMixin, db.Model):
         ]
     
     @staticmethod
+    @value_set('procedure.outcome')
     def get_outcome_options():
         return [
             {"code": "successful", "display": "Successful"},
@@ -852,11 +941,17 @@ class Vitals(UserMixin, db.Model):
     value = db.Column(db.String(50), nullable=True)  # Measured value (e.g., 120/80 for blood pressure)
     unit = db.Column(db.String(20), nullable=True)  # Unit of measurement (e.g., mmHg, °C)
 
+    # Newest-first chart section lookups
+    __table_args__ = (
+        db.Index('ix_vitals_patient_id_effective_date_id', 'patient_id', 'effective_date', 'id'),
+    )
+
     # Relationships
     patient = relationship('Patient', back_populates='vitals')
     visit = relationship('Visit', back_populates='vitals', foreign_keys=[visit_id])
 
     @staticmethod
+    @value_set('vitals.status')
     def get_status_options():
         return [
             {"code": "registered", "display": "Registered"},
@@ -869,12 +964,14 @@ class Vitals(UserMixin, db.Model):
         ]
     
     @staticmethod
+    @value_set('vitals.category')
     def get_category_options():
         return [
             {"code": "vital-signs", "display": "Vital Signs"}
         ]
     
     @staticmethod
+    @value_set('vitals.unit')
     def get_unit_options():
         return [
             {"code": "bpm", "display": "Beats per Minute"},
@@ -889,6 +986,7 @@ class Vitals(UserMixin, db.Model):
         ]
     
     @staticmethod
+    @value_set('vitals.code')
     def get_code_options():
         return [
             {"code": "8310-5", "display": "Body Temperature"},  # LOINC code for Body Temperature
@@ -900,6 +998,29 @@ class Vitals(UserMixin, db.Model):
             {"code": "8302-2", "display": "Height"},           # LOINC code for Height
             {"code": "39156-5", "display": "Body Mass Index (BMI)"}  # LOINC code for BMI
         ]
+class VitalSample(db.Model):
+    __tablename__ = 'vital_samples'
+
+    # Numeric copy of a Vitals row in canonical units, kept in step by app/vitals_series.py
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    vitals_id = db.Column(db.Integer, db.ForeignKey('vitals.id'), nullable=False, unique=True)
+    patient_id = db.Column(db.String(50), db.ForeignKey('patient_basic.id'), nullable=False)
+    code = db.Column(db.String(20), nullable=False)  # LOINC code, e.g. 8867-4 for heart rate
+    effective_date = db.Column(db.DateTime, nullable=False)
+    epoch = db.Column(db.BigInteger, nullable=False)  # effective_date in Unix seconds, for bucketing in SQL
+    value = db.Column(db.Float, nullable=True)  # Single-valued vitals
+    systolic = db.Column(db.Float, nullable=True)  # Blood pressure only
+    diastolic = db.Column(db.Float, nullable=True)
+    unit = db.Column(db.String(20), nullable=False)  # UCUM unit, e.g. Cel, mm[Hg], /min
+
+    # Trend queries read one patient's series of one code over a date range
+    __table_args__ = (
+        db.Index('ix_vital_samples_patient_id_code_effective_date', 'patient_id', 'code', 'effective_date'),
+    )
+
+    def __repr__(self):
+        return f"<VitalSample {self.code} {self.value if self.systolic is None else f'{self.systolic}/{self.diastolic}'} {self.unit}>"
+
 class LabScanGroup(db.Model):
     __tablename__ = 'lab_scan_groups'
 
@@ -924,10 +1045,22 @@ class LabScan(db.Model):
     file_path = db.Column(db.String(255), nullable=False)
     upload_date = db.Column(db.DateTime, default=datetime.utcnow)
     group_id = db.Column(db.Integer, db.ForeignKey('lab_scan_groups.id'), nullable=False)
+    # SHA-256 of the file: its blob and thumbnails. active_history keeps the old value when it changes,
+    # so the previous blob's ref_count is lowered too (app/storage.py)
+    content_hash = db.column_property(db.Column(db.String(64), nullable=True, index=True), active_history=True)
+
+    # Newest-first timeline lookups
+    __table_args__ = (
+        db.Index('ix_lab_scans_group_id_upload_date_id', 'group_id', 'upload_date', 'id'),
+    )
 
     # Relationship to LabScanGroup
     group = db.relationship('LabScanGroup', back_populates='scans', lazy=True)
 
+    @property
+    def is_image(self):
+        return is_image(self.filename)
+
     def __repr__(self):
         return f"<LabScan {self.filename}>"
 class AdditionalDocument(db.Model):
@@ -935,8 +1068,15 @@ class AdditionalDocument(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     patient_id = db.Column(db.String(50), db.ForeignKey('patient_basic.id'), nullable=False)
     document_name = db.Column(db.String(150), nullable=False)
-    document_file = db.Column(db.String(300), nullable=False)  # Path to the file
+    document_file = db.Column(db.String(300), nullable=False)  # Path to the file (original file name for stored blobs)
     upload_date = db.Column(db.DateTime, default=datetime.utcnow)
+    # SHA-256 of the file, see Blob; active_history as on LabScan
+    content_hash = db.column_property(db.Column(db.String(64), nullable=True, index=True), active_history=True)
+
+    # Newest-first timeline lookups
+    __table_args__ = (
+        db.Index('ix_additionaldocument_patient_id_upload_date_id', 'patient_id', 'upload_date', 'id'),
+    )
 
     patient = relationship('Patient', back_populates='additional_documents')
 class SurveyResponse(db.Model):
@@ -954,4 +1094,114 @@ class SurveyResponse(db.Model):
     q10 = db.Column(db.Integer, nullable=False)
     created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
 
-    user = db.relationship('User', backref=db.backref('survey_responses', lazy=True))
\ No newline at end of file
+    user = db.relationship('User', backref=db.backref('survey_responses', lazy=True))
+class Blob(db.Model):
+    __tablename__ = 'blobs'
+
+    # An uploaded file's content, stored once under its SHA-256 (see app/storage.py)
+    content_hash = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    content_type = db.Column(db.String(100), nullable=True)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)  # LabScan and AdditionalDocument rows using it
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)  # Last upload or reference change
+
+    # Garbage collection looks for unreferenced blobs that have not been touched for a while
+    __table_args__ = (
+        db.Index('ix_blobs_ref_count_updated_at', 'ref_count', 'updated_at'),
+    )
+
+    def __repr__(self):
+        return f"<Blob {self.content_hash[:12]} refs={self.ref_count}>"
+
+class EmailOutbox(db.Model):
+    __tablename__ = 'email_outbox'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    sender = db.Column(db.String(255), nullable=False)
+    recipients = db.Column(db.Text, nullable=False)  # Comma-separated addresses
+    subject = db.Column(db.String(255), nullable=False)
+    body = db.Column(db.Text, nullable=True)
+    html = db.Column(db.Text, nullable=True)
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, sending, sent, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    claimed_by = db.Column(db.String(32), nullable=True)  # Token of the worker batch sending the row
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+    # Workers poll for due rows of one status, oldest first
+    __table_args__ = (
+        db.Index('ix_email_outbox_status_next_attempt_at', 'status', 'next_attempt_at'),
+    )
+
+    @property
+    def recipient_list(self):
+        return [address for address in self.recipients.split(',') if address]
+
+    def __repr__(self):
+        return f"<EmailOutbox {self.id} {self.status}>"
+
+class UploadSession(db.Model):
+    __tablename__ = 'upload_sessions'
+
+    # A resumable upload in progress (see app/resumable.py); the bytes received so far are on disk
+    id = db.Column(db.String(32), primary_key=True)  # Random token, part of the upload URL
+    user_id = db.Column(db.String(50), db.ForeignKey('users.id'), nullable=False)
+    patient_id = db.Column(db.String(50), db.ForeignKey('patient_basic.id'), nullable=False)
+    target = db.Column(db.String(20), nullable=False)  # document or lab_scan
+    group_id = db.Column(db.Integer, db.ForeignKey('lab_scan_groups.id'), nullable=True)  # For lab scans
+    document_name = db.Column(db.String(150), nullable=True)  # For documents
+    filename = db.Column(db.String(255), nullable=False)
+    content_type = db.Column(db.String(100), nullable=True)
+    length = db.Column(db.BigInteger, nullable=False)
+    offset = db.Column(db.BigInteger, nullable=False, default=0)
+    checksum = db.Column(db.String(64), nullable=True)  # Expected SHA-256 of the whole file, if announced
+    status = db.Column(db.String(20), nullable=False, default='open')  # open, complete
+    record_id = db.Column(db.Integer, nullable=True)  # The AdditionalDocument or LabScan created at finalize
+    content_hash = db.Column(db.String(64), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+    # Expired sessions are swept by `flask upload-sessions-gc`
+    __table_args__ = (
+        db.Index('ix_upload_sessions_expires_at', 'expires_at'),
+    )
+
+    def __repr__(self):
+        return f"<UploadSession {self.id} {self.offset}/{self.length} {self.status}>"
+
+class ExportJob(db.Model):
+    __tablename__ = 'export_jobs'
+
+    # A FHIR Bulk Data $export (see app/bulk_export.py); its NDJSON files are on disk
+    id = db.Column(db.String(32), primary_key=True)  # Random token, part of the status URL
+    user_id = db.Column(db.String(50), db.ForeignKey('users.id'), nullable=True)  # NULL when started from the CLI
+    doctor_id = db.Column(db.String(50), db.ForeignKey('users.id'), nullable=True)  # Group export: this doctor's patients
+    resource_types = db.Column(db.String(255), nullable=False)  # Comma-separated
+    request_url = db.Column(db.String(1000), nullable=True)
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, complete, failed, cancelled
+    current_type = db.Column(db.String(50), nullable=True)
+    exported = db.Column(db.BigInteger, nullable=False, default=0)  # Resources written so far
+    total = db.Column(db.BigInteger, nullable=True)  # Resources to write, counted when the job starts
+    output = db.Column(db.Text, nullable=True)  # JSON list of the finished files: type, name, count
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    # Finished exports are swept by `flask export-jobs-gc`
+    __table_args__ = (
+        db.Index('ix_export_jobs_status_finished_at', 'status', 'finished_at'),
+    )
+
+    @property
+    def type_list(self):
+        return [name for name in self.resource_types.split(',') if name]
+
+    def __repr__(self):
+        return f"<ExportJob {self.id} {self.status} {self.exported}/{self.total}>"
@@ -0,0 +1,308 @@
+import logging, secrets, smtplib, threading, time
+from collections import deque
+from datetime import datetime, timedelta
+from flask import current_app
+from flask_mail import Message
+from sqlalchemy import func, select, update
+from . import db, mail
+from .models import EmailOutbox
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SENDER = 'noreply@demo.com'
+DEFAULT_BATCH_SIZE = 50
+DEFAULT_MAX_ATTEMPTS = 6
+DEFAULT_RETRY_BACKOFF = 30
+MAX_RETRY_BACKOFF = 3600
+# A row still 'sending' after this many seconds belongs to a worker that died
+CLAIM_TIMEOUT = 600
+
+# SMTP errors after which the connection cannot be used for the rest of the batch
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)
+
+
+def _connection_broken(error):
+    # SMTPException subclasses OSError; apart from CONNECTION_ERRORS it only concerns one message
+    return isinstance(error, CONNECTION_ERRORS) or not isinstance(error, smtplib.SMTPException)
+
+
+def enqueue(subject, recipients, body=None, html=None, sender=None):
+    """
+    Queue an email for the outbox worker. The row is only added to the
+    session, so it is written, or dropped, together with the caller's
+    transaction; nothing talks to the mail server during the request.
+    """
+    if isinstance(recipients, str):
+        recipients = [recipients]
+    row = EmailOutbox(
+        sender=sender or DEFAULT_SENDER,
+        recipients=','.join(recipients),
+        subject=subject,
+        body=body,
+        html=html,
+        status='pending',
+        attempts=0,
+        next_attempt_at=datetime.utcnow(),
+    )
+    db.session.add(row)
+    return row
+
+
+def retry_delay(attempts):
+    """Seconds to wait after the `attempts`-th failed send: the configured backoff, doubled each time."""
+    base = current_app.config.get('OUTBOX_RETRY_BACKOFF', DEFAULT_RETRY_BACKOFF)
+    return min(base * 2 ** (attempts - 1), MAX_RETRY_BACKOFF)
+
+
+class OutboxMetrics:
+    """In-process counters of the worker threads, for `stats()` and the worker log."""
+
+    def __init__(self, samples=1000):
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=samples)
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.batches = 0
+
+    def record_sent(self, seconds):
+        with self._lock:
+            self.sent += 1
+            self._latencies.append(seconds)
+
+    def record_failure(self, gave_up):
+        with self._lock:
+            if gave_up:
+                self.failed += 1
+            else:
+                self.retried += 1
+
+    def record_batch(self):
+        with self._lock:
+            self.batches += 1
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            counters = {"sent": self.sent, "retried": self.retried, "failed": self.failed, "batches": self.batches}
+        if latencies:
+            counters["send_latency_ms"] = {
+                "avg": round(sum(latencies) / len(latencies) * 1000, 1),
+                "p50": round(latencies[len(latencies) // 2] * 1000, 1),
+                "p95": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 1),
+                "max": round(latencies[-1] * 1000, 1),
+            }
+        return counters
+
+
+metrics = OutboxMetrics()
+
+
+def queue_stats():
+    """Queue depth per status and the age of the oldest email still waiting."""
+    depth = dict(db.session.execute(
+        select(EmailOutbox.status, func.count()).group_by(EmailOutbox.status)
+    ).all())
+    oldest = db.session.execute(
+        select(func.min(EmailOutbox.created_at)).where(EmailOutbox.status.in_(('pending', 'sending')))
+    ).scalar()
+    return {
+        "depth": depth,
+        "oldest_pending_seconds": round((datetime.utcnow() - oldest).total_seconds(), 1) if oldest else None,
+    }
+
+
+def stats():
+    return {"queue": queue_stats(), "worker": metrics.stats()}
+
+
+def release_stale_claims(now=None):
+    """Put rows claimed by a worker that died mid-batch back in the queue."""
+    now = now or datetime.utcnow()
+    result = db.session.execute(
+        update(EmailOutbox)
+        .where(EmailOutbox.status == 'sending', EmailOutbox.claimed_at < now - timedelta(seconds=CLAIM_TIMEOUT))
+        .values(status='pending', claimed_by=None, claimed_at=None)
+    )
+    db.session.commit()
+    return result.rowcount
+
+
+def claim_batch(limit):
+    """
+    Mark up to `limit` due emails as 'sending' under a fresh token and return
+    them. The conditional UPDATE makes concurrent workers claim disjoint rows
+    on every backend; on MySQL SKIP LOCKED also keeps them from queueing up
+    behind each other's candidates.
+    """
+    now = datetime.utcnow()
+    token = secrets.token_hex(16)
+    due = (
+        select(EmailOutbox.id)
+        .where(EmailOutbox.status == 'pending', EmailOutbox.next_attempt_at <= now)
+        .order_by(EmailOutbox.next_attempt_at, EmailOutbox.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    ids = db.session.execute(due).scalars().all()
+    if not ids:
+        db.session.commit()
+        return []
+    db.session.execute(
+        update(EmailOutbox)
+        .where(EmailOutbox.id.in_(ids), EmailOutbox.status == 'pending')
+        .values(status='sending', claimed_by=token, claimed_at=now)
+    )
+    db.session.commit()
+    return EmailOutbox.query.filter_by(claimed_by=token, status='sending').order_by(EmailOutbox.id).all()
+
+
+def _message(row):
+    return Message(row.subject, sender=row.sender, recipients=row.recipient_list, body=row.body, html=row.html)
+
+
+def _mark_sent(row):
+    row.status = 'sent'
+    row.sent_at = datetime.utcnow()
+    row.attempts += 1
+    row.last_error = None
+    row.claimed_by = row.claimed_at = None
+
+
+def _mark_failed(row, error):
+    """Schedule a retry with backoff, or give up after OUTBOX_MAX_ATTEMPTS. Returns True when given up."""
+    row.attempts += 1
+    row.last_error = f"{type(error).__name__}: {error}"[:2000]
+    row.claimed_by = row.claimed_at = None
+    if row.attempts >= current_app.config.get('OUTBOX_MAX_ATTEMPTS', DEFAULT_MAX_ATTEMPTS):
+        row.status = 'failed'
+        return True
+    row.status = 'pending'
+    row.next_attempt_at = datetime.utcnow() + timedelta(seconds=retry_delay(row.attempts))
+    return False
+
+
+def _release(rows):
+    """Hand unsent rows back to the queue without counting an attempt."""
+    for row in rows:
+        row.status = 'pending'
+        row.claimed_by = row.claimed_at = None
+
+
+def deliver(rows):
+    """
+    Send claimed rows over one SMTP connection. Each row's outcome is
+    committed right after its send, so a crash re-sends at most one email
+    (delivery is at-least-once).
+    """
+    if not rows:
+        return 0
+    sent = 0
+    try:
+        with mail.connect() as connection:
+            for index, row in enumerate(rows):
+                started = time.perf_counter()
+                try:
+                    connection.send(_message(row))
+                except OSError as error:
+                    metrics.record_failure(_mark_failed(row, error))
+                    if _connection_broken(error):
+                        _release(rows[index + 1:])
+                        db.session.commit()
+                        log.warning("Outbox: SMTP connection lost after %s emails: %s", sent, error)
+                        return sent
+                else:
+                    _mark_sent(row)
+                    metrics.record_sent(time.perf_counter() - started)
+                    sent += 1
+                db.session.commit()
+    except OSError as error:
+        # Could not connect (or quit) at all: every row not yet done counts as an attempt
+        for row in rows:
+            if row.status == 'sending':
+                metrics.record_failure(_mark_failed(row, error))
+        db.session.commit()
+        log.warning("Outbox: cannot reach the mail server: %s", error)
+    return sent
+
+
+def process_batch(limit=None):
+    """Claim and send one batch; returns the number of emails claimed."""
+    limit = limit or current_app.config.get('OUTBOX_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+    rows = claim_batch(limit)
+    if rows:
+        deliver(rows)
+        metrics.record_batch()
+    return len(rows)
+
+
+class OutboxWorker:
+    """
+    A pool of threads that drain the outbox. Every thread claims its own
+    batches and keeps one SMTP connection open per batch, so the pool size
+    bounds the number of concurrent connections to the mail server.
+    """
+
+    def __init__(self, app, threads=2, batch_size=None, poll_interval=None):
+        self.app = app
+        self.threads = threads
+        self.batch_size = batch_size or app.config.get('OUTBOX_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+        self.poll_interval = poll_interval or app.config.get('OUTBOX_POLL_INTERVAL', 5)
+        self.stopping = threading.Event()
+        self._threads = []
+
+    def drain(self):
+        """Send everything that is due right now, then return the number of emails claimed."""
+        total = 0
+        with self.app.app_context():
+            release_stale_claims()
+            while True:
+                claimed = process_batch(self.batch_size)
+                total += claimed
+                if not claimed:
+                    return total
+
+    def _run(self):
+        while not self.stopping.is_set():
+            try:
+                with self.app.app_context():
+                    claimed = process_batch(self.batch_size)
+            except Exception:
+                log.exception("Outbox: batch failed")
+                claimed = 0
+            if not claimed:
+                self.stopping.wait(self.poll_interval)
+
+    def start(self):
+        with self.app.app_context():
+            release_stale_claims()
+        for number in range(self.threads):
+            thread = threading.Thread(target=self._run, name=f"outbox-{number}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        self.stopping.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+
+_start_lock = threading.Lock()
+
+
+def start_in_process(app):
+    """
+    Start an OutboxWorker with OUTBOX_WORKER_THREADS threads inside the web
+    process, once. Called on every request, so CLI commands never start one.
+    With 0 threads nothing starts, for deployments that run
+    `flask outbox-worker` as a process of its own.
+    """
+    if 'outbox_worker' in app.extensions:
+        return
+    with _start_lock:
+        if 'outbox_worker' in app.extensions:
+            return
+        threads = app.config.get('OUTBOX_WORKER_THREADS', 0)
+        worker = app.extensions['outbox_worker'] = OutboxWorker(app, threads=threads) if threads > 0 else None
+        if worker is not None:
+            worker.start()
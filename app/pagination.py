@@ -0,0 +1,132 @@
+import base64, json
+from datetime import datetime, date
+from sqlalchemy import and_, or_
+
+
+class CursorError(ValueError):
+    """Raised when a pagination cursor cannot be decoded."""
+
+
+def _dump_value(value):
+    """Tag datetimes and dates so they survive the JSON round-trip."""
+    if isinstance(value, datetime):
+        return {"dt": value.isoformat()}
+    if isinstance(value, date):
+        return {"d": value.isoformat()}
+    return value
+
+
+def _load_value(value):
+    if isinstance(value, dict):
+        if "dt" in value:
+            return datetime.fromisoformat(value["dt"])
+        if "d" in value:
+            return date.fromisoformat(value["d"])
+    return value
+
+
+def encode_cursor(values, direction='next', scope=None):
+    """
+    Encode the sort key of a boundary row into an opaque, URL-safe cursor.
+    `scope` ties the cursor to one particular ordering so it cannot be replayed
+    against a different sort.
+    """
+    payload = {"k": [_dump_value(v) for v in values], "d": direction}
+    if scope:
+        payload["s"] = scope
+    raw = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, scope=None):
+    """Decode a cursor produced by `encode_cursor`, returning (values, direction)."""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        values = [_load_value(v) for v in payload["k"]]
+        direction = payload.get("d", "next")
+    except (ValueError, KeyError, TypeError) as exc:
+        raise CursorError("Malformed pagination cursor") from exc
+
+    if direction not in ('next', 'prev'):
+        raise CursorError("Unknown cursor direction")
+    if scope and payload.get("s") != scope:
+        raise CursorError("Cursor does not belong to this listing")
+    return values, direction
+
+
+def keyset_condition(columns, values, descending):
+    """
+    Build the row-value comparison `(c1, c2, ...) > (v1, v2, ...)` (or `<` when
+    descending) in its expanded OR/AND form, which every backend can serve from
+    a composite index.
+    """
+    clauses = []
+    for i, column in enumerate(columns):
+        prefix = [columns[j] == values[j] for j in range(i)]
+        step = column < values[i] if descending else column > values[i]
+        clauses.append(and_(*prefix, step))
+    return or_(*clauses)
+
+
+class KeysetPage:
+    """One page of results plus the cursors needed to move either way."""
+
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def keyset_paginate(query, columns, key_fn, cursor=None, limit=25, descending=False, scope=None):
+    """
+    Fetch one page of `query` ordered by `columns` using keyset (seek) pagination.
+
+    `columns` must end in a unique column so the ordering is total, and
+    `key_fn(row)` must return the values of those columns for a result row.
+    Only `limit + 1` rows are read per call, so the cost of a page does not
+    depend on how deep into the listing the cursor points.
+    """
+    values, direction = (None, 'next')
+    if cursor:
+        values, direction = decode_cursor(cursor, scope=scope)
+        if len(values) != len(columns):
+            raise CursorError("Cursor does not match the sort columns")
+
+    # Walking backwards means flipping the ordering and reversing the rows afterwards
+    backwards = direction == 'prev'
+    seek_descending = descending != backwards
+
+    if values is not None:
+        query = query.filter(keyset_condition(columns, values, seek_descending))
+    ordering = [c.desc() if seek_descending else c.asc() for c in columns]
+    rows = query.order_by(*ordering).limit(limit + 1).all()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backwards:
+        rows.reverse()
+
+    next_cursor = prev_cursor = None
+    if rows:
+        first_key, last_key = key_fn(rows[0]), key_fn(rows[-1])
+        if (has_more if not backwards else values is not None):
+            next_cursor = encode_cursor(last_key, 'next', scope)
+        if (has_more if backwards else values is not None):
+            prev_cursor = encode_cursor(first_key, 'prev', scope)
+
+    return KeysetPage(rows, next_cursor=next_cursor, prev_cursor=prev_cursor)
@@ -0,0 +1,216 @@
+import csv, io, time, uuid
+from datetime import date, datetime
+from types import SimpleNamespace
+from flask import current_app
+from sqlalchemy import String, insert
+from . import db, search, sequences
+from .access import access_index
+from .forms import PatientForm
+from .models import DoctorPatient, Patient, PatientSearchToken, PatientSummary
+
+# CSV patient roster import: every row is checked with PatientForm's rules
+# and the accepted ones are written a chunk at a time, with one bulk insert
+# per table and a single id_sequence reservation for the chunk's patient ids
+DEFAULT_CHUNK_SIZE = 5000
+COLUMNS = ('firstname', 'lastname', 'age', 'birthdate', 'gender', 'contact_number', 'home_address',
+           'ecd_name', 'ecd_contact_number')
+REQUIRED_COLUMNS = ('firstname', 'lastname', 'gender', 'contact_number', 'home_address')
+# Rejected rows kept for the upload page; the command writes all of them to its report
+MAX_REJECTED_KEPT = 1000
+
+
+class RosterError(Exception):
+    """A roster that cannot be read at all, e.g. one missing a required column."""
+
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+
+def insert_patients(connection, rows, doctor_id):
+    """
+    Write new patients with one bulk insert per table: their patient_basic
+    rows, search tokens, empty summaries and links to `doctor_id`. Rows
+    without a patient_id get one from a single id_sequence block. Fills in
+    the `id` and `patient_id` of every row.
+    """
+    if not rows:
+        return rows
+    numbers = iter(sequences.allocator.bulk_ids('patient', sum(1 for row in rows if not row.get('patient_id')), connection))
+    for row in rows:
+        row['id'] = str(uuid.uuid4())
+        row['patient_id'] = row.get('patient_id') or next(numbers)
+    now = datetime.utcnow()
+    # executemany of one compiled INSERT; PyMySQL sends it as multi-row INSERT ... VALUES
+    connection.execute(insert(Patient.__table__), rows)
+    connection.execute(insert(PatientSearchToken.__table__), [
+        {"patient_id": row['id'], "token": token, "field": field}
+        for row in rows for token, field in search.patient_tokens(SimpleNamespace(**row))
+    ])
+    connection.execute(insert(PatientSummary.__table__), [
+        {"patient_id": row['id'], "visit_count": 0, "active_medication_count": 0, "allergy_count": 0,
+         "severe_allergy": False, "updated_at": now} for row in rows
+    ])
+    connection.execute(insert(DoctorPatient.__table__), [{"doctor_id": doctor_id, "patient_id": row['id']} for row in rows])
+    # Like a DoctorPatient insert through the ORM: drop the doctor's cached access set now and after the commit
+    access_index.invalidate(doctor_id)
+    db.session.info.setdefault('changed_doctor_ids', set()).add(doctor_id)
+    return rows
+
+
+def age_from_birthdate(birthdate, today=None):
+    """Age in whole years on `today` (default: the current date)."""
+    today = today or date.today()
+    return today.year - birthdate.year - ((today.month, today.day) < (birthdate.month, birthdate.day))
+
+
+class RowValidator:
+    """
+    PatientForm's rules and the column sizes of patient_basic. One form is
+    reused for every row and only its fields' own coercion and validators
+    run, the part of Form.process and Form.validate that a CSV row needs,
+    which is about a third of their cost.
+    """
+
+    def __init__(self):
+        form = self.form = PatientForm(formdata=None, meta={'csrf': False})
+        self.fields = []
+        for name in COLUMNS:
+            # Inline validate_<field> methods, as Form.validate passes them
+            inline = getattr(type(form), f"validate_{name}", None)
+            self.fields.append((form[name], [inline] if inline else []))
+        self.lengths = {column.name: column.type.length for column in Patient.__table__.columns
+                        if column.name in COLUMNS and isinstance(column.type, String) and column.type.length}
+
+    def check(self, values):
+        """(row, None) with the patient_basic values of a CSV row, or (None, errors by column)."""
+        values = {column: (values.get(column) or '').strip() for column in COLUMNS}
+        if not values['age'] and values['birthdate']:
+            # The form asks for the age; a roster often only has the birthdate
+            try:
+                values['age'] = str(age_from_birthdate(date.fromisoformat(values['birthdate'])))
+            except ValueError:
+                pass
+        form = self.form
+        errors = {}
+        for field, extra in self.fields:
+            field.data = field.default
+            field.process_errors = []
+            field.raw_data = [values[field.name]]
+            try:
+                field.process_formdata(field.raw_data)
+            except ValueError as error:
+                field.process_errors.append(error.args[0])
+            for filter in field.filters:
+                field.data = filter(field.data)
+            if not field.validate(form, extra):
+                errors[field.name] = list(field.errors)
+        for column, length in self.lengths.items():
+            if len(values[column]) > length:
+                errors.setdefault(column, []).append(f"Field cannot be longer than {length} characters.")
+        if errors:
+            return None, errors
+        return {
+            "firstname": form.firstname.data,
+            "lastname": form.lastname.data,
+            "age": str(form.age.data),
+            "birthdate": form.birthdate.data,
+            "gender": form.gender.data,
+            "contact_number": form.contact_number.data,
+            "home_address": form.home_address.data,
+            "ecd_name": form.ecd_name.data or None,
+            "ecd_contact_number": form.ecd_contact_number.data or None,
+        }, None
+
+
+class RosterResult:
+    def __init__(self, headers):
+        self.headers = headers
+        self.imported = 0
+        self.rejected = 0
+        # Why the import stopped early, with the rows before it already imported
+        self.error = None
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    def rate(self):
+        return (self.imported + self.rejected) / max(self.elapsed or time.perf_counter() - self.started, 1e-9)
+
+
+def _headers(reader):
+    if reader.fieldnames is None:
+        raise RosterError('The file is empty')
+    headers = [(name or '').strip().lower().replace(' ', '_') for name in reader.fieldnames]
+    missing = [column for column in REQUIRED_COLUMNS if column not in headers]
+    if 'age' not in headers and 'birthdate' not in headers:
+        missing.append('age or birthdate')
+    if missing:
+        raise RosterError(f"Missing column{'s' if len(missing) > 1 else ''}: {', '.join(missing)}")
+    reader.fieldnames = headers
+    return headers
+
+
+def import_roster(lines, doctor_id, chunk_size=None, on_reject=None, report=None):
+    """
+    Import the patients of a CSV roster (a header row naming the COLUMNS,
+    then one patient per row) as patients of `doctor_id`, committing every
+    `chunk_size` accepted rows. Rejected rows are passed to
+    `on_reject(line, values, errors)`, progress to `report(result)` after
+    every chunk. Returns the RosterResult. Bytes that are not UTF-8 after
+    the header stop the import; the rows read before them are imported and
+    the result's `error` says where it stopped.
+    """
+    chunk_size = chunk_size or current_app.config.get('ROSTER_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
+    reader = csv.DictReader(lines)
+    result = RosterResult(_headers(reader))
+    validator = RowValidator()
+
+    def write(chunk):
+        insert_patients(db.session.connection(), chunk, doctor_id)
+        db.session.commit()
+        result.imported += len(chunk)
+        if report is not None:
+            report(result)
+
+    chunk = []
+    try:
+        for values in reader:
+            if not any((value or '').strip() for value in values.values() if isinstance(value, str)):
+                continue
+            row, errors = validator.check(values)
+            if errors:
+                result.rejected += 1
+                if on_reject is not None:
+                    on_reject(reader.line_num, values, errors)
+                continue
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                write(chunk)
+                chunk = []
+    except UnicodeDecodeError:
+        # Earlier chunks are committed already, so keep the rows read so far too
+        result.error = f"The file is not UTF-8 encoded text after line {reader.line_num}; the rows up to it were imported."
+    if chunk:
+        write(chunk)
+    result.elapsed = time.perf_counter() - result.started
+    return result
+
+
+def rejected_row(line, values, errors):
+    """A row of the rejected-rows report: the line number, the row as read and what is wrong with it."""
+    row = {name: value for name, value in values.items() if name is not None}
+    row.update(line=line, errors='; '.join(f"{column}: {' '.join(messages)}" for column, messages in errors.items()))
+    return row
+
+
+def rejected_fields(headers):
+    return ['line'] + [name for name in headers if name not in (None, 'line', 'errors')] + ['errors']
+
+
+def rejected_csv(headers, rows):
+    """The rejected-rows report as CSV text."""
+    output = io.StringIO()
+    writer = csv.DictWriter(output, rejected_fields(headers), extrasaction='ignore')
+    writer.writeheader()
+    writer.writerows(rows)
+    return output.getvalue()
@@ -0,0 +1,100 @@
+from sqlalchemy import Integer, cast
+from sqlalchemy.orm import joinedload
+from . import db, patient_summary
+from .models import Patient, DoctorPatient
+from .pagination import keyset_paginate, CursorError
+from .search import matching_patient_ids
+
+DEFAULT_PAGE_SIZE = 25
+MAX_PAGE_SIZE = 100
+
+# Sort keys for the patient list. Each ends with the primary key so the
+# ordering is total and every row has a unique keyset position.
+PATIENT_SORTS = {
+    'recent': (Patient.created_at, Patient.id),
+    'name': (Patient.firstname, Patient.id),
+}
+
+
+def doctor_patients_query(doctor_id):
+    """All patients linked to a doctor, as a single JOIN against doctor_patient, with their summaries."""
+    return (
+        db.session.query(Patient)
+        .join(DoctorPatient, DoctorPatient.patient_id == Patient.id)
+        .filter(DoctorPatient.doctor_id == doctor_id)
+        .options(joinedload(Patient.summary))
+    )
+
+
+def parse_age_range(age_range):
+    """Turn an age filter such as '21-40' or '60+' into (min_age, max_age)."""
+    if not age_range:
+        return None
+    try:
+        if age_range.endswith('+'):
+            return int(age_range[:-1]), None
+        min_age, max_age = age_range.split('-')
+        return int(min_age), int(max_age)
+    except ValueError:
+        return None
+
+
+def apply_patient_filters(query, search_query=None, age_range=None, gender=None):
+    """Apply the search box, age range and gender filters of the patient list."""
+    if search_query:
+        # Resolved through the patient_search_token prefix index, not LIKE '%q%'
+        matches = matching_patient_ids(search_query)
+        if matches is not None:
+            query = query.filter(Patient.id.in_(matches))
+
+    ages = parse_age_range(age_range)
+    if ages:
+        # age is stored as a string, compare it numerically
+        age = cast(Patient.age, Integer)
+        min_age, max_age = ages
+        query = query.filter(age >= min_age)
+        if max_age is not None:
+            query = query.filter(age <= max_age)
+
+    if gender:
+        query = query.filter(Patient.gender == gender)
+    return query
+
+
+def clamp_page_size(per_page):
+    try:
+        per_page = int(per_page)
+    except (TypeError, ValueError):
+        return DEFAULT_PAGE_SIZE
+    return max(1, min(per_page, MAX_PAGE_SIZE))
+
+
+def list_doctor_patients(doctor_id, filter_by='recent', sort_order='desc', cursor=None,
+                         per_page=DEFAULT_PAGE_SIZE, search_query=None, age_range=None, gender=None):
+    """
+    Return one keyset-paginated page of a doctor's patients.
+
+    The page is read with a single JOIN ... ORDER BY ... LIMIT statement that
+    seeks past the cursor instead of using OFFSET, so page N costs the same as
+    page 1 regardless of how many patients the doctor has.
+    """
+    if filter_by not in PATIENT_SORTS:
+        filter_by = 'recent'
+    descending = sort_order != 'asc'
+    columns = PATIENT_SORTS[filter_by]
+    scope = f"patients:{filter_by}:{'desc' if descending else 'asc'}"
+
+    query = apply_patient_filters(doctor_patients_query(doctor_id), search_query, age_range, gender)
+
+    def key_fn(patient):
+        return [getattr(patient, column.key) for column in columns]
+
+    try:
+        page = keyset_paginate(query, columns, key_fn, cursor=cursor, limit=clamp_page_size(per_page),
+                               descending=descending, scope=scope)
+    except CursorError:
+        # A stale or foreign cursor simply restarts the listing
+        page = keyset_paginate(query, columns, key_fn, limit=clamp_page_size(per_page),
+                               descending=descending, scope=scope)
+    patient_summary.ensure(page.items)
+    return page
@@ -0,0 +1,264 @@
+from datetime import datetime
+from sqlalchemy import bindparam, delete, event, func, insert, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, object_session
+from . import db
+from .models import AllergyIntolerance, Appointment, MedicationStatement, Patient, PatientSummary, Visit
+
+# Appointment statuses that still lead to the patient being seen
+OPEN_APPOINTMENT_STATUSES = ('proposed', 'pending', 'booked', 'arrived', 'checked-in', 'waitlist')
+
+# Summary columns of each aspect, and the fields of its model that can change them
+ASPECT_COLUMNS = {
+    'visits': ('last_visit_at', 'visit_count'),
+    'appointments': ('next_appointment_at',),
+    'medications': ('active_medication_count',),
+    'allergies': ('allergy_count', 'allergy_flags', 'severe_allergy'),
+}
+WATCHED_MODELS = {
+    Visit: ('visits', ('patient_id', 'visit_date', 'status')),
+    Appointment: ('appointments', ('patient_id', 'start', 'status')),
+    MedicationStatement: ('medications', ('patient_id', 'status')),
+    AllergyIntolerance: ('allergies', ('patient_id', 'substance', 'clinical_status', 'severity')),
+}
+
+
+def _visit_values(connection, patient_ids, now):
+    values = {patient_id: {"last_visit_at": None, "visit_count": 0} for patient_id in patient_ids}
+    rows = connection.execute(
+        select(Visit.patient_id, func.max(Visit.visit_date), func.count())
+        .where(Visit.patient_id.in_(patient_ids), Visit.status != 'cancelled')
+        .group_by(Visit.patient_id)
+    )
+    for patient_id, last_visit_at, visit_count in rows:
+        values[patient_id] = {"last_visit_at": last_visit_at, "visit_count": visit_count}
+    return values
+
+
+def _appointment_values(connection, patient_ids, now):
+    values = {patient_id: {"next_appointment_at": None} for patient_id in patient_ids}
+    rows = connection.execute(
+        select(Appointment.patient_id, func.min(Appointment.start))
+        .where(Appointment.patient_id.in_(patient_ids), Appointment.start >= now,
+               Appointment.status.in_(OPEN_APPOINTMENT_STATUSES))
+        .group_by(Appointment.patient_id)
+    )
+    for patient_id, next_appointment_at in rows:
+        values[patient_id] = {"next_appointment_at": next_appointment_at}
+    return values
+
+
+def _medication_values(connection, patient_ids, now):
+    values = {patient_id: {"active_medication_count": 0} for patient_id in patient_ids}
+    rows = connection.execute(
+        select(MedicationStatement.patient_id, func.count())
+        .where(MedicationStatement.patient_id.in_(patient_ids), MedicationStatement.status == 'active')
+        .group_by(MedicationStatement.patient_id)
+    )
+    for patient_id, count in rows:
+        values[patient_id] = {"active_medication_count": count}
+    return values
+
+
+def _allergy_values(connection, patient_ids, now):
+    substances = {patient_id: set() for patient_id in patient_ids}
+    severe = set()
+    rows = connection.execute(
+        select(AllergyIntolerance.patient_id, AllergyIntolerance.substance, AllergyIntolerance.severity)
+        .where(AllergyIntolerance.patient_id.in_(patient_ids),
+               or_(AllergyIntolerance.clinical_status.is_(None), AllergyIntolerance.clinical_status == 'active'))
+    )
+    for patient_id, substance, severity in rows:
+        substances[patient_id].add(substance.replace(',', ' ').strip())
+        if severity == 'severe':
+            severe.add(patient_id)
+
+    max_length = PatientSummary.allergy_flags.type.length
+    values = {}
+    for patient_id, names in substances.items():
+        flags = ','.join(sorted(name for name in names if name))
+        if len(flags) > max_length:
+            flags = flags[:max_length].rsplit(',', 1)[0]
+        values[patient_id] = {"allergy_count": len(names), "allergy_flags": flags or None,
+                              "severe_allergy": patient_id in severe}
+    return values
+
+
+ASPECT_VALUES = {
+    'visits': _visit_values,
+    'appointments': _appointment_values,
+    'medications': _medication_values,
+    'allergies': _allergy_values,
+}
+
+
+def compute(connection, patient_ids, aspects=tuple(ASPECT_COLUMNS), now=None):
+    """Summary column values per patient id for the given aspects, with one grouped query per aspect."""
+    now = now or datetime.utcnow()
+    patient_ids = list(patient_ids)
+    values = {patient_id: {} for patient_id in patient_ids}
+    for aspect in aspects:
+        for patient_id, columns in ASPECT_VALUES[aspect](connection, patient_ids, now).items():
+            values[patient_id].update(columns)
+    return values
+
+
+def refresh(connection, changes, now=None):
+    """
+    Recompute the changed aspects of existing summary rows: `changes` maps
+    patient id -> set of aspects. Patients without a summary row yet are
+    left to `ensure` or `rebuild`.
+    """
+    now = now or datetime.utcnow()
+    t = PatientSummary.__table__
+    by_aspects = {}
+    for patient_id, aspects in changes.items():
+        by_aspects.setdefault(frozenset(aspects), []).append(patient_id)
+    for aspects, patient_ids in by_aspects.items():
+        columns = [column for aspect in sorted(aspects) for column in ASPECT_COLUMNS[aspect]]
+        statement = (
+            update(t).where(t.c.patient_id == bindparam('summary_patient_id'))
+            .values({column: bindparam(column) for column in columns + ['updated_at']})
+        )
+        params = [
+            dict(columns, summary_patient_id=patient_id, updated_at=now)
+            for patient_id, columns in compute(connection, patient_ids, sorted(aspects), now).items()
+        ]
+        connection.execute(statement, params)
+
+
+def _summary_rows(connection, patient_ids, now):
+    return [dict(columns, patient_id=patient_id, updated_at=now)
+            for patient_id, columns in compute(connection, patient_ids, now=now).items()]
+
+
+def rebuild(batch_size=1000):
+    """Recompute every patient's summary from scratch, a batch of patients per transaction. Returns the count."""
+    t = PatientSummary.__table__
+    db.session.execute(delete(t))
+    db.session.commit()
+    count = 0
+    last_id = None
+    while True:
+        query = select(Patient.id).order_by(Patient.id).limit(batch_size)
+        if last_id is not None:
+            query = query.where(Patient.id > last_id)
+        patient_ids = db.session.execute(query).scalars().all()
+        if not patient_ids:
+            break
+        db.session.execute(insert(t), _summary_rows(db.session.connection(), patient_ids, datetime.utcnow()))
+        db.session.commit()
+        count += len(patient_ids)
+        last_id = patient_ids[-1]
+    return count
+
+
+def ensure(patients, now=None):
+    """
+    Bring the summaries of a page of patients up to date before they are
+    shown: create missing rows and move on a next appointment that has
+    passed, the one value that changes with time alone. Runs in a short
+    transaction of its own and reloads only the rows it touched.
+    """
+    now = now or datetime.utcnow()
+    missing = [patient.id for patient in patients if patient.summary is None]
+    expired = [patient.id for patient in patients
+               if patient.summary is not None and patient.summary.next_appointment_at is not None
+               and patient.summary.next_appointment_at < now]
+    if not missing and not expired:
+        return
+
+    for attempt in range(3):
+        try:
+            with db.engine.begin() as connection:
+                if expired:
+                    refresh(connection, {patient_id: {'appointments'} for patient_id in expired}, now)
+                if missing:
+                    connection.execute(insert(PatientSummary.__table__), _summary_rows(connection, missing, now))
+            break
+        except IntegrityError:
+            # Another request created some of the missing rows first
+            with db.engine.connect() as connection:
+                existing = set(connection.execute(
+                    select(PatientSummary.patient_id).where(PatientSummary.patient_id.in_(missing))
+                ).scalars())
+            expired += [patient_id for patient_id in missing if patient_id in existing]
+            missing = [patient_id for patient_id in missing if patient_id not in existing]
+    for patient in patients:
+        if patient.id in missing or patient.id in expired:
+            db.session.expire(patient, ['summary'])
+
+
+def refresh_expired(batch_size=1000, now=None):
+    """Move on every next appointment that has passed, e.g. from a nightly job. Returns the rows updated."""
+    now = now or datetime.utcnow()
+    count = 0
+    while True:
+        patient_ids = db.session.execute(
+            select(PatientSummary.patient_id).where(PatientSummary.next_appointment_at < now).limit(batch_size)
+        ).scalars().all()
+        if not patient_ids:
+            return count
+        refresh(db.session.connection(), {patient_id: {'appointments'} for patient_id in patient_ids}, now)
+        db.session.commit()
+        count += len(patient_ids)
+
+
+def _changed_patient_ids(target):
+    """The patient id of a row, plus its previous value if it was moved to another patient."""
+    patient_ids = {target.patient_id}
+    patient_ids.update(value for value in db.inspect(target).attrs.patient_id.history.deleted if value)
+    return patient_ids
+
+
+def _mark_changed(target):
+    session = object_session(target)
+    if session is None:
+        return
+    aspect = WATCHED_MODELS[type(target)][0]
+    changes = session.info.setdefault('patient_summary_changes', {})
+    for patient_id in _changed_patient_ids(target):
+        changes.setdefault(patient_id, set()).add(aspect)
+
+
+# Collect the patients whose visits, appointments, medications or allergies
+# change during a flush, then recompute their summaries once per flush
+def _row_written(mapper, connection, target):
+    _mark_changed(target)
+
+def _row_updated(mapper, connection, target):
+    state = db.inspect(target)
+    if any(state.attrs[field].history.has_changes() for field in WATCHED_MODELS[type(target)][1]):
+        _mark_changed(target)
+
+for _model in WATCHED_MODELS:
+    event.listen(_model, 'after_insert', _row_written)
+    event.listen(_model, 'after_delete', _row_written)
+    event.listen(_model, 'after_update', _row_updated)
+
+
+@event.listens_for(Patient, 'after_insert')
+def create_summary(mapper, connection, target):
+    # A new patient has nothing to summarize yet; rows added in the same flush are counted afterwards
+    connection.execute(insert(PatientSummary.__table__).values(patient_id=target.id, updated_at=datetime.utcnow()))
+
+@event.listens_for(Patient, 'before_delete')
+def delete_summary(mapper, connection, target):
+    connection.execute(delete(PatientSummary.__table__).where(PatientSummary.patient_id == target.id))
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('patient_summary_deleted', set()).add(target.id)
+
+@event.listens_for(Session, 'after_flush')
+def update_summaries(session, flush_context):
+    changes = session.info.pop('patient_summary_changes', None)
+    deleted = session.info.pop('patient_summary_deleted', set())
+    if changes:
+        changes = {patient_id: aspects for patient_id, aspects in changes.items() if patient_id not in deleted}
+        if changes:
+            refresh(session.connection(), changes)
+
+@event.listens_for(Session, 'after_rollback')
+def forget_summary_changes(session):
+    session.info.pop('patient_summary_changes', None)
+    session.info.pop('patient_summary_deleted', None)
@@ -0,0 +1,292 @@
+import base64, binascii, hashlib, os, secrets
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from flask import current_app
+from werkzeug.exceptions import ClientDisconnected
+from werkzeug.http import http_date
+from werkzeug.utils import secure_filename
+from . import db, derivatives
+from .derivatives import file_hash
+from .models import AdditionalDocument, LabScan, LabScanGroup, Patient, UploadSession
+from .storage import get_store
+from .utils import allowed_file
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process lock, the offset check still applies
+    fcntl = None
+
+# The tus 1.0 protocol (https://tus.io/protocols/resumable-upload), with
+# an extra finalize step that checks the file and creates its record
+TUS_VERSION = '1.0.0'
+TUS_EXTENSIONS = 'creation,checksum,termination,expiration'
+CHECKSUM_ALGORITHM = 'sha256'
+CHUNK_SIZE = 1024 * 1024
+DEFAULT_MAX_SIZE = 4 * 1024 ** 3
+DEFAULT_SESSION_TTL = 24 * 3600
+DOCUMENT_EXTENSIONS = {'pdf', 'doc', 'docx'}
+TARGETS = ('document', 'lab_scan')
+
+
+class UploadError(Exception):
+    """A request the upload session cannot accept; `status` is the HTTP status to answer with."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def parse_metadata(header):
+    """Decode an Upload-Metadata header: comma-separated `key base64(value)` pairs."""
+    metadata = {}
+    for pair in (header or '').split(','):
+        if not pair.strip():
+            continue
+        key, _, value = pair.strip().partition(' ')
+        try:
+            metadata[key] = base64.b64decode(value, validate=True).decode('utf-8') if value else ''
+        except (binascii.Error, UnicodeDecodeError):
+            raise UploadError(f"Invalid Upload-Metadata value for {key!r}")
+    return metadata
+
+
+def part_path(upload_id):
+    """Where the bytes received so far for an upload are kept."""
+    return os.path.join(current_app.config['UPLOAD_SESSION_FOLDER'], f"{upload_id}.part")
+
+
+def tus_headers(session=None):
+    headers = {'Tus-Resumable': TUS_VERSION, 'Cache-Control': 'no-store'}
+    if session is not None:
+        headers['Upload-Offset'] = str(session.offset)
+        headers['Upload-Length'] = str(session.length)
+        if session.status == 'open':
+            headers['Upload-Expires'] = http_date(session.expires_at)
+    return headers
+
+
+def _session_ttl():
+    return timedelta(seconds=current_app.config.get('UPLOAD_SESSION_TTL', DEFAULT_SESSION_TTL))
+
+
+def create_session(user_id, length, metadata):
+    """
+    Start an upload of `length` bytes. `metadata` names the file
+    (`filename`, optional `content_type` and `checksum`, the file's SHA-256
+    in hex) and where it goes: `target` 'document' with `patient_id` and
+    `document_name`, or 'lab_scan' with `group_id`. Access to the patient is
+    the caller's to check.
+    """
+    max_size = current_app.config.get('UPLOAD_MAX_SIZE', DEFAULT_MAX_SIZE)
+    if length is None or length < 0:
+        raise UploadError('Upload-Length is required')
+    if length > max_size:
+        raise UploadError(f'Uploads are limited to {max_size} bytes', 413)
+
+    target = metadata.get('target')
+    if target not in TARGETS:
+        raise UploadError(f"target must be one of {', '.join(TARGETS)}")
+    filename = secure_filename(metadata.get('filename', ''))
+    extension = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    if not filename or (extension not in DOCUMENT_EXTENSIONS if target == 'document' else not allowed_file(filename)):
+        raise UploadError('Invalid file type')
+    checksum = (metadata.get('checksum') or '').lower() or None
+    if checksum is not None and (len(checksum) != 64 or any(c not in '0123456789abcdef' for c in checksum)):
+        raise UploadError('checksum must be a hex SHA-256')
+
+    group = None
+    if target == 'lab_scan':
+        group = db.session.get(LabScanGroup, int(metadata['group_id'])) if metadata.get('group_id', '').isdigit() else None
+        if group is None:
+            raise UploadError('Unknown lab scan group', 404)
+        patient_id = group.patient_id
+    else:
+        patient_id = metadata.get('patient_id')
+        if not metadata.get('document_name'):
+            raise UploadError('document_name is required')
+        if not patient_id or db.session.get(Patient, patient_id) is None:
+            raise UploadError('Unknown patient', 404)
+
+    now = datetime.utcnow()
+    session = UploadSession(
+        id=secrets.token_hex(16),
+        user_id=user_id,
+        patient_id=patient_id,
+        target=target,
+        group_id=group.id if group else None,
+        document_name=(metadata.get('document_name') or '')[:150] or None,
+        filename=filename,
+        content_type=metadata.get('content_type') or None,
+        length=length,
+        offset=0,
+        checksum=checksum,
+        status='open',
+        created_at=now,
+        updated_at=now,
+        expires_at=now + _session_ttl(),
+    )
+    os.makedirs(current_app.config['UPLOAD_SESSION_FOLDER'], exist_ok=True)
+    open(part_path(session.id), 'wb').close()
+    db.session.add(session)
+    db.session.commit()
+    return session
+
+
+@contextmanager
+def _locked_part(session):
+    """The session's part file, opened for writing and locked against other workers."""
+    try:
+        handle = open(part_path(session.id), 'r+b')
+    except FileNotFoundError:
+        raise UploadError('The upload has expired', 410)
+    with handle:
+        if fcntl is not None:
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise UploadError('Another request is writing to this upload', 423)
+        yield handle
+
+
+def _check_open(session):
+    if session.status != 'open':
+        raise UploadError('The upload is already complete', 409)
+    if session.expires_at < datetime.utcnow():
+        raise UploadError('The upload has expired', 410)
+
+
+def _chunk_checksum(header):
+    """The expected digest of an Upload-Checksum header (`sha256 <base64>`), or None."""
+    if not header:
+        return None
+    algorithm, _, value = header.partition(' ')
+    if algorithm.lower() != CHECKSUM_ALGORITHM:
+        raise UploadError(f'Unsupported checksum algorithm; use {CHECKSUM_ALGORITHM}')
+    try:
+        return base64.b64decode(value, validate=True)
+    except binascii.Error:
+        raise UploadError('Invalid Upload-Checksum')
+
+
+def write_chunk(session, offset, stream, checksum=None):
+    """
+    Append the request body at `offset`, which must be where the previous
+    chunk ended. The body is copied to the part file CHUNK_SIZE bytes at a
+    time, so memory use does not depend on the chunk size. When the client
+    disconnects, whatever arrived is kept and the next chunk resumes there.
+    With an Upload-Checksum the chunk is discarded unless it matches.
+    Returns the new offset.
+    """
+    _check_open(session)
+    expected = _chunk_checksum(checksum)
+    with _locked_part(session) as handle:
+        handle.seek(0, os.SEEK_END)
+        # The part file is the truth; the row may lag behind after a crash
+        current = handle.tell()
+        if offset != current:
+            session.offset = current
+            db.session.commit()
+            raise UploadError(f'Upload-Offset must be {current}', 409)
+
+        digest = hashlib.sha256()
+        remaining = session.length - current
+        disconnected = False
+        try:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                if len(chunk) > remaining:
+                    handle.truncate(current)
+                    raise UploadError('The chunk goes past Upload-Length', 413)
+                handle.write(chunk)
+                digest.update(chunk)
+                remaining -= len(chunk)
+        except ClientDisconnected:
+            disconnected = True
+        handle.flush()
+
+        if expected is not None and (disconnected or digest.digest() != expected):
+            handle.truncate(current)
+            if not disconnected:
+                raise UploadError('Checksum mismatch', 460)
+        session.offset = handle.tell()
+
+    session.updated_at = datetime.utcnow()
+    session.expires_at = session.updated_at + _session_ttl()
+    db.session.commit()
+    return session.offset
+
+
+def _create_record(session, content_hash):
+    if session.target == 'document':
+        record = AdditionalDocument(patient_id=session.patient_id, document_name=session.document_name,
+                                    document_file=session.filename, content_hash=content_hash)
+    else:
+        record = LabScan(filename=session.filename, file_path=f"lab_scans/{session.filename}",
+                         group_id=session.group_id, content_hash=content_hash)
+    db.session.add(record)
+    return record
+
+
+def finalize(session, checksum=None):
+    """
+    Check a fully received upload against its SHA-256, move it into the
+    blob store and create its AdditionalDocument or LabScan. On a checksum
+    mismatch the received bytes are discarded so the file can be sent
+    again. Finalizing twice returns the same record.
+    """
+    if session.status == 'complete':
+        return session
+    _check_open(session)
+    expected = (checksum or session.checksum or '').lower() or None
+    with _locked_part(session) as handle:
+        handle.seek(0, os.SEEK_END)
+        if handle.tell() != session.length:
+            session.offset = handle.tell()
+            db.session.commit()
+            raise UploadError(f'Only {session.offset} of {session.length} bytes have been received', 409)
+
+        content_hash = file_hash(handle.name)
+        if expected is not None and content_hash != expected:
+            handle.truncate(0)
+            session.offset = 0
+            db.session.commit()
+            raise UploadError('Checksum mismatch; upload the file again', 460)
+        store = get_store()
+        stored = store.adopt(handle.name, content_hash, session.content_type)
+
+    record = _create_record(session, stored.content_hash)
+    db.session.flush()
+    session.status = 'complete'
+    session.record_id = record.id
+    session.content_hash = stored.content_hash
+    session.updated_at = datetime.utcnow()
+    db.session.commit()
+
+    if session.target == 'lab_scan' and record.is_image:
+        derivatives.schedule(store.source(stored.content_hash), current_app.config['DERIVATIVE_FOLDER'],
+                             stored.content_hash, workers=current_app.config['DERIVATIVE_WORKERS'])
+    return session
+
+
+def terminate(session):
+    """Abandon an upload and delete what was received."""
+    try:
+        os.remove(part_path(session.id))
+    except FileNotFoundError:
+        pass
+    db.session.delete(session)
+    db.session.commit()
+
+
+def expire_sessions(now=None):
+    """Delete expired sessions and their part files; returns how many were removed."""
+    now = now or datetime.utcnow()
+    expired = UploadSession.query.filter(UploadSession.expires_at < now).all()
+    for session in expired:
+        try:
+            os.remove(part_path(session.id))
+        except FileNotFoundError:
+            pass
+        db.session.delete(session)
+    db.session.commit()
+    return len(expired)
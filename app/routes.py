@@ -1,18 +1,50 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app, send_from_directory, abort
+from flask import Blueprint, Response, render_template, request, redirect, url_for, flash, current_app, abort, jsonify, make_response, stream_with_context
 from flask_login import login_user, logout_user, login_required, current_user
 from flask_mail import Message
-from datetime import datetime
-from .models import User, UserEducation,LabScan, LabScanGroup, AdditionalDocument, DoctorPatient, Patient, Visit, Appointment, SurveyResponse, Vitals, AllergyIntolerance, Observation,Immunization, Procedure,MedicalHistory, MedicationStatement
-from .forms import SurveyForm,UploadDocumentForm,RequestResetForm, ResetPasswordForm, RegisterForm,MedicationStatementForm,AllergyIntoleranceForm, AddVisitForm, PatientForm, AppointmentForm, VisitForm, ObservationForm, PasswordResetForm, UserUpdateProfile, PatientUpdateForm, ImmunizationForm, ProcedureForm, VitalsForm, MedicalHistoryForm
-from . import db, bcrypt, mail
+from datetime import datetime, timedelta
+from .models import User, UserEducation,LabScan, LabScanGroup, AdditionalDocument, DoctorPatient, Patient, Visit, Appointment, SurveyResponse, Vitals, AllergyIntolerance, Observation,Immunization, Procedure,MedicalHistory, MedicationStatement, UploadSession, ExportJob
+from .forms import SurveyForm,UploadDocumentForm,RequestResetForm, ResetPasswordForm, RegisterForm,MedicationStatementForm,AllergyIntoleranceForm, AddVisitForm, PatientForm, AppointmentForm, VisitForm, ObservationForm, PasswordResetForm, UserUpdateProfile, PatientUpdateForm, ImmunizationForm, ProcedureForm, VitalsForm, MedicalHistoryForm, PatientImportForm
+from . import db, bcrypt, mail, terminology, outbox, derivatives, resumable, vitals_series, cohorts, timeline, fhir, bulk_export, fhir_import, patient_import
 from .utils import allowed_file, send_reset_email, redirect_dashboard
 from .config import Config
+from .patient_list import list_doctor_patients, DEFAULT_PAGE_SIZE
+from .search import search_patients, DEFAULT_RESULT_LIMIT
+from .chart import load_section, latest_appointments, CHART_SECTIONS, DEFAULT_SECTION_SIZE
+from .user_cache import user_cache
+from .access import access_index, can_access_patient, patient_access_required
+from .storage import get_store, remove_legacy_file
+from .downloads import serve_file, send_upload
+from .exports import lab_scan_group_entries, zip_stream
+from .scan_uploads import DEFAULT_MAX_BATCH_FILES, insert_lab_scans, schedule_derivatives, store_files
+from .schedule import (CALENDAR_VIEWS, DEFAULT_UPCOMING_SIZE, MAX_WINDOW_APPOINTMENTS, adjacent_anchors,
+                       appointments_between, calendar_event, calendar_window, parse_anchor, parse_datetime,
+                       upcoming_appointments)
+from werkzeug.http import http_date
 from werkzeug.utils import secure_filename
-import os
+import base64, io, os
 from sqlalchemy.orm import joinedload
 
 bp = Blueprint('main', __name__)
 
+# Row partials of the chart sections that view_patient loads on demand
+CHART_ROW_TEMPLATES = {
+    'visits': 'partials/visit_rows.html',
+    'appointments': 'partials/appointment_rows.html',
+    'immunizations': 'partials/immunization_rows.html',
+    'allergies': 'partials/allergy_rows.html',
+    'medications': 'partials/medication_rows.html',
+    'medical_history': 'partials/medical_history_rows.html',
+}
+
+# Edit dialogs shown in the shared chart modal: (template, record name, form)
+CHART_EDIT_DIALOGS = {
+    'appointments': ('partials/edit_appointment.html', 'appointment', AppointmentForm),
+    'immunizations': ('partials/edit_immunization.html', 'immunization', ImmunizationForm),
+    'allergies': ('partials/edit_allergy.html', 'allergy', AllergyIntoleranceForm),
+    'medications': ('partials/edit_medication.html', 'medication', MedicationStatementForm),
+    'medical_history': ('partials/edit_medical_history.html', 'medicalhistory', MedicalHistoryForm),
+}
+
 @bp.route('/')
 def index():
     return render_template('home.html')
@@ -131,47 +163,58 @@ def doctor_patients():
     sort_order = request.args.get('sort_order', 'desc')  
     age_range = request.args.get('age_range') 
     gender_filter = request.args.get('gender') 
-
-
-    # Fetch patients linked to the logged-in doctor
-    doctor_id = current_user.id
-    doctor_patients = DoctorPatient.query.filter_by(doctor_id=doctor_id).all()
-    patients_query = db.session.query(Patient).filter(Patient.id.in_([relation.patient_id for relation in doctor_patients]))
-
-    # Apply search filter
-    if search_query:
-        patients_query = patients_query.filter(
-            (Patient.patient_id.like(f"%{search_query}%")) |
-            (Patient.firstname.like(f"%{search_query}%")) |
-            (Patient.lastname.like(f"%{search_query}%"))
-        )
-
-    # Apply age range filter
-    if age_range:
-        min_age, max_age = map(int, age_range.split('-'))
-        patients_query = patients_query.filter(Patient.age.between(min_age, max_age))
-
-    # Apply gender filter
-    if gender_filter:
-        patients_query = patients_query.filter(Patient.gender == gender_filter)
-
-    # Apply sorting filters
-    if filter_by == 'recent':
-        patients_query = patients_query.order_by(Patient.created_at.desc() if sort_order == 'desc' else Patient.created_at.asc())
-    elif filter_by == 'name':
-        patients_query = patients_query.order_by(Patient.firstname.asc() if sort_order == 'asc' else Patient.firstname.desc())
-
-    # Get the final list of patients
-    patients = patients_query.all()
+    cursor = request.args.get('cursor')
+    per_page = request.args.get('per_page', DEFAULT_PAGE_SIZE)
+
+    # Fetch one page of the patients linked to the logged-in doctor
+    page = list_doctor_patients(
+        current_user.id,
+        filter_by=filter_by,
+        sort_order=sort_order,
+        cursor=cursor,
+        per_page=per_page,
+        search_query=search_query,
+        age_range=age_range,
+        gender=gender_filter,
+    )
     patient_form = PatientForm()
 
+    # Keep the active filters on the previous/next links
+    page_args = {key: value for key, value in request.args.items() if key != 'cursor'}
 
     return render_template('doctor_patients.html', 
-                           patients=patients, 
+                           patients=page.items, 
+                           page=page,
+                           page_args=page_args,
                            patient_form=patient_form,
                            show_return_button=True, 
                            return_url=request.referrer)
 
+@bp.route('/patients/search', methods=['GET'])
+@login_required
+def search_patients_json():
+    """Typeahead endpoint for the patient list search box."""
+    if current_user.role != 'doctor':
+        return jsonify({"error": "Unauthorized access"}), 403
+
+    query = request.args.get('q', '').strip()
+    limit = request.args.get('limit', DEFAULT_RESULT_LIMIT, type=int)
+    patients = search_patients(query, doctor_id=current_user.id, limit=limit)
+
+    return jsonify({
+        "query": query,
+        "results": [
+            {
+                "id": patient.id,
+                "patient_id": patient.patient_id,
+                "name": f"{patient.firstname} {patient.lastname}",
+                "url": url_for('main.view_patient', patient_id=patient.id),
+            }
+            for patient in patients
+        ],
+    })
+
+
 
 
 
@@ -179,74 +222,33 @@ def doctor_patients():
 
 @bp.route('/doctor/patient/<string:patient_id>', methods=['GET', 'POST'])
 @login_required
+@patient_access_required('You do not have permission to view this patient.')
 def view_patient(patient_id):
-    if current_user.role != 'doctor':
-        flash('Access unauthorized.', 'danger')
-        return redirect(url_for('login'))
-    
-    # load partient model and its related tables
-    patient = Patient.query.options(
-        joinedload(Patient.visits),
-        joinedload(Patient.appointments),
-        joinedload(Patient.immunizations),
-        joinedload(Patient.allergies),
-        joinedload(Patient.medications),
-        joinedload(Patient.observations),
-        joinedload(Patient.vitals),
-        joinedload(Patient.procedures),
-        joinedload(Patient.medical_history)
-    ).filter_by(id=patient_id).first_or_404()
+    patient = Patient.query.filter_by(id=patient_id).first_or_404()
 
     lab_scan_groups = patient.lab_scan_groups
     additional_documents = AdditionalDocument.query.filter_by(patient_id=patient_id).all()
 
-    doctor_patient = DoctorPatient.query.filter_by(doctor_id=current_user.id, patient_id=patient_id).first()
-    if not doctor_patient:
-        flash('You do not have permission to view this patient.', 'danger')
-        return redirect(url_for('main.doctor_dashboard'))
-    
-    # Get the latest appointment
-    latest_appointments = (
-        sorted(patient.appointments, key=lambda x: x.start, reverse=True)[:3]
-        if patient.appointments else  []
-    )
-    
-    
-    # Sort visits in descending order by visit_date and add reason descriptions
-    sorted_visits = sorted(patient.visits, key=lambda visit: visit.visit_date, reverse=True)
-
-    """
-    for visit in patient.visits:
-        visit.reason_code_description = reason_code_map.get(visit.reason_code, "Unknown Reason")
+    # Only the visit list is rendered up front; the tabbed sections and the
+    # edit dialogs are fetched by static/js/chart.js when they are opened
+    visits = load_section(patient_id, 'visits')
 
-    """
+    # Get the latest appointment
+    latest = latest_appointments(patient_id, limit=3)
 
-    immunizationform = ImmunizationForm()
-    medicationform = MedicationStatementForm()
-    allergyform = AllergyIntoleranceForm()
     appointmentform=AppointmentForm()
     medicalhistoryform = MedicalHistoryForm()
-    editmedicalhistoryform=MedicalHistoryForm()
     uploadform=UploadDocumentForm()
     visit_form = AddVisitForm()
 
     return render_template(
         'view_patient.html', 
         patient=patient, 
-        visit=patient.visits,
-        latest_appointments=latest_appointments,
-        sorted_visits=sorted_visits,
-        immunizations=patient.immunizations,
-        allergies=patient.allergies,
-        medications=patient.medications,
-        medicalhistory=patient.medical_history, 
+        visits=visits,
+        latest_appointments=latest,
         lab_scan_groups = lab_scan_groups,
-        immunizationform=immunizationform,
-        medicationform = medicationform,
         appointmentform = appointmentform,
-        allergyform = allergyform,
         medicalhistoryform=medicalhistoryform,
-        editmedicalhistoryform=editmedicalhistoryform,
         additional_documents = additional_documents,
         uploadform = uploadform,
         visit_form=visit_form,
@@ -254,6 +256,43 @@ def view_patient(patient_id):
         return_url=request.referrer
     )
 
+@bp.route('/doctor/patient/<string:patient_id>/chart/<string:section>', methods=['GET'])
+@login_required
+def chart_section(patient_id, section):
+    """One page of a chart section as an HTML fragment; the next cursor is sent in X-Next-Cursor."""
+    if current_user.role != 'doctor':
+        abort(403)
+    if section not in CHART_ROW_TEMPLATES:
+        abort(404)
+    if not can_access_patient(current_user.id, patient_id):
+        abort(403)
+    patient = Patient.query.filter_by(id=patient_id).first_or_404()
+
+    cursor = request.args.get('cursor')
+    page = load_section(patient_id, section, cursor=cursor, limit=request.args.get('limit', DEFAULT_SECTION_SIZE))
+
+    response = make_response(render_template(CHART_ROW_TEMPLATES[section], patient=patient, rows=page.items, cursor=cursor))
+    if page.next_cursor:
+        response.headers['X-Next-Cursor'] = page.next_cursor
+    return response
+
+@bp.route('/doctor/patient/<string:patient_id>/chart/<string:section>/<int:record_id>/edit', methods=['GET'])
+@login_required
+def chart_edit_dialog(patient_id, section, record_id):
+    """The edit form of a single chart record, rendered into the shared modal on view_patient."""
+    if current_user.role != 'doctor':
+        abort(403)
+    if section not in CHART_EDIT_DIALOGS:
+        abort(404)
+    if not can_access_patient(current_user.id, patient_id):
+        abort(403)
+    patient = Patient.query.filter_by(id=patient_id).first_or_404()
+
+    template, record_name, form_class = CHART_EDIT_DIALOGS[section]
+    model = CHART_SECTIONS[section].model
+    record = model.query.filter_by(id=record_id, patient_id=patient_id).first_or_404()
+    return render_template(template, patient=patient, form=form_class(), **{record_name: record})
+
 @bp.route('/visit/<int:visit_id>', methods=['GET'])
 @login_required
 def view_visit(visit_id):
@@ -272,8 +311,7 @@ def view_visit(visit_id):
     ).filter_by(id=visit_id).first_or_404()
 
     # Ensure the doctor has access to this patient
-    doctor_patient = DoctorPatient.query.filter_by(doctor_id=current_user.id, patient_id=visit.patient_id).first()
-    if not doctor_patient:
+    if not can_access_patient(current_user.id, visit.patient_id):
         flash('You do not have permission to view this visit.', 'danger')
         return redirect(url_for('main.doctor_dashboard'))
     """
@@ -307,21 +345,40 @@ def view_visit(visit_id):
 @bp.route('/view_appointments')
 @login_required
 def view_appointments():
-    # Get the current datetime to filter future appointments
-    now = datetime.now()
-
-    patient = Patient.query.filter_by(id=current_user.id).all()
-    # Query all appointments for the current doctor and use joinedload to load the patient data
-    all_appointments = Appointment.query.filter_by(doctor_id=current_user.id).options(joinedload(Appointment.patient)).all()
-    
-
-    # Filter and sort appointments by start time
-    # Only include appointments that are in the future
-    upcoming_appointments = [appointment for appointment in all_appointments if appointment.start > now]
-    sorted_appointments = sorted(upcoming_appointments, key=lambda x: x.start)
+    # ?view=upcoming (default) pages through future appointments; day, week and
+    # month show the window around ?date=YYYY-MM-DD
+    view = request.args.get('view', 'upcoming')
+    if view not in CALENDAR_VIEWS:
+        view = 'upcoming'
+
+    if view == 'upcoming':
+        page = upcoming_appointments(current_user.id, cursor=request.args.get('cursor'),
+                                     limit=request.args.get('per_page', DEFAULT_UPCOMING_SIZE))
+        return render_template('view_appointments.html', view=view, appointments=page.items, page=page)
+
+    anchor = parse_anchor(request.args.get('date'))
+    start, end = calendar_window(view, anchor)
+    appointments, truncated = appointments_between(current_user.id, start, end)
+    prev_anchor, next_anchor = adjacent_anchors(view, anchor)
+    return render_template('view_appointments.html', view=view, appointments=appointments,
+                           window_start=start, window_end=end, truncated=truncated,
+                           prev_anchor=prev_anchor, next_anchor=next_anchor)
+
+
+@bp.route('/view_appointments/feed')
+@login_required
+def appointments_feed():
+    """JSON events between ?start= and ?end= for a calendar widget."""
+    start = parse_datetime(request.args.get('start'))
+    end = parse_datetime(request.args.get('end'))
+    if start is None or end is None or end <= start:
+        return jsonify({"error": "start and end must be ISO dates with start before end"}), 400
 
-    # Return the rendered template with the list of appointments
-    return render_template('view_appointments.html', appointments=sorted_appointments, patient=patient)
+    appointments, truncated = appointments_between(current_user.id, start, end,
+                                                   limit=request.args.get('limit', MAX_WINDOW_APPOINTMENTS))
+    response = jsonify([calendar_event(appointment) for appointment in appointments])
+    response.headers['X-Truncated'] = 'true' if truncated else 'false'
+    return response
 
 
 @bp.route('/doctor/patient/add', methods=['GET', 'POST'])
@@ -365,6 +422,52 @@ def add_patient():
                            show_return_button=True, 
                             return_url=request.referrer)
 
+@bp.route('/doctor/patient/import', methods=['GET', 'POST'])
+@login_required
+def import_patients():
+    if current_user.role != 'doctor':
+        flash('Access denied.')
+        return redirect_dashboard(current_user.role)
+
+    form = PatientImportForm()
+    result = None
+    rejected = []
+    rejected_csv = None
+
+    if form.validate_on_submit():
+        def keep(line, values, errors):
+            if len(rejected) < patient_import.MAX_REJECTED_KEPT:
+                rejected.append(patient_import.rejected_row(line, values, errors))
+
+        # Read straight from the upload, which werkzeug spools to disk when it is large
+        lines = io.TextIOWrapper(form.roster_file.data.stream, encoding='utf-8-sig', newline='')
+        try:
+            result = patient_import.import_roster(lines, current_user.id, on_reject=keep)
+        except patient_import.RosterError as error:
+            flash(error.message, 'danger')
+        except UnicodeDecodeError:
+            flash('The file is not UTF-8 encoded text.', 'danger')
+        else:
+            if result.error:
+                flash(result.error, 'danger')
+            flash(f'Imported {result.imported} patients, {result.rejected} rows rejected.',
+                  'warning' if result.rejected or result.error else 'success')
+            if rejected:
+                text = patient_import.rejected_csv(result.headers, rejected)
+                rejected_csv = 'data:text/csv;charset=utf-8;base64,' + base64.b64encode(text.encode('utf-8')).decode('ascii')
+
+    return render_template('import_patients.html',
+                           form=form,
+                           result=result,
+                           rejected=rejected,
+                           rejected_columns=patient_import.rejected_fields(result.headers) if result else [],
+                           rejected_csv=rejected_csv,
+                           columns=patient_import.COLUMNS,
+                           required_columns=patient_import.REQUIRED_COLUMNS,
+                           max_rejected=patient_import.MAX_REJECTED_KEPT,
+                           show_return_button=True,
+                           return_url=url_for('main.doctor_patients'))
+
 @bp.route('/add_visit/<string:patient_id>', methods=['GET', 'POST'])
 @login_required
 def add_visit(patient_id):
@@ -372,11 +475,11 @@ def add_visit(patient_id):
     visit_form = AddVisitForm()
 
     # Populate dynamic fields using model methods
-    visit_form.reason_code.choices = [(item["code"], item["display"]) for item in Visit.get_reason_codes()]
-    visit_form.status.choices = [(item["code"], item["display"]) for item in Visit.get_status_codes()]
-    visit_form.class_code.choices = [(item["code"], item["display"]) for item in Visit.get_class_codes()]
-    visit_form.priority.choices = [(item["code"], item["display"]) for item in Visit.get_priority_codes()]
-    visit_form.location.choices = [(item["code"], item["display"]) for item in Visit.get_locations()]
+    visit_form.reason_code.choices = terminology.choices('visit.reason_code')
+    visit_form.status.choices = terminology.choices('visit.status')
+    visit_form.class_code.choices = terminology.choices('visit.class_code')
+    visit_form.priority.choices = terminology.choices('visit.priority')
+    visit_form.location.choices = terminology.choices('visit.location')
 
 
     if visit_form.validate_on_submit():
@@ -416,8 +519,7 @@ def add_immunization(visit_id):
     visit = Visit.query.get_or_404(visit_id)
 
     # Ensure the doctor has access to this visit's patient
-    doctor_patient = DoctorPatient.query.filter_by(doctor_id=current_user.id, patient_id=visit.patient_id).first()
-    if not doctor_patient:
+    if not can_access_patient(current_user.id, visit.patient_id):
         flash('You do not have permission to add immunizations for this patient.', 'danger')
         return redirect(url_for('main.doctor_dashboard'))
 
@@ -472,8 +574,7 @@ def add_medication(visit_id):
     visit = Visit.query.get_or_404(visit_id)
     
     # Ensure the doctor has access to this visit's patient
-    doctor_patient = DoctorPatient.query.filter_by(doctor_id=current_user.id, patient_id=visit.patient_id).first()
-    if not doctor_patient:
+    if not can_access_patient(current_user.id, visit.patient_id):
         flash('You do not have permission to add immunizations for this patient.', 'danger')
         return redirect(url_for('main.doctor_dashboard'))
 
@@ -543,8 +644,7 @@ def add_allergy(visit_id):
     visit = Visit.query.get_or_404(visit_id)
 
     # Ensure the doctor has access to this visit's patient
-    doctor_patient = DoctorPatient.query.filter_by(doctor_id=current_user.id, patient_id=visit.patient_id).first()
-    if not doctor_patient:
+    if not can_access_patient(current_user.id, visit.patient_id):
         flash('You do not have permission to add allergies for this patient.', 'danger')
         return redirect(url_for('main.doctor_dashboard'))
 
@@ -595,8 +695,7 @@ def add_observation(visit_id):
     visit = Visit.query.get_or_404(visit_id)
     
     # Ensure the doctor has access to this visit's patient
-    doctor_patient = DoctorPatient.query.filter_by(doctor_id=current_user.id, patient_id=visit.patient_id).first()
-    if not doctor_patient:
+    if not can_access_patient(current_user.id, visit.patient_id):
         flash('You do not have permission to add observations for this patient.', 'danger')
         return redirect(url_for('main.doctor_dashboard'))
 
@@ -644,8 +743,7 @@ def add_vitals(visit_id):
     visit = Visit.query.get_or_404(visit_id)
     
     # Ensure the doctor has access to this visit's patient
-    doctor_patient = DoctorPatient.query.filter_by(doctor_id=current_user.id, patient_id=visit.patient_id).first()
-    if not doctor_patient:
+    if not can_access_patient(current_user.id, visit.patient_id):
         flash('You do not have permission to add observations for this patient.', 'danger')
         return redirect(url_for('main.doctor_dashboard'))
 
@@ -667,6 +765,7 @@ def add_vitals(visit_id):
             status=status,
             category=category,
             effective_date=effective_date,
+            unit=unit,
         )
 
         # Save to database
@@ -685,20 +784,11 @@ def add_vitals(visit_id):
 
 @bp.route('/patient/<string:patient_id>/add_appointment', methods=['POST', 'GET'])
 @login_required
+@patient_access_required('You do not have permission to add appointments for this patient.')
 def add_appointment(patient_id):
-    if current_user.role != 'doctor':
-        flash('Access unauthorized.', 'danger')
-        return redirect(url_for('main.login'))
-
     # Load the visit object
     patient  = Patient.query.get_or_404(patient_id)
 
-    # Ensure the doctor has access to this visit's patient
-    doctor_patient = DoctorPatient.query.filter_by(doctor_id=current_user.id, patient_id=patient_id).first()
-    if not doctor_patient:
-        flash('You do not have permission to add appointments for this patient.', 'danger')
-        return redirect(url_for('main.doctor_dashboard'))
-
     if request.method == 'POST':
         # Collect data from the form
         start = request.form.get('start')
@@ -745,20 +835,11 @@ def add_appointment(patient_id):
 
 @bp.route('/patient/<string:patient_id>/add_medical_history', methods=['POST', 'GET'])
 @login_required
+@patient_access_required('You do not have permission to add medical history for this patient.')
 def add_medical_history(patient_id):
-    if current_user.role != 'doctor':
-        flash('Access unauthorized.', 'danger')
-        return redirect(url_for('main.login'))
-
     # Load the patient object
     patient  = Patient.query.get_or_404(patient_id)
 
-    # Ensure the doctor has access to this visit's patient
-    doctor_patient = DoctorPatient.query.filter_by(doctor_id=current_user.id, patient_id=patient_id).first()
-    if not doctor_patient:
-        flash('You do not have permission to add medical history for this patient.', 'danger')
-        return redirect(url_for('main.doctor_dashboard'))
-
     if request.method == 'POST':
         # Collect data from the form
         clinical_status = request.form.get('clinical_status')
@@ -802,16 +883,9 @@ def add_medical_history(patient_id):
 
 @bp.route('/patient/<string:patient_id>/edit', methods=['GET', 'POST'])
 @login_required
+@patient_access_required('You do not have permission to edit this patient.')
 def edit_patient(patient_id):
-    if current_user.role != 'doctor':
-        flash('Access unauthorized.', 'danger')
-        return redirect(url_for('main.login'))
-
     patient = Patient.query.filter_by(id=patient_id).first_or_404()
-    doctor_patient = DoctorPatient.query.filter_by(doctor_id=current_user.id, patient_id=patient_id).first()
-    if not doctor_patient:
-        flash('You do not have permission to edit this patient.', 'danger')
-        return redirect(url_for('main.doctor_dashboard'))
 
     if request.method == 'POST':
         # Retrieve only the fields being updated
@@ -850,14 +924,13 @@ def edit_visit(visit_id):
         return redirect(url_for('main.login'))
 
     visit = Visit.query.filter_by(id=visit_id).first_or_404()
-    doctor_patient = DoctorPatient.query.filter_by(doctor_id=current_user.id, patient_id=visit.patient_id).first()
-    if not doctor_patient:
+    if not can_access_patient(current_user.id, visit.patient_id):
         flash('You do not have permission to edit this visit.', 'danger')
         return redirect(url_for('main.doctor_dashboard'))
 
     form = AddVisitForm(obj=visit)
-    form.reason_code.choices = [(item["code"], item["display"]) for item in Visit.get_reason_codes()]
-    form.status.choices = [(item["code"], item["display"]) for item in Visit.get_status_codes()]
+    form.reason_code.choices = terminology.choices('visit.reason_code')
+    form.status.choices = terminology.choices('visit.status')
 
     
     if form.validate_on_submit():
@@ -888,8 +961,7 @@ def edit_vitals(visit_id, vitals_id):
     vitals = Vitals.query.get_or_404(vitals_id)
     
     patient_id = vitals.patient_id
-    doctor_patient = DoctorPatient.query.filter_by(doctor_id=current_user.id, patient_id=vitals.patient_id).first()
-    if not doctor_patient:
+    if not can_access_patient(current_user.id, vitals.patient_id):
         flash('You do not have permission to view this patient.', 'danger')
         return redirect(url_for('main.doctor_dashboard'))
 
@@ -924,17 +996,9 @@ def edit_vitals(visit_id, vitals_id):
 
 @bp.route('/doctor/patient/<string:patient_id>/edit_observation/<int:observation_id>', methods=['GET', 'POST'])
 @login_required
+@patient_access_required('You do not have permission to view this patient.')
 def edit_observation(patient_id, observation_id):
-    if current_user.role != 'doctor':
-        flash('Access unauthorized.', 'danger')
-        return redirect(url_for('login'))
-    
-    # Check if the patient is associated with the doctor
     patient = Patient.query.get_or_404(patient_id)
-    doctor_patient = DoctorPatient.query.filter_by(doctor_id=current_user.id, patient_id=patient_id).first()
-    if not doctor_patient:
-        flash('You do not have permission to view this patient.', 'danger')
-        return redirect(url_for('main.doctor_dashboard'))
     
     # Get the observation to be edited
     observation = Observation.query.get_or_404(observation_id)
@@ -969,17 +1033,9 @@ def edit_observation(patient_id, observation_id):
 
 @bp.route('/doctor/patient/<string:patient_id>/edit_medication/<int:medication_id>', methods=['GET', 'POST'])
 @login_required
+@patient_access_required('You do not have permission to view this patient.')
 def edit_medication(patient_id, medication_id):
-    if current_user.role != 'doctor':
-        flash('Access unauthorized.', 'danger')
-        return redirect(url_for('login'))
-    
-    # Check if the patient is associated with the doctor
     patient = Patient.query.get_or_404(patient_id)
-    doctor_patient = DoctorPatient.query.filter_by(doctor_id=current_user.id, patient_id=patient_id).first()
-    if not doctor_patient:
-        flash('You do not have permission to view this patient.', 'danger')
-        return redirect(url_for('main.doctor_dashboard'))
     
     medication = MedicationStatement.query.get_or_404(medication_id)
     
@@ -1025,17 +1081,9 @@ def edit_medication(patient_id, medication_id):
 
 @bp.route('/doctor/patient/<string:patient_id>/edit_immuinization/<int:immunization_id>', methods=['GET', 'POST'])
 @login_required
+@patient_access_required('You do not have permission to view this patient.')
 def edit_immunization(patient_id, immunization_id):
-    if current_user.role != 'doctor':
-        flash('Access unauthorized.', 'danger')
-        return redirect(url_for('login'))
-    
-    # Check if the patient is associated with the doctor
     patient = Patient.query.get_or_404(patient_id)
-    doctor_patient = DoctorPatient.query.filter_by(doctor_id=current_user.id, patient_id=patient_id).first()
-    if not doctor_patient:
-        flash('You do not have permission to view this patient.', 'danger')
-        return redirect(url_for('main.doctor_dashboard'))
     
     immunization = Immunization.query.get_or_404(immunization_id)
 
@@ -1073,17 +1121,9 @@ def edit_immunization(patient_id, immunization_id):
 
 @bp.route('/doctor/patient/<string:patient_id>/edit_allergy/<int:allergy_id>', methods=['GET', 'POST'])
 @login_required
+@patient_access_required('You do not have permission to view this patient.')
 def edit_allergy(patient_id, allergy_id):
-    if current_user.role != 'doctor':
-        flash('Access unauthorized.', 'danger')
-        return redirect(url_for('login'))
-    
-    # Check if the patient is associated with the doctor
     patient = Patient.query.get_or_404(patient_id)
-    doctor_patient = DoctorPatient.query.filter_by(doctor_id=current_user.id, patient_id=patient_id).first()
-    if not doctor_patient:
-        flash('You do not have permission to view this patient.', 'danger')
-        return redirect(url_for('main.doctor_dashboard'))
     
     allergy = AllergyIntolerance.query.get_or_404(allergy_id)
 
@@ -1117,17 +1157,9 @@ def edit_allergy(patient_id, allergy_id):
 
 @bp.route('/doctor/patient/<string:patient_id>/edit_appointment/<int:appointment_id>', methods=['GET', 'POST'])
 @login_required
+@patient_access_required('You do not have permission to view this patient.')
 def edit_appointment(patient_id, appointment_id):
-    if current_user.role != 'doctor':
-        flash('Access unauthorized.', 'danger')
-        return redirect(url_for('login'))
-
-    # Check if the patient is associated with the doctor
     patient = Patient.query.get_or_404(patient_id)
-    doctor_patient = DoctorPatient.query.filter_by(doctor_id=current_user.id, patient_id=patient_id).first()
-    if not doctor_patient:
-        flash('You do not have permission to view this patient.', 'danger')
-        return redirect(url_for('main.doctor_dashboard'))
 
     # Fetch the appointment object
     appointment = Appointment.query.get_or_404(appointment_id)
@@ -1161,17 +1193,9 @@ def edit_appointment(patient_id, appointment_id):
 
 @bp.route('/doctor/patient/<string:patient_id>/edit_medical_history/<int:medicalhistory_id>', methods=['GET', 'POST'])
 @login_required
+@patient_access_required('You do not have permission to view this patient.')
 def edit_medical_history(patient_id, medicalhistory_id):
-    if current_user.role != 'doctor':
-        flash('Access unauthorized.', 'danger')
-        return redirect(url_for('login'))
-
-    # Check if the patient is associated with the doctor
     patient = Patient.query.get_or_404(patient_id)
-    doctor_patient = DoctorPatient.query.filter_by(doctor_id=current_user.id, patient_id=patient_id).first()
-    if not doctor_patient:
-        flash('You do not have permission to view this patient.', 'danger')
-        return redirect(url_for('main.doctor_dashboard'))
 
     # Fetch the appointment object
     medical_history = MedicalHistory.query.get_or_404(medicalhistory_id)
@@ -1215,8 +1239,7 @@ def delete_visit(visit_id):
     visit = Visit.query.get_or_404(visit_id)
 
     # Check if the doctor is associated with the patient
-    doctor_patient = DoctorPatient.query.filter_by(doctor_id=current_user.id, patient_id=visit.patient_id).first()
-    if not doctor_patient:
+    if not can_access_patient(current_user.id, visit.patient_id):
         flash('You do not have permission to delete this visit.', 'danger')
         return redirect(url_for('main.doctor_dashboard'))
     
@@ -1240,19 +1263,10 @@ def delete_visit(visit_id):
 
 @bp.route('/patient/<string:patient_id>/delete', methods=['POST'])
 @login_required
+@patient_access_required('You do not have permission to delete this patient.')
 def delete_patient(patient_id):
-    if current_user.role != 'doctor':
-        flash('Access unauthorized.', 'danger')
-        return redirect(url_for('login'))
-
     patient = Patient.query.get_or_404(patient_id)
 
-    # Check if the doctor is associated with the patient
-    doctor_patient = DoctorPatient.query.filter_by(doctor_id=current_user.id, patient_id=patient.id).first()
-    if not doctor_patient:
-        flash('You do not have permission to delete this patient.', 'danger')
-        return redirect(url_for('main.doctor_dashboard'))
-    
     # Verify the name input
     entered_name = request.form.get('patient_name', '').strip()
     expected_name = f"{patient.firstname} {patient.lastname}"
@@ -1279,6 +1293,9 @@ def delete_immunization(immunization_id):
     if not current_user.role == 'doctor':
         flash('Access unauthorized.', 'danger')
         return redirect(url_for('main.doctor_dashboard'))
+    if not can_access_patient(current_user.id, immunization.patient_id):
+        flash('You do not have permission to modify this patient.', 'danger')
+        return redirect(url_for('main.doctor_dashboard'))
 
     # Delete the immunization record
     db.session.delete(immunization)
@@ -1318,6 +1335,9 @@ def delete_medication(medication_id):
     if not current_user.role == 'doctor':
         flash('Access unauthorized.', 'danger')
         return redirect(url_for('main.doctor_dashboard'))
+    if not can_access_patient(current_user.id, medication.patient_id):
+        flash('You do not have permission to modify this patient.', 'danger')
+        return redirect(url_for('main.doctor_dashboard'))
 
     # Delete the immunization record
     db.session.delete(medication)
@@ -1357,6 +1377,9 @@ def delete_observation(observation_id):
     if not current_user.role == 'doctor':
         flash('Access unauthorized.', 'danger')
         return redirect(url_for('main.doctor_dashboard'))
+    if not can_access_patient(current_user.id, observation.patient_id):
+        flash('You do not have permission to modify this patient.', 'danger')
+        return redirect(url_for('main.doctor_dashboard'))
 
     # Delete the immunization record
     db.session.delete(observation)
@@ -1395,6 +1418,9 @@ def delete_allergy(allergy_id):
     if not current_user.role == 'doctor':
         flash('Access unauthorized.', 'danger')
         return redirect(url_for('main.doctor_dashboard'))
+    if not can_access_patient(current_user.id, allergy.patient_id):
+        flash('You do not have permission to modify this patient.', 'danger')
+        return redirect(url_for('main.doctor_dashboard'))
 
     # Delete the allergy record
     db.session.delete(allergy)
@@ -1433,6 +1459,9 @@ def delete_vitals(vitals_id):
     if not current_user.role == 'doctor':
         flash('Access unauthorized.', 'danger')
         return redirect(url_for('main.doctor_dashboard'))
+    if not can_access_patient(current_user.id, vitals.patient_id):
+        flash('You do not have permission to modify this patient.', 'danger')
+        return redirect(url_for('main.doctor_dashboard'))
 
     # Delete the allergy record
     db.session.delete(vitals)
@@ -1469,6 +1498,9 @@ def delete_appointment(appointment_id):
     if current_user.role != 'doctor':
         flash('Access unauthorized.', 'danger')
         return redirect(url_for('main.doctor_dashboard'))
+    if not can_access_patient(current_user.id, appointment.patient_id):
+        flash('You do not have permission to modify this patient.', 'danger')
+        return redirect(url_for('main.doctor_dashboard'))
 
     # Delete the appointment record
     db.session.delete(appointment)
@@ -1480,20 +1512,11 @@ def delete_appointment(appointment_id):
 
 @bp.route('/patient/<string:patient_id>/delete_medical_history/<int:medicalhistory_id>', methods=['POST'])
 @login_required
+@patient_access_required('You do not have permission to delete this patient.')
 def delete_medical_history(patient_id, medicalhistory_id):
-    if current_user.role != 'doctor':
-        flash('Access unauthorized.', 'danger')
-        return redirect(url_for('login'))
-
     patient = Patient.query.get_or_404(patient_id)
     medical_history = MedicalHistory.query.get_or_404(medicalhistory_id)
 
-    # Check if the doctor is associated with the patient
-    doctor_patient = DoctorPatient.query.filter_by(doctor_id=current_user.id, patient_id=patient.id).first()
-    if not doctor_patient:
-        flash('You do not have permission to delete this patient.', 'danger')
-        return redirect(url_for('main.doctor_dashboard'))
-    
     # Verify the name input
     entered_name = request.form.get('patient_name', '').strip()
     expected_name = f"{patient.firstname} {patient.lastname}"
@@ -1723,6 +1746,15 @@ def admin_dashboard():
         return redirect_dashboard(current_user.role)
     return render_template('admin_dashboard.html')
 
+@bp.route('/admin/stats')
+@login_required
+def admin_stats():
+    """Counters of the in-process caches and the email outbox, for the admin to check."""
+    if current_user.role != 'admin':
+        return jsonify({"error": "Access unauthorized."}), 403
+    return jsonify({"user_cache": user_cache.stats(), "access_index": access_index.stats(),
+                    "outbox": outbox.stats()})
+
 @bp.route('/logout')
 @login_required
 def logout():
@@ -1737,16 +1769,16 @@ def upload_document(patient_id):
         document_name = uploadform.document_name.data
         document_file = uploadform.document_file.data
         
-        # Save the file
+        # Stream the file into the content-addressed store
         filename = secure_filename(document_file.filename)
-        filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-        document_file.save(filepath)
+        stored = get_store().save_upload(document_file)
         
         # Save to database
         new_document = AdditionalDocument(
             patient_id=patient_id,
             document_name=document_name,
-            document_file=filename
+            document_file=filename,
+            content_hash=stored.content_hash,
         )
         db.session.add(new_document)
         db.session.commit()
@@ -1766,16 +1798,16 @@ def upload_document_page(patient_id):
         document_name = form.document_name.data
         document_file = form.document_file.data
         
-        # Save the file
+        # Stream the file into the content-addressed store
         filename = secure_filename(document_file.filename)
-        filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-        document_file.save(filepath)
+        stored = get_store().save_upload(document_file)
         
         # Save to database
         new_document = AdditionalDocument(
             patient_id=patient_id,
             document_name=document_name,
-            document_file=filename
+            document_file=filename,
+            content_hash=stored.content_hash,
         )
         db.session.add(new_document)
         db.session.commit()
@@ -1786,20 +1818,104 @@ def upload_document_page(patient_id):
     return render_template('upload_document_page.html', form=form, patient_id=patient_id)
 
 
+# Resumable uploads (tus 1.0 plus a finalize step, see app/resumable.py)
+@bp.errorhandler(resumable.UploadError)
+def upload_error(error):
+    return jsonify({"error": error.message}), error.status, resumable.tus_headers()
+
+def _upload_session(upload_id):
+    """The current user's upload session, or 404."""
+    session = db.session.get(UploadSession, upload_id)
+    if session is None or session.user_id != current_user.id:
+        abort(404)
+    return session
+
+@bp.route('/uploads', methods=['OPTIONS'])
+def upload_options():
+    headers = resumable.tus_headers()
+    headers.update({
+        'Tus-Version': resumable.TUS_VERSION,
+        'Tus-Extension': resumable.TUS_EXTENSIONS,
+        'Tus-Max-Size': str(current_app.config['UPLOAD_MAX_SIZE']),
+        'Tus-Checksum-Algorithm': resumable.CHECKSUM_ALGORITHM,
+    })
+    return '', 204, headers
+
+@bp.route('/uploads', methods=['POST'])
+@login_required
+def create_upload():
+    """Open an upload session; the file is then sent with PATCH requests to the returned Location."""
+    if current_user.role != 'doctor':
+        abort(403)
+    length = request.headers.get('Upload-Length', type=int)
+    metadata = resumable.parse_metadata(request.headers.get('Upload-Metadata'))
+    session = resumable.create_session(current_user.id, length, metadata)
+    if not can_access_patient(current_user.id, session.patient_id):
+        resumable.terminate(session)
+        abort(403)
+    headers = resumable.tus_headers(session)
+    headers['Location'] = url_for('main.upload_status', upload_id=session.id)
+    return '', 201, headers
+
+@bp.route('/uploads/<string:upload_id>', methods=['HEAD'])
+@login_required
+def upload_status(upload_id):
+    """How much of the file has arrived, so an interrupted client knows where to resume."""
+    return '', 200, resumable.tus_headers(_upload_session(upload_id))
+
+@bp.route('/uploads/<string:upload_id>', methods=['PATCH'])
+@login_required
+def upload_chunk(upload_id):
+    session = _upload_session(upload_id)
+    if request.mimetype != 'application/offset+octet-stream':
+        return jsonify({"error": "Content-Type must be application/offset+octet-stream"}), 415, resumable.tus_headers()
+    offset = request.headers.get('Upload-Offset', type=int)
+    if offset is None:
+        raise resumable.UploadError('Upload-Offset is required')
+    resumable.write_chunk(session, offset, request.stream, request.headers.get('Upload-Checksum'))
+    return '', 204, resumable.tus_headers(session)
+
+@bp.route('/uploads/<string:upload_id>', methods=['DELETE'])
+@login_required
+def delete_upload(upload_id):
+    resumable.terminate(_upload_session(upload_id))
+    return '', 204, resumable.tus_headers()
+
+@bp.route('/uploads/<string:upload_id>/finalize', methods=['POST'])
+@login_required
+def finalize_upload(upload_id):
+    """
+    Verify the complete file (against the checksum given here or when the
+    session was created) and create its document or lab scan.
+    """
+    session = _upload_session(upload_id)
+    payload = request.get_json(silent=True) or {}
+    session = resumable.finalize(session, payload.get('checksum') or request.form.get('checksum'))
+    if session.target == 'document':
+        redirect_to = url_for('main.view_patient', patient_id=session.patient_id)
+    else:
+        redirect_to = url_for('main.view_lab_scans', patient_id=session.patient_id, group_id=session.group_id)
+    return jsonify({
+        "target": session.target,
+        "id": session.record_id,
+        "content_hash": session.content_hash,
+        "size": session.length,
+        "redirect": redirect_to,
+    }), 201, resumable.tus_headers()
+
+
 @bp.route('/download_document/<int:document_id>', methods=['GET'])
+@login_required
 def download_document(document_id):
     document = AdditionalDocument.query.get(document_id)
     if not document:
         abort(404)
+    if current_user.role != 'doctor' or not can_access_patient(current_user.id, document.patient_id):
+        abort(403)
 
-    # Assuming documents are stored in the configured UPLOAD_FOLDER
-    upload_folder = current_app.config['UPLOAD_FOLDER']
-    filepath = os.path.join(upload_folder, document.document_file)
-
-    if not os.path.exists(filepath):
-        abort(404)
-
-    return send_from_directory(directory=upload_folder, path=document.document_file, as_attachment=True)
+    # Conditional and ranged; documents uploaded before the blob store are still in UPLOAD_FOLDER
+    return send_upload(document.content_hash, document.document_file, os.path.basename(document.document_file),
+                       last_modified=document.upload_date)
 
 
 @bp.route('/create_lab_scan_group/<string:patient_id>', methods=['POST'])
@@ -1825,6 +1941,112 @@ def view_lab_scans(patient_id, group_id):
     scans = group.scans  # Fetch all scans related to this group
     return render_template('view_lab_scans.html', group=group, scans=scans, patient=patient)
 
+@bp.route('/patient/<string:patient_id>/vitals/trend', methods=['GET'])
+@login_required
+def vitals_trend(patient_id):
+    """
+    A patient's vitals series for ?code= (LOINC code or name) as at most
+    ?buckets= points of min/max/avg, between ?start= and ?end= or over all
+    of it, so long-term charts load in a constant-size payload.
+    """
+    if current_user.role != 'doctor' or not can_access_patient(current_user.id, patient_id):
+        abort(403)
+    series = vitals_series.trend(
+        patient_id, request.args.get('code'), start=parse_datetime(request.args.get('start')),
+        end=parse_datetime(request.args.get('end')),
+        buckets=request.args.get('buckets', vitals_series.DEFAULT_BUCKETS, type=int),
+    )
+    if series is None:
+        return jsonify({"error": "Unknown vitals code", "codes": sorted(vitals_series.CANONICAL_UNITS)}), 400
+    return jsonify(series)
+
+@bp.route('/patient/<string:patient_id>/timeline', methods=['GET'])
+@login_required
+def patient_timeline(patient_id):
+    """
+    A patient's visits, results, medications, allergies, history and files
+    as one newest-first event list, ?limit= events per page. ?kinds= limits
+    it to some event kinds and ?before= jumps to a date; follow next_cursor
+    (?cursor=) to scroll further back.
+    """
+    if current_user.role != 'doctor' or not can_access_patient(current_user.id, patient_id):
+        abort(403)
+    page = timeline.load_timeline(
+        patient_id, cursor=request.args.get('cursor'),
+        limit=request.args.get('limit', timeline.DEFAULT_TIMELINE_SIZE),
+        kinds=timeline.parse_kinds(request.args.get('kinds')),
+        before=parse_datetime(request.args.get('before')),
+    )
+    return jsonify({"patient_id": patient_id, "events": page.items, "next_cursor": page.next_cursor})
+
+@bp.route('/cohorts/observations', methods=['GET'])
+@login_required
+def observation_cohort():
+    """
+    The current doctor's patients matching a lab result query on ?code=:
+    ?query=latest (latest result ?above= / ?below=), any (a result beyond
+    the bounds between ?start= and ?end=) or trend (?min_change= /
+    ?max_change= between the first and last result in the window). Only
+    results in ?unit=, by default the code's usual unit, are compared.
+    """
+    if current_user.role != 'doctor':
+        abort(403)
+    code = request.args.get('code')
+    query = request.args.get('query', 'latest')
+    above = request.args.get('above', type=float)
+    below = request.args.get('below', type=float)
+    start = parse_datetime(request.args.get('start'))
+    end = parse_datetime(request.args.get('end'))
+    unit = request.args.get('unit') or None
+    limit = max(1, min(request.args.get('limit', 100, type=int), 1000))
+    if not code:
+        return jsonify({"error": "code is required"}), 400
+
+    if query == 'latest':
+        statement = cohorts.latest_value_cohort(code, above=above, below=below, doctor_id=current_user.id, unit=unit)
+    elif query == 'any':
+        statement = cohorts.threshold_cohort(code, above=above, below=below, start=start, end=end, doctor_id=current_user.id,
+                                             unit=unit)
+    elif query == 'trend':
+        statement = cohorts.trend_cohort(code, start=start, end=end, min_change=request.args.get('min_change', type=float),
+                                         max_change=request.args.get('max_change', type=float), doctor_id=current_user.id,
+                                         unit=unit)
+    else:
+        return jsonify({"error": "query must be latest, any or trend"}), 400
+
+    rows = cohorts.run(statement.limit(limit + 1))
+    patients = {patient.id: patient for patient in Patient.query.filter(Patient.id.in_([row['patient_id'] for row in rows[:limit]]))}
+    for row in rows[:limit]:
+        row.update((key, value.isoformat()) for key, value in list(row.items()) if isinstance(value, datetime))
+        patient = patients.get(row['patient_id'])
+        row['patient_name'] = f"{patient.firstname} {patient.lastname}" if patient else None
+    return jsonify({"code": code, "display": terminology.display('observation.code', code), "query": query,
+                    "unit": unit or cohorts.LAB_DEFAULTS.get(code, (None,))[0],
+                    "patients": rows[:limit], "truncated": len(rows) > limit})
+
+@bp.route('/lab_scan_groups/<int:group_id>/export.zip', methods=['GET'])
+@login_required
+def export_lab_scan_group(group_id):
+    """Stream the group's scans (and with ?documents=1 the patient's documents) as one ZIP."""
+    group = LabScanGroup.query.get_or_404(group_id)
+    if current_user.role != 'doctor' or not can_access_patient(current_user.id, group.patient_id):
+        abort(403)
+
+    include_documents = request.args.get('documents') == '1'
+    entries, missing = lab_scan_group_entries(group, include_documents=include_documents)
+    manifest = {
+        "patient_id": group.patient_id,
+        "group": {"id": group.id, "name": group.group_name, "created_at": group.created_at},
+        "exported_by": current_user.id,
+        "missing": missing,
+    }
+    filename = secure_filename(f"{group.group_name}-{group.patient_id}.zip") or f"lab-scans-{group.id}.zip"
+    return current_app.response_class(
+        stream_with_context(zip_stream(entries, manifest)),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename="{filename}"', 'Cache-Control': 'private, no-store'},
+    )
+
 @bp.route('/upload_lab_scan/<string:patient_id>/<int:group_id>', methods=['POST'])
 def upload_lab_scan(patient_id, group_id):
     # Ensure patient and group exist
@@ -1849,24 +2071,75 @@ def upload_lab_scan(patient_id, group_id):
     # Ensure the file is allowed
     if scan_file and allowed_file(scan_file.filename):
         filename = secure_filename(scan_file.filename)
-        file_path = os.path.join('lab_scans', filename)
-        scan_file.save(os.path.join(current_app.config['UPLOAD_FOLDER'], file_path))
+        store = get_store()
+        stored = store.save_upload(scan_file)
 
         # Save the lab scan record to the database
         new_scan = LabScan(
             filename=filename,
             file_path=os.path.join('lab_scans', filename),  # Corrected file path here
-            group_id=group.id
+            group_id=group.id,
+            content_hash=stored.content_hash,
         )
         db.session.add(new_scan)
         db.session.commit()
 
+        # Thumbnails are rendered in the background, not in this request
+        if new_scan.is_image:
+            derivatives.schedule(store.source(stored.content_hash), current_app.config['DERIVATIVE_FOLDER'],
+                                 stored.content_hash, workers=current_app.config['DERIVATIVE_WORKERS'])
+
         flash('Lab scan uploaded successfully!', 'success')
         return redirect(url_for('main.view_lab_scans', patient_id=patient.id, group_id=group.id))
     else:
         flash('Invalid file type. Only image files are allowed.', 'danger')
         return redirect(url_for('main.view_lab_scans', patient_id=patient.id, group_id=group.id))
 
+@bp.route('/lab_scan_groups/<int:group_id>/scans', methods=['POST'])
+@login_required
+def upload_lab_scans(group_id):
+    """
+    Upload many scans to a group in one multipart request (field `scan_files`).
+    Files are stored concurrently and recorded with one bulk insert; every
+    file gets its own result, so one bad file does not fail the others.
+    Answers JSON (201 all created, 207 some, 422 none) unless the client
+    prefers HTML, e.g. the upload form, which gets a flash message instead.
+    """
+    group = LabScanGroup.query.get_or_404(group_id)
+    if current_user.role != 'doctor' or not can_access_patient(current_user.id, group.patient_id):
+        abort(403)
+
+    wants_html = request.accept_mimetypes.best_match(['application/json', 'text/html']) == 'text/html'
+    back = url_for('main.view_lab_scans', patient_id=group.patient_id, group_id=group.id)
+    files = request.files.getlist('scan_files')
+    limit = current_app.config.get('LAB_SCAN_BATCH_MAX_FILES', DEFAULT_MAX_BATCH_FILES)
+    if not files or len(files) > limit:
+        error = 'No files selected' if not files else f'At most {limit} files can be uploaded at once'
+        if wants_html:
+            flash(error, 'danger')
+            return redirect(back)
+        return jsonify({"error": error}), 400
+
+    results = store_files(files)
+    created = insert_lab_scans(group, results)
+    schedule_derivatives(results)
+
+    if wants_html:
+        failed = [result.filename or f"file {result.index + 1}" for result in results if result.status != 'created']
+        if created:
+            flash(f'{created} lab scan(s) uploaded successfully!', 'success')
+        if failed:
+            flash(f'Not uploaded: {", ".join(failed)}', 'danger')
+        return redirect(back)
+
+    status = 201 if created == len(results) else 207 if created else 422
+    return jsonify({
+        "group_id": group.id,
+        "created": created,
+        "failed": len(results) - created,
+        "results": [result.to_dict() for result in results],
+    }), status
+
 
 @bp.route('/lab_scan_groups/<string:patient_id>', methods=['GET'])
 def lab_scan_groups(patient_id):
@@ -1875,24 +2148,57 @@ def lab_scan_groups(patient_id):
     return render_template('view_patient.html', patient=patient, lab_scan_groups=lab_scan_groups)
 
 @bp.route('/download_lab_scan/<int:scan_id>', methods=['GET'])
+@login_required
 def view_scan(scan_id):
     # Fetch the lab scan by its ID
     scan = LabScan.query.get(scan_id)
     if not scan:
         print(f"Scan with ID {scan_id} not found.")
         abort(404)
+    if current_user.role != 'doctor' or not can_access_patient(current_user.id, scan.group.patient_id):
+        abort(403)
     
-    # Construct the file path
-    upload_folder = current_app.config['UPLOAD_FOLDER']
-    filepath = os.path.join(upload_folder, scan.file_path)  # Corrected path
+    # From the blob store, or UPLOAD_FOLDER for scans uploaded before it
+    return send_upload(scan.content_hash, scan.file_path, scan.filename, last_modified=scan.upload_date)
+
 
-    # Check if file exists
-    if not os.path.exists(filepath):
-        print(f"File not found: {filepath}")
+@bp.route('/lab_scan/<int:scan_id>/<size>.jpg', methods=['GET'])
+@login_required
+def lab_scan_derivative(scan_id, size):
+    """A resized copy of an image scan. `?v=` carries the content hash, so matching URLs are cached for good."""
+    if size not in derivatives.DERIVATIVE_SIZES:
         abort(404)
-    
-    # If everything is correct, send the file
-    return send_from_directory(directory=upload_folder, path=scan.file_path, as_attachment=True)
+    scan = db.session.get(LabScan, scan_id)
+    if scan is None or not scan.is_image:
+        abort(404)
+    if current_user.role != 'doctor' or not can_access_patient(current_user.id, scan.group.patient_id):
+        abort(403)
+
+    store = get_store()
+    if scan.content_hash and store.exists(scan.content_hash):
+        source = store.source(scan.content_hash)
+    else:
+        # Scans uploaded before the blob store still live in UPLOAD_FOLDER
+        source = os.path.join(current_app.config['UPLOAD_FOLDER'], scan.file_path)
+        if not os.path.exists(source):
+            abort(404)
+        if not scan.content_hash:
+            scan.content_hash = derivatives.file_hash(source)
+            db.session.commit()
+
+    try:
+        path = derivatives.ensure(source, current_app.config['DERIVATIVE_FOLDER'], scan.content_hash, size)
+    except (ImportError, OSError):
+        current_app.logger.exception("Could not render the %s of lab scan %s", size, scan_id)
+        return redirect(url_for('main.view_scan', scan_id=scan_id))
+
+    response = serve_file(path, mimetype='image/jpeg', etag=f"{scan.content_hash}-{size}")
+    if request.args.get('v') == scan.content_hash[:16]:
+        # The URL changes with the content, so the browser never needs to revalidate
+        response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    else:
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 
 @bp.route('/delete_lab_scan/<string:patient_id>/<int:scan_id>', methods=['POST'])
@@ -1900,15 +2206,10 @@ def delete_lab_scan(patient_id, scan_id):
     scan = LabScan.query.get_or_404(scan_id)  # Fetch the scan by ID
     group_id = scan.group_id  # Keep track of the group for redirection
     
-    # Remove the scan from the database and the file system
+    # Remove the scan from the database; its blob is garbage-collected once unreferenced
     db.session.delete(scan)
     db.session.commit()
-    
-    # Optionally, delete the file from the file system
-    try:
-        os.remove(scan.file_path)  # Delete the file
-    except FileNotFoundError:
-        pass
+    remove_legacy_file(scan.content_hash, scan.file_path)
     
     flash('Lab scan deleted successfully.', 'success')
     return redirect(url_for('main.view_lab_scans', patient_id = patient_id, group_id=group_id))
@@ -1922,15 +2223,10 @@ def delete_document(patient_id, document_id):
         flash('Document not found', 'danger')
         return redirect(url_for('main.view_patient', patient_id=patient_id))
 
-    # Delete the document record from the database
+    # Delete the document record from the database; its blob is garbage-collected once unreferenced
     db.session.delete(document)
     db.session.commit()
-
-    # Optionally, delete the file from the file system if it's stored
-    upload_folder = current_app.config['UPLOAD_FOLDER']
-    filepath = os.path.join(upload_folder, document.document_file)
-    if os.path.exists(filepath):
-        os.remove(filepath)
+    remove_legacy_file(document.content_hash, document.document_file)
 
     flash('Document deleted successfully!', 'success')
     return redirect(url_for('main.view_patient', patient_id=patient_id))
@@ -1979,3 +2275,129 @@ def reset_password(token):
     return render_template('reset_password.html', token=token)
 
 
+# FHIR R4 read API (see app/fhir.py)
+def _fhir_response(resource, status=200):
+    return Response(fhir.dumps(resource), status, mimetype=fhir.FHIR_MIMETYPE)
+
+@bp.errorhandler(fhir.FhirError)
+def fhir_error(error):
+    return _fhir_response(fhir.operation_outcome(error.message, error.code), error.status)
+
+def _fhir_doctor():
+    if current_user.role != 'doctor':
+        raise fhir.FhirError('Only doctors can use the FHIR API', 403, 'forbidden')
+    return current_user.id
+
+@bp.route('/fhir/metadata', methods=['GET'])
+def fhir_metadata():
+    return _fhir_response(fhir.capability_statement())
+
+@bp.route('/fhir/<string:resource_type>', methods=['GET'])
+@login_required
+def fhir_search(resource_type):
+    """Search a resource type, e.g. /fhir/Observation?patient=<id>&code=4548-4&date=ge2024&_include=Observation:patient."""
+    return _fhir_response(fhir.search(resource_type, request.args, _fhir_doctor()))
+
+@bp.route('/fhir/<string:resource_type>/<string:resource_id>', methods=['GET'])
+@login_required
+def fhir_read(resource_type, resource_id):
+    return _fhir_response(fhir.read(resource_type, resource_id, _fhir_doctor()))
+
+
+# FHIR Bulk Data $export (see app/bulk_export.py)
+def _kick_off_export(doctor_id):
+    if 'respond-async' not in request.headers.get('Prefer', ''):
+        raise fhir.FhirError('$export requires the header Prefer: respond-async')
+    if request.args.get('_outputFormat', bulk_export.NDJSON_MIMETYPE) not in bulk_export.OUTPUT_FORMATS:
+        raise fhir.FhirError('Only NDJSON output is supported')
+    if request.args.get('_since'):
+        raise fhir.FhirError('_since is not supported: the tables do not record when resources change')
+    job = bulk_export.create_job(bulk_export.parse_types(request.args.get('_type')), user_id=current_user.id,
+                                 doctor_id=doctor_id, request_url=request.url)
+    bulk_export.start(job)
+    response = _fhir_response(fhir.operation_outcome('Export started', 'informational'), 202)
+    response.headers['Content-Location'] = url_for('main.fhir_export_status', job_id=job.id, _external=True)
+    return response
+
+@bp.route('/fhir/$export', methods=['GET'])
+@login_required
+def fhir_export():
+    """System-level export of every patient's data, for admins."""
+    if current_user.role != 'admin':
+        raise fhir.FhirError('Only admins can export every patient', 403, 'forbidden')
+    return _kick_off_export(None)
+
+@bp.route('/fhir/Patient/$export', methods=['GET'])
+@login_required
+def fhir_patient_export():
+    """Export of all the patients the caller can see: a doctor's own patients, or everyone for admins."""
+    if current_user.role not in ('doctor', 'admin'):
+        raise fhir.FhirError('Only doctors and admins can export patients', 403, 'forbidden')
+    return _kick_off_export(current_user.id if current_user.role == 'doctor' else None)
+
+@bp.route('/fhir/Group/<string:group_id>/$export', methods=['GET'])
+@login_required
+def fhir_group_export(group_id):
+    """Export of one doctor's patients; the group id is the doctor's user id."""
+    doctor = db.session.get(User, group_id)
+    if doctor is None or doctor.role != 'doctor':
+        raise fhir.FhirError(f"Group/{group_id} not found", 404, 'not-found')
+    if current_user.role != 'admin' and current_user.id != group_id:
+        raise fhir.FhirError('You can only export your own patients', 403, 'forbidden')
+    return _kick_off_export(group_id)
+
+def _export_job(job_id):
+    job = db.session.get(ExportJob, job_id)
+    if job is None or (job.user_id != current_user.id and current_user.role != 'admin'):
+        raise fhir.FhirError('Export not found', 404, 'not-found')
+    return job
+
+@bp.route('/fhir/$export-status/<string:job_id>', methods=['GET'])
+@login_required
+def fhir_export_status(job_id):
+    """202 with X-Progress while the export runs, then 200 with the manifest of NDJSON files."""
+    job = _export_job(job_id)
+    if job.status in ('queued', 'running'):
+        response = Response(status=202)
+        response.headers['X-Progress'] = bulk_export.progress_text(job)
+        response.headers['Retry-After'] = '10'
+        return response
+    if job.status != 'complete':
+        raise fhir.FhirError(job.error or f"The export was {job.status}", 500 if job.status == 'failed' else 404,
+                             'exception' if job.status == 'failed' else 'not-found')
+    file_url = lambda job, name: url_for('main.fhir_export_file', job_id=job.id, filename=name, _external=True)
+    response = jsonify(bulk_export.manifest(job, file_url))
+    response.headers['Expires'] = http_date(job.finished_at + timedelta(seconds=current_app.config['BULK_EXPORT_TTL']))
+    return response
+
+@bp.route('/fhir/$export-status/<string:job_id>', methods=['DELETE'])
+@login_required
+def fhir_export_cancel(job_id):
+    bulk_export.cancel(_export_job(job_id))
+    return Response(status=202)
+
+@bp.route('/fhir/$export-file/<string:job_id>/<string:filename>', methods=['GET'])
+@login_required
+def fhir_export_file(job_id, filename):
+    job = _export_job(job_id)
+    if job.status != 'complete' or filename not in {item["name"] for item in bulk_export.files(job)}:
+        raise fhir.FhirError('File not found', 404, 'not-found')
+    return serve_file(os.path.join(bulk_export.job_folder(job.id), filename), mimetype=bulk_export.NDJSON_MIMETYPE)
+
+
+# FHIR import (see app/fhir_import.py)
+@bp.route('/fhir', methods=['POST'])
+@login_required
+def fhir_transaction():
+    """Create resources from a transaction or batch Bundle; new patients are linked to the doctor."""
+    doctor_id = _fhir_doctor()
+    bundle = request.get_json(force=True, silent=True)
+    return _fhir_response(fhir_import.import_bundle(bundle, doctor_id))
+
+@bp.route('/fhir/$import', methods=['POST'])
+@login_required
+def fhir_import_ndjson():
+    """Create the resources of an NDJSON body, one per line, committing a chunk at a time."""
+    importer = fhir_import.Importer(_fhir_doctor())
+    fhir_import.import_ndjson(request.stream, importer).finish()
+    return _fhir_response(importer.outcome())
@@ -0,0 +1,155 @@
+import logging
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import func, insert, select
+from sqlalchemy.exc import SQLAlchemyError
+from werkzeug.utils import secure_filename
+from . import db, derivatives
+from .models import LabScan
+from .storage import add_references, get_store
+from .utils import allowed_file
+
+log = logging.getLogger(__name__)
+
+DEFAULT_UPLOAD_WORKERS = 4
+DEFAULT_MAX_BATCH_FILES = 100
+
+
+class UploadResult:
+    """What happened to one file of a batch: 'created', 'rejected' (never stored) or 'failed'."""
+
+    def __init__(self, index, filename):
+        self.index = index
+        self.filename = filename
+        self.status = None
+        self.error = None
+        self.stored = None
+        self.scan_id = None
+
+    def reject(self, error):
+        self.status = 'rejected'
+        self.error = error
+
+    def fail(self, error):
+        self.status = 'failed'
+        self.error = error
+
+    def to_dict(self):
+        result = {"index": self.index, "filename": self.filename, "status": self.status}
+        if self.stored is not None:
+            result.update(content_hash=self.stored.content_hash, size=self.stored.size,
+                          deduplicated=self.stored.deduplicated)
+        if self.scan_id is not None:
+            result["id"] = self.scan_id
+        if self.error:
+            result["error"] = self.error
+        return result
+
+
+def _save(app, store, file_storage):
+    # BlobStore registers each blob in a transaction of its own, which needs the app's engine
+    with app.app_context():
+        return store.save_upload(file_storage)
+
+
+def store_files(files, workers=None):
+    """
+    Validate the uploaded files and write them to the blob store, hashing
+    several at once. Returns one UploadResult per file, in upload order;
+    a file that cannot be stored is marked and does not affect the others.
+    """
+    app = current_app._get_current_object()
+    workers = workers or app.config.get('UPLOAD_WORKERS', DEFAULT_UPLOAD_WORKERS)
+    store = get_store(app)
+
+    results, pending = [], []
+    for index, file_storage in enumerate(files):
+        result = UploadResult(index, secure_filename(file_storage.filename or ''))
+        results.append(result)
+        if not file_storage.filename:
+            result.reject('No file selected')
+        elif not result.filename or not allowed_file(result.filename):
+            result.reject('Invalid file type')
+        else:
+            pending.append((result, file_storage))
+
+    if pending:
+        with ThreadPoolExecutor(max_workers=min(workers, len(pending)), thread_name_prefix='uploads') as executor:
+            futures = [(result, executor.submit(_save, app, store, file_storage)) for result, file_storage in pending]
+            for result, future in futures:
+                try:
+                    result.stored = future.result()
+                except Exception as error:
+                    log.exception("Could not store upload %s", result.filename)
+                    result.fail(f"Could not store file: {type(error).__name__}")
+    return results
+
+
+def insert_lab_scans(group, results):
+    """
+    Add a LabScan for every stored result of `store_files` with one
+    multi-row INSERT and commit it. The bulk insert bypasses the mapper
+    events, so the blob reference counts are raised here, in the same
+    transaction. Fills in `scan_id` and returns the number of rows added.
+    """
+    stored = [result for result in results if result.stored is not None and result.status is None]
+    if not stored:
+        return 0
+
+    # Whole seconds, so the rows can be found again on backends that drop microseconds
+    uploaded = datetime.utcnow().replace(microsecond=0)
+    try:
+        previous = db.session.execute(select(func.max(LabScan.id)).where(LabScan.group_id == group.id)).scalar() or 0
+        db.session.execute(insert(LabScan), [
+            {
+                "filename": result.filename,
+                "file_path": f"lab_scans/{result.filename}",
+                "group_id": group.id,
+                "content_hash": result.stored.content_hash,
+                "upload_date": uploaded,
+            }
+            for result in stored
+        ])
+        add_references(db.session.connection(), Counter(result.stored.content_hash for result in stored))
+
+        # MySQL cannot return the ids of a multi-row INSERT, so read them back
+        rows = db.session.execute(
+            select(LabScan.id, LabScan.filename, LabScan.content_hash)
+            .where(LabScan.group_id == group.id, LabScan.id > previous, LabScan.upload_date == uploaded,
+                   LabScan.content_hash.in_({result.stored.content_hash for result in stored}))
+            .order_by(LabScan.id)
+        ).all()
+        db.session.commit()
+    except SQLAlchemyError:
+        # The stored blobs stay unreferenced and are left to garbage collection
+        db.session.rollback()
+        log.exception("Could not save %s lab scans of group %s", len(stored), group.id)
+        for result in stored:
+            result.fail('Could not save the scan record')
+        return 0
+
+    ids = {}
+    for scan_id, filename, content_hash in rows:
+        ids.setdefault((filename, content_hash), []).append(scan_id)
+    for result in stored:
+        result.status = 'created'
+        matches = ids.get((result.filename, result.stored.content_hash))
+        if matches:
+            result.scan_id = matches.pop(0)
+    return len(stored)
+
+
+def schedule_derivatives(results):
+    """Queue thumbnail rendering for every new image of the batch, once per distinct content."""
+    store = get_store()
+    scheduled = set()
+    for result in results:
+        if result.status != 'created' or not derivatives.is_image(result.filename):
+            continue
+        content_hash = result.stored.content_hash
+        if content_hash not in scheduled:
+            scheduled.add(content_hash)
+            derivatives.schedule(store.source(content_hash), current_app.config['DERIVATIVE_FOLDER'],
+                                 content_hash, workers=current_app.config['DERIVATIVE_WORKERS'])
@@ -0,0 +1,131 @@
+from datetime import date, datetime, time, timedelta
+from flask import url_for
+from sqlalchemy.orm import joinedload
+from .models import Appointment, Patient
+from .pagination import keyset_paginate, CursorError
+
+CALENDAR_VIEWS = ('upcoming', 'day', 'week', 'month')
+DEFAULT_UPCOMING_SIZE = 25
+MAX_UPCOMING_SIZE = 100
+# Most appointments a day/week/month view or the JSON feed will return
+MAX_WINDOW_APPOINTMENTS = 500
+
+# Sort key of the calendar, served by ix_appointment_doctor_id_start_id
+CALENDAR_COLUMNS = (Appointment.start, Appointment.id)
+
+
+def doctor_appointments_query(doctor_id):
+    """A doctor's appointments with just the patient columns the calendar shows."""
+    return (
+        Appointment.query
+        .filter(Appointment.doctor_id == doctor_id)
+        .options(joinedload(Appointment.patient).load_only(Patient.id, Patient.firstname, Patient.lastname))
+    )
+
+
+def parse_datetime(value):
+    """
+    Read an ISO date or datetime query argument, or return None. Widgets send
+    UTC offsets; they are dropped since appointments are stored naive.
+    """
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value.replace(' ', '+')).replace(tzinfo=None)
+    except ValueError:
+        return None
+
+
+def parse_anchor(value, default=None):
+    """Read a YYYY-MM-DD query argument, falling back to `default` or today."""
+    parsed = parse_datetime(value)
+    if parsed is not None:
+        return parsed.date()
+    return default or date.today()
+
+
+def calendar_window(view, anchor):
+    """
+    The [start, end) datetimes covered by a day, week or month view around
+    `anchor`. Weeks start on Monday.
+    """
+    if view == 'day':
+        first = anchor
+        last = anchor + timedelta(days=1)
+    elif view == 'week':
+        first = anchor - timedelta(days=anchor.weekday())
+        last = first + timedelta(days=7)
+    elif view == 'month':
+        first = anchor.replace(day=1)
+        last = (first + timedelta(days=32)).replace(day=1)
+    else:
+        raise ValueError(f"Unknown calendar view {view!r}")
+    return datetime.combine(first, time.min), datetime.combine(last, time.min)
+
+
+def adjacent_anchors(view, anchor):
+    """The anchors of the previous and next day/week/month, for the calendar's arrows."""
+    if view == 'month':
+        first = anchor.replace(day=1)
+        return (first - timedelta(days=1)).replace(day=1), (first + timedelta(days=32)).replace(day=1)
+    step = timedelta(days=7 if view == 'week' else 1)
+    return anchor - step, anchor + step
+
+
+def clamp_limit(limit, default, maximum):
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(limit, maximum))
+
+
+def appointments_between(doctor_id, start, end, limit=MAX_WINDOW_APPOINTMENTS):
+    """
+    A doctor's appointments starting in [start, end), earliest first.
+
+    Returns (appointments, truncated). At most `limit` rows are returned; one
+    extra row is read so callers can tell the window held more than that.
+    """
+    limit = clamp_limit(limit, MAX_WINDOW_APPOINTMENTS, MAX_WINDOW_APPOINTMENTS)
+    rows = (
+        doctor_appointments_query(doctor_id)
+        .filter(Appointment.start >= start, Appointment.start < end)
+        .order_by(*CALENDAR_COLUMNS)
+        .limit(limit + 1)
+        .all()
+    )
+    return rows[:limit], len(rows) > limit
+
+
+def upcoming_appointments(doctor_id, now=None, cursor=None, limit=DEFAULT_UPCOMING_SIZE):
+    """One keyset page of a doctor's appointments that start after `now`."""
+    now = now or datetime.now()
+    limit = clamp_limit(limit, DEFAULT_UPCOMING_SIZE, MAX_UPCOMING_SIZE)
+    query = doctor_appointments_query(doctor_id).filter(Appointment.start > now)
+
+    def key_fn(appointment):
+        return [appointment.start, appointment.id]
+
+    try:
+        return keyset_paginate(query, CALENDAR_COLUMNS, key_fn, cursor=cursor, limit=limit, scope="calendar:upcoming")
+    except CursorError:
+        return keyset_paginate(query, CALENDAR_COLUMNS, key_fn, limit=limit, scope="calendar:upcoming")
+
+
+def calendar_event(appointment):
+    """An appointment in the event format of JavaScript calendar widgets (FullCalendar and alike)."""
+    patient = appointment.patient
+    return {
+        "id": appointment.id,
+        "title": f"{patient.firstname} {patient.lastname}" if patient else appointment.patient_id,
+        "start": appointment.start.isoformat(),
+        "end": appointment.end.isoformat() if appointment.end else None,
+        "url": url_for('main.view_patient', patient_id=appointment.patient_id) + '#appointment',
+        "extendedProps": {
+            "patient_id": appointment.patient_id,
+            "status": appointment.status,
+            "service_category": appointment.service_category,
+            "priority": appointment.priority,
+        },
+    }
@@ -0,0 +1,184 @@
+import re, unicodedata
+from sqlalchemy import select, insert, delete, false, func, case, literal, union_all, inspect, event
+from . import db
+from .models import Patient, PatientSearchToken, DoctorPatient
+
+MIN_QUERY_LENGTH = 2
+DEFAULT_RESULT_LIMIT = 10
+MAX_RESULT_LIMIT = 50
+
+# Fields of Patient that feed the search index
+INDEXED_FIELDS = ('patient_id', 'firstname', 'lastname')
+
+# Anything but letters and digits, in every script, separates words
+_WORD_SPLIT = re.compile(r'[\W_]+')
+
+
+def normalize(text):
+    """Lowercase, strip accents and drop punctuation so 'José' matches 'jose'."""
+    if not text:
+        return ''
+    text = str(text)
+    if text.isascii():
+        # Nothing to decompose; the common case for names and ids
+        return text.lower()
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    return text.lower()
+
+
+def split_terms(text):
+    """Split free text into normalized words."""
+    return [word for word in _WORD_SPLIT.split(normalize(text)) if word]
+
+
+def patient_tokens(patient):
+    """
+    Return the set of (token, field) pairs indexed for a patient.
+
+    Names contribute one token per word. The business id contributes its
+    parts ('mdhs', '2024', '0012'), the compacted id ('mdhs20240012') and the
+    sequence number without zero padding ('12'), so any of the ways staff
+    type an id resolves with a prefix lookup.
+    """
+    tokens = set()
+    for word in split_terms(patient.firstname):
+        tokens.add((word, 'firstname'))
+    for word in split_terms(patient.lastname):
+        tokens.add((word, 'lastname'))
+
+    parts = split_terms(patient.patient_id)
+    if parts:
+        tokens.update((part, 'patient_id') for part in parts)
+        tokens.add((''.join(parts), 'patient_id'))
+        if parts[-1].isdigit():
+            tokens.add((parts[-1].lstrip('0') or '0', 'patient_id'))
+
+    max_length = PatientSearchToken.__table__.c.token.type.length
+    return {(token[:max_length], field) for token, field in tokens}
+
+
+def index_patient(connection, patient):
+    """(Re)write the search tokens of a single patient on the given connection."""
+    connection.execute(delete(PatientSearchToken.__table__).where(PatientSearchToken.patient_id == patient.id))
+    rows = [{"patient_id": patient.id, "token": token, "field": field} for token, field in patient_tokens(patient)]
+    if rows:
+        connection.execute(insert(PatientSearchToken.__table__), rows)
+
+
+def rebuild_index(batch_size=1000):
+    """Recompute the whole search index from patient_basic. Returns the patient count."""
+    db.session.execute(delete(PatientSearchToken.__table__))
+    count = 0
+    last_id = None
+    while True:
+        query = Patient.query.order_by(Patient.id)
+        if last_id is not None:
+            query = query.filter(Patient.id > last_id)
+        batch = query.limit(batch_size).all()
+        if not batch:
+            break
+        rows = [
+            {"patient_id": patient.id, "token": token, "field": field}
+            for patient in batch
+            for token, field in patient_tokens(patient)
+        ]
+        if rows:
+            db.session.execute(insert(PatientSearchToken.__table__), rows)
+        count += len(batch)
+        last_id = batch[-1].id
+        db.session.commit()
+        db.session.expunge_all()
+    return count
+
+
+def _term_matches(terms):
+    """
+    One row per (patient, query term) with the best score that term reached.
+    Every lookup is a `token LIKE 'term%'` range scan on the token index;
+    exact token hits score higher than prefix hits.
+    """
+    t = PatientSearchToken.__table__
+    selects = []
+    for position, term in enumerate(terms):
+        score = case((t.c.token == term, 3), else_=1) + case((t.c.field == 'patient_id', 1), else_=0)
+        selects.append(
+            select(
+                t.c.patient_id.label('patient_id'),
+                literal(position).label('term'),
+                func.max(score).label('score'),
+            )
+            .where(t.c.token.like(f"{term}%"))
+            .group_by(t.c.patient_id)
+        )
+    return union_all(*selects).subquery('term_matches')
+
+
+def matching_patient_ids(text):
+    """
+    Select the ids of patients matching every word of `text`, or None when the
+    text is blank. Text with no searchable words, such as '#', matches nobody.
+    Usable as the argument of `Patient.id.in_()`.
+    """
+    if not text or not text.strip():
+        return None
+    terms = split_terms(text)
+    if not terms:
+        return select(PatientSearchToken.patient_id).where(false())
+    matches = _term_matches(terms)
+    return (
+        select(matches.c.patient_id)
+        .group_by(matches.c.patient_id)
+        .having(func.count(matches.c.term) == len(terms))
+    )
+
+
+def search_patients(text, doctor_id=None, limit=DEFAULT_RESULT_LIMIT):
+    """
+    Return up to `limit` patients matching `text`, best matches first.
+
+    When `doctor_id` is given only that doctor's patients are considered.
+    """
+    terms = split_terms(text)
+    if not terms or len(''.join(terms)) < MIN_QUERY_LENGTH:
+        return []
+    limit = max(1, min(int(limit), MAX_RESULT_LIMIT))
+
+    matches = _term_matches(terms)
+    ranked = (
+        select(matches.c.patient_id, func.sum(matches.c.score).label('rank'))
+        .group_by(matches.c.patient_id)
+        .having(func.count(matches.c.term) == len(terms))
+        .subquery('ranked')
+    )
+    query = (
+        db.session.query(Patient)
+        .join(ranked, ranked.c.patient_id == Patient.id)
+    )
+    if doctor_id is not None:
+        query = query.join(DoctorPatient, DoctorPatient.patient_id == Patient.id).filter(DoctorPatient.doctor_id == doctor_id)
+    return (
+        query.order_by(ranked.c.rank.desc(), Patient.lastname, Patient.firstname, Patient.id)
+        .limit(limit)
+        .all()
+    )
+
+
+def _needs_reindex(target):
+    state = inspect(target)
+    return any(state.attrs[field].history.has_changes() for field in INDEXED_FIELDS)
+
+
+# Keep patient_search_token in step with inserts, updates and deletes of Patient
+@event.listens_for(Patient, 'after_insert')
+def index_new_patient(mapper, connection, target):
+    index_patient(connection, target)
+
+@event.listens_for(Patient, 'after_update')
+def reindex_patient(mapper, connection, target):
+    if _needs_reindex(target):
+        index_patient(connection, target)
+
+@event.listens_for(Patient, 'before_delete')
+def unindex_patient(mapper, connection, target):
+    connection.execute(delete(PatientSearchToken.__table__).where(PatientSearchToken.patient_id == target.id))
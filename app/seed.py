@@ -0,0 +1,565 @@
+import mimetypes, multiprocessing, os, random, time, uuid
+from bisect import bisect
+from collections import Counter
+from itertools import accumulate
+from datetime import date, datetime, time as day_time, timedelta
+from types import SimpleNamespace
+from sqlalchemy import func, insert, select
+from . import bcrypt, db, search, sequences, terminology
+from .cohorts import LAB_DEFAULTS, parse_quantity
+from .models import (AllergyIntolerance, Appointment, DoctorPatient, Immunization, LabScan, LabScanGroup, MedicalHistory,
+                     MedicationStatement, Observation, Patient, PatientSearchToken, PatientSummary, Procedure, User,
+                     UserEducation, Visit, Vitals, VitalSample)
+from .patient_import import age_from_birthdate
+from .patient_summary import compute as compute_summaries
+from .storage import add_references, get_store
+from .vitals_series import parse_vitals
+
+# Synthetic clinic for load testing. Patients are generated in blocks of
+# `block_size`; a cheap plan of every block's row counts is drawn first, so
+# each block knows its id ranges up front and produces the same rows from
+# the same seed whichever process generates it and in whatever order.
+# Every table is written with one executemany per block, and the derived
+# rows (search tokens, vital samples, summaries, blob references) along
+# with it, as the other bulk writers do.
+DEFAULT_BLOCK_SIZE = 500
+MAX_VISITS = 80
+SAMPLE_SCANS_FOLDER = os.path.join(os.path.dirname(__file__), 'static', 'uploads', 'lab_scans')
+
+# Tables with ids assigned from the plan, in insert order
+PLANNED_MODELS = (DoctorPatient, Visit, Observation, Vitals, MedicationStatement, Immunization, AllergyIntolerance,
+                  Procedure, MedicalHistory, Appointment, LabScanGroup, LabScan)
+# Everything a block writes, in foreign key order
+BLOCK_MODELS = (Patient, DoctorPatient, PatientSearchToken, Visit, Observation, Vitals, VitalSample, MedicationStatement,
+                Immunization, AllergyIntolerance, Procedure, MedicalHistory, Appointment, LabScanGroup, LabScan)
+
+FIRST_NAMES = {
+    'male': ['Jose', 'Juan', 'Mark', 'John', 'Michael', 'Paolo', 'Carlo', 'Miguel', 'Rafael', 'Daniel', 'Gabriel',
+             'Antonio', 'Roberto', 'Eduardo', 'Ramon', 'Angelo', 'Christian', 'Joshua', 'Francis', 'Luis'],
+    'female': ['Maria', 'Ana', 'Angelica', 'Kristine', 'Jasmine', 'Patricia', 'Andrea', 'Camille', 'Nicole', 'Sofia',
+               'Isabel', 'Carmela', 'Teresa', 'Rosario', 'Elena', 'Bea', 'Katrina', 'Liza', 'Grace', 'Joy'],
+}
+FIRST_NAMES['other'] = FIRST_NAMES['male'][::2] + FIRST_NAMES['female'][::2]
+LAST_NAMES = ['Santos', 'Reyes', 'Cruz', 'Bautista', 'Ocampo', 'Garcia', 'Mendoza', 'Torres', 'Tomas', 'Andrada',
+              'Castillo', 'Flores', 'Villanueva', 'Ramos', 'Castro', 'Rivera', 'Aquino', 'Navarro', 'Salazar', 'Mercado',
+              'Dela Cruz', 'Del Rosario', 'Gonzales', 'Lopez', 'Aguilar', 'Pascual', 'Soriano', 'Domingo', 'Valdez',
+              'Manalo', 'Dizon', 'Lim', 'Tan', 'Go', 'Sy', 'Francisco', 'Ignacio', 'Jimenez', 'Morales', 'Perez']
+STREETS = ['Rizal St', 'Mabini St', 'Bonifacio Ave', 'Luna St', 'Quezon Blvd', 'Del Pilar St', 'Aguinaldo Hwy',
+           'Magsaysay Ave', 'Roxas Blvd', 'Katipunan Ave', 'Taft Ave', 'Shaw Blvd']
+CITIES = ['Manila', 'Quezon City', 'Makati', 'Pasig', 'Taguig', 'Caloocan', 'Cebu City', 'Davao City', 'Iloilo City',
+          'Baguio', 'Antipolo', 'Bacolod']
+
+# Encounter diagnoses (ICD-10) by visit reason
+DIAGNOSES = {
+    '185349003': ['Z00.00'], '386661006': ['R50.9', 'J06.9'], '162864005': ['R05', 'J20.9'], '84229001': ['R51', 'G43.909'],
+    '183460006': ['E11.9', 'E11.65'], '308335008': ['I10'], '168537006': ['R07.9', 'I20.9'], '182888003': ['S93.401D'],
+}
+# Observation codes by the kind of value they hold: lab results with a reference range in
+# LAB_DEFAULTS (except SpO2, a vital sign), reports and screening tests. Other codes are not generated.
+IMAGING_CODES = ('24627-2', '18748-4', '72273-1', '11502-2', '30746-8')
+IMAGING_RESULTS = ('No acute findings', 'Normal study', 'Findings noted, follow-up advised')
+SCREENING_CODES = ('94500-6', '22322-2', '20570-8', '58413-6', '24111-1', '49541-6')
+# Blood pressure, heart rate, temperature, respiratory rate, SpO2 and weight, recorded at most visits
+VITAL_SIGNS = ('85354-9', '8867-4', '8310-5', '9279-1', '59408-5', '29463-7')
+# (RxNorm code, name, timing), first the ones for the chronic conditions
+MEDICATIONS = [
+    ('197361', 'Amlodipine 5 MG Oral Tablet', 'Once daily'),
+    ('979480', 'Losartan Potassium 50 MG Oral Tablet', 'Once daily'),
+    ('861007', 'Metformin Hydrochloride 500 MG Oral Tablet', 'Twice daily'),
+    ('617312', 'Atorvastatin 20 MG Oral Tablet', 'Once daily at bedtime'),
+    ('308182', 'Amoxicillin 500 MG Oral Capsule', 'Three times daily for 7 days'),
+    ('313782', 'Acetaminophen 325 MG Oral Tablet', 'Every 6 hours as needed'),
+    ('197806', 'Ibuprofen 600 MG Oral Tablet', 'Every 8 hours as needed'),
+    ('966571', 'Levothyroxine Sodium 0.05 MG Oral Tablet', 'Once daily before breakfast'),
+    ('745679', 'Albuterol 0.09 MG/ACTUAT Inhaler', 'As needed for wheezing'),
+    ('312961', 'Simvastatin 20 MG Oral Tablet', 'Once daily at bedtime'),
+    ('198013', 'Naproxen 250 MG Oral Tablet', 'Twice daily as needed'),
+    ('310965', 'Ibuprofen 200 MG Oral Tablet', 'Every 6 hours as needed'),
+]
+# (substance, category, reaction)
+ALLERGENS = [('Penicillin', 'medication', 'Hives'), ('Sulfonamides', 'medication', 'Rash'),
+             ('Aspirin', 'medication', 'Wheezing'), ('Peanut', 'food', 'Swelling of the lips'),
+             ('Shellfish', 'food', 'Hives'), ('Egg', 'food', 'Vomiting'), ('Milk', 'food', 'Abdominal cramps'),
+             ('Dust mites', 'environmental', 'Sneezing'), ('Pollen', 'environmental', 'Itchy eyes'),
+             ('Latex', 'environmental', 'Contact dermatitis')]
+# (code, display) of common procedures
+PROCEDURES = [('80146002', 'Appendectomy'), ('73761001', 'Colonoscopy'), ('38102005', 'Cholecystectomy'),
+              ('44608003', 'Blood transfusion'), ('29303009', 'Electrocardiographic procedure'),
+              ('252160004', 'Standard chest X-ray'), ('18286008', 'Catheter ablation'),
+              ('112798008', 'Insertion of endotracheal tube'), ('5880005', 'Physical examination')]
+CONDITIONS = ['Essential hypertension', 'Type 2 diabetes mellitus', 'Asthma', 'Hyperlipidemia', 'Hypothyroidism',
+              'Gastroesophageal reflux disease', 'Osteoarthritis of knee', 'Migraine', 'Allergic rhinitis',
+              'Chronic kidney disease stage 2', 'Pulmonary tuberculosis, treated', 'Dengue fever']
+MANUFACTURERS = ['Sanofi Pasteur', 'GlaxoSmithKline', 'Pfizer', 'Merck', 'Moderna', 'Serum Institute of India']
+SCAN_GROUPS = ['Chest X-ray', 'Abdominal Ultrasound', 'CT Scan', 'Lab Results', 'Knee X-ray', 'Dental X-ray']
+
+
+class SeedSettings:
+    """What every block needs to know; inherited by forked workers."""
+
+    def __init__(self, seed, today, visits, years, doctor_ids, scans, block_size):
+        self.seed = seed
+        self.today = today
+        self.visits = visits
+        self.years = years
+        self.doctor_ids = doctor_ids
+        # A few doctors have most of the patients
+        self.doctor_cum_weights = list(accumulate(1 / (rank + 1) ** 0.8 for rank in range(len(doctor_ids))))
+        self.scans = scans
+        self.block_size = block_size
+        self.start = datetime.combine(today - timedelta(days=int(365.25 * years)), day_time())
+        self.span_minutes = int((datetime.combine(today, day_time()) - self.start).total_seconds() // 60)
+        self.codes = {name: [code for code, _ in terminology.get(name).choices] for name in terminology.names()}
+        observation_codes = self.codes['observation.code']
+        self.lab_codes = [code for code in observation_codes if code in LAB_DEFAULTS and code != '15074-8']
+        self.imaging_codes = [code for code in observation_codes if code in IMAGING_CODES]
+        self.screening_codes = [code for code in observation_codes if code in SCREENING_CODES]
+
+
+class SeedResult:
+    def __init__(self, patients):
+        self.patients = patients
+        self.done = 0
+        self.rows = Counter()
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    def total(self):
+        return sum(self.rows.values())
+
+    def rate(self):
+        return self.total() / max(self.elapsed or time.perf_counter() - self.started, 1e-9)
+
+
+def _uuid(seed, business_id):
+    # From the business id as well, which id_sequence never hands out twice, so seeding again adds new rows
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"seed:{seed}:{business_id}"))
+
+
+def _rng(seed, *parts):
+    # String seeds are hashed with SHA-512, so they give the same stream in every process and run
+    return random.Random(':'.join(str(part) for part in (seed,) + parts))
+
+
+def plan_block(settings, block, size):
+    """The row counts of every patient of a block, drawn from a stream of their own."""
+    rng = _rng(settings.seed, block, 'plan')
+    shared_care = len(settings.doctor_ids) > 1
+    plans = []
+    for _ in range(size):
+        visits = min(MAX_VISITS, 1 + int(rng.expovariate(1 / max(settings.visits - 1, 0.1))))
+        groups = ()
+        if settings.scans and rng.random() < 0.15:
+            groups = tuple(rng.randint(1, 4) for _ in range(rng.randint(1, 2)))
+        plans.append({
+            'visits': visits,
+            'links': 2 if shared_care and rng.random() < 0.1 else 1,
+            'vitals_visits': sum(rng.random() < 0.8 for _ in range(visits)),
+            'observations': rng.randint(0, 3 * visits),
+            'medications': rng.randint(0, 1 + visits // 2),
+            'immunizations': rng.randint(0, 3),
+            'allergies': 0 if rng.random() < 0.7 else rng.randint(1, 3),
+            'procedures': 0 if rng.random() < 0.8 else rng.randint(1, 2),
+            'conditions': 0 if rng.random() < 0.5 else rng.randint(1, 3),
+            'booked_visits': sum(rng.random() < 0.6 for _ in range(visits)),
+            'upcoming': 1 if rng.random() < 0.3 else 0,
+            'scan_groups': groups,
+        })
+    return plans
+
+
+def plan_counts(plans):
+    """Rows per planned table of a block."""
+    counts = Counter()
+    for plan in plans:
+        counts[DoctorPatient] += plan['links']
+        counts[Visit] += plan['visits']
+        counts[Vitals] += len(VITAL_SIGNS) * plan['vitals_visits']
+        counts[Observation] += plan['observations']
+        counts[MedicationStatement] += plan['medications']
+        counts[Immunization] += plan['immunizations']
+        counts[AllergyIntolerance] += plan['allergies']
+        counts[Procedure] += plan['procedures']
+        counts[MedicalHistory] += plan['conditions']
+        counts[Appointment] += plan['booked_visits'] + plan['upcoming']
+        counts[LabScanGroup] += len(plan['scan_groups'])
+        counts[LabScan] += sum(plan['scan_groups'])
+    return counts
+
+
+def _birthdate(rng, today):
+    # Age bands weighted like a general practice list
+    low, high = rng.choices([(0, 12), (13, 19), (20, 39), (40, 59), (60, 79), (80, 99)], [14, 8, 28, 27, 18, 5])[0]
+    return today - timedelta(days=rng.randint(low * 365, high * 365 + 364))
+
+
+def _phone(rng):
+    return f"09{rng.randrange(10 ** 9):09d}"
+
+
+def _lab_value(rng, code, traits):
+    unit, low, high = LAB_DEFAULTS[code]
+    if code == '4548-4' and 'diabetic' in traits:
+        value = rng.gauss(7.8, 1.2)
+    elif code == '2345-7' and 'diabetic' in traits:
+        value = rng.gauss(165, 40)
+    else:
+        middle = (low + high) / 2 if low is not None and high is not None else (high * 0.8 if low is None else low * 1.4)
+        spread = (high - low) / 4 if low is not None and high is not None else middle * 0.15
+        # One result in ten is abnormal
+        value = rng.gauss(middle, spread * (3 if rng.random() < 0.1 else 1))
+    value = max(value, 0.1)
+    # Staff type the unit about half of the time
+    return f"{value:.1f} {unit}" if rng.random() < 0.5 else f"{value:.1f}"
+
+
+def _vital_values(rng, profile):
+    """One reading of each VITAL_SIGNS code around the patient's own baseline."""
+    systolic = rng.gauss(profile['systolic'], 8)
+    temperature = rng.gauss(37.0, 0.3) if rng.random() > 0.05 else rng.uniform(38.0, 39.6)
+    return [
+        (f"{systolic:.0f}/{systolic * 0.64 + rng.gauss(0, 5):.0f}", 'mmhg'),
+        (f"{rng.gauss(profile['heart_rate'], 6):.0f}", 'bpm'),
+        (f"{temperature:.1f}", 'celsius'),
+        (f"{rng.gauss(profile['respiratory_rate'], 1.5):.0f}", 'bpm'),
+        (f"{min(100.0, rng.gauss(97.5, 1.2)):.0f}", '%'),
+        (f"{max(2.0, rng.gauss(profile['weight'], 1.0)):.1f}", 'kg'),
+    ]
+
+
+def generate_block(settings, block, size, numbers, starts):
+    """
+    The rows of one block of patients, by table name. `numbers` are their
+    business ids and `starts` the first id of every planned table.
+    """
+    rng = _rng(settings.seed, block, 'rows')
+    codes = settings.codes
+    today = settings.today
+    ids = {model: starts[model] for model in PLANNED_MODELS}
+    rows = {model.__tablename__: [] for model in BLOCK_MODELS}
+
+    def next_id(model):
+        ids[model] += 1
+        return ids[model] - 1
+
+    def add(model, **values):
+        if model in PLANNED_MODELS:
+            values['id'] = next_id(model)
+        rows[model.__tablename__].append(values)
+        return values
+
+    for plan, number in zip(plan_block(settings, block, size), numbers):
+        gender = rng.choices(['male', 'female', 'other'], [49, 49, 2])[0]
+        birthdate = _birthdate(rng, today)
+        age = age_from_birthdate(birthdate, today)
+        traits = set()
+        if age >= 30 and rng.random() < 0.25 + age / 400:
+            traits.add('hypertensive')
+        if age >= 30 and rng.random() < 0.12:
+            traits.add('diabetic')
+        profile = {
+            'systolic': 105 + 0.35 * min(age, 80) + (22 if 'hypertensive' in traits else 0) + rng.gauss(0, 6),
+            'heart_rate': rng.gauss(75 if age >= 12 else 95, 7),
+            'respiratory_rate': 16 if age >= 12 else 22,
+            'weight': rng.gauss(68 if gender == 'male' else 58, 11) if age >= 18 else 3.5 + age * 3.1,
+        }
+
+        visit_times = sorted(settings.start + timedelta(minutes=rng.randrange(settings.span_minutes))
+                             for _ in range(plan['visits']))
+        # Clinic hours
+        visit_times = [at.replace(hour=rng.randint(8, 16), minute=rng.choice((0, 15, 30, 45)), second=0) for at in visit_times]
+        patient_id = _uuid(settings.seed, number)
+        firstname = rng.choice(FIRST_NAMES[gender])
+        lastname = rng.choice(LAST_NAMES)
+        patient = add(Patient, id=patient_id, patient_id=number, firstname=firstname, lastname=lastname,
+                      age=str(age), birthdate=birthdate, gender=gender, contact_number=_phone(rng),
+                      home_address=f"{rng.randint(1, 2500)} {rng.choice(STREETS)}, {rng.choice(CITIES)}",
+                      ecd_name=f"{rng.choice(FIRST_NAMES['female' if rng.random() < 0.6 else 'male'])} {lastname}"
+                      if rng.random() < 0.7 else None,
+                      ecd_contact_number=None,
+                      created_at=visit_times[0] - timedelta(days=rng.randint(0, 30)))
+        if patient['ecd_name']:
+            patient['ecd_contact_number'] = _phone(rng)
+        for token, field in search.patient_tokens(SimpleNamespace(**patient)):
+            rows[PatientSearchToken.__tablename__].append({"patient_id": patient_id, "token": token, "field": field})
+
+        doctors = []
+        while len(doctors) < plan['links']:
+            doctor_id = settings.doctor_ids[bisect(settings.doctor_cum_weights, rng.random() * settings.doctor_cum_weights[-1])]
+            if doctor_id not in doctors:
+                doctors.append(doctor_id)
+        for doctor_id in doctors:
+            add(DoctorPatient, doctor_id=doctor_id, patient_id=patient_id)
+
+        visits = []
+        for at in visit_times:
+            reason = rng.choice(codes['visit.reason_code'])
+            if 'hypertensive' in traits and rng.random() < 0.3:
+                reason = '308335008'
+            elif 'diabetic' in traits and rng.random() < 0.3:
+                reason = '183460006'
+            class_code = rng.choices(['outpatient', 'virtual', 'inpatient'], [85, 10, 5])[0]
+            visits.append(add(
+                Visit, patient_id=patient_id, doctor_id=doctors[0] if rng.random() < 0.85 else rng.choice(doctors),
+                visit_date=at, reason_code=reason,
+                diagnosis_code=rng.choice(DIAGNOSES[reason]) if reason in DIAGNOSES else None,
+                status='cancelled' if rng.random() < 0.05 else 'completed', class_code=class_code,
+                priority=rng.choices(codes['visit.priority'], [90, 8, 2])[0],
+                location={'virtual': 'virtual', 'inpatient': 'hospital_room_101'}.get(class_code)
+                or rng.choice(['clinic_a', 'clinic_b']),
+                notes=None,
+            ))
+        seen = [visit for visit in visits if visit['status'] == 'completed'] or visits
+
+        for visit in rng.sample(visits, plan['vitals_visits']):
+            taken = visit['visit_date'] + timedelta(minutes=rng.randint(0, 20))
+            for code, (value, unit) in zip(VITAL_SIGNS, _vital_values(rng, profile)):
+                vitals = add(Vitals, patient_id=patient_id, visit_id=visit['id'], status='final',
+                             category='vital-signs', code=code, effective_date=taken, value=value, unit=unit)
+                sample = parse_vitals(SimpleNamespace(**vitals))
+                if sample:
+                    rows[VitalSample.__tablename__].append(sample)
+
+        for _ in range(plan['observations']):
+            visit = rng.choice(seen)
+            kind = rng.random()
+            if kind < 0.8:
+                code = rng.choice(settings.lab_codes)
+                category, value = 'laboratory', _lab_value(rng, code, traits)
+            elif kind < 0.9:
+                code = rng.choice(settings.imaging_codes)
+                category, value = 'imaging', rng.choices(IMAGING_RESULTS, [60, 30, 10])[0]
+            else:
+                code = rng.choice(settings.screening_codes)
+                category, value = 'laboratory', 'Positive' if rng.random() < 0.08 else 'Negative'
+            value_numeric, unit, reference_low, reference_high = parse_quantity(code, value)
+            add(Observation, patient_id=patient_id, visit_id=visit['id'], code=code, value=value,
+                status=rng.choices(['final', 'preliminary', 'amended'], [92, 5, 3])[0], category=category,
+                effectiveDateTime=visit['visit_date'] + timedelta(minutes=rng.randint(10, 240)),
+                value_numeric=value_numeric, unit=unit, reference_low=reference_low, reference_high=reference_high)
+
+        chronic = [MEDICATIONS[0], MEDICATIONS[1]] if 'hypertensive' in traits else []
+        if 'diabetic' in traits:
+            chronic.append(MEDICATIONS[2])
+        for index in range(plan['medications']):
+            visit = rng.choice(seen)
+            code, name, timing = chronic[index] if index < len(chronic) else rng.choice(MEDICATIONS[3:])
+            status = 'active' if index < len(chronic) else rng.choices(['active', 'completed', 'stopped'], [30, 60, 10])[0]
+            started = visit['visit_date'].date()
+            add(MedicationStatement, patient_id=patient_id, visit_id=visit['id'], medication_code=code,
+                medication_name=name, status=status, effectivePeriod_start=started,
+                effectivePeriod_end=started + timedelta(days=rng.randint(5, 90)) if status != 'active' else None,
+                date_asserted=started, information_source=rng.choice(['Patient', 'Practitioner', 'Pharmacy record']),
+                adherence=rng.choices(codes['medication_statement.adherence'], [75, 15, 10])[0],
+                reason_code=visit['reason_code'], reason_reference=None, status_reason=None,
+                dosage_instruction=f"Take as directed: {timing.lower()}", notes=None,
+                category=rng.choices(codes['medication_statement.category'], [90, 7, 3])[0],
+                route_of_administration='Inhalation' if 'Inhaler' in name else 'Oral', timing=timing)
+
+        for _ in range(plan['immunizations']):
+            visit = rng.choice(seen)
+            add(Immunization, patient_id=patient_id, visit_id=visit['id'],
+                vaccine_code=rng.choice(codes['immunization.vaccine_code']),
+                status='completed' if rng.random() < 0.95 else 'not-done', date=visit['visit_date'].date(),
+                lot_number=f"{''.join(rng.choices('ABCDEFGHJKLMNPRSTUVWXYZ', k=2))}{rng.randint(1000, 99999)}",
+                site=rng.choice(codes['immunization.site']), route=rng.choices(codes['immunization.route'], [80, 15, 5])[0],
+                dose_quantity='0.5 mL', manufacturer=rng.choice(MANUFACTURERS), notes=None)
+
+        for substance, category, reaction in rng.sample(ALLERGENS, plan['allergies']):
+            add(AllergyIntolerance, patient_id=patient_id, visit_id=rng.choice(seen)['id'], substance=substance,
+                clinical_status=rng.choices(codes['allergy_intolerance.clinical_status'], [85, 10, 5])[0],
+                verification_status=rng.choices(codes['allergy_intolerance.verification_status'], [80, 18, 2])[0],
+                severity=rng.choices(codes['allergy_intolerance.severity'], [60, 30, 10])[0],
+                type='allergy' if rng.random() < 0.8 else 'intolerance', category=category, reaction=reaction,
+                onset=rng.choice(codes['allergy_intolerance.onset']))
+
+        for _ in range(plan['procedures']):
+            visit = rng.choice(seen)
+            code, display = rng.choice(PROCEDURES)
+            add(Procedure, patient_id=patient_id, visit_id=visit['id'], status='completed',
+                category=rng.choice(codes['procedure.category']), code=code, performed_date=visit['visit_date'].date(),
+                performer_id=visit['doctor_id'], reason_code=visit['reason_code'],
+                outcome=rng.choices(codes['procedure.outcome'], [90, 3, 7])[0], report=f"{display} performed without complications.")
+
+        for condition in rng.sample(CONDITIONS, plan['conditions']):
+            visit = rng.choice(seen)
+            onset = visit['visit_date'].date() - timedelta(days=rng.randint(0, 3650))
+            add(MedicalHistory, patient_id=patient_id, doctor_id=visit['doctor_id'], visit_id=visit['id'],
+                clinical_status=rng.choices(codes['medical_history.clinical_status'][:3], [60, 30, 10])[0],
+                verification_status=rng.choices(codes['medical_history.verification_status'][:2], [85, 15])[0],
+                category=rng.choice(codes['medical_history.category'][:2]), code=rng.choice(codes['medical_history.code']),
+                onset_date=onset, abatement_date=onset + timedelta(days=rng.randint(14, 3650)), notes=condition)
+
+        def appointment(start, status, visit_id, doctor_id):
+            add(Appointment, patient_id=patient_id, visit_id=visit_id, doctor_id=doctor_id, status=status,
+                service_category=rng.choices(codes['appointment.service_category'], [70] + [30 / 8] * 8)[0],
+                service_type=rng.choice(codes['appointment.service_type']),
+                specialty=rng.choice(codes['appointment.specialty']),
+                appointment_type=rng.choices(codes['appointment.appointment_type'], [75, 10, 10, 5])[0],
+                reason_code=rng.choice(codes['appointment.reason_code']),
+                priority=rng.choices(codes['appointment.priority'], [15, 75, 8, 2])[0],
+                start=start, end=start + timedelta(minutes=rng.choice((15, 30, 30, 45))),
+                participant_actor='patient', participant_status='accepted')
+
+        for visit in sorted(rng.sample(visits, plan['booked_visits']), key=lambda visit: visit['id']):
+            status = 'fulfilled' if visit['status'] == 'completed' else 'cancelled'
+            appointment(visit['visit_date'], status, visit['id'], visit['doctor_id'])
+        for _ in range(plan['upcoming']):
+            start = datetime.combine(today + timedelta(days=rng.randint(1, 90)), day_time(rng.randint(8, 16), rng.choice((0, 30))))
+            appointment(start, 'booked', None, doctors[0])
+
+        for scans in plan['scan_groups']:
+            visit = rng.choice(seen)
+            uploaded = visit['visit_date'] + timedelta(hours=rng.randint(1, 72))
+            group = add(LabScanGroup, group_name=f"{rng.choice(SCAN_GROUPS)} {visit['visit_date']:%Y-%m-%d}",
+                        created_at=uploaded, patient_id=patient_id)
+            for _ in range(scans):
+                content_hash, filename = rng.choice(settings.scans)
+                add(LabScan, filename=filename, file_path=f"lab_scans/{filename}", upload_date=uploaded,
+                    group_id=group['id'], content_hash=content_hash)
+    return rows
+
+
+def write_block(connection, rows, now=None):
+    """Insert a block's rows, then its blob references and patient summaries, on `connection`. Returns rows per table."""
+    counts = Counter()
+    for model in BLOCK_MODELS:
+        table_rows = rows[model.__tablename__]
+        if table_rows:
+            connection.execute(insert(model.__table__), table_rows)
+            counts[model.__tablename__] += len(table_rows)
+    add_references(connection, Counter(scan['content_hash'] for scan in rows[LabScan.__tablename__]))
+    patient_ids = [patient['id'] for patient in rows[Patient.__tablename__]]
+    summaries = [dict(columns, patient_id=patient_id, updated_at=now or datetime.utcnow())
+                 for patient_id, columns in compute_summaries(connection, patient_ids, now=now).items()]
+    connection.execute(insert(PatientSummary.__table__), summaries)
+    counts[PatientSummary.__tablename__] += len(summaries)
+    return counts
+
+
+def create_doctors(count, seed, password):
+    """Add `count` doctor accounts signing in with `password`. Returns their ids."""
+    rng = _rng(seed, 'doctors')
+    prefix, numbers = sequences.reserve_block('user', count)
+    hashed = bcrypt.generate_password_hash(password).decode('utf-8')
+    users, education = [], []
+    for number in numbers:
+        gender = rng.choice(['male', 'female'])
+        user_id = sequences.format_id(prefix, number)
+        doctor_id = _uuid(seed, user_id)
+        users.append({
+            "id": doctor_id, "user_id": user_id, "username": user_id.lower(), "password": hashed,
+            "email": f"{user_id.lower()}@example.com", "role": 'doctor', "firstname": rng.choice(FIRST_NAMES[gender]),
+            "lastname": rng.choice(LAST_NAMES), "age": str(rng.randint(28, 65)), "gender": gender,
+            "contact_number": _phone(rng), "id_card_number": f"{rng.randrange(10 ** 11):011d}",
+            "home_address": f"{rng.randint(1, 2500)} {rng.choice(STREETS)}, {rng.choice(CITIES)}",
+            "country": 'Philippines', "has_submitted_survey": True,
+        })
+        education.append({
+            "doctor_id": doctor_id, "med_deg": 'MD', "med_deg_spec": rng.choice(['Family Medicine', 'Internal Medicine', 'Pediatrics']),
+            "board_cert": 'Diplomate', "license_number": f"{rng.randrange(10 ** 7):07d}", "license_issuer": 'PRC',
+            "license_expiration": date(rng.randint(2026, 2029), rng.randint(1, 12), 1), "years_of_experience": str(rng.randint(1, 30)),
+        })
+    if users:
+        with db.engine.begin() as connection:
+            connection.execute(insert(User.__table__), users)
+            connection.execute(insert(UserEducation.__table__), education)
+    return [user["id"] for user in users]
+
+
+def sample_scans():
+    """(content hash, filename) of the bundled sample images, stored in the blob store."""
+    scans = []
+    if os.path.isdir(SAMPLE_SCANS_FOLDER):
+        store = get_store()
+        for filename in sorted(os.listdir(SAMPLE_SCANS_FOLDER)):
+            if filename.lower().endswith(('.jpg', '.jpeg', '.png')):
+                stored = store.save_path(os.path.join(SAMPLE_SCANS_FOLDER, filename), mimetypes.guess_type(filename)[0])
+                scans.append((stored.content_hash, filename))
+    return scans
+
+
+# Set before forking the workers, which inherit them
+_worker_app = None
+_worker_settings = None
+
+
+def _init_worker():
+    with _worker_app.app_context():
+        # Never reuse connections inherited from the parent process
+        db.engine.dispose(close=False)
+
+
+def _run_block(task, write):
+    block, size, numbers, starts = task
+    with _worker_app.app_context():
+        rows = generate_block(_worker_settings, block, size, numbers, starts)
+        if not write:
+            return size, rows
+        with db.engine.begin() as connection:
+            return size, write_block(connection, rows)
+
+
+def _generate_task(task):
+    return _run_block(task, write=False)
+
+
+def _write_task(task):
+    return _run_block(task, write=True)
+
+
+def seed(app, patients, settings, workers=1, report=None):
+    """
+    Generate `patients` patients and their charts with `workers` processes.
+    On MySQL every worker writes its own blocks, each in a transaction; on
+    SQLite, which has a single writer, the workers only generate rows and
+    this process writes them. `report(result)` is called after every block.
+    """
+    global _worker_app, _worker_settings
+    block_size = settings.block_size
+    blocks = [(block, min(block_size, patients - block * block_size)) for block in range(-(-patients // block_size))]
+
+    # Every block's id ranges, from the plans, after the rows already there
+    with db.engine.connect() as connection:
+        next_ids = {model: (connection.execute(select(func.max(model.__table__.c.id))).scalar() or 0) + 1
+                    for model in PLANNED_MODELS}
+    prefix, numbers = sequences.reserve_block('patient', patients)
+    tasks = []
+    first_patient = 0
+    for block, size in blocks:
+        counts = plan_counts(plan_block(settings, block, size))
+        block_numbers = [sequences.format_id(prefix, numbers.start + first_patient + index) for index in range(size)]
+        tasks.append((block, size, block_numbers, dict(next_ids)))
+        for model in PLANNED_MODELS:
+            next_ids[model] += counts[model]
+        first_patient += size
+
+    result = SeedResult(patients)
+    parallel_writes = db.engine.dialect.name != 'sqlite'
+    _worker_app, _worker_settings = app, settings
+
+    def done(size, counts):
+        result.done += size
+        result.rows.update(counts)
+        if report is not None:
+            report(result)
+
+    def write_here(rows):
+        with db.engine.begin() as connection:
+            return write_block(connection, rows)
+
+    if workers <= 1:
+        for task in tasks:
+            size, rows = _run_block(task, write=False)
+            done(size, write_here(rows))
+    else:
+        context = multiprocessing.get_context('fork')
+        with context.Pool(workers, initializer=_init_worker) as pool:
+            if parallel_writes:
+                for size, counts in pool.imap_unordered(_write_task, tasks):
+                    done(size, counts)
+            else:
+                for size, rows in pool.imap(_generate_task, tasks):
+                    done(size, write_here(rows))
+    result.elapsed = time.perf_counter() - result.started
+    return result
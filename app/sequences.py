@@ -0,0 +1,163 @@
+import threading
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import select, insert, update, event
+from sqlalchemy.exc import IntegrityError
+from . import db
+from .models import IdSequence, Patient, User
+
+DEFAULT_BLOCK_SIZE = 10
+
+# Business id formats: prefix template and the column the ids are stored in
+SEQUENCES = {
+    'patient': ("MDHS-{year}-", Patient.patient_id),
+    'user': ("MDHS-USER-{year}-", User.user_id),
+}
+
+
+def sequence_prefix(kind, year=None):
+    template, _ = SEQUENCES[kind]
+    return template.format(year=year or datetime.now().year)
+
+
+def format_id(prefix, number):
+    return f"{prefix}{str(number).zfill(4)}"
+
+
+def _highest_existing(connection, kind, prefix):
+    """
+    Largest number already used under `prefix`. Only read when a prefix gets
+    its counter row, so ids issued before id_sequence existed are skipped.
+    """
+    _, column = SEQUENCES[kind]
+    highest = 0
+    for (value,) in connection.execute(select(column).where(column.like(f"{prefix}%"))):
+        suffix = value[len(prefix):]
+        if suffix.isdigit():
+            highest = max(highest, int(suffix))
+    return highest
+
+
+def _bump(connection, prefix, count):
+    """Advance the counter by `count`; returns the first reserved number, or None if the row is missing."""
+    t = IdSequence.__table__
+    result = connection.execute(
+        update(t).where(t.c.prefix == prefix).values(next_value=t.c.next_value + count)
+    )
+    if result.rowcount == 0:
+        return None
+    # The UPDATE holds the row lock, so this read sees our own increment
+    return connection.execute(select(t.c.next_value).where(t.c.prefix == prefix)).scalar_one() - count
+
+
+def _reserve_on(connection, kind, prefix, count):
+    start = _bump(connection, prefix, count)
+    if start is not None:
+        return start
+    first = _highest_existing(connection, kind, prefix) + 1
+    connection.execute(insert(IdSequence.__table__).values(prefix=prefix, next_value=first + count))
+    return first
+
+
+def _in_caller_transaction(connection):
+    return connection is not None and connection.dialect.name == 'sqlite'
+
+
+def reserve_block(kind, count, connection=None):
+    """
+    Reserve `count` consecutive numbers for `kind` and return them as a range.
+
+    The counter row is updated in its own short transaction and committed
+    straight away, so the row lock is never held for the length of the
+    caller's transaction. Numbers reserved by a transaction that later rolls
+    back are simply skipped. SQLite has a single writer anyway, so there the
+    reservation runs on the caller's `connection` when one is given, to avoid
+    waiting on its own write lock.
+    """
+    prefix = sequence_prefix(kind)
+    if _in_caller_transaction(connection):
+        start = _reserve_on(connection, kind, prefix, count)
+        return prefix, range(start, start + count)
+
+    for attempt in range(3):
+        try:
+            with db.engine.begin() as own:
+                start = _reserve_on(own, kind, prefix, count)
+            return prefix, range(start, start + count)
+        except IntegrityError:
+            # Another worker created the counter row first; bump it instead
+            if attempt == 2:
+                raise
+
+
+class IdAllocator:
+    """
+    Hands out business ids from blocks reserved in id_sequence.
+
+    Each process keeps the rest of its current block in memory, so only one
+    insert in `block_size` touches the counter row. Ids stay unique across
+    workers, but are not strictly chronological between them.
+    """
+
+    def __init__(self, block_size=None):
+        self.block_size = block_size
+        self._blocks = {}
+        self._lock = threading.Lock()
+
+    def _block_size(self):
+        if self.block_size:
+            return self.block_size
+        return current_app.config.get('ID_BLOCK_SIZE', DEFAULT_BLOCK_SIZE)
+
+    def next_id(self, kind, connection=None):
+        if _in_caller_transaction(connection):
+            # The reservation rolls back with the caller, so it cannot be cached
+            prefix, numbers = reserve_block(kind, 1, connection)
+            return format_id(prefix, numbers.start)
+
+        prefix = sequence_prefix(kind)
+        with self._lock:
+            block = self._blocks.get(kind)
+            if block is None or block[0] != prefix or block[1] >= block[2]:
+                # A new year starts a new prefix and therefore a new block
+                block_prefix, numbers = reserve_block(kind, self._block_size(), connection)
+                block = [block_prefix, numbers.start, numbers.stop]
+                self._blocks[kind] = block
+            number = block[1]
+            block[1] += 1
+            return format_id(block[0], number)
+
+    def bulk_ids(self, kind, count, connection=None):
+        """`count` ids from a single reservation, for imports and seeding."""
+        if count <= 0:
+            return []
+        prefix, numbers = reserve_block(kind, count, connection)
+        return [format_id(prefix, number) for number in numbers]
+
+    def reset(self):
+        """Forget the cached blocks, e.g. after forking a worker process."""
+        with self._lock:
+            self._blocks.clear()
+
+
+allocator = IdAllocator()
+
+
+def next_patient_id(connection=None):
+    return allocator.next_id('patient', connection)
+
+
+def next_user_id(connection=None):
+    return allocator.next_id('user', connection)
+
+
+# Fill in patient_id / user_id on insert unless the caller already set one
+@event.listens_for(Patient, 'before_insert')
+def set_patient_id(mapper, connection, target):
+    if not target.patient_id:
+        target.patient_id = next_patient_id(connection)
+
+@event.listens_for(User, 'before_insert')
+def set_user_id(mapper, connection, target):
+    if not target.user_id:
+        target.user_id = next_user_id(connection)
@@ -0,0 +1,92 @@
+import os, random, socketserver, threading, time
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    """Just enough SMTP (RFC 5321) for smtplib and Flask-Mail to deliver to."""
+
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode('ascii'))
+
+    def handle(self):
+        server = self.server
+        mail_from, rcpt_tos = None, []
+        self.reply("220 localhost EHR SMTP sink ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command, _, argument = line.decode('utf-8', 'replace').strip().partition(' ')
+            command = command.upper()
+            if command in ('EHLO', 'HELO'):
+                self.reply("250 localhost")
+            elif command == 'MAIL':
+                mail_from, rcpt_tos = argument.partition(':')[2].strip(' <>'), []
+                self.reply("250 OK")
+            elif command == 'RCPT':
+                rcpt_tos.append(argument.partition(':')[2].strip(' <>'))
+                self.reply("250 OK")
+            elif command == 'DATA':
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                data = self._read_data()
+                if server.fail_rate and random.random() < server.fail_rate:
+                    self.reply("451 Requested action aborted: simulated failure")
+                else:
+                    server.store(mail_from, rcpt_tos, data)
+                    self.reply("250 OK: queued")
+                mail_from, rcpt_tos = None, []
+            elif command == 'RSET':
+                mail_from, rcpt_tos = None, []
+                self.reply("250 OK")
+            elif command == 'NOOP':
+                self.reply("250 OK")
+            elif command == 'QUIT':
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+    def _read_data(self):
+        lines = []
+        while True:
+            line = self.rfile.readline()
+            if not line or line in (b".\r\n", b".\n"):
+                break
+            # Undo dot-stuffing
+            lines.append(line[1:] if line.startswith(b"..") else line)
+        return b"".join(lines)
+
+
+class LocalSMTPServer(socketserver.ThreadingTCPServer):
+    """
+    A local stand-in for the real mail server, for development and for
+    exercising the outbox worker. Accepted messages are kept in `messages`
+    and, when `maildir` is given, written there as .eml files. `fail_rate`
+    answers that fraction of messages with a temporary 451 error so retries
+    can be observed.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=8025, maildir=None, fail_rate=0.0):
+        super().__init__((host, port), _SMTPHandler)
+        self.maildir = maildir
+        self.fail_rate = fail_rate
+        self.messages = []
+        self._lock = threading.Lock()
+        if maildir:
+            os.makedirs(maildir, exist_ok=True)
+
+    def store(self, mail_from, rcpt_tos, data):
+        with self._lock:
+            self.messages.append((mail_from, rcpt_tos, data))
+            count = len(self.messages)
+        if self.maildir:
+            path = os.path.join(self.maildir, f"{time.time():.6f}-{count}.eml")
+            with open(path, 'wb') as handle:
+                handle.write(data)
+
+    def start(self):
+        """Serve from a background thread; returns the server for chaining in tests."""
+        threading.Thread(target=self.serve_forever, name='smtp-sink', daemon=True).start()
+        return self
@@ -0,0 +1,99 @@
+// static/js/chart.js
+// Loads the patient chart sections on demand and drives the shared edit/delete modals.
+document.addEventListener("DOMContentLoaded", function() {
+    const editModal = document.getElementById("chartEditModal");
+    const deleteModal = document.getElementById("chartDeleteModal");
+
+    function moreButton(container) {
+        return document.querySelector(`[data-chart-more="#${container.id}"]`);
+    }
+
+    // Fetch one page of rows; without a cursor the section is (re)loaded from the top
+    function loadRows(container, cursor) {
+        const url = new URL(container.dataset.chartUrl, window.location.origin);
+        if (cursor) {
+            url.searchParams.set("cursor", cursor);
+        }
+        container.dataset.chartLoaded = "1";
+
+        return fetch(url, { headers: { "X-Requested-With": "XMLHttpRequest" } })
+            .then(response => {
+                if (!response.ok) {
+                    throw new Error(`Failed to load ${url}: ${response.status}`);
+                }
+                container.dataset.nextCursor = response.headers.get("X-Next-Cursor") || "";
+                return response.text();
+            })
+            .then(html => {
+                if (cursor) {
+                    container.insertAdjacentHTML("beforeend", html);
+                } else {
+                    container.innerHTML = html;
+                }
+                const button = moreButton(container);
+                if (button) {
+                    button.classList.toggle("d-none", !container.dataset.nextCursor);
+                }
+            })
+            .catch(error => {
+                delete container.dataset.chartLoaded;
+                console.error(error);
+            });
+    }
+
+    // Sections inside a tab are only fetched the first time the tab is shown
+    function loadPane(pane) {
+        if (!pane) {
+            return;
+        }
+        pane.querySelectorAll("[data-chart-url]").forEach(container => {
+            if (!container.dataset.chartLoaded) {
+                loadRows(container);
+            }
+        });
+    }
+
+    document.addEventListener("shown.bs.tab", function(event) {
+        loadPane(document.querySelector(event.target.getAttribute("href")));
+    });
+    document.querySelectorAll(".tab-pane.active").forEach(loadPane);
+
+    document.addEventListener("click", function(event) {
+        const more = event.target.closest("[data-chart-more]");
+        if (more) {
+            const container = document.querySelector(more.dataset.chartMore);
+            more.disabled = true;
+            loadRows(container, container.dataset.nextCursor).finally(() => { more.disabled = false; });
+            return;
+        }
+
+        // One modal for every edit dialog: fetch the form and drop it into the modal
+        const edit = event.target.closest("[data-chart-edit]");
+        if (edit && editModal) {
+            event.preventDefault();
+            fetch(edit.dataset.chartEdit, { headers: { "X-Requested-With": "XMLHttpRequest" } })
+                .then(response => {
+                    if (!response.ok) {
+                        throw new Error(`Failed to load ${edit.dataset.chartEdit}: ${response.status}`);
+                    }
+                    return response.text();
+                })
+                .then(html => {
+                    editModal.querySelector(".modal-content").innerHTML = html;
+                    bootstrap.Modal.getOrCreateInstance(editModal).show();
+                })
+                .catch(error => console.error(error));
+            return;
+        }
+
+        const del = event.target.closest("[data-chart-delete]");
+        if (del && deleteModal) {
+            event.preventDefault();
+            const form = deleteModal.querySelector("form");
+            form.action = del.dataset.chartDelete;
+            form.reset();
+            deleteModal.querySelector(".modal-title").textContent = del.dataset.chartDeleteTitle || "Confirm Deletion";
+            bootstrap.Modal.getOrCreateInstance(deleteModal).show();
+        }
+    });
+});
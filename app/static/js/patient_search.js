@@ -0,0 +1,61 @@
+// static/js/patient_search.js
+
+document.addEventListener("DOMContentLoaded", function() {
+    const searchInput = document.getElementById("patientSearch");
+    const resultsList = document.getElementById("patientSearchResults");
+    if (!searchInput || !resultsList) {
+        return;
+    }
+
+    const searchUrl = searchInput.dataset.searchUrl;
+    let debounceTimer = null;
+    let pendingRequest = null;
+
+    searchInput.addEventListener("input", function() {
+        clearTimeout(debounceTimer);
+        debounceTimer = setTimeout(fetchSuggestions, 200);  // Wait for the user to pause typing
+    });
+
+    // Hide the suggestions when focus leaves the search box
+    searchInput.addEventListener("blur", function() {
+        setTimeout(clearResults, 200);
+    });
+
+    function fetchSuggestions() {
+        const query = searchInput.value.trim();
+        if (query.length < 2) {
+            clearResults();
+            return;
+        }
+
+        // Drop the previous request so stale results never overwrite newer ones
+        if (pendingRequest) {
+            pendingRequest.abort();
+        }
+        pendingRequest = new AbortController();
+
+        fetch(`${searchUrl}?q=${encodeURIComponent(query)}`, { signal: pendingRequest.signal })
+            .then(response => response.json())
+            .then(data => renderResults(data.results || []))
+            .catch(error => {
+                if (error.name !== "AbortError") {
+                    console.error("Patient search failed", error);
+                }
+            });
+    }
+
+    function renderResults(results) {
+        clearResults();
+        results.forEach(function(patient) {
+            const item = document.createElement("a");
+            item.href = patient.url;
+            item.className = "list-group-item list-group-item-action";
+            item.textContent = `${patient.name} (${patient.patient_id})`;
+            resultsList.appendChild(item);
+        });
+    }
+
+    function clearResults() {
+        resultsList.innerHTML = "";
+    }
+});
@@ -0,0 +1,445 @@
+import hashlib, io, logging, mimetypes, os, shutil, tempfile, threading, time
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import delete, event, func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from . import db
+from .models import AdditionalDocument, Blob, LabScan
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+DEFAULT_GC_GRACE = 3600
+
+# Models whose `content_hash` column references a blob
+REFERENCING_MODELS = (LabScan, AdditionalDocument)
+# Where records from before the blob store keep their file, relative to UPLOAD_FOLDER
+LEGACY_PATH_COLUMNS = ((LabScan, LabScan.file_path), (AdditionalDocument, AdditionalDocument.document_file))
+
+
+def blob_key(content_hash):
+    """Backend key of a blob, sharded two levels deep so no directory grows too large."""
+    return f"{content_hash[:2]}/{content_hash[2:4]}/{content_hash}"
+
+
+class StorageBackend:
+    """
+    Where blob contents live. Keys are '/'-separated relative paths made by
+    `blob_key`. `put` takes ownership of a finished temporary file.
+    """
+
+    # Directory for upload temp files; None means the system default
+    temp_dir = None
+
+    def put(self, key, source_path):
+        raise NotImplementedError
+
+    def open(self, key):
+        """A readable binary file object; raises FileNotFoundError for unknown keys."""
+        raise NotImplementedError
+
+    def exists(self, key):
+        raise NotImplementedError
+
+    def size(self, key):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def keys(self):
+        raise NotImplementedError
+
+    def local_path(self, key):
+        """Filesystem path of the blob when the backend has one, so it can be served by the web server."""
+        return None
+
+
+class LocalFileSystemBackend(StorageBackend):
+    """Blobs as files below `root`; temp files live in `root`/tmp so finishing an upload is a rename."""
+
+    def __init__(self, root):
+        self.root = root
+        self.temp_dir = os.path.join(root, 'tmp')
+        os.makedirs(self.temp_dir, exist_ok=True)
+
+    def local_path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def put(self, key, source_path):
+        target = self.local_path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            os.replace(source_path, target)
+        except OSError:
+            # The temp file was on another filesystem
+            shutil.move(source_path, target)
+
+    def open(self, key):
+        return open(self.local_path(key), 'rb')
+
+    def exists(self, key):
+        return os.path.exists(self.local_path(key))
+
+    def size(self, key):
+        return os.path.getsize(self.local_path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self.local_path(key))
+        except FileNotFoundError:
+            pass
+
+    def keys(self):
+        for directory, subdirectories, filenames in os.walk(self.root):
+            if directory == self.root and 'tmp' in subdirectories:
+                subdirectories.remove('tmp')
+            for filename in filenames:
+                yield os.path.relpath(os.path.join(directory, filename), self.root).replace(os.sep, '/')
+
+
+class MemoryObjectStore(StorageBackend):
+    """
+    Stand-in for an S3-style object store, for tests and development: whole
+    objects kept in memory by key, no local paths, so everything is read
+    through `open`.
+    """
+
+    def __init__(self):
+        self._objects = {}
+        self._lock = threading.Lock()
+
+    def put(self, key, source_path):
+        with open(source_path, 'rb') as handle:
+            data = handle.read()
+        os.remove(source_path)
+        with self._lock:
+            self._objects[key] = data
+
+    def open(self, key):
+        with self._lock:
+            data = self._objects.get(key)
+        if data is None:
+            raise FileNotFoundError(key)
+        return io.BytesIO(data)
+
+    def exists(self, key):
+        with self._lock:
+            return key in self._objects
+
+    def size(self, key):
+        with self._lock:
+            if key not in self._objects:
+                raise FileNotFoundError(key)
+            return len(self._objects[key])
+
+    def delete(self, key):
+        with self._lock:
+            self._objects.pop(key, None)
+
+    def keys(self):
+        with self._lock:
+            return list(self._objects)
+
+
+# STORAGE_BACKEND name -> factory taking the app config
+BACKENDS = {
+    'local': lambda config: LocalFileSystemBackend(config['STORAGE_FOLDER']),
+    'memory': lambda config: MemoryObjectStore(),
+}
+
+
+def register_backend(name, factory):
+    BACKENDS[name] = factory
+
+
+class StoredFile:
+    """The outcome of saving an upload."""
+
+    def __init__(self, content_hash, size, content_type, deduplicated):
+        self.content_hash = content_hash
+        self.size = size
+        self.content_type = content_type
+        self.deduplicated = deduplicated
+
+    def __repr__(self):
+        return f"<StoredFile {self.content_hash[:12]} {self.size}B{' dedup' if self.deduplicated else ''}>"
+
+
+class BlobStore:
+    """
+    Content-addressed storage for uploads.
+
+    A file is streamed to a temp file in chunks while it is hashed, then
+    stored once under its SHA-256, however many records and patients use
+    it. The blobs table counts the LabScan and AdditionalDocument rows that
+    reference each blob. `collect_garbage` removes blobs that have stayed
+    unreferenced for a grace period.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def save(self, stream, content_type=None):
+        """Store everything readable from `stream` and return a StoredFile."""
+        digest = hashlib.sha256()
+        size = 0
+        handle = tempfile.NamedTemporaryFile(dir=self.backend.temp_dir, prefix='upload-', delete=False)
+        try:
+            with handle:
+                for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    handle.write(chunk)
+                    size += len(chunk)
+            return self._register(handle.name, digest.hexdigest(), size, content_type)
+        finally:
+            if os.path.exists(handle.name):
+                os.remove(handle.name)
+
+    def save_upload(self, file_storage):
+        """Store a werkzeug FileStorage from request.files or a FileField."""
+        return self.save(file_storage.stream, file_storage.mimetype or None)
+
+    def save_path(self, path, content_type=None):
+        """Store a copy of a file already on disk."""
+        with open(path, 'rb') as handle:
+            return self.save(handle, content_type)
+
+    def adopt(self, path, content_hash, content_type=None):
+        """
+        Store a finished file whose SHA-256 the caller has already computed,
+        moving it into place rather than copying it. The file is consumed.
+        """
+        try:
+            return self._register(path, content_hash, os.path.getsize(path), content_type)
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _register(self, temp_path, content_hash, size, content_type):
+        """
+        Create or touch the blob row and move the content into place in one
+        short transaction of its own. Touching `updated_at` keeps a concurrent
+        garbage collection from removing a blob that is about to be referenced.
+        """
+        key = blob_key(content_hash)
+        now = datetime.utcnow()
+        t = Blob.__table__
+        for attempt in range(3):
+            try:
+                with db.engine.begin() as connection:
+                    touched = connection.execute(
+                        update(t).where(t.c.content_hash == content_hash).values(updated_at=now)
+                    ).rowcount
+                    if not touched:
+                        connection.execute(insert(t).values(
+                            content_hash=content_hash, size=size, content_type=content_type,
+                            ref_count=0, created_at=now, updated_at=now,
+                        ))
+                    deduplicated = bool(touched) and self.backend.exists(key)
+                    if not deduplicated:
+                        self.backend.put(key, temp_path)
+                return StoredFile(content_hash, size, content_type, deduplicated)
+            except IntegrityError:
+                # Someone uploaded the same content at the same moment; touch theirs instead
+                if attempt == 2:
+                    raise
+
+    def exists(self, content_hash):
+        return self.backend.exists(blob_key(content_hash))
+
+    def open(self, content_hash):
+        return self.backend.open(blob_key(content_hash))
+
+    def size(self, content_hash):
+        return self.backend.size(blob_key(content_hash))
+
+    def local_path(self, content_hash):
+        return self.backend.local_path(blob_key(content_hash))
+
+    def source(self, content_hash):
+        """A path, or a callable opening the blob, for consumers such as the thumbnail renderer."""
+        return self.local_path(content_hash) or (lambda: self.open(content_hash))
+
+    def collect_garbage(self, grace=DEFAULT_GC_GRACE, dry_run=False):
+        """
+        Delete blobs with no references that have not been touched for
+        `grace` seconds, plus stale upload temp files. Each blob's row is
+        deleted first, in the same transaction as its content, so an upload
+        touching the row at the same time either wins or waits.
+        Returns (blobs removed, bytes freed).
+        """
+        from .derivatives import remove_derivatives
+
+        cutoff = datetime.utcnow() - timedelta(seconds=grace)
+        t = Blob.__table__
+        orphaned = (t.c.ref_count <= 0) & (t.c.updated_at < cutoff)
+        candidates = db.session.execute(select(t.c.content_hash, t.c.size).where(orphaned)).all()
+        db.session.commit()
+        if dry_run:
+            return len(candidates), sum(size for _, size in candidates)
+
+        removed = freed = 0
+        for content_hash, size in candidates:
+            with db.engine.begin() as connection:
+                deleted = connection.execute(delete(t).where(t.c.content_hash == content_hash, orphaned)).rowcount
+                if deleted:
+                    self.backend.delete(blob_key(content_hash))
+            if deleted:
+                remove_derivatives(current_app.config['DERIVATIVE_FOLDER'], content_hash)
+                removed += 1
+                freed += size
+        self._remove_stale_temp_files(grace)
+        return removed, freed
+
+    def _remove_stale_temp_files(self, grace):
+        temp_dir = self.backend.temp_dir
+        if not temp_dir or not os.path.isdir(temp_dir):
+            return
+        cutoff = time.time() - grace
+        for entry in os.scandir(temp_dir):
+            if entry.name.startswith('upload-') and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+
+    def recount(self):
+        """
+        Recompute every blob's ref_count from the referencing tables, e.g.
+        after importing legacy files or editing rows outside the ORM.
+        Returns the number of blobs whose count changed.
+        """
+        counts = {}
+        for model in REFERENCING_MODELS:
+            rows = db.session.execute(
+                select(model.content_hash, func.count()).where(model.content_hash.isnot(None)).group_by(model.content_hash)
+            )
+            for content_hash, count in rows:
+                counts[content_hash] = counts.get(content_hash, 0) + count
+
+        changed = 0
+        now = datetime.utcnow()
+        for blob in Blob.query.all():
+            actual = counts.get(blob.content_hash, 0)
+            if blob.ref_count != actual:
+                blob.ref_count = actual
+                blob.updated_at = now
+                changed += 1
+        db.session.commit()
+        return changed
+
+
+def get_store(app=None):
+    """The app's BlobStore, built from STORAGE_BACKEND on first use."""
+    app = app or current_app._get_current_object()
+    store = app.extensions.get('blob_store')
+    if store is None:
+        backend = BACKENDS[app.config.get('STORAGE_BACKEND', 'local')](app.config)
+        store = app.extensions['blob_store'] = BlobStore(backend)
+    return store
+
+
+def _adjust_references(connection, content_hash, delta):
+    if content_hash:
+        t = Blob.__table__
+        connection.execute(
+            update(t).where(t.c.content_hash == content_hash)
+            .values(ref_count=t.c.ref_count + delta, updated_at=datetime.utcnow())
+        )
+
+
+def add_references(connection, counts):
+    """
+    Raise ref_count by `counts` (content hash -> new rows) for rows inserted
+    in bulk, which skips the mapper events below. Hashes are updated in
+    sorted order so concurrent batches lock the blob rows alike.
+    """
+    for content_hash in sorted(counts):
+        _adjust_references(connection, content_hash, counts[content_hash])
+
+
+# Keep blobs.ref_count in step with the rows pointing at each blob, inside
+# the same transaction as the row change
+def _count_new_reference(mapper, connection, target):
+    _adjust_references(connection, target.content_hash, 1)
+
+def _count_dropped_reference(mapper, connection, target):
+    _adjust_references(connection, target.content_hash, -1)
+
+def _count_moved_reference(mapper, connection, target):
+    history = db.inspect(target).attrs.content_hash.history
+    for content_hash in history.deleted:
+        _adjust_references(connection, content_hash, -1)
+    for content_hash in history.added:
+        _adjust_references(connection, content_hash, 1)
+
+for _model in REFERENCING_MODELS:
+    event.listen(_model, 'after_insert', _count_new_reference)
+    event.listen(_model, 'after_delete', _count_dropped_reference)
+    event.listen(_model, 'after_update', _count_moved_reference)
+
+
+def legacy_path_in_use(legacy_path):
+    """Whether a record without a blob still points at the pre-blob file `legacy_path`."""
+    for model, column in LEGACY_PATH_COLUMNS:
+        query = select(model.id).where(column == legacy_path, model.content_hash.is_(None)).limit(1)
+        if db.session.execute(query).first():
+            return True
+    return False
+
+
+def remove_legacy_file(content_hash, legacy_path):
+    """
+    Delete a record's pre-blob file; stored blobs are left to garbage
+    collection. Old uploads could overwrite each other's file, so it stays
+    while any other record without a blob still points at it.
+    """
+    if content_hash and get_store().exists(content_hash):
+        return
+    if legacy_path_in_use(legacy_path):
+        return
+    path = os.path.join(current_app.config['UPLOAD_FOLDER'], legacy_path)
+    if os.path.isfile(path):
+        os.remove(path)
+
+
+def import_legacy_files(batch_size=500, remove_files=False):
+    """
+    Move the files of records from before the blob store into it. Each
+    record without a content_hash whose file is still in UPLOAD_FOLDER gets
+    the hash of a stored copy, which counts as its reference; records that
+    share a path share the blob. With `remove_files`, a legacy file is
+    deleted once no record without a blob points at it any more.
+    Returns (records imported, records whose file is missing).
+    """
+    store = get_store()
+    folder = current_app.config['UPLOAD_FOLDER']
+    # Legacy path -> content hash of its stored copy, or None if the file is gone
+    stored = {}
+    imported = missing = 0
+    for model, column in LEGACY_PATH_COLUMNS:
+        last_id = 0
+        while True:
+            rows = (model.query.filter(model.content_hash.is_(None), model.id > last_id)
+                    .order_by(model.id).limit(batch_size).all())
+            if not rows:
+                break
+            for row in rows:
+                legacy_path = getattr(row, column.key)
+                if legacy_path not in stored:
+                    path = os.path.join(folder, legacy_path)
+                    if os.path.isfile(path):
+                        stored[legacy_path] = store.save_path(path, mimetypes.guess_type(path)[0]).content_hash
+                    else:
+                        stored[legacy_path] = None
+                if stored[legacy_path] is None:
+                    missing += 1
+                    continue
+                row.content_hash = stored[legacy_path]
+                imported += 1
+            last_id = rows[-1].id
+            db.session.commit()
+
+    if remove_files:
+        for legacy_path, content_hash in stored.items():
+            if content_hash:
+                remove_legacy_file(None, legacy_path)
+    return imported, missing
@@ -0,0 +1,105 @@
+import sys
+from functools import wraps
+from types import MappingProxyType
+
+# Every registered value set, keyed by '<table>.<field>' (e.g. 'visit.reason_code')
+_VALUE_SETS = {}
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class ValueSet:
+    """
+    An immutable code system such as the vaccine codes of Immunization.
+
+    Built once from a list of {"code", "display"} dicts. Holds the entries as
+    read-only mappings, a code -> display map for O(1) lookups and the
+    (code, display) tuples that WTForms SelectFields take as `choices`.
+    Codes and displays are interned, so every set shares the same string
+    objects no matter how many forms or rows use them.
+    """
+
+    __slots__ = ('name', 'entries', 'choices', 'displays', 'source')
+
+    def __init__(self, name, items, source=None):
+        self.name = name
+        self.entries = tuple(
+            MappingProxyType({"code": _intern(item["code"]), "display": _intern(item["display"])})
+            for item in items
+        )
+        self.choices = tuple((entry["code"], entry["display"]) for entry in self.entries)
+        self.displays = MappingProxyType(dict(self.choices))
+        self.source = source
+
+    def display(self, code, default=None):
+        """The display text of `code`, or `default` when it is not part of the set."""
+        return self.displays.get(code, default)
+
+    def decode(self, codes, default=None):
+        """Display texts for a list of codes, in the same order."""
+        get = self.displays.get
+        return [get(code, default) for code in codes]
+
+    def __contains__(self, code):
+        return code in self.displays
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return f'<ValueSet {self.name} ({len(self.entries)} codes)>'
+
+
+def register(name, items, source=None):
+    if name in _VALUE_SETS:
+        raise ValueError(f"Value set {name!r} is already registered")
+    value_set = _VALUE_SETS[name] = ValueSet(name, items, source)
+    return value_set
+
+
+def value_set(name):
+    """
+    Register a model's `get_*` loader as the value set `name`.
+
+    The loader runs once, at import time. The decorated method keeps its
+    name and signature but returns the shared, read-only entries instead of
+    building a new list of dicts on every call.
+    """
+    def decorator(loader):
+        registered = register(name, loader(), source=loader)
+
+        @wraps(loader)
+        def entries():
+            return registered.entries
+
+        entries.value_set = registered
+        return entries
+    return decorator
+
+
+def get(name):
+    """The ValueSet registered under `name`; raises KeyError for unknown names."""
+    return _VALUE_SETS[name]
+
+
+def names():
+    return sorted(_VALUE_SETS)
+
+
+def display(name, code, default=None):
+    return _VALUE_SETS[name].display(code, default)
+
+
+def decode(name, codes, default=None):
+    """Decode many codes of one value set at once, e.g. a whole column of a page of rows."""
+    return _VALUE_SETS[name].decode(codes, default)
+
+
+def choices(name):
+    """Pre-built (code, display) tuples for a SelectField."""
+    return _VALUE_SETS[name].choices
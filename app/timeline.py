@@ -0,0 +1,195 @@
+import heapq
+from datetime import datetime, time
+from sqlalchemy import Date, DateTime, Integer, String, and_, func, literal, null, or_, select, type_coerce, union_all
+from . import db, terminology
+from .models import (AdditionalDocument, AllergyIntolerance, Immunization, LabScan, LabScanGroup, MedicalHistory,
+                     MedicationStatement, Observation, Procedure, Visit, Vitals)
+from .pagination import CursorError, KeysetPage, decode_cursor, encode_cursor
+
+DEFAULT_TIMELINE_SIZE = 50
+MAX_TIMELINE_SIZE = 200
+
+
+class TimelineSource:
+    """
+    One stream of events on a patient's timeline.
+
+    `at` is the event time: a DateTime expression, or a Date one when
+    `dated` is set (those events sort as midnight of their day). Records
+    without a time of their own fall back to their visit through `joins`.
+    `label`, `detail` and `status` are the columns shown for an event, and
+    `value_set` decodes `label` into a display name.
+    """
+
+    def __init__(self, kind, model, at, label, detail=None, status=None, value_set=None, dated=False,
+                 patient_column=None, visit_column=None, joins=()):
+        self.kind = kind
+        self.model = model
+        self.at = at
+        self.label = label
+        self.detail = detail
+        self.status = status
+        self.value_set = value_set
+        self.dated = dated
+        self.patient_column = patient_column if patient_column is not None else model.patient_id
+        self.visit_column = visit_column if visit_column is not None else model.visit_id
+        self.joins = joins
+
+    def _seek(self, rank, values):
+        """Condition for the events that come after the cursor `values` in newest-first order."""
+        at, kind, record_id = values
+        cursor_rank = TIMELINE_RANKS[kind]
+        if self.dated:
+            day = at.date()
+            if at != datetime.combine(day, time()):
+                # Dated events sit at midnight, so all of that day is older than the cursor
+                return self.at <= day
+            at = day
+        if rank < cursor_rank:
+            return self.at <= at
+        if rank > cursor_rank:
+            return self.at < at
+        return or_(self.at < at, and_(self.at == at, self.model.id < record_id))
+
+    def select(self, patient_id, rank, values, limit):
+        """The next `limit` events of this stream as a subquery, newest first."""
+        empty = lambda type_: type_coerce(null(), type_)
+        statement = select(
+            literal(self.kind, String).label('kind'),
+            self.model.id.label('id'),
+            empty(DateTime).label('at_dt') if self.dated else type_coerce(self.at, DateTime).label('at_dt'),
+            type_coerce(self.at, Date).label('at_d') if self.dated else empty(Date).label('at_d'),
+            type_coerce(self.label, String).label('label'),
+            (type_coerce(self.detail, String) if self.detail is not None else empty(String)).label('detail'),
+            (type_coerce(self.status, String) if self.status is not None else empty(String)).label('status'),
+            (self.visit_column if self.visit_column is not False else empty(Integer)).label('visit_id'),
+        ).select_from(self.model)
+        for target, onclause in self.joins:
+            statement = statement.join(target, onclause)
+        statement = statement.where(self.patient_column == patient_id, self.at.isnot(None))
+        if values is not None:
+            statement = statement.where(self._seek(rank, values))
+        return statement.order_by(self.at.desc(), self.model.id.desc()).limit(limit).subquery(f"{self.kind}_events")
+
+
+TIMELINE_SOURCES = (
+    TimelineSource('visit', Visit, Visit.visit_date, Visit.reason_code, Visit.diagnosis_code, Visit.status,
+                   value_set='visit.reason_code', visit_column=Visit.id),
+    TimelineSource('observation', Observation, func.coalesce(Observation.effectiveDateTime, Visit.visit_date),
+                   Observation.code, Observation.value, Observation.status, value_set='observation.code',
+                   joins=((Visit, Visit.id == Observation.visit_id),)),
+    TimelineSource('vitals', Vitals, Vitals.effective_date, Vitals.code, Vitals.value, Vitals.status,
+                   value_set='vitals.code'),
+    TimelineSource('procedure', Procedure, func.coalesce(Procedure.performed_date, func.date(Visit.visit_date)),
+                   Procedure.code, Procedure.outcome, Procedure.status, dated=True,
+                   joins=((Visit, Visit.id == Procedure.visit_id),)),
+    TimelineSource('immunization', Immunization, Immunization.date, Immunization.vaccine_code,
+                   Immunization.dose_quantity, Immunization.status, value_set='immunization.vaccine_code', dated=True),
+    TimelineSource('medication', MedicationStatement,
+                   func.coalesce(MedicationStatement.effectivePeriod_start, MedicationStatement.date_asserted,
+                                 func.date(Visit.visit_date)),
+                   MedicationStatement.medication_name, MedicationStatement.timing, MedicationStatement.status,
+                   dated=True, joins=((Visit, Visit.id == MedicationStatement.visit_id),)),
+    TimelineSource('allergy', AllergyIntolerance, Visit.visit_date, AllergyIntolerance.substance,
+                   AllergyIntolerance.severity, AllergyIntolerance.clinical_status,
+                   joins=((Visit, Visit.id == AllergyIntolerance.visit_id),)),
+    TimelineSource('medical_history', MedicalHistory, MedicalHistory.onset_date, MedicalHistory.code,
+                   MedicalHistory.category, MedicalHistory.clinical_status, value_set='medical_history.code',
+                   dated=True),
+    TimelineSource('lab_scan', LabScan, LabScan.upload_date, LabScan.filename, LabScanGroup.group_name,
+                   patient_column=LabScanGroup.patient_id, visit_column=False,
+                   joins=((LabScanGroup, LabScanGroup.id == LabScan.group_id),)),
+    TimelineSource('document', AdditionalDocument, AdditionalDocument.upload_date, AdditionalDocument.document_name,
+                   AdditionalDocument.document_file, visit_column=False),
+)
+TIMELINE_KINDS = tuple(source.kind for source in TIMELINE_SOURCES)
+# Events at the same moment are ordered by kind, in the order above
+TIMELINE_RANKS = {kind: rank for rank, kind in enumerate(TIMELINE_KINDS)}
+
+
+def clamp_timeline_size(limit):
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return DEFAULT_TIMELINE_SIZE
+    return max(1, min(limit, MAX_TIMELINE_SIZE))
+
+
+def parse_kinds(kinds):
+    """The known event kinds of a comma-separated list, in timeline order; all of them when empty."""
+    wanted = {kind.strip() for kind in (kinds or '').split(',') if kind.strip()}
+    return tuple(kind for kind in TIMELINE_KINDS if kind in wanted) or TIMELINE_KINDS
+
+
+def _event_key(row):
+    at = row.at_dt if row.at_d is None else datetime.combine(row.at_d, time())
+    return at, TIMELINE_RANKS[row.kind], row.id
+
+
+def _event(row, displays):
+    at, _, _ = _event_key(row)
+    return {
+        "kind": row.kind,
+        "id": row.id,
+        "at": row.at_d.isoformat() if row.at_d is not None else at.isoformat(),
+        "all_day": row.at_d is not None,
+        "label": row.label,
+        "display": displays.get((row.kind, row.label)),
+        "detail": row.detail,
+        "status": row.status,
+        "visit_id": row.visit_id,
+    }
+
+
+def load_timeline(patient_id, cursor=None, limit=DEFAULT_TIMELINE_SIZE, kinds=None, before=None):
+    """
+    One page of a patient's clinical history across all chart tables,
+    newest first, optionally limited to some event `kinds` and starting
+    `before` a moment.
+
+    Every stream contributes at most `limit + 1` rows, read from the
+    patient's rows of its table past the cursor, and the streams are sent
+    as one UNION ALL statement. The already ordered streams are then merged
+    here, so a page costs the same however far back it is and holds at most
+    `limit + 1` rows per stream in memory.
+    """
+    kinds = tuple(kinds or TIMELINE_KINDS)
+    limit = clamp_timeline_size(limit)
+    scope = f"timeline:{','.join(kinds)}"
+    values = None
+    if cursor:
+        try:
+            values, _ = decode_cursor(cursor, scope=scope)
+            if len(values) != 3 or not isinstance(values[0], datetime) or values[1] not in TIMELINE_RANKS:
+                raise CursorError("Cursor does not match the timeline")
+        except CursorError:
+            # A stale or foreign cursor simply restarts the timeline
+            values = None
+    if values is None and before is not None:
+        # Before every kind at that moment: strictly older events only
+        values = [before, TIMELINE_KINDS[0], 0]
+
+    sources = [source for source in TIMELINE_SOURCES if source.kind in kinds]
+    streams = [source.select(patient_id, TIMELINE_RANKS[source.kind], values, limit + 1) for source in sources]
+    rows = db.session.execute(union_all(*[select(*stream.c) for stream in streams])).all()
+
+    by_kind = {source.kind: [] for source in sources}
+    for row in rows:
+        by_kind[row.kind].append(row)
+    merged = heapq.merge(*by_kind.values(), key=_event_key, reverse=True)
+    page = [row for _, row in zip(range(limit + 1), merged)]
+
+    has_more = len(page) > limit
+    page = page[:limit]
+    displays = {}
+    for source in sources:
+        if source.value_set:
+            labels = sorted({row.label for row in page if row.kind == source.kind and row.label})
+            for label, display in zip(labels, terminology.decode(source.value_set, labels)):
+                displays[(source.kind, label)] = display
+
+    next_cursor = None
+    if has_more:
+        at, _, record_id = _event_key(page[-1])
+        next_cursor = encode_cursor([at, page[-1].kind, record_id], 'next', scope)
+    return KeysetPage([_event(row, displays) for row in page], next_cursor=next_cursor)
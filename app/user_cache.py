@@ -0,0 +1,104 @@
+import threading, time
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session, make_transient_to_detached, object_session
+from . import db
+from .models import User
+
+DEFAULT_TTL = 60
+
+
+class UserCache:
+    """
+    Per-process cache of the logged-in users' rows, keyed by users.id.
+
+    Entries hold plain column values, not ORM instances, so nothing is shared
+    between requests or sessions. `load` rebuilds a User from them and
+    merges it into the current session without a SELECT, which lets routes
+    modify and commit current_user as before.
+
+    Entries expire after `ttl` seconds and are dropped as soon as a User row
+    is updated or deleted through the ORM in this process. Other worker
+    processes pick up such changes when their own entry expires.
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _ttl(self):
+        if self.ttl is not None:
+            return self.ttl
+        return current_app.config.get('USER_CACHE_TTL', DEFAULT_TTL)
+
+    def load(self, user_id):
+        """Return the User with this id, from the cache when possible."""
+        ttl = self._ttl()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                values = entry[1]
+            else:
+                self.misses += 1
+                values = None
+
+        if values is not None:
+            user = User(**values)
+            make_transient_to_detached(user)
+            return db.session.merge(user, load=False)
+
+        user = db.session.get(User, user_id)
+        if user is not None and ttl > 0:
+            values = {attr.key: getattr(user, attr.key) for attr in User.__mapper__.column_attrs}
+            with self._lock:
+                self._entries[user_id] = (now + ttl, values)
+        return user
+
+    def invalidate(self, user_id):
+        with self._lock:
+            if self._entries.pop(user_id, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else None,
+            }
+
+
+user_cache = UserCache()
+
+
+# Drop cached users as soon as their row changes, and once more after the
+# commit so a request that re-read the old row mid-transaction cannot keep it
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def invalidate_cached_user(mapper, connection, target):
+    user_cache.invalidate(target.id)
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('changed_user_ids', set()).add(target.id)
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_committed_users(session):
+    for user_id in session.info.pop('changed_user_ids', ()):
+        user_cache.invalidate(user_id)
+
+@event.listens_for(Session, 'after_rollback')
+def forget_rolled_back_users(session):
+    session.info.pop('changed_user_ids', None)
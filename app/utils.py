@@ -1,7 +1,6 @@
 from itsdangerous import URLSafeTimedSerializer
 from flask import current_app, url_for, redirect
-from flask_mail import Message
-from . import mail
+from . import db, outbox
 
 def allowed_file(filename):
     allowed_extensions = {'png', 'jpg', 'jpeg', 'pdf', 'doc', 'docx'}
@@ -9,13 +8,12 @@ def allowed_file(filename):
 
 def send_reset_email(user):
     token = user.set_reset_token()  # Set and get the token
-    msg = Message('Password Reset Request',
-                  sender='noreply@demo.com',
-                  recipients=[user.email])
-    msg.body = f'''To reset your password, visit the following link: {url_for('main.reset_password', token=token, _external=True)} 
+    body = f'''To reset your password, visit the following link: {url_for('main.reset_password', token=token, _external=True)} 
                 If you did not make this request, simply ignore this email and no changes will be made.
                 '''
-    mail.send(msg)
+    # Queued only; `flask outbox-worker` delivers it
+    outbox.enqueue('Password Reset Request', [user.email], body=body, sender='noreply@demo.com')
+    db.session.commit()
 
 # Define redirect_dashboard directly in routes.py
 def redirect_dashboard(role):
@@ -0,0 +1,257 @@
+import calendar, math, re
+from datetime import datetime, timedelta
+from sqlalchemy import delete, event, func, insert, inspect, select
+from . import db, terminology
+from .models import Vitals, VitalSample
+
+DEFAULT_BUCKETS = 200
+MAX_BUCKETS = 1000
+
+BLOOD_PRESSURE = '85354-9'
+BODY_TEMPERATURE = '8310-5'
+
+# Canonical UCUM unit of every vitals code; samples are stored in these
+CANONICAL_UNITS = {
+    BODY_TEMPERATURE: 'Cel',
+    BLOOD_PRESSURE: 'mm[Hg]',
+    '8867-4': '/min',     # Heart rate
+    '9279-1': '/min',     # Respiratory rate
+    '59408-5': '%',       # Oxygen saturation
+    '29463-7': 'kg',      # Weight
+    '8302-2': 'cm',       # Height
+    '39156-5': 'kg/m2',   # BMI
+}
+
+# Names staff type into the free-text code field, besides the LOINC codes and their displays
+CODE_ALIASES = {
+    'temperature': BODY_TEMPERATURE, 'temp': BODY_TEMPERATURE,
+    'bp': BLOOD_PRESSURE,
+    'pulse': '8867-4', 'hr': '8867-4',
+    'rr': '9279-1', 'respiration': '9279-1',
+    'spo2': '59408-5', 'o2 sat': '59408-5', 'oxygen': '59408-5',
+    'bmi': '39156-5',
+}
+
+# Unit spellings of the vitals.unit value set and of free text -> UCUM
+UNIT_ALIASES = {
+    'celsius': 'Cel', 'c': 'Cel', '°c': 'Cel', 'cel': 'Cel',
+    'fahrenheit': '[degF]', 'f': '[degF]', '°f': '[degF]', '[degf]': '[degF]',
+    'bpm': '/min', '/min': '/min', 'beats/min': '/min', 'breaths/min': '/min', 'rpm': '/min',
+    'mmhg': 'mm[Hg]', 'mm hg': 'mm[Hg]', 'mm[hg]': 'mm[Hg]',
+    'kg': 'kg', 'g': 'g', 'lb': '[lb_av]', 'lbs': '[lb_av]', '[lb_av]': '[lb_av]',
+    'cm': 'cm', 'm': 'm', 'in': '[in_i]', 'inch': '[in_i]', 'inches': '[in_i]', '[in_i]': '[in_i]',
+    'kg/m2': 'kg/m2', 'm2': 'kg/m2',  # The unit list offers 'm2' for BMI
+    '%': '%',
+}
+
+# (from, to) -> conversion of a value
+CONVERSIONS = {
+    ('[degF]', 'Cel'): lambda value: (value - 32) * 5 / 9,
+    ('[lb_av]', 'kg'): lambda value: value * 0.45359237,
+    ('g', 'kg'): lambda value: value / 1000,
+    ('m', 'cm'): lambda value: value * 100,
+    ('[in_i]', 'cm'): lambda value: value * 2.54,
+}
+
+_NUMBER = r'[-+]?\d+(?:[.,]\d+)?'
+_SINGLE_VALUE = re.compile(rf'^\s*({_NUMBER})\s*(.*?)\s*$')
+_PRESSURE_VALUE = re.compile(rf'^\s*({_NUMBER})\s*/\s*({_NUMBER})\s*(.*?)\s*$')
+
+# Fields of Vitals that feed its sample
+SAMPLED_FIELDS = ('patient_id', 'code', 'effective_date', 'value', 'unit')
+
+
+def _code_lookup():
+    lookup = {code.lower(): code for code in CANONICAL_UNITS}
+    for entry in terminology.get('vitals.code'):
+        lookup[entry['display'].lower()] = entry['code']
+        lookup[re.sub(r'\s*\(.*\)$', '', entry['display']).lower()] = entry['code']
+    lookup.update(CODE_ALIASES)
+    return lookup
+
+_CODES = _code_lookup()
+
+
+def normalize_code(code):
+    """The LOINC code for a code, display name or common abbreviation, or None."""
+    return _CODES.get((code or '').strip().lower())
+
+
+def code_spellings(code):
+    """Every lower-case spelling `normalize_code` reads as `code`, the code itself included."""
+    return sorted({spelling for spelling, target in _CODES.items() if target == code} | {code.lower()})
+
+
+def normalize_unit(unit):
+    return UNIT_ALIASES.get((unit or '').strip().lower())
+
+
+def _number(text):
+    return float(text.replace(',', '.'))
+
+
+def _to_canonical(value, unit, code):
+    """`value` converted from `unit` to the code's canonical unit, or None when they do not convert."""
+    canonical = CANONICAL_UNITS[code]
+    if unit is None:
+        # No unit recorded: temperatures above 45 can only be Fahrenheit
+        unit = '[degF]' if code == BODY_TEMPERATURE and value > 45 else canonical
+    if unit == canonical:
+        return value
+    convert = CONVERSIONS.get((unit, canonical))
+    return convert(value) if convert else None
+
+
+def _epoch(moment):
+    return calendar.timegm(moment.timetuple())
+
+
+def parse_vitals(vitals):
+    """
+    The VitalSample column values for a Vitals row, or None when its code is
+    unknown or its value is not a number in a convertible unit. Blood
+    pressure must be written systolic/diastolic, e.g. '120/80'.
+    """
+    code = normalize_code(vitals.code)
+    effective_date = vitals.effective_date
+    if isinstance(effective_date, str):
+        # Set straight from the form by add_vitals
+        try:
+            effective_date = datetime.fromisoformat(effective_date)
+        except ValueError:
+            return None
+    if code is None or effective_date is None or not vitals.value:
+        return None
+
+    row = {
+        "vitals_id": vitals.id, "patient_id": vitals.patient_id, "code": code,
+        "effective_date": effective_date, "epoch": _epoch(effective_date),
+        "value": None, "systolic": None, "diastolic": None, "unit": CANONICAL_UNITS[code],
+    }
+    if code == BLOOD_PRESSURE:
+        match = _PRESSURE_VALUE.match(vitals.value)
+        if not match:
+            return None
+        unit = normalize_unit(vitals.unit) or normalize_unit(match.group(3))
+        row["systolic"] = _to_canonical(_number(match.group(1)), unit, code)
+        row["diastolic"] = _to_canonical(_number(match.group(2)), unit, code)
+        return row if row["systolic"] is not None and row["diastolic"] is not None else None
+
+    match = _SINGLE_VALUE.match(vitals.value)
+    if not match:
+        return None
+    row["value"] = _to_canonical(_number(match.group(1)), normalize_unit(vitals.unit) or normalize_unit(match.group(2)), code)
+    return row if row["value"] is not None else None
+
+
+def index_vitals(connection, vitals):
+    """(Re)write the sample of a single Vitals row on the given connection."""
+    t = VitalSample.__table__
+    connection.execute(delete(t).where(t.c.vitals_id == vitals.id))
+    row = parse_vitals(vitals)
+    if row:
+        connection.execute(insert(t), [row])
+
+
+def backfill(batch_size=1000):
+    """
+    Recompute every sample from the vitals table, a batch of rows per
+    transaction. Returns (vitals read, samples written).
+    """
+    t = VitalSample.__table__
+    db.session.execute(delete(t))
+    read = written = 0
+    last_id = 0
+    while True:
+        batch = Vitals.query.filter(Vitals.id > last_id).order_by(Vitals.id).limit(batch_size).all()
+        if not batch:
+            break
+        rows = [row for row in map(parse_vitals, batch) if row]
+        if rows:
+            db.session.execute(insert(t), rows)
+        read += len(batch)
+        written += len(rows)
+        last_id = batch[-1].id
+        db.session.commit()
+        db.session.expunge_all()
+    return read, written
+
+
+def components(code):
+    return ('systolic', 'diastolic') if code == BLOOD_PRESSURE else ('value',)
+
+
+def series_bounds(patient_id, code):
+    """First and last effective_date of a patient's samples of `code`."""
+    return db.session.execute(
+        select(func.min(VitalSample.effective_date), func.max(VitalSample.effective_date))
+        .where(VitalSample.patient_id == patient_id, VitalSample.code == code)
+    ).one()
+
+
+def trend(patient_id, code, start=None, end=None, buckets=DEFAULT_BUCKETS):
+    """
+    Downsample a patient's series of `code` between `start` and `end` (by
+    default all of it) into at most `buckets` equal time buckets, each with
+    its sample count and the min, max and average of every component. The
+    grouping happens in the database, so the work per request is one index
+    range scan and the result size does not depend on the window.
+    Returns None for codes without a numeric series.
+    """
+    code = normalize_code(code)
+    if code is None:
+        return None
+    buckets = max(1, min(int(buckets), MAX_BUCKETS))
+    if start is None or end is None:
+        first, last = series_bounds(patient_id, code)
+        start = start or first
+        end = end or last
+    result = {"patient_id": patient_id, "code": code, "display": terminology.display('vitals.code', code),
+              "unit": CANONICAL_UNITS[code], "components": list(components(code)), "points": []}
+    if start is None or end is None or end < start:
+        return result
+
+    low, high = _epoch(start), _epoch(end)
+    width = max(1, math.ceil((high - low + 1) / buckets))
+    # Bucket start in Unix seconds; integer arithmetic that MySQL and SQLite agree on
+    bucket = (VitalSample.epoch - (VitalSample.epoch - low) % width).label('bucket')
+    aggregates = []
+    for name in components(code):
+        column = getattr(VitalSample, name)
+        aggregates += [func.min(column), func.max(column), func.avg(column)]
+    rows = db.session.execute(
+        select(bucket, func.count(), *aggregates)
+        .where(VitalSample.patient_id == patient_id, VitalSample.code == code,
+               VitalSample.effective_date >= start, VitalSample.effective_date <= end)
+        .group_by(bucket)
+        .order_by(bucket)
+    ).all()
+
+    result.update(start=start.isoformat(), end=end.isoformat(), bucket_seconds=width)
+    for row in rows:
+        point = {"t": (datetime(1970, 1, 1) + timedelta(seconds=int(row[0]))).isoformat(), "count": row[1]}
+        for index, name in enumerate(components(code)):
+            minimum, maximum, average = row[2 + 3 * index:5 + 3 * index]
+            point[name] = {"min": round(float(minimum), 2), "max": round(float(maximum), 2), "avg": round(float(average), 2)}
+        result["points"].append(point)
+    return result
+
+
+def _needs_reindex(target):
+    state = inspect(target)
+    return any(state.attrs[field].history.has_changes() for field in SAMPLED_FIELDS)
+
+
+# Keep vital_samples in step with inserts, updates and deletes of Vitals
+@event.listens_for(Vitals, 'after_insert')
+def sample_new_vitals(mapper, connection, target):
+    index_vitals(connection, target)
+
+@event.listens_for(Vitals, 'after_update')
+def resample_vitals(mapper, connection, target):
+    if _needs_reindex(target):
+        index_vitals(connection, target)
+
+@event.listens_for(Vitals, 'before_delete')
+def unsample_vitals(mapper, connection, target):
+    connection.execute(delete(VitalSample.__table__).where(VitalSample.vitals_id == target.id))
@@ -0,0 +1,48 @@
+import io
+import pytest
+from app import create_app, db
+from app.config import Config
+from app.models import Patient, User
+from app.patient_import import import_roster
+
+HEADER = 'firstname,lastname,age,gender,contact_number,home_address\n'
+
+
+@pytest.fixture
+def doctor_id(tmp_path, monkeypatch):
+    monkeypatch.setattr(Config, 'SQLALCHEMY_DATABASE_URI', f"sqlite:///{tmp_path / 'test.db'}")
+    app = create_app()
+    app.config['TESTING'] = True
+    with app.app_context():
+        db.create_all()
+        doctor = User(username='doc', password='x', email='doc@example.com', role='doctor', firstname='Doc',
+                      lastname='Tor', age='40', gender='female', contact_number='09170000000',
+                      id_card_number='123456789012', home_address='1 Rizal St, Manila')
+        db.session.add(doctor)
+        db.session.commit()
+        yield doctor.id
+        db.session.remove()
+
+
+def roster_rows(count):
+    return ''.join(f'Ana{i},Cruz,40,female,0917{i:07d},1 Rizal St\n' for i in range(count))
+
+
+def test_bytes_that_are_not_utf8_stop_the_import_with_a_partial_result(doctor_id):
+    data = (HEADER + roster_rows(300)).encode() + 'José,Cruz,40,male,09171234567,1 Rizal St\n'.encode('latin-1')
+    lines = io.TextIOWrapper(io.BytesIO(data), encoding='utf-8', newline='')
+
+    result = import_roster(lines, doctor_id, chunk_size=50)
+
+    assert result.error.startswith('The file is not UTF-8 encoded text after line ')
+    assert 0 < result.imported <= 300
+    assert Patient.query.count() == result.imported
+
+
+def test_utf8_roster_imports_every_row(doctor_id):
+    lines = io.StringIO(HEADER + roster_rows(120))
+
+    result = import_roster(lines, doctor_id, chunk_size=50)
+
+    assert (result.imported, result.rejected, result.error) == (120, 0, None)
+    assert Patient.query.count() == 120
@@ -0,0 +1,31 @@
+import multiprocessing
+from collections import Counter
+import pytest
+from app import commands, create_app, db
+from app.config import Config
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    # A SQLite file rather than memory, so forked workers share the database
+    monkeypatch.setattr(Config, 'SQLALCHEMY_DATABASE_URI', f"sqlite:///{tmp_path / 'test.db'}")
+    app = create_app()
+    app.config['TESTING'] = True
+    with app.app_context():
+        db.create_all()
+        db.session.remove()
+        db.engine.dispose()
+        yield app
+
+
+@pytest.mark.skipif('fork' not in multiprocessing.get_all_start_methods(), reason='needs fork')
+@pytest.mark.parametrize('kind', ['patient', 'user'])
+def test_concurrent_processes_never_share_an_id(app, monkeypatch, kind):
+    monkeypatch.setattr(commands, '_worker_app', app)
+    workers = 4
+    with multiprocessing.get_context('fork').Pool(workers) as pool:
+        results = pool.starmap(commands._allocate_ids, [(kind, 50, 5, 20)] * workers)
+
+    ids = [value for worker_ids in results for value in worker_ids]
+    assert len(ids) == workers * 70
+    assert [value for value, seen in Counter(ids).items() if seen > 1] == []
@@ -0,0 +1,155 @@
+import io, os
+import pytest
+from app import create_app, db
+from app.config import Config
+from app.models import Blob, LabScan, LabScanGroup, Patient
+from app.storage import MemoryObjectStore, blob_key, get_store, import_legacy_files, remove_legacy_file
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    # A throwaway SQLite database, with blobs in the in-memory object store
+    monkeypatch.setattr(Config, 'SQLALCHEMY_DATABASE_URI', f"sqlite:///{tmp_path / 'test.db'}")
+    monkeypatch.setattr(Config, 'UPLOAD_FOLDER', str(tmp_path / 'uploads'))
+    monkeypatch.setattr(Config, 'DERIVATIVE_FOLDER', str(tmp_path / 'derivatives'))
+    monkeypatch.setattr(Config, 'STORAGE_BACKEND', 'memory')
+    app = create_app()
+    app.config['TESTING'] = True
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+
+
+@pytest.fixture
+def store(app):
+    store = get_store(app)
+    assert isinstance(store.backend, MemoryObjectStore)
+    return store
+
+
+@pytest.fixture
+def group(app):
+    patient = Patient(firstname='Ana', lastname='Cruz', age='40', gender='female', contact_number='09171234567',
+                      home_address='1 Rizal St, Manila')
+    db.session.add(patient)
+    db.session.flush()
+    group = LabScanGroup(group_name='Chest X-ray', patient_id=patient.id)
+    db.session.add(group)
+    db.session.commit()
+    return group
+
+
+def ref_count(content_hash):
+    db.session.expire_all()
+    return db.session.get(Blob, content_hash).ref_count
+
+
+def add_scan(group, content_hash):
+    scan = LabScan(filename='scan.png', file_path='scan.png', group_id=group.id, content_hash=content_hash)
+    db.session.add(scan)
+    db.session.commit()
+    return scan
+
+
+def test_save_stores_content_once(store):
+    first = store.save(io.BytesIO(b'scan'), 'image/png')
+    second = store.save(io.BytesIO(b'scan'), 'image/png')
+
+    assert first.content_hash == second.content_hash
+    assert (first.deduplicated, second.deduplicated) == (False, True)
+    assert first.size == 4
+    assert store.backend.keys() == [blob_key(first.content_hash)]
+    assert store.open(first.content_hash).read() == b'scan'
+    assert store.local_path(first.content_hash) is None
+    assert Blob.query.count() == 1
+    assert ref_count(first.content_hash) == 0
+
+
+def test_reference_counts_follow_rows(store, group):
+    stored = store.save(io.BytesIO(b'scan'))
+    other = store.save(io.BytesIO(b'other scan'))
+
+    first = add_scan(group, stored.content_hash)
+    second = add_scan(group, stored.content_hash)
+    assert ref_count(stored.content_hash) == 2
+
+    db.session.delete(first)
+    db.session.commit()
+    assert ref_count(stored.content_hash) == 1
+
+    second.content_hash = other.content_hash
+    db.session.commit()
+    assert (ref_count(stored.content_hash), ref_count(other.content_hash)) == (0, 1)
+
+    # Counts drift when rows change outside the ORM; recount puts them right
+    db.session.execute(Blob.__table__.update().values(ref_count=5))
+    db.session.commit()
+    assert store.recount() == 2
+    assert (ref_count(stored.content_hash), ref_count(other.content_hash)) == (0, 1)
+
+
+def test_collect_garbage_removes_unreferenced_blobs_after_grace(store, group):
+    kept = store.save(io.BytesIO(b'referenced'))
+    orphan = store.save(io.BytesIO(b'orphan'))
+    add_scan(group, kept.content_hash)
+
+    # Both are too recent to collect
+    assert store.collect_garbage(grace=3600) == (0, 0)
+    assert store.collect_garbage(grace=0, dry_run=True) == (1, orphan.size)
+    assert store.exists(orphan.content_hash)
+
+    assert store.collect_garbage(grace=0) == (1, orphan.size)
+    assert not store.exists(orphan.content_hash)
+    assert db.session.get(Blob, orphan.content_hash) is None
+    assert store.open(kept.content_hash).read() == b'referenced'
+
+    # Uploading the same content again brings it back
+    again = store.save(io.BytesIO(b'orphan'))
+    assert not again.deduplicated
+    assert store.open(again.content_hash).read() == b'orphan'
+
+
+def write_legacy_file(app, legacy_path, content):
+    path = os.path.join(app.config['UPLOAD_FOLDER'], legacy_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as handle:
+        handle.write(content)
+    return path
+
+
+def test_legacy_file_stays_while_another_record_uses_it(app, group):
+    path = write_legacy_file(app, 'lab_scans/scan.png', b'scan')
+    first = add_scan(group, None)
+    second = add_scan(group, None)
+    for scan in (first, second):
+        scan.file_path = 'lab_scans/scan.png'
+    db.session.commit()
+
+    db.session.delete(first)
+    db.session.commit()
+    remove_legacy_file(first.content_hash, first.file_path)
+    assert os.path.isfile(path)
+
+    db.session.delete(second)
+    db.session.commit()
+    remove_legacy_file(second.content_hash, second.file_path)
+    assert not os.path.isfile(path)
+
+
+def test_import_legacy_files(app, store, group):
+    path = write_legacy_file(app, 'lab_scans/scan.png', b'scan')
+    shared = [add_scan(group, None) for _ in range(3)]
+    for scan in shared:
+        scan.file_path = 'lab_scans/scan.png'
+    lost = add_scan(group, None)
+    lost.file_path = 'lab_scans/gone.png'
+    db.session.commit()
+
+    assert import_legacy_files(batch_size=2, remove_files=True) == (3, 1)
+    content_hash = shared[0].content_hash
+    assert {scan.content_hash for scan in shared} == {content_hash}
+    assert lost.content_hash is None
+    assert ref_count(content_hash) == 3
+    assert store.open(content_hash).read() == b'scan'
+    assert not os.path.isfile(path)